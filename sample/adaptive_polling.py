@@ -0,0 +1,311 @@
+#! /usr/bin/python3
+"""
+Description: Poll every (host, collector) pair as often as it changes.
+
+Each pair keeps a fingerprint of the STABLE_PROPERTIES of its last
+content, so free space, counters and clocks moving on every poll do not
+make a pair look busy, and exponentially
+weighted averages of whether a poll saw a change and of the seconds
+since the poll before, their ratio being its change rate. After every
+poll its next interval is set so about target_changes changes are
+expected between polls, clamped between min_interval and max_interval
+and at most doubling per poll: static build servers drift towards
+max_interval and busy hosts towards min_interval instead of all sharing
+one cadence.
+
+Due pairs are kept in a heap keyed by due time, so scheduling is
+O(log n) per poll and 100k pairs cost little. Polls are dispatched as
+they come due and reported as each finishes, so a slow host does not
+hold back the others. The clock and the wait for a poll to finish are
+injectable so the scheduler can be driven by a simulated clock.
+
+Usage:
+    adaptive_polling.py hosts.txt --min-interval 300 --max-interval 86400
+
+Author: Shayne Cardwell
+
+Module: adaptive_polling.py
+"""
+import argparse
+import hashlib
+import heapq
+import itertools
+import json
+import time
+from multiprocessing.dummy import Pool
+from queue import Empty, Queue
+
+DEFAULT_MIN_INTERVAL = 5 * 60
+DEFAULT_MAX_INTERVAL = 24 * 60 * 60
+DEFAULT_TARGET_CHANGES = 0.5
+DEFAULT_ALPHA = 0.3
+
+# collector name: {content section: the properties fingerprinted per
+# instance}, sections and collectors not listed are fingerprinted whole
+STABLE_PROPERTIES = {
+    'collect_os_stats':            {
+        'os_info': ('Caption', 'Version', 'BuildNumber', 'CSDVersion', 'OSArchitecture',
+                    'InstallDate', 'LastBootUpTime', 'TotalVisibleMemorySize')},
+    'collect_win_cpu_stats':       {
+        'processors': ('DeviceID', 'Name', 'Manufacturer', 'NumberOfCores',
+                       'NumberOfLogicalProcessors', 'MaxClockSpeed')},
+    'collect_win_disk_stats':      {
+        'disk_partitions': ('DeviceID', 'DiskIndex', 'Index', 'Size', 'Type', 'Bootable'),
+        'logical_drives':  ('DeviceID', 'DriveType', 'FileSystem', 'Size', 'VolumeName',
+                            'VolumeSerialNumber', 'ProviderName'),
+        'physical_drives': ('Index', 'Model', 'SerialNumber', 'Size', 'Partitions',
+                            'InterfaceType')},
+    'collect_win_network_stats':   {
+        'network_adapters':      ('Index', 'Name', 'MACAddress', 'NetEnabled',
+                                  'NetConnectionStatus', 'Speed'),
+        'network_configuration': ('Index', 'IPAddress', 'IPSubnet', 'DefaultIPGateway',
+                                  'DNSServerSearchOrder', 'DHCPEnabled', 'MACAddress')},
+    'collect_win_processes_stats': {
+        'processes': ('Caption', 'ExecutablePath', 'Owner')},
+    'collect_win_services_stats':  {
+        'services': ('Name', 'DisplayName', 'State', 'StartMode', 'StartName', 'PathName')}
+}
+
+
+def fingerprint(content, collector=None):
+    """Return a digest of the STABLE_PROPERTIES of a collector's content.
+
+    Args:
+        content(dict): The collector's content
+        collector(string): Optional, the collector name, without it the
+            whole content is fingerprinted
+
+    """
+    stable = STABLE_PROPERTIES.get(collector, {})
+    kept = {}
+    for section, instances in content.items():
+        properties = stable.get(section)
+        if properties is None or not isinstance(instances, dict):
+            kept[section] = instances
+            continue
+        kept[section] = {key: {name: item.get(name) for name in properties}
+                         if isinstance(item, dict) else item
+                         for key, item in instances.items()}
+    return hashlib.sha1(json.dumps(kept, sort_keys=True, default=str).encode(
+        'utf-8')).hexdigest()
+
+
+def _next_finished(finished, seconds):
+    return finished.get(timeout=seconds)
+
+
+class _Pair(object):  # pylint: disable=R0903
+    __slots__ = ('host', 'collector', 'interval', 'changed', 'elapsed', 'fingerprint', 'polled',
+                 'polls', 'changes')
+
+    def __init__(self, host, collector, interval):
+        self.host = host
+        self.collector = collector
+        self.interval = interval
+        self.changed = None
+        self.elapsed = None
+        self.fingerprint = None
+        self.polled = None
+        self.polls = 0
+        self.changes = 0
+
+
+class PollingScheduler(object):
+    """Schedule (host, collector) polls by their observed change rate.
+
+    Args:
+        min_interval(float): Shortest seconds between polls of a pair
+        max_interval(float): Longest seconds between polls of a pair
+        target_changes(float): Changes expected between two polls
+        alpha(float): Weight of the newest rate observation
+        clock(function): Optional, returns the current time in seconds
+
+    """
+
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 target_changes=DEFAULT_TARGET_CHANGES, alpha=DEFAULT_ALPHA, clock=time.time):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_changes = target_changes
+        self.alpha = alpha
+        self.clock = clock
+        self.pairs = {}
+        self.heap = []
+        self.sequence = itertools.count()
+        # Polls dispatched by run and not reported yet.
+        self.running = 0
+
+    def add(self, host, collector, interval=None, due=None):
+        """Start polling a pair, first at due, by default now."""
+        pair = _Pair(host, collector, interval or self.min_interval)
+        self.pairs[(host, collector)] = pair
+        heapq.heappush(self.heap, (self.clock() if due is None else due,
+                                   next(self.sequence), pair))
+
+    def remove(self, host, collector):
+        """Stop polling a pair, its heap entry is dropped when it comes up."""
+        self.pairs.pop((host, collector), None)
+
+    def next_due(self):
+        """Return the time the next pair is due, None when there are none."""
+        while self.heap and self.pairs.get((self.heap[0][2].host,
+                                            self.heap[0][2].collector)) is not self.heap[0][2]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def due(self, now=None):
+        """Pop the pairs due by now.
+
+        Returns:
+            pairs(list): (host, collector) tuples to poll, each must be
+                handed back to report, or to reschedule on failure
+
+        """
+        now = self.clock() if now is None else now
+        pairs = []
+        while self.next_due() is not None and self.heap[0][0] <= now:
+            pair = heapq.heappop(self.heap)[2]
+            pairs.append((pair.host, pair.collector))
+        return pairs
+
+    def report(self, host, collector, content, now=None):
+        """Fold a poll's content into the pair and schedule its next poll.
+
+        Returns:
+            changed(bool): Whether the content differs from the last poll
+
+        """
+        pair = self.pairs.get((host, collector))
+        if pair is None:
+            return False
+        now = self.clock() if now is None else now
+        digest = fingerprint(content, collector)
+        changed = pair.fingerprint is not None and digest != pair.fingerprint
+        if pair.polled is not None:
+            if pair.changed is None:
+                pair.changed, pair.elapsed = float(changed), now - pair.polled
+            else:
+                pair.changed = self.alpha * changed + (1 - self.alpha) * pair.changed
+                pair.elapsed = self.alpha * (now - pair.polled) + (1 - self.alpha) * pair.elapsed
+            interval = self.max_interval if not pair.changed else \
+                self.target_changes * pair.elapsed / pair.changed
+            pair.interval = min(self.max_interval, 2 * pair.interval,
+                                max(self.min_interval, interval))
+        pair.fingerprint = digest
+        pair.polled = now
+        pair.polls += 1
+        pair.changes += changed
+        heapq.heappush(self.heap, (now + pair.interval, next(self.sequence), pair))
+        return changed
+
+    def reschedule(self, host, collector, now=None):
+        """Poll a pair again after its current interval, e.g. after a failure."""
+        pair = self.pairs.get((host, collector))
+        if pair is not None:
+            now = self.clock() if now is None else now
+            heapq.heappush(self.heap, (now + pair.interval, next(self.sequence), pair))
+
+    def interval(self, host, collector):
+        """Return the seconds between polls of a pair."""
+        return self.pairs[(host, collector)].interval
+
+    def rate(self, host, collector):
+        """Return the changes a second estimated for a pair, None before two polls."""
+        pair = self.pairs[(host, collector)]
+        return None if pair.changed is None else pair.changed / max(pair.elapsed, 1e-9)
+
+    def run(self, poll, workers=16, wait=_next_finished, until=None):
+        """Poll due pairs until the clock reaches until, or forever.
+
+        Polls still running at until are waited for and reported.
+
+        Args:
+            poll(function): Takes (host, collector) and returns the
+                content, an error reschedules the pair
+            workers(int): Pairs polled at once
+            wait(function): Optional, takes the queue finished polls
+                are put on and the most seconds to wait, None for no
+                limit, and returns the next finished poll or raises
+                queue.Empty, a simulated clock moves forward in it
+            until(float): Optional, the time to stop at
+
+        """
+        pool = Pool(workers)
+        finished = Queue()
+        self.running = 0
+
+        def _poll(pair):
+            try:
+                return pair, poll(*pair), None
+            except Exception as error:  # pylint: disable=W0703
+                return pair, None, error
+
+        def _handle(result):
+            self.running -= 1
+            (host, collector), content, error = result
+            if error is None:
+                self.report(host, collector, content)
+            else:
+                self.reschedule(host, collector)
+
+        try:
+            while until is None or self.clock() < until:
+                for pair in self.due():
+                    self.running += 1
+                    pool.apply_async(_poll, (pair,), callback=finished.put)
+                next_due = self.next_due()
+                if next_due is None and not self.running:
+                    break
+                stops = [stop for stop in (next_due, until) if stop is not None]
+                try:
+                    result = wait(finished, max(0.0, min(stops) - self.clock()) if stops else None)
+                except Empty:
+                    continue
+                _handle(result)
+        finally:
+            pool.close()
+        while self.running:
+            try:
+                _handle(wait(finished, None))
+            except Empty:
+                continue
+        pool.join()
+
+
+def poll_collector(host, collector):
+    """Run one collector of collect_system_stats against a host.
+
+    Returns:
+        content(dict): The collector's content
+
+    """
+    # Imported here so the scheduler itself does not need the Windows packages.
+    import sample.win_system_get_statistics as orchestrator  # pylint: disable=C0415
+
+    function = {function.__name__: function
+                for function in orchestrator.SYSTEM_INFORMATION_FUNCTIONS}[collector]
+    return function(host)['content']
+
+
+def main():
+    """Make module a standalone module."""
+    import sample.win_system_get_statistics as orchestrator  # pylint: disable=C0415
+
+    parser = argparse.ArgumentParser(description='Poll hosts as often as they change.')
+    parser.add_argument('hosts_file', help='file with one host name per line')
+    parser.add_argument('--min-interval', type=float, default=DEFAULT_MIN_INTERVAL)
+    parser.add_argument('--max-interval', type=float, default=DEFAULT_MAX_INTERVAL)
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    with open(args.hosts_file) as file_object:
+        hosts = [line.strip() for line in file_object if line.strip()]
+    scheduler = PollingScheduler(args.min_interval, args.max_interval)
+    for host in hosts:
+        for function in orchestrator.SYSTEM_INFORMATION_FUNCTIONS:
+            scheduler.add(host, function.__name__)
+    scheduler.run(poll_collector, args.workers)
+
+
+if __name__ == '__main__':
+    main()
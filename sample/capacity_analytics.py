@@ -0,0 +1,261 @@
+#! /usr/bin/python3
+"""
+Description: Fleet wide capacity analytics over drive and memory inventories.
+
+The logical_drives and physical_memory sections of many host results are
+loaded into NumPy arrays once, converting the string numerics WMI
+returns, and every aggregation is then a vectorized operation over the
+whole fleet.
+
+Author: Shayne Cardwell
+
+Module: capacity_analytics.py
+"""
+import itertools
+import sys
+
+try:
+    import numpy
+except ModuleNotFoundError:
+    print('Had trouble finding packages')
+    print('Please install via the command below')
+    print('pipenv install')
+    sys.exit(1)
+
+LOCAL_DISK = 3
+
+# DeviceID to a number shared by every snapshot loaded in this process, so
+# drives are matched between snapshots without comparing strings.
+_DEVICE_CODES = {}
+_NEXT_CODE = itertools.count()
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+
+def _device_code(device):
+    code = _DEVICE_CODES.get(device)
+    if code is None:
+        code = _DEVICE_CODES.setdefault(device, next(_NEXT_CODE))
+    return code
+
+
+def load_logical_drives(results):
+    """Load the logical_drives section of many hosts into arrays.
+
+    Args:
+        results(dict): Host content keyed by host name, as returned in
+            collect_fleet_stats()['content']
+
+    Returns:
+        drives(dict): 'hosts' (list of names) and the per drive arrays
+            'host' (index into hosts), 'device', 'device_code',
+            'drive_type', 'size' and 'free' in bytes
+
+    """
+    hosts = []
+    host_index = []
+    devices = []
+    device_codes = []
+    drive_types = []
+    sizes = []
+    free = []
+    for position, (host, content) in enumerate(results.items()):
+        hosts.append(host)
+        for device, drive in content.get('logical_drives', {}).items():
+            host_index.append(position)
+            devices.append(device)
+            device_codes.append(_device_code(device))
+            drive_types.append(drive.get('DriveType') or 0)
+            sizes.append(_number(drive.get('Size')))
+            free.append(_number(drive.get('FreeSpace')))
+    return {
+        'hosts':       hosts,
+        'host':        numpy.array(host_index, dtype=numpy.int64),
+        'device':      numpy.array(devices, dtype=object),
+        'device_code': numpy.array(device_codes, dtype=numpy.int64),
+        'drive_type':  numpy.array(drive_types, dtype=numpy.int64),
+        'size':        numpy.array(sizes, dtype=numpy.float64),
+        'free':        numpy.array(free, dtype=numpy.float64)
+    }
+
+
+def load_physical_memory(results):
+    """Load the physical_memory section of many hosts into arrays.
+
+    Args:
+        results(dict): Host content keyed by host name
+
+    Returns:
+        memory(dict): 'hosts' (list of names) and the per DIMM arrays
+            'host' (index into hosts) and 'capacity' in bytes
+
+    """
+    hosts = []
+    host_index = []
+    capacity = []
+    for position, (host, content) in enumerate(results.items()):
+        hosts.append(host)
+        for dimm in content.get('physical_memory', {}).values():
+            host_index.append(position)
+            capacity.append(_number(dimm.get('Capacity')))
+    return {
+        'hosts':    hosts,
+        'host':     numpy.array(host_index, dtype=numpy.int64),
+        'capacity': numpy.array(capacity, dtype=numpy.float64)
+    }
+
+
+def _selected(drives, drive_type):
+    mask = drives['size'] > 0
+    if drive_type is not None:
+        mask &= drives['drive_type'] == drive_type
+    return mask
+
+
+def free_space_percent(drives, drive_type=LOCAL_DISK):
+    """Return the free space percentage of every selected drive.
+
+    Returns:
+        mask(ndarray): The drives selected
+        percent(ndarray): Their free space as a percentage of size
+
+    """
+    mask = _selected(drives, drive_type)
+    return mask, 100.0 * drives['free'][mask] / drives['size'][mask]
+
+
+def free_space_percentiles(drives, percentiles=(5, 25, 50, 75, 95), drive_type=LOCAL_DISK):
+    """Return percentiles of free space percentage across the fleet.
+
+    Args:
+        drives(dict): As returned by load_logical_drives
+        percentiles(tuple): The percentiles to compute
+        drive_type(int): Optional, the DriveType to include, None for all
+
+    Returns:
+        result(dict): {percentile: free space percent}
+
+    """
+    _, percent = free_space_percent(drives, drive_type)
+    if not percent.size:
+        return {}
+    values = numpy.nanpercentile(percent, percentiles)
+    return dict(zip(percentiles, values.tolist()))
+
+
+def hosts_under_threshold(drives, min_free_percent=10.0, drive_type=LOCAL_DISK):
+    """Return the drives with less free space than a threshold.
+
+    Args:
+        drives(dict): As returned by load_logical_drives
+        min_free_percent(float): The lowest acceptable free percentage
+        drive_type(int): Optional, the DriveType to include, None for all
+
+    Returns:
+        low(list): (host, device, free percent) tuples, fullest first
+
+    """
+    mask, percent = free_space_percent(drives, drive_type)
+    low = percent < min_free_percent
+    hosts = drives['host'][mask][low]
+    devices = drives['device'][mask][low]
+    percent = percent[low]
+    order = numpy.argsort(percent)
+    return [(drives['hosts'][hosts[index]], devices[index], float(percent[index]))
+            for index in order]
+
+
+def installed_memory(memory):
+    """Return the installed RAM of every host in bytes.
+
+    Returns:
+        installed(ndarray): Bytes per host, in the order of memory['hosts']
+
+    """
+    return numpy.bincount(memory['host'], weights=numpy.nan_to_num(memory['capacity']),
+                          minlength=len(memory['hosts']))
+
+
+def memory_by_model(memory, host_models):
+    """Return installed RAM totals grouped by hardware model.
+
+    Args:
+        memory(dict): As returned by load_physical_memory
+        host_models(dict): The model of every host, missing hosts are
+            grouped as 'unknown'
+
+    Returns:
+        models(dict): {model: {'hosts': n, 'total': bytes,
+            'mean': bytes, 'min': bytes, 'max': bytes}}
+
+    """
+    installed = installed_memory(memory)
+    names, groups = numpy.unique(
+        numpy.array([host_models.get(host, 'unknown') for host in memory['hosts']], dtype=str),
+        return_inverse=True)
+    counts = numpy.bincount(groups, minlength=len(names))
+    totals = numpy.bincount(groups, weights=installed, minlength=len(names))
+    minimum = numpy.full(len(names), numpy.inf)
+    maximum = numpy.zeros(len(names))
+    numpy.minimum.at(minimum, groups, installed)
+    numpy.maximum.at(maximum, groups, installed)
+    return {str(name): {'hosts': int(counts[index]), 'total': float(totals[index]),
+                        'mean': float(totals[index] / counts[index]),
+                        'min': float(minimum[index]), 'max': float(maximum[index])}
+            for index, name in enumerate(names)}
+
+
+def _drive_keys(before, after):
+    # Integer (host, DeviceID) keys shared by both snapshots, a host only
+    # in before gets a negative key that matches nothing.
+    positions = {host: index for index, host in enumerate(after['hosts'])}
+    before_hosts = numpy.array([positions.get(host, -1) for host in before['hosts']],
+                               dtype=numpy.int64)[before['host']]
+    return (before_hosts << 32) + before['device_code'], \
+        (after['host'] << 32) + after['device_code']
+
+
+def free_space_growth(before, after, drive_type=LOCAL_DISK):
+    """Return the change in used space between two fleet snapshots.
+
+    Drives are matched on host name and DeviceID, drives present in only
+    one snapshot are left out.
+
+    Args:
+        before(dict): load_logical_drives of the earlier results
+        after(dict): load_logical_drives of the later results
+        drive_type(int): Optional, the DriveType to include, None for all
+
+    Returns:
+        growth(dict): 'host' and 'device' of every matched drive, 'used'
+            the growth in used bytes and 'per_host' the summed growth
+            keyed by host name
+
+    """
+    before_mask = _selected(before, drive_type)
+    after_mask = _selected(after, drive_type)
+    before_keys, after_keys = _drive_keys(before, after)
+    _, before_index, after_index = numpy.intersect1d(
+        before_keys[before_mask], after_keys[after_mask], assume_unique=True,
+        return_indices=True)
+    before_index = numpy.flatnonzero(before_mask)[before_index]
+    after_index = numpy.flatnonzero(after_mask)[after_index]
+
+    used_before = before['size'][before_index] - before['free'][before_index]
+    used_after = after['size'][after_index] - after['free'][after_index]
+    used = used_after - used_before
+    hosts = after['host'][after_index]
+    per_host = numpy.bincount(hosts, weights=used, minlength=len(after['hosts']))
+    touched = numpy.unique(hosts)
+    names = numpy.array(after['hosts'], dtype=object)
+    return {
+        'host':     names[hosts].tolist(),
+        'device':   after['device'][after_index].tolist(),
+        'used':     used,
+        'per_host': dict(zip(names[touched].tolist(), per_host[touched].tolist()))
+    }
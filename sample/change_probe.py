@@ -0,0 +1,236 @@
+#! /usr/bin/python3
+"""
+Description: Decide which collectors a host needs from a few cheap signals.
+
+The probe starts its queries semisynchronously over one connection, so
+they run on the provider together and come back in one round trip, and
+reads the Uninstall key counts over the registry connection:
+
+    last_boot       Win32_OperatingSystem LastBootUpTime
+    processes       Win32_OperatingSystem NumberOfProcesses
+    memory          Win32_OperatingSystem TotalVisibleMemorySize
+    services        Win32_Service count and running count
+    uninstall_keys  subkeys under the Uninstall registry paths
+    group_members   hash of the member count of every local group
+    drives          Win32_LogicalDisk count, total Size and total
+                    FreeSpace in FREE_SPACE_STEP steps
+    network         hash of the adapters and IP configurations the
+                    network collector reads
+
+Every collector is stored with the signals it was last collected
+under. A collector runs again when one of its signals moved, after a
+reboot, once it is older than max_age, or when it never succeeded, so
+a failed collector is retried on the next sweep.
+
+Author: Shayne Cardwell
+
+Module: change_probe.py
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import quote
+
+try:
+    import sample.utility as utility
+    from sample.win_application_statistics import HKEY, REG_PATHS
+    from sample.win_network_statistics import DEFAULT_FILTERS as NETWORK_FILTERS
+except ModuleNotFoundError:
+    print('Had trouble finding packages')
+    print('Please install via the command below')
+    print('pipenv install')
+    sys.exit(1)
+
+STATE_PATH = 'logs/probe_state'
+MAX_AGE = 24 * 60 * 60
+# Free space moves all the time, a drive collection is due once it moved
+# by a step.
+FREE_SPACE_STEP = 1024 ** 3
+
+# collector name: the signals it depends on besides last_boot, collectors
+# not listed only run after a reboot or once older than max_age
+COLLECTOR_SIGNALS = {
+    'collect_win_application_stats':   ('uninstall_keys',),
+    'collect_win_disk_stats':          ('drives',),
+    'collect_win_local_account_stats': ('group_members',),
+    'collect_win_local_group_stats':   ('group_members',),
+    'collect_win_mem_stats':           ('memory',),
+    'collect_win_network_stats':       ('network',),
+    'collect_win_processes_stats':     ('processes',),
+    'collect_win_services_stats':      ('services',)
+}
+
+
+def _get_wmi_obj(name, namespace):
+    return utility.connect(name, namespace)
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode(
+        'utf-8')).hexdigest()
+
+
+def _total(rows, name):
+    return sum(int(row.get(name) or 0) for row in rows)
+
+
+def read_signals(host):
+    """Read the probe's signals from a host.
+
+    Args:
+        host(string): The name of the host
+
+    Returns:
+        signals(dict): The value of every signal, see the module
+            docstring
+
+    """
+    wmi_obj = _get_wmi_obj(host, 'root/cimv2')
+    pending = [utility.exec_query(wmi_obj, utility.build_wql(
+        class_name, NETWORK_FILTERS.get(class_name), properties))
+               for class_name, properties in (
+                   ('Win32_OperatingSystem', ['LastBootUpTime', 'NumberOfProcesses',
+                                              'TotalVisibleMemorySize']),
+                   ('Win32_Service', ['Name', 'State']),
+                   ('Win32_GroupUser', ['GroupComponent']),
+                   ('Win32_LogicalDisk', ['DeviceID', 'Size', 'FreeSpace']),
+                   ('Win32_NetworkAdapter', ['Index', 'NetEnabled', 'NetConnectionStatus',
+                                             'Speed', 'MACAddress']),
+                   ('Win32_NetworkAdapterConfiguration', ['Index', 'IPAddress',
+                                                          'DefaultIPGateway',
+                                                          'DNSServerSearchOrder',
+                                                          'DHCPEnabled']))]
+    operating_system, services, group_users, logical_disks, adapters, configurations = (
+        list(utility.iter_results(enumerator)) for enumerator in pending)
+
+    os_row = operating_system[0] if operating_system else {}
+    members = Counter(row['GroupComponent'] for row in group_users)
+    reg_obj = _get_wmi_obj(host, 'root/default').StdRegProv
+    uninstall_keys = 0
+    for reg_path in REG_PATHS:
+        uninstall_keys += len(reg_obj.EnumKey(hDefKey=HKEY['HKEY_LOCAL_MACHINE'],
+                                              sSubKeyName=reg_path)[1] or ())
+    return {
+        'last_boot':      os_row.get('LastBootUpTime'),
+        'processes':      os_row.get('NumberOfProcesses'),
+        'services':       [len(services), sum(row.get('State') == 'Running' for row in services)],
+        'uninstall_keys': uninstall_keys,
+        'group_members':  _digest(sorted(members.items())),
+        'memory':         os_row.get('TotalVisibleMemorySize'),
+        'drives':         [len(logical_disks), _total(logical_disks, 'Size'),
+                           _total(logical_disks, 'FreeSpace') // FREE_SPACE_STEP],
+        'network':        _digest([sorted(_digest(row) for row in rows)
+                                   for rows in (adapters, configurations)])
+    }
+
+
+def collectors_to_run(collected, signals, names, now, max_age=MAX_AGE):
+    """Return the collectors that need to run and why.
+
+    Args:
+        collected(dict): Per collector name, the 'time' it last
+            succeeded and the 'signals' it was collected under
+        signals(dict): The signals just read
+        names(list): The collector names to decide on
+        now(float): The current time in seconds
+        max_age(float): Seconds after which a collector runs anyway
+
+    Returns:
+        reasons(dict): Why each collector that must run does, keyed by
+            collector name, the others are left out
+
+    """
+    reasons = {}
+    for name in names:
+        previous = collected.get(name)
+        if previous is None:
+            reasons[name] = 'never collected'
+            continue
+        moved = [signal for signal in ('last_boot',) + COLLECTOR_SIGNALS.get(name, ())
+                 if previous['signals'].get(signal) != signals.get(signal)]
+        if moved:
+            reasons[name] = '{0} changed'.format(', '.join(moved))
+        elif now - previous['time'] >= max_age:
+            reasons[name] = 'older than {0}s'.format(max_age)
+    return reasons
+
+
+class ChangeProbe(object):
+    """Keep the signals every host's collectors were collected under.
+
+    Args:
+        state_path(string): The directory of the per host state files
+        max_age(float): Seconds after which a collector runs anyway
+        read(function): Optional, takes a host name and returns its
+            signals, defaults to read_signals
+        clock(function): Optional, returns the current time in seconds
+
+    """
+
+    def __init__(self, state_path=STATE_PATH, max_age=MAX_AGE, read=read_signals,
+                 clock=time.time):
+        self.state_path = state_path
+        self.max_age = max_age
+        self.read = read
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def _state_file(self, host):
+        return os.path.join(self.state_path, '{0}.json'.format(quote(host, safe='')))
+
+    def load(self, host):
+        """Return a host's collected collectors, see collectors_to_run."""
+        try:
+            with open(self._state_file(host)) as file_obj:
+                return json.loads(file_obj.read())
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, host, collected):
+        os.makedirs(self.state_path, exist_ok=True)
+        path = self._state_file(host)
+        with open(path + '.tmp', 'w') as file_obj:
+            file_obj.write(json.dumps(collected))
+        os.replace(path + '.tmp', path)
+
+    def select(self, host, collectors):
+        """Probe a host and split its collectors into run and skip.
+
+        Args:
+            host(string): The name of the host
+            collectors(list): The collector functions
+
+        Returns:
+            run(list): The collectors that need to run
+            skipped(dict): Why each other collector was skipped, keyed
+                by collector name
+
+        """
+        signals = self.read(host)
+        collected = self.load(host)
+        with self.lock:
+            self.pending[host] = signals
+        reasons = collectors_to_run(collected, signals, [collector.__name__
+                                                         for collector in collectors],
+                                    self.clock(), self.max_age)
+        skipped = {collector.__name__: 'unchanged since {0}'.format(time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(collected[collector.__name__]['time'])))
+                   for collector in collectors if collector.__name__ not in reasons}
+        return [collector for collector in collectors if collector.__name__ in reasons], skipped
+
+    def commit(self, host, names):
+        """Record that the named collectors succeeded under the probed signals."""
+        with self.lock:
+            signals = self.pending.pop(host, None)
+        if signals is None:
+            return
+        collected = self.load(host)
+        now = self.clock()
+        for name in names:
+            collected[name] = {'time': now, 'signals': signals}
+        self._save(host, collected)
@@ -0,0 +1,231 @@
+#! /usr/bin/python3
+"""
+Description: Run collectors longest expected first under one concurrency limit.
+
+A CostModel keeps an exponentially weighted moving average of the
+seconds every (host, collector) pair took, persisted as JSON, falling
+back to the collector's average over all hosts for a new host. A
+CollectorScheduler owns a fixed pool of worker threads shared by every
+host it is given work for and always starts the queued job with the
+longest expected cost next (LPT), so the registry walks and process
+owner lookups start first and the quick BIOS and OS queries fill the
+gaps instead of holding connection slots while the slow ones wait.
+
+With a timeout budget a run is in deadline mode: jobs expected to take
+longer than the time left are not started, jobs still queued when it
+runs out are dropped, and the sections finished by then are returned.
+Failed jobs count at the time they took, and a job still running when
+the budget runs out at the time it had run by then, so a collector that
+always overruns learns its cost.
+
+Author: Shayne Cardwell
+
+Module: collector_scheduler.py
+"""
+import heapq
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+from queue import Empty, Queue
+
+COSTS_PATH = 'logs/collector_costs.json'
+DEFAULT_COST = 1.0
+DEFAULT_ALPHA = 0.3
+DEFAULT_WORKERS = 8
+
+
+class CostModel(object):
+    """Expected seconds per (host, collector), learned from past runs.
+
+    Args:
+        path(string): Optional, the JSON file the averages are kept in,
+            None keeps them in memory only
+        alpha(float): Weight of the newest observation
+        default(float): Seconds expected of a collector never seen
+
+    """
+
+    def __init__(self, path=COSTS_PATH, alpha=DEFAULT_ALPHA, default=DEFAULT_COST):
+        self.path = path
+        self.alpha = alpha
+        self.default = default
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.costs = {}
+        if path:
+            try:
+                with open(path) as file_object:
+                    self.costs = json.loads(file_object.read())
+            except (IOError, ValueError):
+                self.costs = {}
+
+    def estimate(self, host, name):
+        """Return the seconds a collector is expected to take on a host."""
+        with self.lock:
+            known = self.costs.get(host, {}).get(name)
+            if known is not None:
+                return known
+            others = [costs[name] for costs in self.costs.values() if name in costs]
+        return sum(others) / len(others) if others else self.default
+
+    def observe(self, host, name, seconds):
+        """Fold one measured run into the host's average."""
+        with self.lock:
+            costs = self.costs.setdefault(host, {})
+            previous = costs.get(name)
+            costs[name] = seconds if previous is None else \
+                self.alpha * seconds + (1 - self.alpha) * previous
+
+    def save(self):
+        """Replace the JSON file with the current averages.
+
+        Every save writes its own temporary file beside the JSON file
+        and renames it over it, so concurrent saves never mix.
+        """
+        if not self.path:
+            return
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps(self.costs, sort_keys=True)
+            directory = os.path.dirname(self.path) or '.'
+            os.makedirs(directory, exist_ok=True)
+            handle, temporary = tempfile.mkstemp(
+                dir=directory, prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'w') as file_object:
+                    file_object.write(data)
+                os.replace(temporary, self.path)
+            except BaseException:
+                os.remove(temporary)
+                raise
+
+
+class _Job(object):  # pylint: disable=R0903
+
+    def __init__(self, host, name, function, results):
+        self.host = host
+        self.name = name
+        self.function = function
+        self.results = results
+        self.cancelled = False
+        self.started = None
+        self.finished = False
+        self.observed = False
+
+
+class CollectorScheduler(object):
+    """Dispatch collector calls of any number of hosts, LPT first.
+
+    Args:
+        max_workers(int): The number of collectors running at once,
+            across all hosts
+        cost_model(CostModel): Optional, defaults to one kept at
+            COSTS_PATH
+        clock(function): Optional, returns the current time in seconds
+
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, cost_model=None, clock=time.monotonic):
+        self.max_workers = max_workers
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.heap = []
+        self.sequence = itertools.count()
+        self.workers = []
+        self.save_error = None
+
+    def _start_workers(self):
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, name='collector-scheduler')
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                job = heapq.heappop(self.heap)[2]
+                if job.cancelled:
+                    continue
+                job.started = self.clock()
+            try:
+                content, error = job.function(), None
+            except Exception as exception:  # pylint: disable=W0703
+                content, error = {}, '{0}: {1}'.format(type(exception).__name__, exception)
+            with self.condition:
+                job.finished = True
+                observed = job.observed
+            if not observed:
+                self.cost_model.observe(job.host, job.name, self.clock() - job.started)
+            job.results.put((job.name, content, error))
+
+    def run(self, host, jobs, budget=None, failures=None):
+        """Run one host's collectors and wait for them.
+
+        Args:
+            host(string): The name of the host
+            jobs(dict): Calls taking no arguments and returning a
+                section dictionary, keyed by collector name
+            budget(TimeoutBudget): Optional, turns on deadline mode
+            failures(dict): Optional, filled with the error of every
+                collector that failed, was not started or ran out of
+                time
+
+        Returns:
+            information(dict): The sections of the collectors that
+                finished. A failure to save the cost model does not
+                lose them, it is kept in save_error
+
+        """
+        information = {}
+        results = Queue()
+        failures = failures if failures is not None else {}
+        queued = {}
+        with self.condition:
+            for name, function in jobs.items():
+                expected = self.cost_model.estimate(host, name)
+                remaining = budget.remaining() if budget else None
+                if remaining is not None and expected > remaining:
+                    failures[name] = 'Skipped, expected {0:.1f}s does not fit in the {1:.1f}s ' \
+                                     'left'.format(expected, remaining)
+                    continue
+                queued[name] = _Job(host, name, function, results)
+                heapq.heappush(self.heap, (-expected, next(self.sequence), queued[name]))
+            self._start_workers()
+            self.condition.notify_all()
+
+        pending = set(queued)
+        while pending:
+            try:
+                name, content, error = results.get(timeout=budget.remaining() if budget else None)
+            except Empty:
+                break
+            pending.discard(name)
+            information.update(content)
+            if error:
+                failures[name] = error
+
+        overran = []
+        with self.condition:
+            now = self.clock()
+            for name in pending:
+                job = queued[name]
+                job.cancelled = True
+                failures[name] = 'Timed out, timeout budget used up'
+                if job.started is not None and not job.finished:
+                    job.observed = True
+                    overran.append((name, now - job.started))
+        for name, seconds in overran:
+            self.cost_model.observe(host, name, seconds)
+        try:
+            self.cost_model.save()
+            self.save_error = None
+        except (IOError, OSError) as error:
+            self.save_error = '{0}: {1}'.format(type(error).__name__, error)
+        return information
@@ -0,0 +1,421 @@
+#! /usr/bin/python3
+"""
+Description: Sweep a large fleet with several worker processes.
+
+The coordinator splits the host list into shards and gives every
+worker process a contiguous run of them. Shard ownership lives in
+shared memory: a worker takes shards from the front of its own run and,
+once that is empty, steals from the back of the run with the most work
+left, so slow shards are rebalanced without the coordinator stepping
+in. Each worker initializes COM once for its own apartment and runs a
+host's collectors one after another in it, sharing one pooled WMI
+connection per namespace. Per host results stream back over a queue to
+the coordinator, which writes the per host fleet_sweep report and adds
+the services collected to service_index.get_index(); the collectors
+still write their own reports from the workers, as they do under
+collect_system_stats.
+
+The coordinator watches the workers while it waits. When one dies, the
+host it was collecting is reported as failed and the rest of its shard
+is handed to a replacement worker.
+
+With --journal every host result is also recorded in a sweep journal,
+see sweep_journal. Running the same command again after a crash skips
+the hosts already complete and retries only the collectors that failed.
+
+Usage:
+    fleet_sweep.py hosts.txt --workers 8 --shard-size 25 --journal logs/sweep.journal
+
+Author: Shayne Cardwell
+
+Module: fleet_sweep.py
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from queue import Empty
+from datetime import datetime
+from platform import node
+
+import sample.report_log as report_log
+import sample.resilience as resilience
+import sample.service_index as service_index
+import sample.sweep_journal as sweep_journal
+import sample.utility as utility
+
+try:
+    import pythoncom
+except ModuleNotFoundError:
+    pythoncom = None
+
+DEFAULT_SHARD_SIZE = 25
+DEFAULT_HOST_TIMEOUT = 600
+# How often the coordinator checks its workers are alive while waiting.
+POLL_SECONDS = 1.0
+# Replacements of a worker that die before reporting a single host.
+MAX_FRUITLESS_RESTARTS = 3
+# Shard numbers for a worker holding no shard, and one working through
+# the unfinished hosts of the worker it replaced.
+_NO_SHARD = -1
+_RETRY_SHARD = -2
+
+
+class _InThread(object):  # pylint: disable=R0903
+    """Run a host's collectors one after another in the calling thread.
+
+    Used as the scheduler of get_system_information, so the collectors
+    share the connections of the worker's connection pool.
+    """
+
+    @staticmethod
+    def run(host, jobs, budget=None, failures=None):  # pylint: disable=W0613
+        """Run the jobs in order, as CollectorScheduler.run does."""
+        information = {}
+        failures = failures if failures is not None else {}
+        for name, function in jobs.items():
+            if budget is not None and budget.remaining() <= 0:
+                failures[name] = 'Timed out, timeout budget used up'
+                continue
+            try:
+                information.update(function())
+            except Exception as error:  # pylint: disable=W0703
+                failures[name] = '{0}: {1}'.format(type(error).__name__, error)
+        return information
+
+
+def collect_host(host, filters=None, collectors=None, host_timeout=DEFAULT_HOST_TIMEOUT):
+    """Collect one host the way collect_system_stats does, without reporting.
+
+    Args:
+        host(string): The name of the host
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name
+        collectors(list): Optional, the names of the collectors to run,
+            collect_planned_stats standing for every planned collector,
+            defaults to all of them
+        host_timeout(float): Seconds the host may use
+
+    Returns:
+        content(dict): The collected sections
+        failures(dict): The error of every collector that failed
+
+    """
+    # Imported here so workers driven by another collect function do not
+    # need the Windows packages.
+    import sample.win_system_get_statistics as orchestrator  # pylint: disable=C0415
+
+    import sample.wmi_query_planner as wmi_query_planner  # pylint: disable=C0415
+
+    functions = None
+    if collectors is not None:
+        functions = [function for function in orchestrator.SYSTEM_INFORMATION_FUNCTIONS
+                     if function.__name__ in collectors or ('collect_planned_stats' in collectors
+                     and wmi_query_planner.COLLECTOR_SECTIONS.get(function.__name__))]
+    failures = {}
+    with utility.connection_pool():
+        content = orchestrator.get_system_information(
+            host, filters, resilience.TimeoutBudget(host_timeout), failures, planned=True,
+            scheduler=_InThread(), functions=functions)
+    return content, failures
+
+
+class ReportWriter(object):
+    """Write every host result as a report through report_log.
+
+    Args:
+        log_path(string): The directory holding the logs
+        capability_name(string): The capability the reports belong to
+
+    """
+
+    def __init__(self, log_path='logs', capability_name='fleet_sweep'):
+        self.log_path = log_path
+        self.capability_name = capability_name
+        self.writer = report_log.get_writer(log_path, capability_name)
+
+    def __call__(self, host, content, failures):
+        """Write a host result and return its location, see ReportLogWriter.write."""
+        return self.writer.write({
+            'messages':        ['{0} failed: {1}'.format(name, failures[name])
+                                for name in sorted(failures)],
+            'start_time':      datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'capability_name': self.capability_name,
+            'version':         '0',
+            'host':            node(),
+            'target':          host,
+            'project_dir':     os.getcwd(),
+            'log_path':        self.log_path,
+            'outcome':         'Successful' if content or not failures else 'Failed',
+            'content':         content
+        }, host)
+
+    def flush(self):
+        """Write whatever is still buffered."""
+        self.writer.flush()
+
+    def close(self):
+        """Write whatever is still buffered."""
+        self.flush()
+
+
+def _take_shard(worker_id, heads, tails, lock, current, owners):
+    # The shard taken and its owner are noted under the lock, so a worker
+    # dying right after taking it does not lose it.
+    with lock:
+        current[worker_id] = _NO_SHARD
+        if heads[worker_id] < tails[worker_id]:
+            heads[worker_id] += 1
+            shard, stolen = heads[worker_id] - 1, False
+        else:
+            victim = max(range(len(heads)), key=lambda index: tails[index] - heads[index])
+            if heads[victim] >= tails[victim]:
+                return None, False
+            tails[victim] -= 1
+            shard, stolen = tails[victim], True
+        current[worker_id] = shard
+        owners[shard] = worker_id
+    return shard, stolen
+
+
+def _collect_one(host, collectors, collect, filters):
+    try:
+        if collectors is None:
+            return collect(host, filters)
+        return collect(host, filters, collectors)
+    except Exception as error:  # pylint: disable=W0703
+        return {}, {'worker': '{0}: {1}'.format(type(error).__name__, error)}
+
+
+def _worker(worker_id, shards, heads, tails, lock, current, owners, position, results,
+            collect, filters, retry=()):
+    if pythoncom is not None:
+        pythoncom.CoInitialize()  # pylint: disable=E1101
+    stats = {'worker': worker_id, 'hosts': 0, 'shards': 0, 'stolen': 0}
+    try:
+        for index, (host, collectors) in enumerate(retry):
+            position[worker_id] = index
+            results.put((host,) + tuple(_collect_one(host, collectors, collect, filters)) +
+                        (collectors,))
+            stats['hosts'] += 1
+        while True:
+            shard, stolen = _take_shard(worker_id, heads, tails, lock, current, owners)
+            if shard is None:
+                break
+            stats['shards'] += 1
+            stats['stolen'] += stolen
+            for index, (host, collectors) in enumerate(shards[shard]):
+                position[worker_id] = index
+                results.put((host,) + tuple(_collect_one(host, collectors, collect, filters)) +
+                            (collectors,))
+                stats['hosts'] += 1
+    finally:
+        results.put((None, stats, None, None))
+        if pythoncom is not None:
+            pythoncom.CoUninitialize()  # pylint: disable=E1101
+
+
+def make_shards(hosts, shard_size=DEFAULT_SHARD_SIZE):
+    """Return the host list cut into shards of shard_size hosts."""
+    return [hosts[start:start + shard_size] for start in range(0, len(hosts), shard_size)]
+
+
+def sweep(hosts, workers=None, shard_size=DEFAULT_SHARD_SIZE, filters=None, collect=collect_host,
+          writer=None, journal_path=None):
+    """Collect many hosts with a pool of worker processes.
+
+    Args:
+        hosts(list): The names of the hosts
+        workers(int): Optional, worker processes, defaults to the number
+            of CPUs
+        shard_size(int): Hosts per shard, the unit of work stealing
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name
+        collect(function): Module level function taking (host, filters)
+            and returning (content, failures), defaults to collect_host.
+            Retries after a resume pass the collector names to run as
+            a third argument
+        writer(callable): Optional, called with (host, content, failures)
+            for every host in the coordinator, defaults to a ReportWriter.
+            Its return value is journaled as the result's location and
+            its flush method, if any, is called before every journal sync
+        journal_path(string): Optional, the sweep journal, resumed from
+            when it exists, see sweep_journal
+
+    Returns:
+        summary(dict): 'hosts', 'failed_hosts' {host: messages},
+            'workers' (per worker stats), 'restarts' (dead workers
+            replaced), 'skipped' (hosts already complete in the journal)
+            and 'seconds'
+
+    """
+    started = time.time()
+    own_writer = writer is None
+    writer = ReportWriter() if own_writer else writer
+    journal = None
+    work = [(host, None) for host in hosts]
+    if journal_path:
+        work = sweep_journal.remaining(hosts, sweep_journal.load(journal_path))
+        flush = getattr(writer, 'flush', None)
+        journal = sweep_journal.SweepJournal(journal_path, before_sync=[flush] if flush else [])
+    workers = min(workers or os.cpu_count() or 1, max(len(work), 1))
+    shards = make_shards(work, shard_size)
+
+    context = multiprocessing.get_context()
+    per_worker, extra = divmod(len(shards), workers)
+    bounds = [0]
+    for worker_id in range(workers):
+        bounds.append(bounds[-1] + per_worker + (worker_id < extra))
+    heads = context.Array('l', bounds[:-1], lock=False)
+    tails = context.Array('l', bounds[1:], lock=False)
+    current = context.Array('l', [_NO_SHARD] * workers, lock=False)
+    position = context.Array('l', [0] * workers, lock=False)
+    owners = context.Array('l', [-1] * len(shards), lock=False)
+    lock = context.Lock()
+    results = context.Queue()
+
+    def start(worker_id, retry=()):
+        process = context.Process(target=_worker, args=(worker_id, shards, heads, tails, lock,
+                                                        current, owners, position, results,
+                                                        collect, filters, retry))
+        process.daemon = True
+        process.start()
+        return process
+
+    processes = [start(worker_id) for worker_id in range(workers)]
+    retries = [[] for _ in range(workers)]
+    fruitless = [0] * workers
+    finished = set()
+    reported = set()
+    summary = {'hosts': 0, 'failed_hosts': {}, 'workers': [], 'restarts': 0,
+               'skipped': len(hosts) - len(work)}
+
+    def handle(host, content, failures, collectors):
+        summary['hosts'] += 1
+        reported.add(host)
+        if failures:
+            summary['failed_hosts'][host] = failures
+        service_index.index_content(host, content)
+        location = writer(host, content, failures)
+        # A host the worker could not collect at all stays pending.
+        if journal is not None and 'worker' not in failures:
+            journal.record(host, collectors, failures, location)
+
+    def replace(worker_id):
+        # The host at the dead worker's position is the one it died on
+        # and fails. The other hosts of its shards that never arrived,
+        # not collected yet or lost in flight, are retried.
+        process = processes[worker_id]
+        shard = current[worker_id]
+        items = retries[worker_id] if shard == _RETRY_SHARD else \
+            shards[shard] if shard >= 0 else []
+        died_on = items[position[worker_id]] if items else None
+        if died_on is not None and died_on[0] not in reported:
+            fruitless[worker_id] = 0
+            handle(died_on[0], {}, {'worker': 'Worker process exited with code {0}'.format(
+                process.exitcode)}, died_on[1])
+        else:
+            fruitless[worker_id] += 1
+        owned = retries[worker_id] + [item for number, shard_items in enumerate(shards)
+                                      if owners[number] == worker_id for item in shard_items]
+        seen = set(reported)
+        left = []
+        for item in owned:
+            if item[0] not in seen:
+                seen.add(item[0])
+                left.append(item)
+        own_run = heads[worker_id] < tails[worker_id]
+        if not (left or own_run) or fruitless[worker_id] > MAX_FRUITLESS_RESTARTS:
+            # Hosts it leaves are stolen by the live workers, or listed
+            # as not collected below.
+            current[worker_id] = _NO_SHARD
+            finished.add(worker_id)
+            return
+        retries[worker_id] = left
+        current[worker_id] = _RETRY_SHARD if left else _NO_SHARD
+        position[worker_id] = 0
+        summary['restarts'] += 1
+        processes[worker_id] = start(worker_id, left)
+
+    def receive(message):
+        host, content, failures, collectors = message
+        if host is None:
+            finished.add(content['worker'])
+            summary['workers'].append(content)
+        else:
+            handle(host, content, failures, collectors)
+
+    completed = False
+    try:
+        checked = time.time()
+        while len(finished) < workers:
+            try:
+                receive(results.get(timeout=POLL_SECONDS))
+            except Empty:
+                pass
+            if time.time() - checked < POLL_SECONDS:
+                continue
+            checked = time.time()
+            dead = [worker_id for worker_id, process in enumerate(processes)
+                    if worker_id not in finished and not process.is_alive()]
+            if not dead:
+                continue
+            # Whatever the dead workers sent before exiting is read first.
+            while True:
+                try:
+                    receive(results.get(timeout=0.1))
+                except Empty:
+                    break
+            for worker_id in dead:
+                if worker_id not in finished:
+                    replace(worker_id)
+        completed = True
+    finally:
+        for process in processes:
+            # Workers blocked sending to a coordinator that gave up would
+            # never exit.
+            if not completed:
+                process.terminate()
+            process.join()
+        if journal is not None:
+            journal.close()
+        if own_writer:
+            writer.close()
+    for host, _ in work:
+        if host not in reported:
+            summary['failed_hosts'][host] = {'worker': 'Not collected, worker processes kept '
+                                                       'exiting'}
+    summary['workers'].sort(key=lambda stats: stats['worker'])
+    summary['seconds'] = time.time() - started
+    return summary
+
+
+def main():
+    """Make module a standalone module."""
+    parser = argparse.ArgumentParser(description='Sweep a fleet with worker processes.')
+    parser.add_argument('hosts_file', help='file with one host name per line')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE)
+    parser.add_argument('--log-path', default='logs')
+    parser.add_argument('--journal', help='sweep journal to record progress in and resume from')
+    args = parser.parse_args()
+
+    with open(args.hosts_file) as file_object:
+        hosts = [line.strip() for line in file_object if line.strip()]
+    writer = ReportWriter(args.log_path)
+    try:
+        summary = sweep(hosts, args.workers, args.shard_size, writer=writer,
+                        journal_path=args.journal)
+    finally:
+        writer.close()
+    print('{0} hosts in {1:.1f}s, {2} with failures, {3} already complete'.format(
+        summary['hosts'], summary['seconds'], len(summary['failed_hosts']), summary['skipped']))
+    for stats in summary['workers']:
+        print('worker {worker}: {hosts} hosts, {shards} shards, {stolen} stolen'.format(**stats))
+    if summary['failed_hosts']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
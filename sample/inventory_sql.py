@@ -0,0 +1,342 @@
+#! /usr/bin/python3
+"""
+Description: Load collected inventories into SQLite and query them with SQL.
+
+Every report is a row of the reports table and every section of its
+content (services, processes, logical_drives, software_details, ...)
+becomes rows of a table named after the section, one row per entry
+with the report id, the host, the entry's key and one column per
+property. Nested dictionaries are flattened into "parent.child"
+columns, lists are stored as JSON. Columns are added as new properties
+show up. Rows are buffered and inserted with executemany, one
+transaction per batch, into a WAL mode database.
+
+The host of a report is its 'target'. Reports from collectors that did
+not record one only name the machine that collected them, so their
+target and the host of their rows are left NULL.
+
+Usage:
+    inventory_sql.py fleet.db load logs/win_system_get_statistics_report
+    inventory_sql.py fleet.db load --log-path logs --capability win_services_statistics
+    inventory_sql.py fleet.db query "SELECT host, key FROM services WHERE State = 'Stopped'"
+
+Author: Shayne Cardwell
+
+Module: inventory_sql.py
+"""
+import argparse
+import json
+import re
+import sqlite3
+import sys
+
+import sample.report_log as report_log
+
+DEFAULT_BATCH_SIZE = 5000
+
+_FIXED_COLUMNS = ('report_id', 'host', 'key')
+
+
+def _quote(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def table_name(section):
+    """Return the table a content section is stored in.
+
+    >>> table_name('software_details')
+    'software_details'
+    >>> table_name('Win32 Stuff-2')
+    'Win32_Stuff_2'
+
+    """
+    return re.sub(r'\W', '_', section)
+
+
+def _value(value):
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value)
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def flatten(entry, prefix=''):
+    """Return the columns of one section entry.
+
+    >>> flatten({'Name': 'Users', 'group_information': {'SID': 'S-1'}, 'group_users': ['a']})
+    {'Name': 'Users', 'group_information.SID': 'S-1', 'group_users': '["a"]'}
+
+    Args:
+        entry(dict): The entry, any other value is stored as 'value'
+        prefix(string): Optional, prepended to the column names
+
+    Returns:
+        columns(dict): Column name, SQLite value pairs
+
+    """
+    if not isinstance(entry, dict):
+        return {prefix.rstrip('.') or 'value': _value(entry)}
+    columns = {}
+    for name, value in entry.items():
+        if isinstance(value, dict):
+            columns.update(flatten(value, '{0}{1}.'.format(prefix, name)))
+        else:
+            columns[prefix + name] = _value(value)
+    return columns
+
+
+def report_rows(reports):
+    """Return the rows one report is stored as, without its id.
+
+    This is the CPU bound part of loading, done before a report id is
+    known so it can run in other processes.
+
+    Args:
+        reports(dict): A reports dict as written by utility.reporting
+
+    Returns:
+        report(tuple): The reports table values after the id
+        sections(dict): Per table, the flattened rows of the section,
+            'report_id' is filled in by add_rows
+
+    """
+    # 'host' is the collecting machine, not the one inventoried.
+    host = reports.get('target')
+    report = (reports.get('capability_name'), reports.get('host'), host,
+              reports.get('start_time'), reports.get('end_time'), reports.get('outcome'),
+              json.dumps(reports.get('messages', [])))
+    sections = {}
+    for section, entries in (reports.get('content') or {}).items():
+        if not isinstance(entries, dict):
+            entries = {'': entries}
+        rows = sections.setdefault(table_name(section), [])
+        for key, entry in entries.items():
+            row = flatten(entry)
+            row['host'] = host
+            row['key'] = str(key)
+            rows.append(row)
+    return report, sections
+
+
+class InventoryDatabase(object):
+    """SQLite store of collected reports, one table per content section.
+
+    A database has a single writer, report ids are assigned by the
+    loader so rows can be buffered before their report is written.
+
+    Args:
+        path(string): The database file, ':memory:' for a scratch one
+        batch_size(int): Rows buffered before they are written
+
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.batch_size = batch_size
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS reports (id INTEGER PRIMARY KEY, capability_name, '
+                'host, target, start_time, end_time, outcome, messages)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS reports_target ON reports (target, start_time)')
+        self.columns = {}
+        for (table,) in self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'reports'"):
+            self.columns[table] = [row[1] for row in
+                                   self.connection.execute('PRAGMA table_info({0})'.format(
+                                       _quote(table)))]
+        self.next_id = (self.connection.execute('SELECT max(id) FROM reports').fetchone()[0]
+                        or 0) + 1
+        self.pending_reports = []
+        self.pending = {}
+        self.pending_rows = 0
+
+    def _ensure_table(self, table, columns):
+        if table not in self.columns:
+            self.connection.execute('CREATE TABLE {0} (report_id INTEGER, host, key)'.format(
+                _quote(table)))
+            self.connection.execute('CREATE INDEX {0} ON {1} (host, key)'.format(
+                _quote(table + '_host_key'), _quote(table)))
+            self.connection.execute('CREATE INDEX {0} ON {1} (report_id)'.format(
+                _quote(table + '_report'), _quote(table)))
+            self.columns[table] = list(_FIXED_COLUMNS)
+        # SQLite column names are case insensitive
+        known = {column.lower() for column in self.columns[table]}
+        for column in columns:
+            if column.lower() not in known:
+                self.connection.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(
+                    _quote(table), _quote(column)))
+                self.columns[table].append(column)
+                known.add(column.lower())
+
+    def add(self, reports):
+        """Buffer one report and its sections for loading.
+
+        Args:
+            reports(dict): A reports dict as written by utility.reporting
+
+        Returns:
+            report_id(int): The id the report is stored under
+
+        """
+        return self.add_rows(*report_rows(reports))
+
+    def add_rows(self, report, sections):
+        """Buffer one report already turned into rows by report_rows.
+
+        Returns:
+            report_id(int): The id the report is stored under
+
+        """
+        report_id = self.next_id
+        self.next_id += 1
+        self.pending_reports.append((report_id,) + tuple(report))
+        for table, rows in sections.items():
+            for row in rows:
+                row['report_id'] = report_id
+            self.pending.setdefault(table, []).extend(rows)
+            self.pending_rows += len(rows)
+        self.pending_rows += 1
+        if self.pending_rows >= self.batch_size:
+            self.flush()
+        return report_id
+
+    def flush(self):
+        """Write the buffered rows in one transaction."""
+        if not self.pending_reports:
+            return
+        with self.connection:
+            self.connection.executemany('INSERT INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        self.pending_reports)
+            for table, rows in self.pending.items():
+                names = set()
+                for row in rows:
+                    names.update(row)
+                self._ensure_table(table, sorted(names))
+                columns = self.columns[table]
+                self.connection.executemany(
+                    'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                        _quote(table), ', '.join(_quote(column) for column in columns),
+                        ', '.join('?' * len(columns))),
+                    [tuple(map(row.get, columns)) for row in rows])
+        self.pending_reports = []
+        self.pending = {}
+        self.pending_rows = 0
+
+    def remove(self, report_ids):
+        """Delete reports and their section rows, e.g. superseded copies.
+
+        Args:
+            report_ids(list): The ids of the reports to delete
+
+        """
+        self.flush()
+        if not report_ids:
+            return
+        with self.connection:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS removed (id INTEGER)')
+            self.connection.execute('DELETE FROM removed')
+            self.connection.executemany('INSERT INTO removed VALUES (?)',
+                                        ((report_id,) for report_id in report_ids))
+            self.connection.execute('DELETE FROM reports WHERE id IN (SELECT id FROM removed)')
+            for table in self.columns:
+                self.connection.execute(
+                    'DELETE FROM {0} WHERE report_id IN (SELECT id FROM removed)'.format(
+                        _quote(table)))
+            self.connection.execute('DELETE FROM removed')
+
+    def load(self, records):
+        """Load an iterable of reports.
+
+        Returns:
+            count(int): The number of reports loaded
+
+        """
+        count = 0
+        for reports in records:
+            self.add(reports)
+            count += 1
+        self.flush()
+        return count
+
+    def load_report_log(self, log_file):
+        """Load a logs/<capability>_report file or a report_log segment."""
+        return self.load(report_log.read_records(log_file))
+
+    def load_capability(self, log_path, capability_name, processes=None):
+        """Load every segment of a capability, decompressed in parallel."""
+        return self.load(report_log.scan(log_path, capability_name, processes))
+
+    def query(self, sql, parameters=()):
+        """Run a query against the loaded inventories.
+
+        Args:
+            sql(string): The SQL statement
+            parameters(tuple): Optional, values for the ? placeholders
+
+        Returns:
+            columns(list): The names of the result columns
+            rows(list): The result rows as tuples
+
+        """
+        self.flush()
+        cursor = self.connection.execute(sql, parameters)
+        columns = [description[0] for description in cursor.description or ()]
+        return columns, cursor.fetchall()
+
+    def close(self):
+        """Flush and close the database."""
+        self.flush()
+        self.connection.close()
+
+
+def main():
+    """Make module a standalone module."""
+    parser = argparse.ArgumentParser(description='Load and query collected inventories.')
+    parser.add_argument('database', help='the SQLite database file')
+    commands = parser.add_subparsers(dest='command')
+    load = commands.add_parser('load', help='load report logs')
+    load.add_argument('paths', nargs='*', help='logs/<capability>_report files or segments')
+    load.add_argument('--log-path', default='logs')
+    load.add_argument('--capability', action='append', default=[],
+                      help='load every segment of a capability, may be repeated')
+    load.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    query = commands.add_parser('query', help='run SQL against the database')
+    query.add_argument('sql')
+    query.add_argument('--json', action='store_true', help='print rows as JSON objects')
+    args = parser.parse_args()
+
+    if args.command == 'load':
+        database = InventoryDatabase(args.database, args.batch_size)
+        count = 0
+        for path in args.paths:
+            count += database.load_report_log(path)
+        for capability_name in args.capability:
+            count += database.load_capability(args.log_path, capability_name)
+        database.close()
+        print('Loaded {0} reports'.format(count))
+    elif args.command == 'query':
+        database = InventoryDatabase(args.database)
+        try:
+            columns, rows = database.query(args.sql)
+        except sqlite3.Error as error:
+            print('Query failed: {0}'.format(error))
+            sys.exit(1)
+        finally:
+            database.close()
+        if args.json:
+            for row in rows:
+                print(json.dumps(dict(zip(columns, row))))
+        else:
+            print('\t'.join(columns))
+            for row in rows:
+                print('\t'.join('' if value is None else str(value) for value in row))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
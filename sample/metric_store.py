@@ -0,0 +1,489 @@
+#! /usr/bin/python3
+"""
+Description: Embedded time series store for per host hardware and OS metrics.
+
+Numeric properties such as processor LoadPercentage, logical disk
+FreeSpace and OS FreePhysicalMemory are pulled out of every
+collect_system_stats result and appended to one series per host,
+metric and instance. Points are kept in chunks compressed the Gorilla
+way: timestamps as delta of deltas and values as the XOR with the
+previous value, both bit packed. Sealed chunks are appended to the
+series file behind a fixed header so reads can memory map the file and
+skip chunks outside the requested range. Hourly rollups are kept
+beside every series for long range queries. Points of the chunk still
+filling are appended raw to a head file as they arrive, and the next
+run carries on filling the same chunk.
+
+Layout under the store path:
+    <host>/<metric>@<instance>.tsc     chunks of encoded points
+    <host>/<metric>@<instance>.rollup  fixed size hourly rollup records
+    <host>/<metric>@<instance>.head    raw points of the open chunk
+
+Author: Shayne Cardwell
+
+Module: metric_store.py
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from urllib.parse import quote, unquote
+
+# (section, property, metric name) read from collect_system_stats content
+METRICS = (
+    ('processors', 'LoadPercentage', 'processor.LoadPercentage'),
+    ('logical_drives', 'FreeSpace', 'logical_disk.FreeSpace'),
+    ('logical_drives', 'Size', 'logical_disk.Size'),
+    ('os_info', 'FreePhysicalMemory', 'os.FreePhysicalMemory'),
+    ('os_info', 'FreeVirtualMemory', 'os.FreeVirtualMemory'),
+    ('os_info', 'NumberOfProcesses', 'os.NumberOfProcesses')
+)
+
+DEFAULT_PATH = 'logs/metrics'
+CHUNK_POINTS = 720
+ROLLUP_SECONDS = 3600
+
+_CHUNK_HEADER = struct.Struct('<qqII')
+_ROLLUP = struct.Struct('<qdddI')
+_POINT = struct.Struct('<qd')
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+class _BitWriter(object):
+
+    def __init__(self):
+        self.value = 0
+        self.length = 0
+
+    def write(self, bits, width):
+        self.value = (self.value << width) | (bits & ((1 << width) - 1))
+        self.length += width
+
+    def to_bytes(self):
+        padding = -self.length % 8
+        return (self.value << padding).to_bytes((self.length + padding) // 8, 'big')
+
+
+class _BitReader(object):
+
+    def __init__(self, data):
+        self.value = int.from_bytes(data, 'big')
+        self.length = len(data) * 8
+        self.position = 0
+
+    def read(self, width):
+        self.position += width
+        return (self.value >> (self.length - self.position)) & ((1 << width) - 1)
+
+
+def _float_bits(value):
+    return struct.unpack('<Q', struct.pack('<d', value))[0]
+
+
+def _bits_float(bits):
+    return struct.unpack('<d', struct.pack('<Q', bits))[0]
+
+
+# (prefix, prefix width, value width) for the delta of delta buckets
+_DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+
+
+def encode_chunk(points):
+    """Return the Gorilla encoding of (timestamp, value) points.
+
+    >>> points = [(1000, 1.5), (1060, 1.5), (1120, 2.0), (1185, 7.25)]
+    >>> decode_chunk(encode_chunk(points), len(points)) == points
+    True
+
+    Args:
+        points(list): (int timestamp, float value) pairs in time order
+
+    Returns:
+        data(bytes): The bit packed points
+
+    """
+    writer = _BitWriter()
+    first_time, first_value = points[0]
+    writer.write(first_time, 64)
+    writer.write(_float_bits(first_value), 64)
+    previous_time, previous_delta = first_time, 0
+    previous_bits = _float_bits(first_value)
+    previous_leading, previous_trailing = 65, 65
+    for timestamp, value in points[1:]:
+        delta = timestamp - previous_time
+        dod = delta - previous_delta
+        if dod == 0:
+            writer.write(0, 1)
+        else:
+            for prefix, prefix_width, width in _DOD_BUCKETS:
+                half = 1 << (width - 1)
+                if -half < dod <= half:
+                    writer.write(prefix, prefix_width)
+                    writer.write(dod + half - 1, width)
+                    break
+            else:
+                writer.write(0b1111, 4)
+                writer.write(dod, 64)
+        previous_time, previous_delta = timestamp, delta
+
+        bits = _float_bits(value)
+        xor = bits ^ previous_bits
+        previous_bits = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        writer.write(1, 1)
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if leading >= previous_leading and trailing >= previous_trailing:
+            writer.write(0, 1)
+            writer.write(xor >> previous_trailing, 64 - previous_leading - previous_trailing)
+        else:
+            meaningful = 64 - leading - trailing
+            writer.write(1, 1)
+            writer.write(leading, 5)
+            writer.write(meaningful - 1, 6)
+            writer.write(xor >> trailing, meaningful)
+            previous_leading, previous_trailing = leading, trailing
+    return writer.to_bytes()
+
+
+def decode_chunk(data, count):
+    """Return the points encoded by encode_chunk.
+
+    Args:
+        data(bytes): The bit packed points
+        count(int): The number of points in the chunk
+
+    Returns:
+        points(list): (timestamp, value) pairs in time order
+
+    """
+    reader = _BitReader(data)
+    timestamp = reader.read(64)
+    if timestamp >= 1 << 63:
+        timestamp -= 1 << 64
+    bits = reader.read(64)
+    points = [(timestamp, _bits_float(bits))]
+    delta = 0
+    leading, trailing = 0, 0
+    for _ in range(count - 1):
+        if reader.read(1):
+            for _, _, width in _DOD_BUCKETS:
+                if reader.read(1) == 0:
+                    dod = reader.read(width) - (1 << (width - 1)) + 1
+                    break
+            else:
+                dod = reader.read(64)
+                if dod >= 1 << 63:
+                    dod -= 1 << 64
+            delta += dod
+        timestamp += delta
+
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                meaningful = reader.read(6) + 1
+                trailing = 64 - leading - meaningful
+            bits ^= reader.read(64 - leading - trailing) << trailing
+        points.append((timestamp, _bits_float(bits)))
+    return points
+
+
+def _last_sealed(path):
+    # The last timestamp of the newest chunk, walking the chunk headers.
+    last = None
+    if os.path.exists(path):
+        size = os.path.getsize(path)
+        with open(path, 'rb') as file_object:
+            offset = 0
+            while offset + _CHUNK_HEADER.size <= size:
+                file_object.seek(offset)
+                _, last, _, length = _CHUNK_HEADER.unpack(file_object.read(_CHUNK_HEADER.size))
+                offset += _CHUNK_HEADER.size + length
+    return last
+
+
+def _read_head(path):
+    # A torn last point from a crash is ignored.
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as file_object:
+        data = file_object.read()
+    return list(_POINT.iter_unpack(data[:len(data) - len(data) % _POINT.size]))
+
+
+def _replace_head(path, points):
+    if not points:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path + '.tmp', 'wb') as file_object:
+        file_object.write(b''.join(_POINT.pack(*point) for point in points))
+    os.replace(path + '.tmp', path)
+
+
+def _merge_rollup(rollups, bucket, minimum, maximum, total, count):
+    if bucket in rollups:
+        old = rollups[bucket]
+        rollups[bucket] = (min(old[0], minimum), max(old[1], maximum), old[2] + total,
+                           old[3] + count)
+    else:
+        rollups[bucket] = (minimum, maximum, total, count)
+
+
+def downsample(points, bucket_seconds):
+    """Return min, max, mean and count of points per time bucket.
+
+    Args:
+        points(list): (timestamp, value) pairs
+        bucket_seconds(int): The width of a bucket
+
+    Returns:
+        buckets(list): (bucket start, min, max, mean, count) tuples
+
+    """
+    rollups = {}
+    for timestamp, value in points:
+        _merge_rollup(rollups, timestamp - timestamp % bucket_seconds, value, value, value, 1)
+    return [(bucket, low, high, total / count, count)
+            for bucket, (low, high, total, count) in sorted(rollups.items())]
+
+
+class MetricStore(object):
+    """Append only time series store keyed by host, metric and instance.
+
+    Args:
+        path(string): The directory holding the store
+        chunk_points(int): Points per sealed chunk
+
+    """
+
+    def __init__(self, path=DEFAULT_PATH, chunk_points=CHUNK_POINTS):
+        self.path = path
+        self.chunk_points = chunk_points
+        self.heads = {}
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def _series_path(self, host, metric, instance):
+        name = '{0}@{1}'.format(quote(metric, safe=''), quote(str(instance), safe=''))
+        return os.path.join(self.path, quote(host, safe=''), name)
+
+    def _head(self, key):
+        # The open chunk of a series, reloaded from its .head file the
+        # first time the process touches the series.
+        if key not in self.heads:
+            series = self._series_path(*key)
+            sealed = _last_sealed(series + '.tsc')
+            stored = _read_head(series + '.head')
+            head = [point for point in stored if sealed is None or point[0] > sealed]
+            if len(head) < len(stored) or os.path.exists(series + '.head') and \
+                    os.path.getsize(series + '.head') != len(stored) * _POINT.size:
+                # A crash between sealing and replacing the head, or
+                # during a write; later points are appended after these.
+                _replace_head(series + '.head', head)
+            self.heads[key] = head
+            self.last[key] = head[-1][0] if head else sealed
+        return self.heads[key]
+
+    def append(self, host, metric, instance, timestamp, value):
+        """Add one point, sealing the series' chunk when it is full.
+
+        Points at or before the newest stored point of the series are
+        dropped.
+
+        Args:
+            host(string): The name of the host
+            metric(string): The metric name, e.g. 'os.FreePhysicalMemory'
+            instance(string): The instance, e.g. the DeviceID of a disk
+            timestamp(int): UNIX time of the point in seconds
+            value(float): The value of the point
+
+        Returns:
+            count(int): 1 if the point was stored, 0 if it was dropped
+
+        """
+        return self.extend(host, metric, instance, [(timestamp, value)])
+
+    def extend(self, host, metric, instance, points):
+        """Add points to one series, as append does for each of them.
+
+        Args:
+            host(string): The name of the host
+            metric(string): The metric name
+            instance(string): The instance
+            points(list): (timestamp, value) pairs in time order
+
+        Returns:
+            count(int): The number of points stored
+
+        """
+        key = (host, metric, str(instance))
+        with self.lock:
+            head = self._head(key)
+            last = self.last[key]
+            added = []
+            for timestamp, value in points:
+                if last is None or timestamp > last:
+                    last = int(timestamp)
+                    added.append((last, float(value)))
+            if not added:
+                return 0
+            self.last[key] = last
+            head.extend(added)
+            series = self._series_path(*key)
+            os.makedirs(os.path.dirname(series), exist_ok=True)
+            if len(head) < self.chunk_points:
+                with open(series + '.head', 'ab') as file_object:
+                    file_object.write(b''.join(_POINT.pack(*point) for point in added))
+                return len(added)
+            while len(head) >= self.chunk_points:
+                self._write_chunk(series, head[:self.chunk_points])
+                del head[:self.chunk_points]
+            _replace_head(series + '.head', head)
+        return len(added)
+
+    def _write_chunk(self, series, points):
+        data = encode_chunk(points)
+        with open(series + '.tsc', 'ab') as file_object:
+            file_object.write(_CHUNK_HEADER.pack(points[0][0], points[-1][0], len(points),
+                                                 len(data)))
+            file_object.write(data)
+        with open(series + '.rollup', 'ab') as file_object:
+            for bucket, low, high, mean, count in downsample(points, ROLLUP_SECONDS):
+                file_object.write(_ROLLUP.pack(bucket, low, high, mean * count, count))
+
+    def seal(self):
+        """Seal the open chunk of every series this process touched.
+
+        Open chunks are already durable in their .head files, sealing
+        early only makes smaller chunks.
+        """
+        with self.lock:
+            for key, head in self.heads.items():
+                if head:
+                    series = self._series_path(*key)
+                    self._write_chunk(series, head)
+                    _replace_head(series + '.head', [])
+                    self.heads[key] = []
+
+    def ingest_content(self, host, content, timestamp=None):
+        """Append the METRICS found in a collect_system_stats result.
+
+        Args:
+            host(string): The name of the host
+            content(dict): The content of the result
+            timestamp(int): Optional, UNIX time of the result, now if
+                omitted
+
+        Returns:
+            count(int): The number of points appended
+
+        """
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        count = 0
+        for section, prop, metric in METRICS:
+            for instance, item in content.get(section, {}).items():
+                try:
+                    value = float(item.get(prop))
+                except (TypeError, ValueError):
+                    continue
+                count += self.append(host, metric, instance, timestamp, value)
+        return count
+
+    def series(self, host):
+        """Return the (metric, instance) pairs stored for a host."""
+        directory = os.path.join(self.path, quote(host, safe=''))
+        found = set()
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith(('.tsc', '.head')):
+                    metric, instance = name.rsplit('.', 1)[0].split('@', 1)
+                    found.add((unquote(metric), unquote(instance)))
+        return sorted(found)
+
+    def query(self, host, metric, instance, start=None, end=None):
+        """Return the points of one series within a time range.
+
+        Args:
+            host(string): The name of the host
+            metric(string): The metric name
+            instance(string): The instance
+            start(int): Optional, earliest UNIX time included
+            end(int): Optional, latest UNIX time included
+
+        Returns:
+            points(list): (timestamp, value) pairs in time order
+
+        """
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        points = []
+        sealed = None
+        series = self._series_path(host, metric, instance) + '.tsc'
+        if os.path.exists(series) and os.path.getsize(series):
+            with open(series, 'rb') as file_object:
+                mapped = mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    offset = 0
+                    while offset < len(mapped):
+                        first, last, count, size = _CHUNK_HEADER.unpack_from(mapped, offset)
+                        offset += _CHUNK_HEADER.size
+                        sealed = last
+                        if last >= start and first <= end:
+                            points.extend(point for point in
+                                          decode_chunk(mapped[offset:offset + size], count)
+                                          if start <= point[0] <= end)
+                        offset += size
+                finally:
+                    mapped.close()
+        points.extend(point for point in _read_head(series[:-4] + '.head')
+                      if start <= point[0] <= end and (sealed is None or point[0] > sealed))
+        return points
+
+    def query_rollup(self, host, metric, instance, start=None, end=None,
+                     bucket_seconds=ROLLUP_SECONDS):
+        """Return downsampled buckets of one series within a time range.
+
+        Buckets that are whole multiples of an hour are served from the
+        stored hourly rollups, finer buckets from the raw points.
+
+        Returns:
+            buckets(list): (bucket start, min, max, mean, count) tuples
+
+        """
+        if bucket_seconds % ROLLUP_SECONDS:
+            return downsample(self.query(host, metric, instance, start, end), bucket_seconds)
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        rollups = {}
+        path = self._series_path(host, metric, instance) + '.rollup'
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as file_object:
+                mapped = mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for record in _ROLLUP.iter_unpack(mapped):
+                        hour = record[0]
+                        if start <= hour + ROLLUP_SECONDS - 1 and hour <= end:
+                            _merge_rollup(rollups, hour - hour % bucket_seconds, *record[1:])
+                finally:
+                    mapped.close()
+        sealed = _last_sealed(path[:-7] + '.tsc')
+        for timestamp, value in _read_head(path[:-7] + '.head'):
+            if start <= timestamp <= end and (sealed is None or timestamp > sealed):
+                _merge_rollup(rollups, timestamp - timestamp % bucket_seconds,
+                              value, value, value, 1)
+        return [(bucket, low, high, total / count, count)
+                for bucket, (low, high, total, count) in sorted(rollups.items())]
+
+
+def get_store(path=DEFAULT_PATH):
+    """Return the process wide store for a path."""
+    key = os.path.abspath(path)
+    with _STORES_LOCK:
+        if key not in _STORES:
+            _STORES[key] = MetricStore(key)
+        return _STORES[key]
@@ -0,0 +1,188 @@
+#! /usr/bin/python3
+"""
+Description: Network interface throughput from raw performance counters.
+
+Win32_PerfRawData_Tcpip_NetworkInterface returns the cumulative
+counters of every interface with the performance counter time and
+frequency they were read at. Two samples of many hosts are loaded into
+NumPy arrays and every rate is computed at once from the counter deltas
+over the exact time between the samples, which the formatted classes
+only give for the provider's own one second window.
+
+Counters are unsigned and wrap: deltas are taken modulo the counter's
+width, so a 32 bit counter that wrapped still gives the right rate. A
+64 bit counter going backwards, or a perf time that did not move
+forward, means the interface or host was reset and gives NaN.
+
+Author: Shayne Cardwell
+
+Module: network_throughput.py
+"""
+import sys
+import time
+from platform import node
+
+try:
+    import numpy
+    import sample.utility as utility
+except ModuleNotFoundError:
+    print('Had trouble finding packages')
+    print('Please install via the command below')
+    print('pipenv install')
+    sys.exit(1)
+
+PERF_CLASS = 'Win32_PerfRawData_Tcpip_NetworkInterface'
+
+# counter: (bits, per second), per second counters are returned as rates,
+# the others as the count over the window
+COUNTERS = {
+    'BytesReceivedPersec':           (64, True),
+    'BytesSentPersec':               (64, True),
+    'BytesTotalPersec':              (64, True),
+    'PacketsReceivedPersec':         (32, True),
+    'PacketsSentPersec':             (32, True),
+    'PacketsPersec':                 (32, True),
+    'PacketsOutboundErrors':         (32, False),
+    'PacketsReceivedErrors':         (32, False),
+    'PacketsOutboundDiscarded':      (32, False),
+    'PacketsReceivedDiscarded':      (32, False)
+}
+
+_NAMES = sorted(COUNTERS)
+_MASKS = numpy.array([(1 << COUNTERS[name][0]) - 1 for name in _NAMES], dtype=numpy.uint64)
+_WIDE = numpy.array([COUNTERS[name][0] == 64 for name in _NAMES])
+_PER_SECOND = numpy.array([COUNTERS[name][1] for name in _NAMES])
+
+
+def _get_wmi_obj(name):
+    return utility.connect(name)
+
+
+def read_counters(host=node(), wmi_obj=None):
+    """Return the raw counters of every interface of a host.
+
+    Args:
+        host(string): The name of the host
+        wmi_obj(WMI): Optional, an open connection to reuse
+
+    Returns:
+        rows(list): A dictionary per interface with Name,
+            Timestamp_PerfTime, Frequency_PerfTime and the COUNTERS
+
+    """
+    wmi_obj = wmi_obj or _get_wmi_obj(host)
+    wql = utility.build_wql(PERF_CLASS, None,
+                            ['Name', 'Timestamp_PerfTime', 'Frequency_PerfTime'] + _NAMES)
+    return list(utility.iter_query(wmi_obj, wql))
+
+
+def load_samples(samples):
+    """Load one sample of many hosts into arrays.
+
+    Args:
+        samples(dict): read_counters rows keyed by host name
+
+    Returns:
+        sample(dict): 'keys' ('host\\x00interface' per row), 'timestamp'
+            and 'frequency' (uint64 per row) and 'counters' (uint64,
+            one column per name in sorted COUNTERS order)
+
+    """
+    keys = []
+    timestamps = []
+    frequencies = []
+    counters = []
+    for host, rows in samples.items():
+        for row in rows:
+            keys.append('{0}\x00{1}'.format(host, row['Name']))
+            timestamps.append(int(row['Timestamp_PerfTime']))
+            frequencies.append(int(row['Frequency_PerfTime']))
+            counters.append([int(row.get(name) or 0) for name in _NAMES])
+    return {
+        'keys':      numpy.array(keys, dtype=str),
+        'timestamp': numpy.array(timestamps, dtype=numpy.uint64),
+        'frequency': numpy.array(frequencies, dtype=numpy.uint64),
+        'counters':  numpy.array(counters, dtype=numpy.uint64).reshape(len(keys), len(_NAMES))
+    }
+
+
+def rates(before, after):
+    """Return the rates between two samples of the same interfaces.
+
+    Interfaces are matched on host and Name, those in only one sample
+    are left out.
+
+    Args:
+        before(dict): load_samples of the earlier sample
+        after(dict): load_samples of the later sample
+
+    Returns:
+        result(dict): 'host' and 'interface' per matched interface,
+            'seconds' between its samples, and per counter name an
+            array of rates per second or counts over the window
+
+    """
+    _, before_index, after_index = numpy.intersect1d(
+        before['keys'], after['keys'], assume_unique=True, return_indices=True)
+    ticks = after['timestamp'][after_index] - before['timestamp'][before_index]
+    moved = after['timestamp'][after_index] > before['timestamp'][before_index]
+    seconds = numpy.where(moved, ticks.astype(numpy.float64), numpy.nan) / \
+        after['frequency'][after_index].astype(numpy.float64)
+
+    old = before['counters'][before_index]
+    new = after['counters'][after_index]
+    # uint64 subtraction wraps modulo 2**64, the mask narrows it to the width
+    delta = ((new - old) & _MASKS).astype(numpy.float64)
+    delta[(new < old) & _WIDE] = numpy.nan
+    delta[~moved] = numpy.nan
+    values = numpy.where(_PER_SECOND, delta / seconds[:, None], delta)
+
+    hosts, interfaces = zip(*(key.split('\x00', 1) for key in after['keys'][after_index])) \
+        if len(after_index) else ((), ())
+    result = {'host': list(hosts), 'interface': list(interfaces), 'seconds': seconds}
+    for column, name in enumerate(_NAMES):
+        result[name] = values[:, column]
+    return result
+
+
+class ThroughputSampler(object):
+    """Keep the last sample of every host and return rates since it.
+
+    Args:
+        read(function): Optional, takes a host name and returns its
+            read_counters rows, defaults to read_counters
+
+    """
+
+    def __init__(self, read=read_counters):
+        self.read = read
+        self.last = None
+
+    def sample(self, hosts):
+        """Read the hosts and return the rates since the previous call.
+
+        Returns:
+            result(dict): As returned by rates, None on the first call
+
+        """
+        current = load_samples({host: self.read(host) for host in hosts})
+        previous, self.last = self.last, current
+        return None if previous is None else rates(previous, current)
+
+
+def main():
+    """Make module a standalone module."""
+    sampler = ThroughputSampler()
+    sampler.sample([node()])
+    while True:
+        time.sleep(5)
+        result = sampler.sample([node()])
+        for index, interface in enumerate(result['interface']):
+            print('{0}: {1:.0f} B/s in, {2:.0f} B/s out, {3:.0f} errors'.format(
+                interface, result['BytesReceivedPersec'][index],
+                result['BytesSentPersec'][index],
+                result['PacketsOutboundErrors'][index] + result['PacketsReceivedErrors'][index]))
+
+
+if __name__ == '__main__':
+    main()
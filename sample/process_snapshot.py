@@ -0,0 +1,254 @@
+#! /usr/bin/python3
+"""
+Description: Hold a host's processes keyed by ProcessId with a tree index.
+
+Unlike the Caption keyed output of win_processes_statistics, a snapshot
+keeps every process, indexes children by ParentProcessId and stores the
+resource counters in NumPy int64 arrays so totals, aggregation per image
+name or per subtree and CPU rates are vectorized rather than walking
+dictionaries.
+
+Snapshots are stamped with the host's own clock, read from
+Win32_PerfRawData_PerfOS_System just before the processes, so CPU rates
+do not depend on how long the query took to reach the collector.
+
+Author: Shayne Cardwell
+
+Module: process_snapshot.py
+"""
+import heapq
+import sys
+import time
+
+try:
+    import numpy
+    import sample.utility as utility
+except ModuleNotFoundError:
+    print('Had trouble finding packages')
+    print('Please install via the command below')
+    print('pipenv install')
+    sys.exit(1)
+
+NUMERIC_COLUMNS = ('WorkingSetSize', 'PageFileUsage', 'KernelModeTime', 'UserModeTime',
+                   'HandleCount', 'ThreadCount')
+SNAPSHOT_PROPERTIES = ('ProcessId', 'ParentProcessId', 'Name', 'CreationDate') + NUMERIC_COLUMNS
+
+# KernelModeTime, UserModeTime and Timestamp_Sys100NS are in 100 nanosecond units.
+_TICKS_PER_SECOND = 10000000
+
+
+def _to_int(value):
+    # uint64 properties come back from WMI as strings.
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class ProcessSnapshot(object):
+    """Processes of one host at one point in time.
+
+    Args:
+        rows(iterable): Win32_Process dictionaries as returned by
+            utility.clean_win32_obj
+        timestamp(float): Optional, when the rows were read in seconds,
+            defaults to the collector's clock now
+
+    """
+
+    def __init__(self, rows, timestamp=None):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        pids = []
+        parents = []
+        self.names = []
+        self.created = []
+        columns = {column: [] for column in NUMERIC_COLUMNS}
+        self.position = {}
+        for row in rows:
+            self.position[_to_int(row.get('ProcessId'))] = len(pids)
+            pids.append(_to_int(row.get('ProcessId')))
+            parents.append(_to_int(row.get('ParentProcessId')))
+            self.names.append(str(row.get('Name') or row.get('Caption') or '').lower())
+            self.created.append(row.get('CreationDate'))
+            for column in NUMERIC_COLUMNS:
+                columns[column].append(_to_int(row.get(column)))
+        self.pids = numpy.array(pids, dtype=numpy.int64)
+        self.parents = numpy.array(parents, dtype=numpy.int64)
+        self.columns = {column: numpy.array(values, dtype=numpy.int64)
+                        for column, values in columns.items()}
+        self.name_ids, self.name_codes = numpy.unique(numpy.array(self.names, dtype=object),
+                                                      return_inverse=True)
+
+        self.children = {}
+        for index, pid in enumerate(pids):
+            if self._has_parent(index):
+                self.children.setdefault(parents[index], []).append(pid)
+
+    def _has_parent(self, index):
+        # PID 0 is its own parent, and a parent may have exited and had
+        # its id reused, so only a live process created earlier counts.
+        parent = int(self.parents[index])
+        if parent == self.pids[index] or parent not in self.position:
+            return False
+        parent_created = self.created[self.position[parent]]
+        created = self.created[index]
+        return not (parent_created and created and parent_created > created)
+
+    def __len__(self):
+        return len(self.pids)
+
+    def roots(self):
+        """Return the ids of processes without a live parent."""
+        return [pid for index, pid in enumerate(self.pids.tolist())
+                if not self._has_parent(index)]
+
+    def subtree(self, pid):
+        """Return the ids of a process and all of its descendants."""
+        found = []
+        stack = [pid]
+        seen = set()
+        while stack:
+            current = stack.pop()
+            if current in seen or current not in self.position:
+                continue
+            seen.add(current)
+            found.append(current)
+            stack.extend(self.children.get(current, ()))
+        return found
+
+    def total(self, column, pids=None):
+        """Return the sum of a column over some or all processes.
+
+        Args:
+            column(string): One of NUMERIC_COLUMNS
+            pids(iterable): Optional, the processes to include
+
+        Returns:
+            total(int): The sum of the column
+
+        """
+        values = self.columns[column]
+        if pids is None:
+            return int(values.sum())
+        indexes = [self.position[pid] for pid in pids if pid in self.position]
+        return int(values[indexes].sum())
+
+    def aggregate_by_name(self, columns=NUMERIC_COLUMNS):
+        """Return per image name totals and process counts.
+
+        Returns:
+            totals(dict): {name: {'count': n, column: total, ...}}
+
+        """
+        counts = numpy.bincount(self.name_codes, minlength=len(self.name_ids))
+        sums = {}
+        for column in columns:
+            # add.at keeps int64 exact where bincount weights go through float64.
+            sums[column] = numpy.zeros(len(self.name_ids), dtype=numpy.int64)
+            numpy.add.at(sums[column], self.name_codes, self.columns[column])
+            sums[column] = sums[column].tolist()
+        totals = {}
+        for code, name in enumerate(self.name_ids.tolist()):
+            totals[name] = {column: sums[column][code] for column in columns}
+            totals[name]['count'] = int(counts[code])
+        return totals
+
+    def aggregate_subtree(self, pid, columns=NUMERIC_COLUMNS):
+        """Return the column totals of a process and its descendants."""
+        pids = self.subtree(pid)
+        totals = {column: self.total(column, pids) for column in columns}
+        totals['count'] = len(pids)
+        return totals
+
+    def top(self, column, count=10):
+        """Return the processes with the largest values of a column.
+
+        Args:
+            column(string): One of NUMERIC_COLUMNS
+            count(int): How many processes to return
+
+        Returns:
+            top(list): (value, ProcessId, name) tuples, largest first
+
+        """
+        values = self.columns[column].tolist()
+        indexes = heapq.nlargest(count, range(len(values)), key=values.__getitem__)
+        return [(values[index], int(self.pids[index]), self.names[index]) for index in indexes]
+
+    def cpu_rates(self, earlier):
+        """Return the CPU use of each process since an earlier snapshot.
+
+        A process is matched on ProcessId and CreationDate so a reused id
+        is not mistaken for the process that held it before.
+
+        Args:
+            earlier(ProcessSnapshot): A snapshot of the same host
+
+        Returns:
+            rates(dict): {ProcessId: cpu seconds per second}, summed over
+                all processors
+
+        """
+        elapsed = self.timestamp - earlier.timestamp
+        if elapsed <= 0:
+            raise ValueError('Snapshots must be in time order')
+        if not len(self) or not len(earlier):
+            return {}
+        order = numpy.argsort(earlier.pids, kind='stable')
+        slots = numpy.searchsorted(earlier.pids[order], self.pids)
+        old = order[numpy.minimum(slots, len(order) - 1)]
+        matched = (earlier.pids[old] == self.pids) & \
+            (numpy.array(earlier.created, dtype=object)[old] ==
+             numpy.array(self.created, dtype=object))
+        ticks = (self.columns['KernelModeTime'] + self.columns['UserModeTime'])[matched] - \
+            (earlier.columns['KernelModeTime'] + earlier.columns['UserModeTime'])[old[matched]]
+        rates = numpy.maximum(ticks, 0) / _TICKS_PER_SECOND / elapsed
+        return dict(zip(self.pids[matched].tolist(), rates.tolist()))
+
+    def top_cpu(self, earlier, count=10):
+        """Return the processes with the highest CPU rate since earlier.
+
+        Returns:
+            top(list): (rate, ProcessId, name) tuples, busiest first
+
+        """
+        rates = self.cpu_rates(earlier)
+        busiest = heapq.nlargest(count, rates.items(), key=lambda item: item[1])
+        return [(rate, pid, self.names[self.position[pid]]) for pid, rate in busiest]
+
+
+def host_clock(wmi_obj):
+    """Return the host's system time in seconds, None if it is not readable.
+
+    Args:
+        wmi_obj(WMI): A connection to the root/cimv2 namespace
+
+    Returns:
+        timestamp(float): Timestamp_Sys100NS of the host in seconds
+
+    """
+    wql = utility.build_wql('Win32_PerfRawData_PerfOS_System', properties=('Timestamp_Sys100NS',))
+    for row in utility.iter_query(wmi_obj, wql):
+        ticks = _to_int(row.get('Timestamp_Sys100NS'))
+        if ticks:
+            return ticks / _TICKS_PER_SECOND
+    return None
+
+
+def take_snapshot(wmi_obj):
+    """Read a ProcessSnapshot from a WMI connection.
+
+    Only the properties the snapshot uses are selected. The snapshot is
+    stamped with the host's clock, or the collector's when the host's
+    performance counters cannot be read.
+
+    Args:
+        wmi_obj(WMI): A connection to the root/cimv2 namespace
+
+    Returns:
+        snapshot(ProcessSnapshot): The processes of the host
+
+    """
+    timestamp = host_clock(wmi_obj)
+    wql = utility.build_wql('Win32_Process', properties=SNAPSHOT_PROPERTIES)
+    return ProcessSnapshot(utility.iter_query(wmi_obj, wql), timestamp)
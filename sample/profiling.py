@@ -0,0 +1,178 @@
+#! /usr/bin/python3
+"""
+Description: Profile collectors across threads and hosts.
+
+Two modes are offered. 'cprofile' runs every wrapped collector call
+under its own cProfile.Profile, in the thread making the call, and
+merges the results with pstats. 'sample' starts one thread that reads
+sys._current_frames() every interval and counts the stacks of the
+threads running wrapped collectors, prefixed with the collector name,
+so the cost of a collector is added up across threads and hosts at a
+low, fixed overhead.
+
+Both modes write a top table of functions, 'cprofile' a .pstats dump as
+well and 'sample' a collapsed stack file that flamegraph.pl or
+speedscope read directly.
+
+Author: Shayne Cardwell
+
+Module: profiling.py
+"""
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+MODES = ('cprofile', 'sample')
+DEFAULT_INTERVAL = 0.005
+
+
+def _frame_name(code):
+    return '{0}:{1}:{2}'.format(os.path.basename(code.co_filename), code.co_firstlineno,
+                                code.co_name)
+
+
+class CollectorProfiler(object):
+    """Profile wrapped collector calls from any number of threads.
+
+    Args:
+        mode(string): 'cprofile' or 'sample'
+        interval(float): Seconds between samples in 'sample' mode
+
+    """
+
+    def __init__(self, mode='sample', interval=DEFAULT_INTERVAL):
+        if mode not in MODES:
+            raise ValueError('Unknown profile mode {0}'.format(mode))
+        self.mode = mode
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stats = None
+        self.stacks = Counter()
+        self.samples = 0
+        self.threads = {}
+        self.sampler = None
+        self.stopping = threading.Event()
+        self._wrapper_code = None
+
+    def wrap(self, function):
+        """Return function profiled on every call, in the calling thread."""
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            if self.mode == 'cprofile':
+                profile = cProfile.Profile()
+                try:
+                    return profile.runcall(function, *args, **kwargs)
+                finally:
+                    with self.lock:
+                        if self.stats is None:
+                            self.stats = pstats.Stats(profile)
+                        else:
+                            self.stats.add(profile)
+            ident = threading.get_ident()
+            outer = self.threads.get(ident)
+            self.threads[ident] = function.__name__
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if outer is None:
+                    self.threads.pop(ident, None)
+                else:
+                    self.threads[ident] = outer
+        self._wrapper_code = profiled.__code__
+        return profiled
+
+    def start(self):
+        """Start sampling, a no-op in 'cprofile' mode."""
+        if self.mode == 'sample' and self.sampler is None:
+            self.stopping.clear()
+            self.sampler = threading.Thread(target=self._sample, name='profiler')
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    def stop(self):
+        """Stop sampling."""
+        if self.sampler is not None:
+            self.stopping.set()
+            self.sampler.join()
+            self.sampler = None
+
+    def _sample(self):
+        while not self.stopping.wait(self.interval):
+            frames = sys._current_frames()  # pylint: disable=W0212
+            for ident, label in list(self.threads.items()):
+                frame = frames.get(ident)
+                stack = []
+                # The frames below the wrapper are the same thread plumbing everywhere.
+                while frame is not None and frame.f_code is not self._wrapper_code:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    stack.append(label)
+                    self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """Return the sampled stacks as 'frame;frame;frame count' lines."""
+        return ''.join('{0} {1}\n'.format(stack, count)
+                       for stack, count in sorted(self.stacks.items()))
+
+    def top(self, limit=30):
+        """Return a table of the functions that took the most time.
+
+        Args:
+            limit(int): The number of functions listed
+
+        Returns:
+            table(string): The table, cumulative then own time per
+                function, in seconds for 'cprofile' and samples for
+                'sample'
+
+        """
+        if self.mode == 'cprofile':
+            if self.stats is None:
+                return ''
+            stream = io.StringIO()
+            self.stats.stream = stream
+            self.stats.sort_stats('cumulative').print_stats(limit)
+            return stream.getvalue()
+
+        total = Counter()
+        own = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        lines = ['{0:>10} {1:>10}  {2}'.format('total', 'own', 'function')]
+        for name, count in total.most_common(limit):
+            lines.append('{0:>10} {1:>10}  {2}'.format(count, own[name], name))
+        lines.append('{0} samples every {1}s'.format(self.samples, self.interval))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory):
+        """Write the results to a directory.
+
+        Returns:
+            paths(list): The files written
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d%H%M%S')
+        paths = []
+        if self.mode == 'cprofile' and self.stats is not None:
+            paths.append(os.path.join(directory, 'profile.{0}.pstats'.format(stamp)))
+            self.stats.dump_stats(paths[-1])
+        if self.mode == 'sample':
+            paths.append(os.path.join(directory, 'profile.{0}.collapsed'.format(stamp)))
+            with open(paths[-1], 'w') as file_object:
+                file_object.write(self.collapsed())
+        paths.append(os.path.join(directory, 'profile.{0}.top.txt'.format(stamp)))
+        with open(paths[-1], 'w') as file_object:
+            file_object.write(self.top())
+        return paths
@@ -0,0 +1,214 @@
+#! /usr/bin/python3
+"""
+Description: Import years of report history into SQLite in parallel.
+
+Plain logs/<capability>_report files, one reports dict per line, are
+split into byte ranges of about chunk_bytes that end on a line break.
+Worker processes map the file, decode the lines of their range and turn
+every report into the rows inventory_sql stores it as, so decoding and
+flattening run on every core while the single SQLite writer only
+inserts. Compressed report_log segments are one range each.
+
+The threaded collectors write some reports twice, and the old unlocked
+appends can leave torn lines. A report is identified by its capability,
+target and start time and the copy written last wins: a copy that
+arrives after another one supersedes the rows loaded before it, which
+are deleted once the import is done, reports already in the database
+included. Reports from before the target was recorded name only the
+machine that collected them, shared by every host it collected, so
+they are identified by a digest of everything but the fields a later
+copy rewrites (DIGEST_EXCLUDED) instead and only merged with copies in
+the same import. Lines that do not decode are counted and skipped.
+
+Usage:
+    report_import.py fleet.db logs/*_report --processes 8 --chunk-mb 32
+
+Author: Shayne Cardwell
+
+Module: report_import.py
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import time
+from multiprocessing import Pool
+
+import sample.inventory_sql as inventory_sql
+import sample.report_log as report_log
+
+DEFAULT_CHUNK_BYTES = 32 * 1024 * 1024
+# Left out of the digest of a report without a target: a copy written
+# again once the collector finished changes its outcome, the return body
+# that repeats it and its end time.
+DIGEST_EXCLUDED = ('end_time', 'outcome', 'return_body')
+
+
+def split_ranges(path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Split a JSON lines file into byte ranges ending on line breaks.
+
+    Args:
+        path(string): The file to split
+        chunk_bytes(int): The size a range is cut at, it grows to the
+            end of the line it cuts through
+
+    Returns:
+        ranges(list): (start, end) byte offsets covering the file
+
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    ranges = []
+    with open(path, 'rb') as file_object, \
+            mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        start = 0
+        while start < size:
+            end = mapped.find(b'\n', min(start + chunk_bytes, size) - 1)
+            end = size if end < 0 else end + 1
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def report_key(reports):
+    """Return what identifies a report, None when it cannot be told apart."""
+    if reports.get('start_time') is None:
+        return None
+    if 'target' in reports:
+        return reports.get('capability_name'), reports['target'], reports['start_time']
+    copy = {name: value for name, value in reports.items() if name not in DIGEST_EXCLUDED}
+    return (reports.get('capability_name'), ('digest', hashlib.sha1(json.dumps(
+        copy, sort_keys=True, default=str).encode('utf-8')).hexdigest()), reports['start_time'])
+
+
+def _lines(path, start, end):
+    if start is None:
+        for reports in report_log.read_records(path):
+            yield reports
+        return
+    with open(path, 'rb') as file_object, \
+            mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        data = mapped[start:end]
+    for line in data.splitlines():
+        if line.strip():
+            yield line
+
+
+def parse_range(task):
+    """Decode one range into rows, keeping the last copy of every report.
+
+    Args:
+        task(tuple): (path, start, end), start and end are None for a
+            compressed segment, which is read whole
+
+    Returns:
+        reports(list): (key, report, sections) in the order of their
+            last copy in the range, see inventory_sql.report_rows
+        lines(int): The reports read, duplicates included
+        invalid(int): The lines that did not decode
+
+    """
+    path, start, end = task
+    latest = {}
+    lines = invalid = 0
+    for line in _lines(path, start, end):
+        try:
+            reports = json.loads(line) if isinstance(line, bytes) else line
+        except ValueError:
+            invalid += 1
+            continue
+        if not isinstance(reports, dict):
+            invalid += 1
+            continue
+        lines += 1
+        key = report_key(reports)
+        # Unidentifiable reports are never merged.
+        slot = ('line', lines) if key is None else key
+        latest.pop(slot, None)
+        latest[slot] = (key,) + inventory_sql.report_rows(reports)
+    return list(latest.values()), lines, invalid
+
+
+def import_reports(database, paths, processes=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Import report files into an InventoryDatabase.
+
+    Args:
+        database(InventoryDatabase): The database to load into
+        paths(list): logs/<capability>_report files or segments, later
+            files win over earlier ones for the same report
+        processes(int): Optional, worker processes, defaults to the
+            number of CPUs
+        chunk_bytes(int): The size plain files are split at
+
+    Returns:
+        summary(dict): The 'bytes' and 'lines' read, the 'reports'
+            kept, the 'duplicates' dropped, earlier imports included,
+            the 'invalid' lines and the 'seconds' taken
+
+    """
+    started = time.time()
+    tasks = []
+    summary = {'bytes': 0, 'lines': 0, 'reports': 0, 'duplicates': 0, 'invalid': 0}
+    for path in paths:
+        summary['bytes'] += os.path.getsize(path)
+        if path.endswith(('.gz', '.zst')):
+            tasks.append((path, None, None))
+        else:
+            tasks.extend((path, start, end) for start, end in split_ranges(path, chunk_bytes))
+
+    database.flush()
+    known = {(capability_name, target, start_time): report_id
+             for report_id, capability_name, target, start_time in database.connection.execute(
+                 'SELECT id, capability_name, target, start_time FROM reports '
+                 'WHERE start_time IS NOT NULL AND target IS NOT NULL')}
+    superseded = []
+    first_id = database.next_id
+    pool = Pool(processes)
+    try:
+        for reports, lines, invalid in pool.imap(parse_range, tasks):
+            summary['lines'] += lines
+            summary['invalid'] += invalid
+            for key, report, sections in reports:
+                report_id = database.add_rows(report, sections)
+                if key is not None:
+                    previous = known.get(key)
+                    if previous is not None:
+                        superseded.append(previous)
+                    known[key] = report_id
+    finally:
+        pool.close()
+        pool.join()
+    database.remove(superseded)
+    added = database.next_id - first_id
+    summary['reports'] = added - sum(report_id >= first_id for report_id in superseded)
+    summary['duplicates'] = summary['lines'] - added + len(superseded)
+    summary['seconds'] = time.time() - started
+    return summary
+
+
+def main():
+    """Make module a standalone module."""
+    parser = argparse.ArgumentParser(description='Import report history into SQLite.')
+    parser.add_argument('database', help='the SQLite database file')
+    parser.add_argument('paths', nargs='+', help='logs/<capability>_report files or segments')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk-mb', type=float, default=DEFAULT_CHUNK_BYTES / 1024 / 1024)
+    parser.add_argument('--batch-size', type=int, default=inventory_sql.DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    database = inventory_sql.InventoryDatabase(args.database, args.batch_size)
+    try:
+        summary = import_reports(database, args.paths, args.processes,
+                                 int(args.chunk_mb * 1024 * 1024))
+    finally:
+        database.close()
+    print('Imported {0} reports from {1} lines, {2} duplicates and {3} invalid lines dropped, '
+          '{4:.1f} MB/s'.format(summary['reports'], summary['lines'], summary['duplicates'],
+                                summary['invalid'],
+                                summary['bytes'] / 1e6 / max(summary['seconds'], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+#! /usr/bin/python3
+"""
+Description: Compressed, rotating, append optimized report logs.
+
+Reports are buffered and written as independently compressed blocks, a
+gzip member or a zstd frame each, so a segment is a valid .gz or .zst
+stream and any block can be decompressed on its own. Every segment has
+a sidecar .idx file of JSON lines, one per record, giving the host, the
+time it was written and the offset and length of its block, which lets
+a reader fetch one host's records without decompressing the segment.
+Segments rotate on size or age, and each process claims its own segment
+file when it opens one.
+
+append buffers records until a block is full, write writes the block
+straight away so the record survives a crash. Buffered records are
+written when the process exits, including multiprocessing children; a
+forked child drops the buffers it inherits, the parent writes those.
+
+Layout under the log path:
+    <capability>_report.<YYYYmmddHHMMSS>.gz      compressed blocks
+    <capability>_report.<YYYYmmddHHMMSS>.gz.idx  index of the records
+
+Author: Shayne Cardwell
+
+Module: report_log.py
+"""
+import atexit
+import glob
+import gzip
+import io
+import json
+import multiprocessing.util
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+DEFAULT_SETTINGS = {
+    'compression':    'gzip',
+    'max_bytes':      64 * 1024 * 1024,
+    'max_age':        24 * 60 * 60,
+    'block_bytes':    256 * 1024,
+    'flush_interval': 60
+}
+
+_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+_SEGMENT_NAME = re.compile(r'_report\.(\d{14})(?:-(\d+))?\.')
+_WRITERS = {}
+_WRITERS_LOCK = threading.Lock()
+
+
+def _compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data)
+
+
+def _decompress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def _compression_of(path):
+    return 'zstd' if path.endswith('.zst') else 'gzip'
+
+
+class ReportLogWriter(object):
+    """Append reports of one capability to rotating compressed segments.
+
+    Args:
+        log_path(string): The directory holding the logs
+        capability_name(string): The capability the reports belong to
+        compression(string): 'gzip' or 'zstd'
+        max_bytes(int): Compressed size at which a segment is rotated
+        max_age(int): Seconds after which a segment is rotated
+        block_bytes(int): Uncompressed bytes buffered per block
+        flush_interval(int): Seconds a record may stay buffered before
+            its block is written
+
+    """
+
+    def __init__(self, log_path, capability_name, compression='gzip', max_bytes=None,
+                 max_age=None, block_bytes=None, flush_interval=None):
+        if compression not in _EXTENSIONS:
+            raise ValueError('Unknown compression {0}'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        self.log_path = log_path
+        self.capability_name = capability_name
+        self.compression = compression
+        self.max_bytes = max_bytes or DEFAULT_SETTINGS['max_bytes']
+        self.max_age = max_age or DEFAULT_SETTINGS['max_age']
+        self.block_bytes = block_bytes or DEFAULT_SETTINGS['block_bytes']
+        self.flush_interval = flush_interval or DEFAULT_SETTINGS['flush_interval']
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_started = None
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def _open_segment(self):
+        os.makedirs(self.log_path, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        base = os.path.join(self.log_path, '{0}_report.{1}'.format(self.capability_name, stamp))
+        path = base + _EXTENSIONS[self.compression]
+        suffix = 1
+        while True:
+            # Creating the file claims the name, other processes writing the
+            # same capability in the same second move on to the next suffix.
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                path = '{0}-{1}{2}'.format(base, suffix, _EXTENSIONS[self.compression])
+                suffix += 1
+        self.segment = path
+        self.segment_started = time.time()
+
+    def _needs_rotation(self):
+        if self.segment is None:
+            return True
+        if time.time() - self.segment_started >= self.max_age:
+            return True
+        return os.path.exists(self.segment) and os.path.getsize(self.segment) >= self.max_bytes
+
+    def append(self, record, host=None):
+        """Buffer one record, writing a block once enough is buffered.
+
+        Args:
+            record(dict): The report to store
+            host(string): Optional, the host the record is indexed under
+
+        """
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self.lock:
+            self.buffer.append((line, host, time.time()))
+            self.buffered_bytes += len(line)
+            if self.buffered_bytes >= self.block_bytes or \
+                    time.time() - self.buffer[0][2] >= self.flush_interval:
+                self._write_block()
+
+    def write(self, record, host=None):
+        """Append one record and write it out before returning.
+
+        Args:
+            record(dict): The report to store
+            host(string): Optional, the host the record is indexed under
+
+        Returns:
+            location(dict): The 'segment' holding the record, the
+                'offset' and 'length' of its block and its 'record'
+                position in the block, as in the index
+
+        """
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self.lock:
+            self.buffer.append((line, host, time.time()))
+            self.buffered_bytes += len(line)
+            return self._write_block()
+
+    def flush(self):
+        """Write whatever is buffered as a block."""
+        with self.lock:
+            self._write_block()
+
+    def _write_block(self):
+        if not self.buffer:
+            return None
+        if self._needs_rotation():
+            self._open_segment()
+        block = _compress(b''.join(line for line, _, _ in self.buffer), self.compression)
+        with open(self.segment, 'ab') as file_object:
+            offset = file_object.tell()
+            file_object.write(block)
+        with open(self.segment + '.idx', 'a') as index_object:
+            for position, (_, host, written) in enumerate(self.buffer):
+                index_object.write(json.dumps({'host': host, 'time': written, 'offset': offset,
+                                               'length': len(block), 'record': position}) + '\n')
+        location = {'segment': self.segment, 'offset': offset, 'length': len(block),
+                    'record': len(self.buffer) - 1}
+        self.buffer = []
+        self.buffered_bytes = 0
+        return location
+
+
+def get_writer(log_path, capability_name, **settings):
+    """Return the process wide writer for a capability.
+
+    Writers are shared between threads and flushed when the process
+    exits, settings default to DEFAULT_SETTINGS.
+
+    Returns:
+        writer(ReportLogWriter): The writer for the capability
+
+    """
+    key = (os.path.abspath(log_path), capability_name)
+    with _WRITERS_LOCK:
+        if key not in _WRITERS:
+            options = dict(DEFAULT_SETTINGS)
+            options.update(settings)
+            writer = _WRITERS[key] = ReportLogWriter(key[0], capability_name, **options)
+            # atexit does not run in multiprocessing children, their exit
+            # runs the finalizers registered in them instead.
+            multiprocessing.util.Finalize(writer, writer.flush, exitpriority=10)
+        return _WRITERS[key]
+
+
+@atexit.register
+def flush_all():
+    """Write the buffered records of every writer in the process."""
+    with _WRITERS_LOCK:
+        writers = list(_WRITERS.values())
+    for writer in writers:
+        writer.flush()
+
+
+def _forget_writers():
+    # The buffers a forked child inherits are the parent's to write.
+    global _WRITERS_LOCK  # pylint: disable=W0603
+    _WRITERS_LOCK = threading.Lock()
+    _WRITERS.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_writers)
+
+
+def segments(log_path, capability_name):
+    """Return the compressed segments of a capability, oldest first."""
+    pattern = os.path.join(log_path, '{0}_report.*'.format(capability_name))
+    return sorted((path for path in glob.glob(pattern) if path.endswith(('.gz', '.zst'))),
+                  key=_segment_order)
+
+
+def _segment_order(path):
+    match = _SEGMENT_NAME.search(os.path.basename(path))
+    if match is None:
+        return ('', 0, path)
+    return (match.group(1), int(match.group(2) or 0), path)
+
+
+def read_records(path):
+    """Yield the records of a plain JSON lines log or a segment.
+
+    Args:
+        path(string): A logs/<capability>_report file or a segment
+
+    Returns:
+        records(generator): The decoded reports
+
+    """
+    if path.endswith('.zst'):
+        file_object = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), read_across_frames=True, closefd=True), encoding='utf-8')
+    elif path.endswith('.gz'):
+        file_object = gzip.open(path, 'rt', encoding='utf-8')
+    else:
+        file_object = open(path)
+    with file_object:
+        for line in file_object:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _read_segment(path):
+    return list(read_records(path))
+
+
+def find(log_path, capability_name, host, start=None, end=None):
+    """Return a host's records between two times using the indexes.
+
+    Only the blocks holding matching records are read and decompressed.
+
+    Args:
+        log_path(string): The directory holding the logs
+        capability_name(string): The capability the reports belong to
+        host(string): The host the records were indexed under
+        start(float): Optional, earliest write time as a UNIX timestamp
+        end(float): Optional, latest write time as a UNIX timestamp
+
+    Returns:
+        records(list): The matching reports, oldest first
+
+    """
+    records = []
+    for segment in segments(log_path, capability_name):
+        if not os.path.exists(segment + '.idx'):
+            continue
+        wanted = {}
+        with open(segment + '.idx') as index_object:
+            for line in index_object:
+                entry = json.loads(line)
+                if entry['host'] != host:
+                    continue
+                if (start is not None and entry['time'] < start) or \
+                        (end is not None and entry['time'] > end):
+                    continue
+                wanted.setdefault((entry['offset'], entry['length']), []).append(entry['record'])
+        if not wanted:
+            continue
+        with open(segment, 'rb') as file_object:
+            for (offset, length), positions in sorted(wanted.items()):
+                file_object.seek(offset)
+                lines = _decompress(file_object.read(length),
+                                    _compression_of(segment)).splitlines()
+                records.extend(json.loads(lines[position]) for position in positions)
+    return records
+
+
+def scan(log_path, capability_name, processes=None):
+    """Yield every record of a capability, decompressing segments in parallel.
+
+    Args:
+        log_path(string): The directory holding the logs
+        capability_name(string): The capability the reports belong to
+        processes(int): Optional, worker processes, defaults to the
+            number of CPUs
+
+    Returns:
+        records(generator): The reports, segment by segment in order
+
+    """
+    paths = segments(log_path, capability_name)
+    if len(paths) < 2 or processes == 1:
+        for path in paths:
+            for record in read_records(path):
+                yield record
+        return
+    pool = Pool(processes)
+    try:
+        for records in pool.imap(_read_segment, paths):
+            for record in records:
+                yield record
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,280 @@
+#! /usr/bin/python3
+"""
+Description: Keep unreachable or overloaded hosts from stalling a sweep.
+
+Provides a per host timeout budget, jittered exponential retry of the
+transient COM errors raised by DCOM and WMI, and a circuit breaker that
+skips hosts which keep failing for a cooldown window. The clock, sleep
+and random functions are injectable so the behaviour can be driven by a
+simulated clock.
+
+A budget is put in scope for a collector thread with budget_scope, and
+utility.connect and utility.exec_query retry their own connect and
+query calls against it, so one failed call is retried instead of the
+whole collector. A DCOM call cannot be interrupted, a caller waiting on
+a collector thread stops waiting once the budget runs out.
+
+Author: Shayne Cardwell
+
+Module: resilience.py
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# https://docs.microsoft.com/en-us/windows/win32/wmisdk/wmi-error-constants
+# https://docs.microsoft.com/en-us/windows/win32/rpc/rpc-return-values
+TRANSIENT_HRESULTS = {
+    0x800706BA: 'RPC_S_SERVER_UNAVAILABLE',
+    0x800706BE: 'RPC_S_CALL_FAILED',
+    0x800706BF: 'RPC_S_CALL_FAILED_DNE',
+    0x80010001: 'RPC_E_CALL_REJECTED',
+    0x8001010A: 'RPC_E_SERVERCALL_RETRYLATER',
+    0x80041015: 'WBEM_E_TRANSPORT_FAILURE',
+    0x80041045: 'WBEM_E_SERVER_TOO_BUSY',
+    0x80043001: 'WBEM_E_RETRY_LATER'
+}
+
+
+class BudgetExhausted(Exception):
+    """Raised when a host's timeout budget runs out."""
+
+
+class CircuitOpen(Exception):
+    """Raised when a host is skipped because its circuit is open."""
+
+
+def hresult_of(error):
+    """Return the unsigned HRESULT carried by a COM or WMI error.
+
+    pywintypes.com_error carries it as args[0] and wmi.x_wmi wraps the
+    original com_error in its com_error attribute.
+
+    Args:
+        error(exception): The exception raised by the call
+
+    Returns:
+        hresult(int): The HRESULT, None when the error has none
+
+    """
+    error = getattr(error, 'com_error', None) or error
+    hresult = getattr(error, 'hresult', None)
+    if hresult is None and getattr(error, 'args', None) and isinstance(error.args[0], int):
+        hresult = error.args[0]
+    if hresult is None:
+        return None
+    return hresult & 0xffffffff
+
+
+def is_transient_error(error):
+    """Return True if retrying the call may succeed.
+
+    Args:
+        error(exception): The exception raised by the call
+
+    Returns:
+        is_transient(bool): Whether the error is worth retrying
+
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return hresult_of(error) in TRANSIENT_HRESULTS
+
+
+class TimeoutBudget(object):
+    """Track the time left for one host across all of its calls.
+
+    Args:
+        seconds(float): The total time the host may use, None for no
+            limit
+        clock(function): Optional, returns the current time in seconds
+
+    """
+
+    def __init__(self, seconds, clock=time.monotonic):
+        self.clock = clock
+        self.deadline = None if seconds is None else clock() + seconds
+        self.connections = 0
+        self.connect_failures = 0
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        """Return the seconds left, None when there is no limit."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - self.clock())
+
+    def expired(self):
+        """Return True once the budget is used up."""
+        return self.deadline is not None and self.clock() >= self.deadline
+
+    def record_connect(self, connected):
+        """Count a connection made, or one that failed after its retries."""
+        with self.lock:
+            if connected:
+                self.connections += 1
+            else:
+                self.connect_failures += 1
+
+    def reachable(self):
+        """Return False if connecting failed and never succeeded, else True."""
+        with self.lock:
+            return self.connections > 0 or not self.connect_failures
+
+
+_SCOPE = threading.local()
+
+
+@contextmanager
+def budget_scope(budget):
+    """Make budget the current budget of this thread while in the block.
+
+    Args:
+        budget(TimeoutBudget): The budget of the host being collected
+
+    """
+    previous = getattr(_SCOPE, 'budget', None)
+    _SCOPE.budget = budget
+    try:
+        yield budget
+    finally:
+        _SCOPE.budget = previous
+
+
+def current_budget():
+    """Return the budget put in scope for this thread, None if there is none."""
+    return getattr(_SCOPE, 'budget', None)
+
+
+class RetryPolicy(object):  # pylint: disable=R0903
+    """Describe how transient failures are retried.
+
+    Args:
+        attempts(int): The maximum number of calls, including the first
+        base_delay(float): The delay before the first retry in seconds
+        max_delay(float): The cap on a single delay in seconds
+        retry_on(function): Optional, decides whether an error is
+            transient
+
+    """
+
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=30.0, retry_on=is_transient_error):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+
+    def delay(self, attempt, rand=random.random):
+        """Return the full jitter delay before the given retry.
+
+        Args:
+            attempt(int): The number of calls made so far
+            rand(function): Optional, returns a float in [0, 1)
+
+        Returns:
+            delay(float): Seconds to wait before the next call
+
+        """
+        return rand() * min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+
+
+def call_with_retry(function, args=(), kwargs=None, policy=None, budget=None,
+                    sleep=time.sleep, rand=random.random):
+    """Call a function, retrying transient failures within the budget.
+
+    Args:
+        function(function): The call to make
+        args(tuple): Optional, positional arguments for the call
+        kwargs(dict): Optional, keyword arguments for the call
+        policy(RetryPolicy): Optional, how to retry
+        budget(TimeoutBudget): Optional, stops retrying once the next
+            delay would not fit in the time left
+        sleep(function): Optional, waits the given number of seconds
+        rand(function): Optional, jitter source returning [0, 1)
+
+    Returns:
+        result(object): The return value of the call
+
+    """
+    policy = policy or RetryPolicy()
+    kwargs = kwargs or {}
+    attempt = 0
+    while True:
+        if budget is not None and budget.expired():
+            raise BudgetExhausted('Timeout budget used up after {0} attempts'.format(attempt))
+        attempt += 1
+        try:
+            return function(*args, **kwargs)
+        except Exception as error:  # pylint: disable=W0703
+            if attempt >= policy.attempts or not policy.retry_on(error):
+                raise
+            delay = policy.delay(attempt, rand)
+            remaining = None if budget is None else budget.remaining()
+            if remaining is not None and delay >= remaining:
+                raise
+            sleep(delay)
+
+
+class CircuitBreaker(object):
+    """Skip hosts that keep failing until a cooldown has passed.
+
+    After failure_threshold consecutive failures a host's circuit opens
+    and allow() returns False for cooldown seconds. The first call after
+    the cooldown is let through as a trial and every other call is
+    refused until it is recorded; success closes the circuit, failure
+    opens it again. A trial not recorded within cooldown seconds is
+    taken as lost and another one is let through.
+
+    Args:
+        failure_threshold(int): Consecutive failures that open a circuit
+        cooldown(float): Seconds an open circuit skips the host
+        clock(function): Optional, returns the current time in seconds
+
+    """
+
+    def __init__(self, failure_threshold=3, cooldown=900, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def state(self, host):
+        """Return 'closed', 'open' or 'half_open' for the host."""
+        with self.lock:
+            entry = self.hosts.get(host)
+        if entry is None or entry['opened_at'] is None:
+            return 'closed'
+        if self.clock() - entry['opened_at'] < self.cooldown:
+            return 'open'
+        return 'half_open'
+
+    def allow(self, host):
+        """Return True if a call to the host should be attempted."""
+        with self.lock:
+            entry = self.hosts.get(host)
+            if entry is None or entry['opened_at'] is None:
+                return True
+            now = self.clock()
+            if now - entry['opened_at'] < self.cooldown:
+                return False
+            if entry['trial_at'] is not None and now - entry['trial_at'] < self.cooldown:
+                return False
+            entry['trial_at'] = now
+            return True
+
+    def record_success(self, host):
+        """Close the host's circuit."""
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def record_failure(self, host):
+        """Count a failure, opening the circuit at the threshold."""
+        with self.lock:
+            entry = self.hosts.setdefault(host, {'failures': 0, 'opened_at': None,
+                                                 'trial_at': None})
+            entry['failures'] += 1
+            entry['trial_at'] = None
+            if entry['opened_at'] is not None or entry['failures'] >= self.failure_threshold:
+                entry['opened_at'] = self.clock()
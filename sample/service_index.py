@@ -0,0 +1,261 @@
+#! /usr/bin/python3
+"""
+Description: Index services across hosts by name, state and dependency.
+
+Built from win_services_statistics output, the index keeps each host's
+services keyed by Name, the fleet dependency graph in both directions
+and, per (StartMode, State) pair and service Name, a bitmap of the
+hosts in that state held in a Python int. Fleet questions such as
+"which hosts have a stopped auto start service" are then ORs and ANDs
+of bitmaps instead of scans over every record.
+
+collect_system_stats and the fleet sweep add every services result they
+collect to the process wide index returned by get_index, so it is
+built alongside collection, and add_report_log loads history.
+
+Author: Shayne Cardwell
+
+Module: service_index.py
+"""
+import threading
+
+import sample.report_log as report_log
+
+# Properties kept per service, the rest of Win32_Service is left out.
+INDEXED_PROPERTIES = ('DisplayName', 'StartMode', 'State', 'Status', 'StartName', 'PathName',
+                      'ProcessId')
+
+
+def _bitmap(host_ids):
+    bits = bytearray((max(host_ids) >> 3) + 1)
+    for host_id in host_ids:
+        bits[host_id >> 3] |= 1 << (host_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class ServiceIndex(object):
+    """Name keyed services, dependency graph and state bitmaps per host."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.hosts = []
+        self.host_ids = {}
+        self.records = {}
+        self.dependencies = {}
+        self.dependents = {}
+        self.members = {}
+        self.bitmaps = {}
+        self.state_bitmaps = {}
+        self._dirty = False
+
+    def _host_id(self, host):
+        if host not in self.host_ids:
+            self.host_ids[host] = len(self.hosts)
+            self.hosts.append(host)
+        return self.host_ids[host]
+
+    def add(self, host, content):
+        """Add or replace one host's services.
+
+        Args:
+            host(string): The name of the host
+            content(dict): The content of collect_win_services_stats,
+                'services' and optionally 'service_dependencies'
+
+        """
+        with self.lock:
+            self.remove(host)
+            host_id = self._host_id(host)
+            records = {}
+            for service in content.get('services', {}).values():
+                record = {name: service.get(name) for name in INDEXED_PROPERTIES}
+                records[service['Name']] = record
+                key = (record['StartMode'], record['State'], service['Name'])
+                self.members.setdefault(key, set()).add(host_id)
+            self.records[host] = records
+
+            dependencies = content.get('service_dependencies', {})
+            self.dependencies[host] = dependencies
+            for dependent, antecedents in dependencies.items():
+                for antecedent in antecedents:
+                    self.dependents.setdefault(antecedent, {}).setdefault(
+                        dependent, set()).add(host_id)
+            self._dirty = True
+
+    def remove(self, host):
+        """Drop a host's services from the index, if it has any."""
+        with self.lock:
+            if host not in self.records:
+                return
+            host_id = self.host_ids[host]
+            for name, record in self.records.pop(host).items():
+                self.members[(record['StartMode'], record['State'], name)].discard(host_id)
+            for dependent, antecedents in self.dependencies.pop(host).items():
+                for antecedent in antecedents:
+                    self.dependents[antecedent][dependent].discard(host_id)
+            self._dirty = True
+
+    def add_report_log(self, log_file):
+        """Add every successful services report found in a log file.
+
+        Args:
+            log_file(string): A logs/<capability>_report file or a
+                report_log segment
+
+        Returns:
+            counts(dict): The number of hosts added and the reports
+                skipped for naming no target, which older collectors
+                did not record
+
+        """
+        counts = {'hosts': 0, 'untargeted': 0}
+        for reports in report_log.read_records(log_file):
+            content = reports.get('content', {})
+            if 'services' not in content or reports.get('outcome') != 'Successful':
+                continue
+            # 'host' is the collecting machine, not the one inventoried.
+            if not reports.get('target'):
+                counts['untargeted'] += 1
+                continue
+            self.add(reports['target'], content)
+            counts['hosts'] += 1
+        return counts
+
+    def build(self):
+        """Rebuild the bitmaps, called automatically before the first query."""
+        with self.lock:
+            bitmaps = {}
+            state_bitmaps = {}
+            for (start_mode, state, name), host_ids in self.members.items():
+                if not host_ids:
+                    continue
+                bitmap = _bitmap(host_ids)
+                bitmaps.setdefault((start_mode, state), {})[name] = bitmap
+                state_bitmaps[(start_mode, state)] = \
+                    state_bitmaps.get((start_mode, state), 0) | bitmap
+            self.bitmaps = bitmaps
+            self.state_bitmaps = state_bitmaps
+            self._dirty = False
+
+    def bitmap(self, start_mode=None, state=None, service=None):
+        """Return the hosts matching a StartMode, State and service.
+
+        Args:
+            start_mode(string): Optional, e.g. 'Auto', any when omitted
+            state(string): Optional, e.g. 'Stopped', any when omitted
+            service(string): Optional, a service Name, any when omitted
+
+        Returns:
+            bitmap(int): Bit n is set when hosts[n] matches, combine
+                bitmaps with & and | and negate them with not_ before
+                passing to host_names
+
+        """
+        if self._dirty:
+            self.build()
+        result = 0
+        for (mode, current), names in self.bitmaps.items():
+            if start_mode not in (None, mode) or state not in (None, current):
+                continue
+            if service is None:
+                result |= self.state_bitmaps[(mode, current)]
+            else:
+                result |= names.get(service, 0)
+        return result
+
+    def not_(self, bitmap):
+        """Return the indexed hosts not set in a bitmap.
+
+        A Python int has no width, ~ would give a negative number with
+        every bit above the hosts set, so the complement is masked to
+        the hosts that have services in the index.
+        """
+        with self.lock:
+            present = _bitmap([self.host_ids[host] for host in self.records]) \
+                if self.records else 0
+        return ~bitmap & present
+
+    def host_names(self, bitmap):
+        """Return the names of the hosts set in a bitmap."""
+        return [self.hosts[host_id]
+                for host_id, bit in enumerate(bin(bitmap)[:1:-1]) if bit == '1']
+
+    def hosts_with(self, start_mode=None, state=None, service=None):
+        """Return the names of the hosts matching, see bitmap."""
+        return self.host_names(self.bitmap(start_mode, state, service))
+
+    def services_in(self, start_mode, state):
+        """Return the hosts of every service in a StartMode and State.
+
+        Returns:
+            services(dict): {service Name: [host names]}
+
+        """
+        if self._dirty:
+            self.build()
+        return {name: self.host_names(bitmap)
+                for name, bitmap in self.bitmaps.get((start_mode, state), {}).items()}
+
+    def dependents_of(self, name, host=None, recursive=True):
+        """Return the services that depend on a service.
+
+        Args:
+            name(string): The service Name
+            host(string): Optional, follow one host's graph instead of
+                the union over the fleet
+            recursive(bool): Whether indirect dependents are included
+
+        Returns:
+            dependents(set): The dependent service Names
+
+        """
+        host_id = None if host is None else self.host_ids.get(host, -1)
+        found = set()
+        pending = [name]
+        while pending:
+            for dependent, host_ids in self.dependents.get(pending.pop(), {}).items():
+                if dependent in found or not host_ids:
+                    continue
+                if host_id is not None and host_id not in host_ids:
+                    continue
+                found.add(dependent)
+                if recursive:
+                    pending.append(dependent)
+        return found
+
+    def dependencies_of(self, name, host, recursive=True):
+        """Return the services a service depends on, on one host.
+
+        Args:
+            name(string): The service Name
+            host(string): The name of the host
+            recursive(bool): Whether indirect dependencies are included
+
+        Returns:
+            dependencies(set): The service Names depended upon
+
+        """
+        graph = self.dependencies.get(host, {})
+        found = set()
+        pending = [name]
+        while pending:
+            for antecedent in graph.get(pending.pop(), ()):
+                if antecedent not in found:
+                    found.add(antecedent)
+                    if recursive:
+                        pending.append(antecedent)
+        return found
+
+
+_INDEX = ServiceIndex()
+
+
+def get_index():
+    """Return the process wide index collection adds to."""
+    return _INDEX
+
+
+def index_content(host, content):
+    """Add a host's services to the process wide index, when they were collected."""
+    if 'services' in content:
+        _INDEX.add(host, content)
@@ -0,0 +1,231 @@
+#! /usr/bin/python3
+"""
+Description: Store installed software inventories once per distinct product.
+
+Every product record from win_application_statistics is normalized and
+hashed, the record is written once under its hash and each host keeps a
+manifest of hashes. Fleet level questions go through an inverted index of
+product name to record hashes, sorted by version so a version range is
+two binary searches, and record hash to hosts.
+
+Layout of the store directory:
+    objects     JSON lines of {'hash': ..., 'record': ...}, append only
+    manifests   JSON lines of {'host': ..., 'collected': ...,
+                'software': {key: hash}, 'extras': {key: {...}}},
+                the last manifest of a host wins
+
+Author: Shayne Cardwell
+
+Module: software_store.py
+"""
+import hashlib
+import json
+import os
+from bisect import bisect_left
+from datetime import datetime
+
+import sample.report_log as report_log
+import sample.utility as utility
+
+# Values that differ between otherwise identical installs, kept per host.
+HOST_SPECIFIC_VALUES = ('InstallDate', 'InstallLocation', 'InstallSource', 'LocalPackage')
+
+
+def normalize_record(record):
+    """Split a software_details entry into its shared and host parts.
+
+    Args:
+        record(dict): The registry values of one product
+
+    Returns:
+        shared(dict): The values identical across hosts with the same
+            product, without empty values
+        extras(dict): The host specific values
+
+    """
+    shared = {}
+    extras = {}
+    for name, value in record.items():
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+            if not value:
+                continue
+        if name in HOST_SPECIFIC_VALUES:
+            extras[name] = value
+        else:
+            shared[name] = value
+    return shared, extras
+
+
+def record_hash(record):
+    """Return the content address of a normalized record."""
+    encoded = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+class SoftwareStore(object):
+    """Content addressed store of installed software per host.
+
+    Args:
+        path(string): The directory holding the store, created if missing
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.records = {}
+        self.manifests = {}
+        self.name_index = {}
+        self.version_index = {}
+        self.host_index = {}
+        self._load()
+
+    def _load(self):
+        objects = os.path.join(self.path, 'objects')
+        if os.path.exists(objects):
+            with open(objects) as file_object:
+                for line in file_object:
+                    entry = json.loads(line)
+                    self._add_record(entry['hash'], entry['record'])
+        manifests = os.path.join(self.path, 'manifests')
+        if os.path.exists(manifests):
+            with open(manifests) as file_object:
+                for line in file_object:
+                    self._set_manifest(json.loads(line))
+
+    def _add_record(self, digest, record):
+        self.records[digest] = record
+        name = str(record.get('DisplayName', '')).lower()
+        self.name_index.setdefault(name, set()).add(digest)
+        self.version_index.pop(name, None)
+
+    def _versions(self, name):
+        if name not in self.version_index:
+            entries = sorted((utility.parse_version(self.records[digest].get('DisplayVersion')),
+                              digest) for digest in self.name_index.get(name, ()))
+            self.version_index[name] = ([entry[0] for entry in entries],
+                                        [entry[1] for entry in entries])
+        return self.version_index[name]
+
+    def _set_manifest(self, manifest):
+        host = manifest['host']
+        for digest in self.manifests.get(host, {}).get('software', {}).values():
+            self.host_index.get(digest, set()).discard(host)
+        self.manifests[host] = manifest
+        for digest in manifest['software'].values():
+            self.host_index.setdefault(digest, set()).add(host)
+
+    def ingest(self, inventories):
+        """Store a batch of host inventories with one write per file.
+
+        Args:
+            inventories(iterable): (host, software_details) pairs
+
+        Returns:
+            counts(dict): The number of hosts and new records written
+
+        """
+        collected = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        new_objects = []
+        new_manifests = []
+        for host, software_details in inventories:
+            manifest = {'host': host, 'collected': collected, 'software': {}, 'extras': {}}
+            for key, record in software_details.items():
+                shared, extras = normalize_record(record)
+                digest = record_hash(shared)
+                if digest not in self.records:
+                    self._add_record(digest, shared)
+                    new_objects.append({'hash': digest, 'record': shared})
+                manifest['software'][key] = digest
+                if extras:
+                    manifest['extras'][key] = extras
+            self._set_manifest(manifest)
+            new_manifests.append(manifest)
+
+        for name, entries in (('objects', new_objects), ('manifests', new_manifests)):
+            if entries:
+                with open(os.path.join(self.path, name), 'a') as file_object:
+                    file_object.write(''.join(json.dumps(entry, separators=(',', ':')) + '\n'
+                                              for entry in entries))
+        return {'hosts': len(new_manifests), 'new_records': len(new_objects)}
+
+    def ingest_report_log(self, log_file, batch_size=500):
+        """Store the inventories found in a reporting log file.
+
+        Args:
+            log_file(string): A logs/<capability>_report file or a
+                report_log segment
+            batch_size(int): Hosts written per batch
+
+        Returns:
+            counts(dict): The number of hosts and new records written,
+                and the reports skipped for naming no target, which
+                older collectors did not record
+
+        """
+        totals = {'hosts': 0, 'new_records': 0, 'untargeted': 0}
+        batch = []
+        for reports in report_log.read_records(log_file):
+            details = reports.get('content', {}).get('software_details')
+            if details is None or reports.get('outcome') != 'Successful':
+                continue
+            # 'host' is the collecting machine, not the one inventoried.
+            if not reports.get('target'):
+                totals['untargeted'] += 1
+                continue
+            batch.append((reports['target'], details))
+            if len(batch) >= batch_size:
+                for key, value in self.ingest(batch).items():
+                    totals[key] += value
+                batch = []
+        if batch:
+            for key, value in self.ingest(batch).items():
+                totals[key] += value
+        return totals
+
+    def host_software(self, host):
+        """Return a host's software_details rebuilt from the store."""
+        manifest = self.manifests[host]
+        details = {}
+        for key, digest in manifest['software'].items():
+            details[key] = dict(self.records[digest])
+            details[key].update(manifest['extras'].get(key, {}))
+        return details
+
+    def hosts_with(self, display_name, min_version=None, below_version=None):
+        """Return the hosts with a product, optionally in a version range.
+
+        Args:
+            display_name(string): The DisplayName, case insensitive
+            min_version(string): Optional, lowest version included
+            below_version(string): Optional, first version excluded
+
+        Returns:
+            hosts(set): The names of the matching hosts
+
+        """
+        versions, digests = self._versions(display_name.lower())
+        start = bisect_left(versions, utility.parse_version(min_version)) if min_version else 0
+        end = bisect_left(versions, utility.parse_version(below_version)) \
+            if below_version else len(versions)
+        hosts = set()
+        for digest in digests[start:end]:
+            hosts.update(self.host_index.get(digest, ()))
+        return hosts
+
+    def stats(self):
+        """Return the size of the store against storing every host copy.
+
+        Returns:
+            stats(dict): Record, reference and byte counts
+
+        """
+        references = sum(len(manifest['software']) for manifest in self.manifests.values())
+        stored = sum(os.path.getsize(os.path.join(self.path, name))
+                     for name in ('objects', 'manifests')
+                     if os.path.exists(os.path.join(self.path, name)))
+        return {'hosts': len(self.manifests), 'records': len(self.records),
+                'references': references, 'bytes_on_disk': stored}
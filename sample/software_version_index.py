@@ -0,0 +1,148 @@
+#! /usr/bin/python3
+"""
+Description: Index installed software by product and version across hosts.
+
+Built from win_application_statistics output, the index keeps, per
+DisplayName and Publisher, the (version, host) pairs sorted by the
+parsed version, so version range queries are two binary searches. The
+product names are kept sorted as well for prefix search.
+
+Author: Shayne Cardwell
+
+Module: software_version_index.py
+"""
+from bisect import bisect_left, bisect_right
+
+import sample.report_log as report_log
+import sample.utility as utility
+
+
+class SoftwareVersionIndex(object):
+    """Sorted (version, host) lists per product for range queries."""
+
+    def __init__(self):
+        self.products = {}
+        self.host_products = {}
+        self.names = []
+        self._dirty = False
+
+    def add(self, host, software_details):
+        """Add or replace one host's software_details.
+
+        Args:
+            host(string): The name of the host
+            software_details(dict): The records keyed by product
+
+        """
+        self.remove(host)
+        keys = self.host_products.setdefault(host, set())
+        for key, record in software_details.items():
+            name = (record.get('DisplayName') or key).strip()
+            publisher = (record.get('Publisher') or '').strip()
+            publishers = self.products.setdefault(name.lower(), {})
+            product = publishers.setdefault(publisher.lower(), {
+                'DisplayName': name, 'Publisher': publisher, 'entries': []})
+            version = record.get('DisplayVersion')
+            product['entries'].append((utility.parse_version(version), host, version))
+            keys.add((name.lower(), publisher.lower()))
+        self._dirty = True
+
+    def remove(self, host):
+        """Drop a host's installs from the index, if it has any."""
+        if host not in self.host_products:
+            return
+        for name, publisher in self.host_products.pop(host):
+            publishers = self.products[name]
+            entries = [entry for entry in publishers[publisher]['entries'] if entry[1] != host]
+            if entries:
+                publishers[publisher]['entries'] = entries
+            else:
+                del publishers[publisher]
+                if not publishers:
+                    del self.products[name]
+        self._dirty = True
+
+    def add_report_log(self, log_file):
+        """Add every successful application report found in a log file.
+
+        Args:
+            log_file(string): A logs/<capability>_report file or a
+                report_log segment
+
+        """
+        for reports in report_log.read_records(log_file):
+            details = reports.get('content', {}).get('software_details')
+            # Reports naming no target only say which machine collected them.
+            if details is not None and reports.get('outcome') == 'Successful' and \
+                    reports.get('target'):
+                self.add(reports['target'], details)
+
+    def build(self):
+        """Sort the entries, called automatically before the first query."""
+        for publishers in self.products.values():
+            for product in publishers.values():
+                product['entries'].sort(key=lambda entry: (entry[0], entry[1]))
+                product['versions'] = [entry[0] for entry in product['entries']]
+        self.names = sorted(self.products)
+        self._dirty = False
+
+    def _matching_products(self, display_name, publisher=None):
+        if self._dirty:
+            self.build()
+        publishers = self.products.get(display_name.lower(), {})
+        if publisher is not None:
+            product = publishers.get(publisher.lower())
+            return [product] if product else []
+        return list(publishers.values())
+
+    def hosts_between(self, display_name, min_version=None, max_version=None,
+                      publisher=None, include_max=False):
+        """Return the installs of a product within a version range.
+
+        Args:
+            display_name(string): The DisplayName, case insensitive
+            min_version(string): Optional, lowest version included
+            max_version(string): Optional, upper bound of the range
+            publisher(string): Optional, restrict to one Publisher
+            include_max(bool): Whether max_version itself is included
+
+        Returns:
+            installs(list): (host, DisplayVersion) pairs sorted by version
+
+        """
+        installs = []
+        for product in self._matching_products(display_name, publisher):
+            versions = product['versions']
+            start = 0
+            end = len(versions)
+            if min_version is not None:
+                start = bisect_left(versions, utility.parse_version(min_version))
+            if max_version is not None:
+                bound = bisect_right if include_max else bisect_left
+                end = bound(versions, utility.parse_version(max_version))
+            installs.extend((host, version) for _, host, version in product['entries'][start:end])
+        return installs
+
+    def search_prefix(self, prefix, limit=None):
+        """Return the products whose name starts with prefix.
+
+        Args:
+            prefix(string): The start of the DisplayName, case insensitive
+            limit(int): Optional, the maximum number of names returned
+
+        Returns:
+            products(list): (DisplayName, Publisher, install count) tuples
+
+        """
+        if self._dirty:
+            self.build()
+        prefix = prefix.lower()
+        start = bisect_left(self.names, prefix)
+        end = bisect_left(self.names, prefix + '\uffff')
+        names = self.names[start:end][:limit] if limit else self.names[start:end]
+        products = []
+        for name in names:
+            for product in self.products[name].values():
+                products.append((product['DisplayName'], product['Publisher'],
+                                 len(product['entries'])))
+        return products
@@ -0,0 +1,174 @@
+#! /usr/bin/python3
+"""
+Description: Append only journal of a sweep, so a restart resumes it.
+
+Every host result adds one JSON line giving the collectors that ran,
+the ones that failed with their error, and where the result was
+written. Lines are buffered and written with a single fsync once
+sync_every of them are waiting or sync_interval seconds have passed,
+and before that the result writers are flushed, so a line is never on
+disk ahead of the result it points to. A crash loses at most the
+unsynced lines, whose hosts are collected again.
+
+Reading a journal back folds the lines into the collectors still
+missing per host without touching the results themselves. A torn last
+line from a crash is ignored, and cut off before the journal is
+appended to again so the next line starts on a line of its own.
+
+Author: Shayne Cardwell
+
+Module: sweep_journal.py
+"""
+import json
+import os
+import threading
+import time
+
+DEFAULT_SYNC_EVERY = 256
+DEFAULT_SYNC_INTERVAL = 1.0
+TAIL_CHUNK = 65536
+
+
+def load(path):
+    """Return what a journal records for each host.
+
+    Args:
+        path(string): The journal file
+
+    Returns:
+        hosts(dict): Per host name, 'complete' True once every
+            collector succeeded, and 'failed', the names of the
+            collectors still to retry
+
+    """
+    hosts = {}
+    try:
+        file_object = open(path)
+    except IOError:
+        return hosts
+    with file_object:
+        for line in file_object:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            failed = set(entry['failed'])
+            state = hosts.get(entry['host'])
+            if entry['ran'] is None:
+                hosts[entry['host']] = {'complete': not failed, 'failed': failed}
+            elif state is not None:
+                # A retry of some collectors only counts on top of a full run.
+                state['failed'] = (state['failed'] - set(entry['ran'])) | failed
+                state['complete'] = not state['failed']
+    return hosts
+
+
+def _cut_torn_line(path):
+    """Truncate a journal after its last complete line."""
+    try:
+        file_object = open(path, 'rb+')
+    except IOError:
+        return
+    with file_object:
+        end = file_object.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - TAIL_CHUNK)
+            file_object.seek(start)
+            newline = file_object.read(position - start).rfind(b'\n')
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            file_object.truncate(position)
+
+
+def remaining(hosts, journaled):
+    """Return the work a resumed sweep still has to do.
+
+    Args:
+        hosts(list): The host names of the sweep
+        journaled(dict): As returned by load
+
+    Returns:
+        work(list): (host, collector names) pairs, the names are None
+            for hosts never journaled, which are collected in full
+
+    """
+    work = []
+    for host in hosts:
+        state = journaled.get(host)
+        if state is None:
+            work.append((host, None))
+        elif not state['complete']:
+            work.append((host, sorted(state['failed'])))
+    return work
+
+
+class SweepJournal(object):
+    """Append per host completions of a sweep with batched fsyncs.
+
+    Args:
+        path(string): The journal file, appended to if it exists
+        sync_every(int): Lines buffered before they are synced
+        sync_interval(float): Seconds a line may wait to be synced
+        before_sync(list): Optional, calls made before every sync, e.g.
+            the flush of the writer the results go to
+
+    """
+
+    def __init__(self, path, sync_every=DEFAULT_SYNC_EVERY, sync_interval=DEFAULT_SYNC_INTERVAL,
+                 before_sync=None):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.before_sync = list(before_sync or ())
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.last_sync = time.time()
+        self.syncs = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        _cut_torn_line(path)
+        self.file_object = open(path, 'a')
+
+    def record(self, host, ran, failures, location=None):
+        """Add one host result.
+
+        Args:
+            host(string): The name of the host
+            ran(list): The collector names that ran, None for all
+            failures(dict): The error of every collector that failed
+            location(dict): Optional, where the result was written
+
+        """
+        line = json.dumps({'host': host, 'ran': ran, 'failed': failures,
+                           'location': location, 'time': time.time()})
+        with self.lock:
+            self.buffer.append(line + '\n')
+            if len(self.buffer) >= self.sync_every or \
+                    time.time() - self.last_sync >= self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        """Write and fsync whatever is buffered."""
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        self.last_sync = time.time()
+        if not self.buffer:
+            return
+        for call in self.before_sync:
+            call()
+        self.file_object.write(''.join(self.buffer))
+        self.file_object.flush()
+        os.fsync(self.file_object.fileno())
+        self.buffer = []
+        self.syncs += 1
+
+    def close(self):
+        """Sync and close the journal."""
+        with self.lock:
+            self._sync()
+            self.file_object.close()
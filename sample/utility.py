@@ -7,11 +7,32 @@ Title: utility.py
 Author: Shayne Cardwell
 """
 import ast
-import json
+import inspect
 import os
+import re
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from platform import node
 from traceback import format_exc
 
+import sample.report_log as report_log
+import sample.resilience as resilience
+
+# https://docs.microsoft.com/en-us/windows/win32/wmisdk/swbemservices-execquery
+WBEM_FLAG_RETURN_IMMEDIATELY = 0x10
+WBEM_FLAG_FORWARD_ONLY = 0x20
+# https://docs.microsoft.com/en-us/windows/win32/wmisdk/swbemlocator-connectserver
+WBEM_FLAG_CONNECT_USE_MAX_WAIT = 0x80
+# How connect and exec_query retry transient DCOM and WMI errors.
+RETRY_POLICY = resilience.RetryPolicy()
+DEFAULT_BATCH_SIZE = 100
+# Connections handed out again by connect inside connection_pool, kept per
+# thread as a COM object belongs to the apartment that created it.
+_POOL = threading.local()
+# The report_logs_off blocks open in any thread, reporting writes no log while any is.
+_LOGS_OFF = [0]
+_LOGS_OFF_LOCK = threading.Lock()
 
 def _clean_win32_obj(instance):
     item = instance[instance.find('{') + 1:instance.rfind('}')].replace(';', ',')
@@ -141,10 +162,344 @@ def clean_win32_obj(str_obj):
     return _clean_win32_obj(str_obj)
 
 
+def _format_wql_value(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return str(value)
+    # WQL string literals escape backslashes and quotes with a backslash.
+    return "'{0}'".format(str(value).replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def _compile_wql_condition(condition):
+    if len(condition) == 2:
+        prop, value = condition
+        operator = 'IS' if value is None else '='
+    else:
+        prop, operator, value = condition
+    operator = operator.upper()
+    if operator == 'IN':
+        return '({0})'.format(' OR '.join(
+            '{0} = {1}'.format(prop, _format_wql_value(item)) for item in value))
+    return '{0} {1} {2}'.format(prop, operator, _format_wql_value(value))
+
+
+def build_wql(class_name, filters=None, properties=None):
+    """Return a WQL query for the Win32 class specified.
+
+    This function compiles collector level filter expressions into a
+    WQL WHERE clause so rows are dropped by the WMI provider instead of
+    being parsed and thrown away locally. Filters may be given as a
+    dictionary of property, value pairs or as a list of
+    (property, operator, value) tuples.
+
+    >>> build_wql('Win32_NetworkAdapterConfiguration', {'IPEnabled': True})
+    'SELECT * FROM Win32_NetworkAdapterConfiguration WHERE IPEnabled = TRUE'
+    >>> build_wql('Win32_Service', [('State', '=', 'Running')])
+    "SELECT * FROM Win32_Service WHERE State = 'Running'"
+    >>> build_wql('Win32_LogicalDisk', [('DriveType', 'IN', [2, 3])], ['DeviceID'])
+    'SELECT DeviceID FROM Win32_LogicalDisk WHERE (DriveType = 2 OR DriveType = 3)'
+    >>> build_wql('Win32_NetworkAdapter', [('NetEnabled', 'IS NOT', None)])
+    'SELECT * FROM Win32_NetworkAdapter WHERE NetEnabled IS NOT NULL'
+    >>> print(build_wql('Win32_Service', {'DisplayName': 'Bob\\'s "agent"'}))
+    SELECT * FROM Win32_Service WHERE DisplayName = 'Bob\\'s "agent"'
+
+    The query is complete WQL with its literals escaped, run it through
+    exec_query or iter_query rather than wmi.WMI.query, which escapes
+    backslashes a second time.
+
+    Args:
+        class_name(string): The name of the Win32 class to query
+        filters(dict|list): Optional, filter expressions for the class
+        properties(list): Optional, the properties to select
+
+    Returns:
+        wql(string): The compiled WQL query
+
+    """
+    if isinstance(filters, dict):
+        filters = list(filters.items())
+
+    wql = 'SELECT {0} FROM {1}'.format(', '.join(properties) if properties else '*', class_name)
+    if filters:
+        wql = '{0} WHERE {1}'.format(
+            wql, ' AND '.join(_compile_wql_condition(condition) for condition in filters))
+    return wql
+
+
+def merge_filters(defaults, filters):
+    """Return the class keyed filters with the caller's overrides applied.
+
+    Args:
+        defaults(dict): The collector's default filters keyed by class
+        filters(dict): Optional, caller supplied filters keyed by class
+
+    Returns:
+        merged(dict): The filters to use keyed by class name
+
+    """
+    merged = dict(defaults)
+    merged.update(filters or {})
+    return merged
+
+
+def collector_kwargs(collector, filters):
+    """Return the keyword arguments that hand filters to a collector.
+
+    Collectors without a WQL query, such as the registry walk of
+    win_application_statistics, take no filters and get none.
+
+    Args:
+        collector(function): A collect_win_*_stats function
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name
+
+    Returns:
+        kwargs(dict): {'filters': filters} or an empty dictionary
+
+    """
+    if 'filters' not in inspect.signature(collector).parameters:
+        return {}
+    return {'filters': filters}
+
+
+def _connect(name, namespace):
+    # Imported here so the rest of this module stays usable off Windows.
+    import wmi  # pylint: disable=C0415
+
+    if name == node():
+        return wmi.WMI(namespace=namespace)
+    # Connecting through a moniker can wait on an unreachable host for as
+    # long as DCOM likes, ConnectServer with this flag gives up after at
+    # most two minutes.
+    services = wmi.connect_server(name, namespace, os.environ.get('USER', ''),
+                                  os.environ.get('PASS', ''),
+                                  security_flags=WBEM_FLAG_CONNECT_USE_MAX_WAIT)
+    return wmi.WMI(namespace=namespace, wmi=services)
+
+
+@contextmanager
+def connection_pool():
+    """Reuse the connections connect makes in this thread while in the block.
+
+    Collectors run one after another in the thread then share one
+    connection per host and namespace. Nested blocks share the outer
+    pool, the connections are released when the outer block ends.
+
+    Returns:
+        connections(dict): The pooled connections keyed by (host,
+            namespace)
+
+    """
+    if getattr(_POOL, 'connections', None) is not None:
+        yield _POOL.connections
+        return
+    _POOL.connections = {}
+    try:
+        yield _POOL.connections
+    finally:
+        _POOL.connections = None
+
+
+def connect(name, namespace='root/cimv2'):
+    """Connect to a WMI namespace of a host, retrying transient errors.
+
+    Remote hosts are connected with the USER and PASS environment
+    variables. Retries stop when the budget put in scope by
+    resilience.budget_scope runs out, and the outcome is counted on it
+    so the caller can tell an unreachable host from a failed query.
+    Inside connection_pool an open connection is returned again.
+
+    Args:
+        name(string): The host, node() connects locally
+        namespace(string): Optional, the WMI namespace
+
+    Returns:
+        wmi_obj(WMI): A wmi.WMI connection
+
+    """
+    pool = getattr(_POOL, 'connections', None)
+    if pool is not None and (name, namespace) in pool:
+        return pool[(name, namespace)]
+    budget = resilience.current_budget()
+    try:
+        wmi_obj = resilience.call_with_retry(_connect, (name, namespace), policy=RETRY_POLICY,
+                                             budget=budget)
+    except Exception:
+        if budget is not None:
+            budget.record_connect(False)
+        raise
+    if budget is not None:
+        budget.record_connect(True)
+    if pool is not None:
+        pool[(name, namespace)] = wmi_obj
+    return wmi_obj
+
+
+def exec_query(wmi_obj, wql, flags=WBEM_FLAG_RETURN_IMMEDIATELY | WBEM_FLAG_FORWARD_ONLY):
+    """Start a semisynchronous WQL query and return its enumerator.
+
+    With the default flags the call returns as soon as the provider has
+    accepted the query, so several queries can be started on the same
+    connection and run on the provider side while earlier results are
+    still being read.
+
+    Transient errors starting the query are retried within the budget
+    put in scope by resilience.budget_scope, errors reading the rows are
+    not as part of them may have been used already.
+
+    Args:
+        wmi_obj(WMI): A wmi.WMI connection
+        wql(string): The query, e.g. from build_wql
+        flags(int): The SWbemServices.ExecQuery flags
+
+    Returns:
+        enumerator(SWbemObjectSet): The raw COM result set
+
+    """
+    namespace = wmi_obj._namespace  # pylint: disable=W0212
+    return resilience.call_with_retry(namespace.ExecQuery,
+                                      kwargs={'strQuery': wql, 'iFlags': flags},
+                                      policy=RETRY_POLICY, budget=resilience.current_budget())
+
+
+def iter_results(enumerator, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield the rows of a forward only result set as dictionaries.
+
+    Instances are pulled from the COM enumerator batch_size at a time,
+    parsed and released straight away, so the first row is available
+    as soon as the provider returns it and only one batch of COM objects
+    is alive at any point.
+
+    Args:
+        enumerator(SWbemObjectSet): As returned by exec_query
+        batch_size(int): The number of instances fetched per call
+
+    Returns:
+        rows(generator): A dictionary per instance, see clean_win32_obj
+
+    """
+    # Imported here so the rest of this module stays usable off Windows.
+    import pythoncom  # pylint: disable=C0415
+    from win32com.client import Dispatch  # pylint: disable=C0415
+
+    com_enum = enumerator._oleobj_.InvokeTypes(  # pylint: disable=W0212
+        pythoncom.DISPID_NEWENUM, 0, pythoncom.DISPATCH_METHOD | pythoncom.DISPATCH_PROPERTYGET,
+        (13, 10), ()).QueryInterface(pythoncom.IID_IEnumVARIANT)
+    while True:
+        batch = com_enum.Next(batch_size)
+        if not batch:
+            break
+        rows = [_clean_win32_obj(Dispatch(item).GetObjectText_()) for item in batch]
+        del batch
+        for row in rows:
+            yield row
+
+
+def iter_query(wmi_obj, wql, batch_size=DEFAULT_BATCH_SIZE):
+    """Run a WQL query and yield its rows as they arrive.
+
+    This is the streaming counterpart of wmi_obj.query for large
+    classes such as Win32_Service, Win32_Process or Win32_GroupUser.
+
+    Args:
+        wmi_obj(WMI): A wmi.WMI connection
+        wql(string): The query, e.g. from build_wql
+        batch_size(int): The number of instances fetched per call
+
+    Returns:
+        rows(generator): A dictionary per instance, see clean_win32_obj
+
+    """
+    return iter_results(exec_query(wmi_obj, wql), batch_size)
+
+
+def parse_version(version):
+    """Return a tuple that orders version strings the way people read them.
+
+    Numeric parts compare as numbers and trailing zero parts are
+    ignored, so DisplayVersion values from the registry can be compared
+    and sorted directly.
+
+    >>> parse_version('16.0.4266.1001') < parse_version('16.0.10827.20118')
+    True
+    >>> parse_version('14.28.29913.0') == parse_version('14.28.29913')
+    True
+    >>> parse_version(None)
+    ()
+
+    Args:
+        version(string): The version string, may be None
+
+    Returns:
+        version_key(tuple): A comparable key for the version
+
+    """
+    if not version:
+        return ()
+    parts = [(1, int(part)) if part.isdigit() else (0, part.lower())
+             for part in re.findall(r'\d+|[A-Za-z]+', str(version))]
+    while parts and parts[-1] == (1, 0):
+        parts.pop()
+    return tuple(parts)
+
+
+def parse_wmi_reference(path):
+    """Return the class and keys of a WMI object path.
+
+    Association classes such as Win32_DependentService or
+    Win32_GroupUser return the objects they link as object paths.
+
+    >>> parse_wmi_reference('\\\\\\\\PC\\\\root\\\\cimv2:Win32_Service.Name="RpcSs"')
+    ('Win32_Service', {'Name': 'RpcSs'})
+    >>> parse_wmi_reference('Win32_Group.Domain="PC",Name="Users, local"')
+    ('Win32_Group', {'Domain': 'PC', 'Name': 'Users, local'})
+    >>> parse_wmi_reference('Win32_LogicalDisk.DeviceID="C:"')
+    ('Win32_LogicalDisk', {'DeviceID': 'C:'})
+    >>> _, keys = parse_wmi_reference(r'Win32_DiskDrive.DeviceID="\\\\\\\\.\\\\PHYSICALDRIVE0"')
+    >>> print(keys['DeviceID'])
+    \\\\.\\PHYSICALDRIVE0
+
+    Args:
+        path(string): The object path
+
+    Returns:
+        class_name(string): The class of the referenced object
+        keys(dict): The key properties of the referenced object
+
+    """
+    relative = path[path.split('"', 1)[0].rfind(':') + 1:]
+    class_name, _, keys = relative.partition('.')
+    return class_name, {
+        name: re.sub(r'\\(.)', r'\1', value[1:-1]) if value.startswith('"') else value
+        for name, value in re.findall(r'(\w+)=("(?:[^"\\]|\\.)*"|[^,]*)', keys)}
+
+
+@contextmanager
+def report_logs_off():
+    """Stop reporting writing report logs while in the block.
+
+    This holds for every thread, as the collectors of a host run in
+    threads of their own, until the last open block ends.
+
+    """
+    with _LOGS_OFF_LOCK:
+        _LOGS_OFF[0] += 1
+    try:
+        yield
+    finally:
+        with _LOGS_OFF_LOCK:
+            _LOGS_OFF[0] -= 1
+
+
 def reporting(reports):
     """Report duties performed.
 
-    This function is used to finalize information
+    This function is used to finalize information. The report is
+    written to the capability's compressed, rotating log before this
+    returns, see report_log, unless inside report_logs_off.
 
     Args:
         reports(dict): Reporting key, value object used to store basic
@@ -156,18 +511,18 @@ def reporting(reports):
 
     """
     os.chdir(reports['project_dir'])
-    os.makedirs(reports['log_path'], exist_ok=True)
     reports['end_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     reports['return_body']['outcome'] = reports['outcome']
     reports['return_body']['messages'] = reports['messages']
     reports['return_body']['content'] = reports['content']
+    if _LOGS_OFF[0]:
+        return reports['return_body']
 
+    os.makedirs(reports['log_path'], exist_ok=True)
     try:
-        with open('{0}/{1}_report'.format(reports['log_path'], reports['capability_name']),
-                  'a') as file_object:
-            json.dump(reports, file_object)
-            file_object.write('\n')
-    except IOError as error:
+        report_log.get_writer(reports['log_path'], reports['capability_name']).write(
+            reports, reports.get('target', reports['host']))
+    except (IOError, ValueError) as error:
         reports['return_body']['messages'].append('Error with logging procedure')
         reports['return_body']['exception'] = format_exc()
         reports['return_body']['messages'].append(str(error))
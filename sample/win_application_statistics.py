@@ -14,10 +14,10 @@ import os
 import sys
 from datetime import datetime
 from platform import node
+from urllib.parse import quote
 
 try:
     import pythoncom
-    import wmi
     import sample.utility as utility
 except ModuleNotFoundError:
     print('Had trouble finding packages000')
@@ -25,6 +25,23 @@ except ModuleNotFoundError:
     print('pipenv install')
     sys.exit(1)
 
+# https://msdn.microsoft.com/en-us/library/windows/desktop/aa384911(v=vs.85).aspx
+HKEY = {
+    'HKEY_CLASSES_ROOT':   2147483648,
+    'HKEY_CURRENT_USER':   2147483649,
+    'HKEY_LOCAL_MACHINE':  2147483650,
+    'HKEY_USERS':          2147483651,
+    'HKEY_CURRENT_CONFIG': 2147483653
+}
+
+REG_PATHS = [r'SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall',
+             r'SOFTWARE\Wow6432Node\Microsoft\Windows\CurrentVersion\Uninstall']
+
+# Values read for every key on an incremental run to tell if it changed.
+FINGERPRINT_VALUES = ('DisplayVersion', 'InstallDate')
+
+STATE_PATH = 'logs/application_state'
+
 
 def _get_secrets(reports):
     try:
@@ -36,83 +53,128 @@ def _get_secrets(reports):
 
 
 def _get_wmi_obj(name):
-    if name == node():
-        return wmi.WMI()
-
-    credentials = {
-        'user_name': os.environ.get('USER', ''),
-        'password':  os.environ.get('PASS', '')
-    }
-    return wmi.WMI(name, user=credentials['user_name'], password=credentials['password'])
+    return utility.connect(name)
 
 
 def _get_reg_obj(name):
-    if name == node():
-        return wmi.WMI(name, namespace='root/default').StdRegProv
+    return utility.connect(name, 'root/default').StdRegProv
 
-    credentials = {
-        'user_name': os.environ.get('USER', ''),
-        'password':  os.environ.get('PASS', '')
-    }
-    return wmi.WMI(name, namespace='root/default', user=credentials['user_name'],
-                   password=credentials['password']).StdRegProv
+
+def _read_key(wmi_reg_obj, reg_path, item, value_path, values):
+    if not values:
+        return item, {'reg_path': r'HKLM\{0}'.format(reg_path)}
+    name = item
+    if 'DisplayName' in values:
+        name = wmi_reg_obj.GetStringValue(hDefKey=HKEY['HKEY_LOCAL_MACHINE'],
+                                          sSubKeyName=value_path, sValueName='DisplayName')[1]
+    record = {'reg_path': r'HKLM\{0}'.format(value_path)}
+    for val in values:
+        result = wmi_reg_obj.GetStringValue(hDefKey=HKEY['HKEY_LOCAL_MACHINE'],
+                                            sSubKeyName=value_path, sValueName=val)
+        record[val] = result[1]
+    return name, record
+
+
+def _fingerprint(wmi_reg_obj, value_path, values):
+    fingerprint = [sorted(values)]
+    for val in FINGERPRINT_VALUES:
+        if val in values:
+            fingerprint.append(wmi_reg_obj.GetStringValue(hDefKey=HKEY['HKEY_LOCAL_MACHINE'],
+                                                          sSubKeyName=value_path,
+                                                          sValueName=val)[1])
+        else:
+            fingerprint.append(None)
+    return fingerprint
+
+
+def _state_file(state_path, host):
+    return os.path.join(state_path, '{0}.json'.format(quote(host, safe='')))
+
+
+def _load_state(state_path, host):
+    try:
+        with open(_state_file(state_path, host)) as file_obj:
+            return json.loads(file_obj.read())
+    except (IOError, ValueError):
+        return {'keys': {}}
+
+
+def _save_state(state_path, host, state):
+    os.makedirs(state_path, exist_ok=True)
+    path = _state_file(state_path, host)
+    with open(path + '.tmp', 'w') as file_obj:
+        file_obj.write(json.dumps(state))
+    os.replace(path + '.tmp', path)
 
 
 def _run_process(reports, host):
-    # https://msdn.microsoft.com/en-us/library/windows/desktop/aa384911(v=vs.85).aspx
-    hkey = {
-        'HKEY_CLASSES_ROOT':   2147483648,
-        'HKEY_CURRENT_USER':   2147483649,
-        'HKEY_LOCAL_MACHINE':  2147483650,
-        'HKEY_USERS':          2147483651,
-        'HKEY_CURRENT_CONFIG': 2147483653
-    }
     reg = {}
+    reg_paths = list(REG_PATHS)
+    wmi_reg_obj = _get_reg_obj(host)
+
+    for reg_path in reg_paths:
+        first_layer = wmi_reg_obj.EnumKey(hDefKey=HKEY['HKEY_LOCAL_MACHINE'],
+                                          sSubKeyName=reg_path)[1]
+        for item in first_layer or ():
+            value_path = r'{0}\{1}'.format(reg_path, item)
+            reg_paths.append(value_path)
+            values = wmi_reg_obj.EnumValues(hDefKey=HKEY['HKEY_LOCAL_MACHINE'],
+                                            sSubKeyName=value_path)[1]
+            name, record = _read_key(wmi_reg_obj, reg_path, item, value_path, values)
+            reg[name] = record
+    reports['content']['software_list'] = sorted(reg.keys())
+    reports['content']['software_details'] = reg
+
 
-    reg_paths = [r'SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall',
-                 r'SOFTWARE\Wow6432Node\Microsoft\Windows\CurrentVersion\Uninstall']
+def _run_incremental(reports, host, state_path):
+    # Keys whose value names and FINGERPRINT_VALUES are unchanged since the
+    # last run keep their stored record, only new or changed keys are read
+    # in full. Subkeys are enumerated every run, a key's values say
+    # nothing about keys added or deleted below it.
+    reg = {}
+    previous = _load_state(state_path, host)['keys']
+    current = {}
+    reg_paths = list(REG_PATHS)
     wmi_reg_obj = _get_reg_obj(host)
 
     for reg_path in reg_paths:
-        first_layer = wmi_reg_obj.EnumKey(hDefKey=hkey['HKEY_LOCAL_MACHINE'],
+        first_layer = wmi_reg_obj.EnumKey(hDefKey=HKEY['HKEY_LOCAL_MACHINE'],
                                           sSubKeyName=reg_path)[1]
-        for item in first_layer:
+        for item in first_layer or ():
             value_path = r'{0}\{1}'.format(reg_path, item)
             reg_paths.append(value_path)
-            second_layer = wmi_reg_obj.EnumValues(hDefKey=hkey['HKEY_LOCAL_MACHINE'],
-                                                  sSubKeyName=value_path)
-            values = second_layer[1]
-            if values:
-                if 'DisplayName' in values:
-                    display_name = wmi_reg_obj.GetStringValue(hDefKey=hkey['HKEY_LOCAL_MACHINE'],
-                                                              sSubKeyName=value_path,
-                                                              sValueName='DisplayName')[1]
-                    reg[display_name] = {}
-                    for val in values:
-                        reg[display_name]['reg_path'] = r'HKLM\{0}'.format(value_path)
-                        result = wmi_reg_obj.GetStringValue(hDefKey=hkey['HKEY_LOCAL_MACHINE'],
-                                                            sSubKeyName=value_path, sValueName=val)
-                        reg[display_name][val] = result[1]
-                else:
-                    reg[item] = {}
-                    for val in values:
-                        reg[item]['reg_path'] = r'HKLM\{0}'.format(value_path)
-                        result = wmi_reg_obj.GetStringValue(hDefKey=hkey['HKEY_LOCAL_MACHINE'],
-                                                            sSubKeyName=value_path, sValueName=val)
-                        reg[item][val] = result[1]
+            values = wmi_reg_obj.EnumValues(hDefKey=HKEY['HKEY_LOCAL_MACHINE'],
+                                            sSubKeyName=value_path)[1] or ()
+            fingerprint = _fingerprint(wmi_reg_obj, value_path, values)
+            known = previous.get(value_path)
+            if known and known['fingerprint'] == fingerprint:
+                entry = known
             else:
-                reg[item] = {}
-                reg[item]['reg_path'] = r'HKLM\{0}'.format(reg_path)
-                continue
+                name, record = _read_key(wmi_reg_obj, reg_path, item, value_path, values)
+                entry = {'fingerprint': fingerprint, 'name': name, 'record': record}
+            current[value_path] = entry
+            reg[entry['name']] = entry['record']
+
+    removed = {previous[path]['name'] for path in previous if path not in current}
+    _save_state(state_path, host, {'keys': current})
     reports['content']['software_list'] = sorted(reg.keys())
     reports['content']['software_details'] = reg
+    reports['content']['software_removed'] = sorted(removed - set(reg))
 
 
-def collect_win_application_stats(host=node(), is_threaded=0, queue=None):
+def collect_win_application_stats(host=node(), is_threaded=0, queue=None, incremental=False,
+                                  state_path=STATE_PATH):
     """Create business logic of the module.
 
     This module orchestrates the business logic for this module.
 
+    Args:
+        incremental(bool): Optional, reuse the keys read on the last
+            incremental run when their fingerprint is unchanged, and
+            list the products gone since in software_removed
+        state_path(string): Optional, where the per host key listing
+            and fingerprints of incremental runs are kept
+
     Returns:
         return_body(dict): A key, value object that contains the
             response that is sent to the requester
@@ -124,6 +186,7 @@ def collect_win_application_stats(host=node(), is_threaded=0, queue=None):
         'capability_name': str(os.path.basename(__file__)[:-3]),
         'version':         '0',
         'host':            node(),
+        'target':          host,
         'project_dir':     os.getcwd(),
         'log_path':        'logs',
         'outcome':         'Failed',
@@ -133,14 +196,21 @@ def collect_win_application_stats(host=node(), is_threaded=0, queue=None):
     if is_threaded:
         pythoncom.CoInitialize()  # pylint: disable=E1101
         try:
-            _run_process(reports, host)
+            if incremental:
+                _run_incremental(reports, host, state_path)
+            else:
+                _run_process(reports, host)
             reports['outcome'] = 'Successful'
-            queue.put(utility.reporting(reports)['content'])
-            return utility.reporting(reports)
+            return_body = utility.reporting(reports)
+            queue.put(return_body['content'])
+            return return_body
         finally:
             pythoncom.CoUninitialize()  # pylint: disable=E1101
     else:
-        _run_process(reports, host)
+        if incremental:
+            _run_incremental(reports, host, state_path)
+        else:
+            _run_process(reports, host)
         reports['outcome'] = 'Successful'
         return utility.reporting(reports)
 
@@ -16,7 +16,6 @@ from platform import node
 
 try:
     import pythoncom
-    import wmi
     import sample.utility as utility
 except ModuleNotFoundError:
     print('Had trouble finding packages')
@@ -26,31 +25,29 @@ except ModuleNotFoundError:
 
 
 def _get_wmi_obj(name):
-    if name == node():
-        return wmi.WMI()
-
-    credentials = {
-        'user_name': os.environ.get('USER', ''),
-        'password':  os.environ.get('PASS', '')
-    }
-    return wmi.WMI(name, user=credentials['user_name'], password=credentials['password'])
+    return utility.connect(name)
 
 
-def _run_process(reports, host):
+def _run_process(reports, host, filters):
     wmi_obj = _get_wmi_obj(host)
+    filters = filters or {}
 
     temp_dict = {}
-    for item in wmi_obj.Win32_BIOS():
-        temp_item = utility.clean_win32_obj(str(item))
+    wql = utility.build_wql('Win32_BIOS', filters.get('Win32_BIOS'))
+    for temp_item in utility.iter_query(wmi_obj, wql):
         temp_dict[temp_item['Caption']] = temp_item
     reports['content']['bios_information'] = temp_dict
 
 
-def collect_win_bios_stats(host=node(), is_threaded=0, queue=None):
+def collect_win_bios_stats(host=node(), is_threaded=0, queue=None, filters=None):
     """Create business logic of the module.
 
     This module orchestrates the business logic for this module
 
+    Args:
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, see utility.build_wql
+
     Returns:
         return_body(dict): A key, value object that contains the
             response that is sent to the requester
@@ -62,6 +59,7 @@ def collect_win_bios_stats(host=node(), is_threaded=0, queue=None):
         'capability_name': str(os.path.basename(__file__)[:-3]),
         'version':         '0',
         'host':            node(),
+        'target':          host,
         'project_dir':     os.getcwd(),
         'log_path':        'logs',
         'outcome':         'Failed',
@@ -71,14 +69,15 @@ def collect_win_bios_stats(host=node(), is_threaded=0, queue=None):
     if is_threaded:
         pythoncom.CoInitialize()  # pylint: disable=E1101
         try:
-            _run_process(reports, host)
+            _run_process(reports, host, filters)
             reports['outcome'] = 'Successful'
-            queue.put(utility.reporting(reports)['content'])
-            return utility.reporting(reports)
+            return_body = utility.reporting(reports)
+            queue.put(return_body['content'])
+            return return_body
         finally:
             pythoncom.CoUninitialize()  # pylint: disable=E1101
     else:
-        _run_process(reports, host)
+        _run_process(reports, host, filters)
         reports['outcome'] = 'Successful'
         return utility.reporting(reports)
 
@@ -0,0 +1,541 @@
+#! /usr/bin/python
+"""
+Description: run the collectors on the host itself and serve the results.
+
+The agent keeps a warm cache of every collector's content, refreshed in
+the background, and answers requests over the wire_protocol framing.
+Each cached section's version is the digest of its content, so a client
+only receives the sections that changed since the versions it already
+holds, across agent restarts too. Requests carry an id and may be
+pipelined, responses come back in request order.
+
+The agent listens on loopback unless told otherwise and every
+connection has to answer a challenge with an HMAC of the shared secret
+before anything else is served. COM and the collectors are only loaded
+once a refresh runs, so the agent can be exercised off Windows with any
+collectors.
+
+Usage:
+    AGENT_SECRET=... win_collector_agent.py --bind 0.0.0.0 --port 47810
+
+Author: Shayne Cardwell
+
+Module: win_collector_agent.py
+"""
+from __future__ import print_function
+
+import argparse
+import contextlib
+import hashlib
+import hmac
+import importlib
+import json
+import logging
+import os
+import selectors
+import socket
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime
+from multiprocessing.dummy import Pool
+from platform import node
+
+import sample.utility as utility
+import sample.wire_protocol as wire_protocol
+
+DEFAULT_BIND = '127.0.0.1'
+DEFAULT_PORT = 47810
+DEFAULT_REFRESH_INTERVAL = 300
+SECRET_VARIABLE = 'AGENT_SECRET'
+
+# section name: (module, collector function), imported on first use
+COLLECTORS = {
+    'win_application_statistics':     ('win_application_statistics',
+                                       'collect_win_application_stats'),
+    'win_bios_statistics':            ('win_bios_statistics', 'collect_win_bios_stats'),
+    'win_drive_statistics':           ('win_drive_statistics', 'collect_win_disk_stats'),
+    'win_local_accounts_statistics':  ('win_local_accounts_statistics',
+                                       'collect_win_local_account_stats'),
+    'win_local_groups_statistics':    ('win_local_groups_statistics',
+                                       'collect_win_local_group_stats'),
+    'win_memory_statistics':          ('win_memory_statistics', 'collect_win_mem_stats'),
+    'win_network_statistics':         ('win_network_statistics', 'collect_win_network_stats'),
+    'win_os_statistics':              ('win_os_statistics', 'collect_os_stats'),
+    'win_processes_statistics':       ('win_processes_statistics',
+                                       'collect_win_processes_stats'),
+    'win_processor_statistics':       ('win_processor_statistics', 'collect_win_cpu_stats'),
+    'win_services_statistics':        ('win_services_statistics', 'collect_win_services_stats')
+}
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AuthenticationError(Exception):
+    """Raised when an agent rejects the shared secret."""
+
+
+def load_collectors(names=None):
+    """Import the collector functions of the named sections.
+
+    Args:
+        names(list): Optional, section names of COLLECTORS, all of them
+            by default
+
+    Returns:
+        collectors(dict): Collector functions keyed by section name
+
+    """
+    collectors = {}
+    for name in names or COLLECTORS:
+        module, function = COLLECTORS[name]
+        collectors[name] = getattr(importlib.import_module('sample.' + module), function)
+    return collectors
+
+
+@contextlib.contextmanager
+def _com_apartment():
+    try:
+        import pythoncom  # pylint: disable=C0415
+    except ModuleNotFoundError:
+        # No COM off Windows, collectors that need it fail on their own.
+        yield
+        return
+    pythoncom.CoInitialize()  # pylint: disable=E1101
+    try:
+        yield
+    finally:
+        pythoncom.CoUninitialize()  # pylint: disable=E1101
+
+
+def answer(secret, nonce):
+    """Return the response to an agent's challenge.
+
+    Args:
+        secret(string): The shared secret
+        nonce(string): The challenge sent by the agent
+
+    Returns:
+        digest(string): The hex HMAC-SHA256 of the nonce
+
+    """
+    return hmac.new(secret.encode('utf-8'), nonce.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+class CollectorCache(object):
+    """Hold the latest content of every collector with a version each.
+
+    Args:
+        collectors(dict): Optional, collector functions keyed by section
+            name, by default every collector of COLLECTORS
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, passed to every collector taking filters
+
+    """
+
+    def __init__(self, collectors=None, filters=None):
+        self.collectors = collectors
+        self.filters = filters
+        self.sections = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.refreshed = None
+
+    def refresh(self):
+        """Run every collector and record the sections that changed.
+
+        Concurrent calls run one refresh at a time. A collector that
+        fails keeps its last content and its error is kept in errors.
+
+        Returns:
+            changed(list): The names of the sections that changed
+
+        """
+        with self.refresh_lock, _com_apartment():
+            if self.collectors is None:
+                self.collectors = load_collectors()
+            changed = []
+            for name, collector in self.collectors.items():
+                try:
+                    content = collector(node(), **utility.collector_kwargs(
+                        collector, self.filters))['content']
+                except Exception as error:  # pylint: disable=W0703
+                    LOGGER.warning('%s failed: %s', name, error)
+                    with self.lock:
+                        self.errors[name] = '{0}: {1}'.format(type(error).__name__, error)
+                    continue
+                digest = hashlib.sha1(json.dumps(content, sort_keys=True,
+                                                 default=str).encode('utf-8')).hexdigest()
+                with self.lock:
+                    self.errors.pop(name, None)
+                    if self.sections.get(name, (None, None))[0] != digest:
+                        self.sections[name] = (digest, content)
+                        changed.append(name)
+            self.refreshed = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            return changed
+
+    def delta(self, since=None, sections=None):
+        """Return the sections newer than the versions the caller holds.
+
+        Args:
+            since(dict): Optional, section versions the caller holds
+            sections(list): Optional, restrict the reply to these names
+
+        Returns:
+            reply(dict): The current versions, the changed sections, the
+                names of the sections the caller already has and the
+                errors of the collectors whose last run failed
+
+        """
+        since = since or {}
+        reply = {'versions': {}, 'sections': {}, 'unchanged': [],
+                 'host': node(), 'refreshed': self.refreshed}
+        with self.lock:
+            reply['errors'] = {name: error for name, error in self.errors.items()
+                               if not sections or name in sections}
+            for name, (version, content) in self.sections.items():
+                if sections and name not in sections:
+                    continue
+                reply['versions'][name] = version
+                if since.get(name) == version:
+                    reply['unchanged'].append(name)
+                else:
+                    reply['sections'][name] = content
+        return reply
+
+
+class _AgentHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        buffer = bytearray()
+        nonce = os.urandom(16).hex()
+        self.request.sendall(wire_protocol.encode_frame({'op': 'hello', 'nonce': nonce}))
+        try:
+            request = wire_protocol.read_frame(self.request, buffer)
+        except wire_protocol.ProtocolError:
+            return
+        if request is None:
+            return
+        if not isinstance(request, dict) or not hmac.compare_digest(
+                str(request.get('auth', '')), answer(self.server.secret, nonce)):
+            LOGGER.warning('Rejected %s, bad shared secret', self.client_address[0])
+            self.request.sendall(wire_protocol.encode_frame(
+                {'id': None, 'op': 'auth', 'error': 'Authentication failed'}))
+            return
+        self.request.sendall(wire_protocol.encode_frame({'id': request.get('id'), 'op': 'auth'}))
+        while True:
+            try:
+                request = wire_protocol.read_frame(self.request, buffer)
+            except wire_protocol.ProtocolError as error:
+                LOGGER.warning('Dropped %s: %s', self.client_address[0], error)
+                return
+            if request is None:
+                return
+            response = self.server.dispatch(request)
+            try:
+                frame = wire_protocol.encode_frame(response, self.server.compress_threshold)
+            except wire_protocol.ProtocolError as error:
+                frame = wire_protocol.encode_frame({'id': response['id'], 'op': response['op'],
+                                                    'error': str(error)})
+            self.request.sendall(frame)
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Serve a CollectorCache over the wire protocol.
+
+    Args:
+        address(tuple): The (host, port) to listen on
+        cache(CollectorCache): The cache answering requests
+        secret(string): The shared secret clients must prove they hold
+        refresh_interval(int): Seconds between background refreshes,
+            0 disables the refresh thread
+        compress_threshold(int): Optional, see wire_protocol.encode_frame
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cache, secret, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 compress_threshold=wire_protocol.COMPRESS_THRESHOLD):
+        if not secret:
+            raise ValueError('The agent needs a shared secret')
+        socketserver.TCPServer.__init__(self, address, _AgentHandler)
+        self.cache = cache
+        self.secret = secret
+        self.refresh_interval = refresh_interval
+        self.compress_threshold = compress_threshold
+        self.stopping = threading.Event()
+        self.refresher = None
+
+    def dispatch(self, request):
+        """Return the response to a single decoded request.
+
+        Args:
+            request(dict): {'id': int, 'op': 'get'|'refresh'|'ping',
+                'since': dict, 'sections': list}
+
+        Returns:
+            response(dict): The reply tagged with the request id
+
+        """
+        operation = request.get('op', 'get')
+        response = {'id': request.get('id'), 'op': operation}
+        if operation == 'ping':
+            response['refreshed'] = self.cache.refreshed
+        elif operation in ('get', 'refresh'):
+            if operation == 'refresh':
+                self.cache.refresh()
+            response.update(self.cache.delta(request.get('since'), request.get('sections')))
+        else:
+            response['error'] = 'Unknown operation {0}'.format(operation)
+        return response
+
+    def _refresh_loop(self):
+        while not self.stopping.is_set():
+            self.cache.refresh()
+            self.stopping.wait(self.refresh_interval)
+
+    def start_refresher(self):
+        """Start the background thread keeping the cache warm."""
+        if self.refresh_interval and self.refresher is None:
+            self.refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+            self.refresher.start()
+
+    def server_close(self):
+        self.stopping.set()
+        socketserver.TCPServer.server_close(self)
+
+
+class AgentClient(object):
+    """Talk to a single agent, tracking the section versions held.
+
+    Args:
+        host(string): The name or address of the agent
+        secret(string): The shared secret of the agent
+        port(int): The agent's port
+        timeout(float): Socket timeout in seconds
+
+    """
+
+    def __init__(self, host, secret, port=DEFAULT_PORT, timeout=30):
+        self.host = host
+        self.secret = secret
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = bytearray()
+        self.next_id = 0
+        self.pending = []
+        self.versions = {}
+        self.content = {}
+
+    def connect(self):
+        """Open and authenticate the connection if it is not open yet."""
+        if self.sock is not None:
+            return
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            hello = wire_protocol.read_frame(self.sock, self.buffer)
+            if not isinstance(hello, dict) or hello.get('op') != 'hello':
+                raise wire_protocol.ProtocolError('Agent {0} sent no challenge'.format(self.host))
+            self.sock.sendall(wire_protocol.encode_frame(
+                {'id': 0, 'op': 'auth', 'auth': answer(self.secret, hello['nonce'])}))
+            reply = wire_protocol.read_frame(self.sock, self.buffer)
+            if reply is None or reply.get('error'):
+                raise AuthenticationError('Agent {0} rejected the shared secret'.format(
+                    self.host))
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        """Close the connection."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self.buffer = bytearray()
+            self.pending = []
+
+    def request_frame(self, operation='get', sections=None):
+        """Return the frame for a request and remember it as pending.
+
+        Args:
+            operation(string): 'get', 'refresh' or 'ping'
+            sections(list): Optional, restrict the reply to these names
+
+        Returns:
+            frame(bytes): The encoded request
+
+        """
+        self.next_id += 1
+        self.pending.append(self.next_id)
+        request = {'id': self.next_id, 'op': operation, 'since': dict(self.versions)}
+        if sections:
+            request['sections'] = list(sections)
+        return wire_protocol.encode_frame(request)
+
+    def apply(self, response):
+        """Merge a delta response into the content held for the agent.
+
+        Args:
+            response(dict): A decoded response from the agent
+
+        Returns:
+            content(dict): The full, merged content of the agent
+
+        """
+        if response.get('id') in self.pending:
+            self.pending.remove(response['id'])
+        for name, content in response.get('sections', {}).items():
+            self.content[name] = content
+            self.versions[name] = response['versions'][name]
+        return self.content
+
+    def send(self, operation='get', sections=None):
+        """Pipeline a request without waiting for its response.
+
+        Returns:
+            request_id(int): The id the response will carry
+
+        """
+        self.connect()
+        self.sock.sendall(self.request_frame(operation, sections))
+        return self.next_id
+
+    def receive(self):
+        """Block for the next response and merge it.
+
+        Returns:
+            response(dict): The decoded response
+
+        """
+        response = wire_protocol.read_frame(self.sock, self.buffer)
+        if response is None:
+            self.close()
+            raise ConnectionError('Agent {0} closed the connection'.format(self.host))
+        self.apply(response)
+        return response
+
+    def get(self, sections=None):
+        """Return the agent's full content, fetching only the deltas.
+
+        Returns:
+            content(dict): The merged content keyed by section name
+
+        """
+        self.send('get', sections)
+        self.receive()
+        return self.content
+
+
+def _connect(client):
+    try:
+        client.connect()
+        return client, None
+    except (OSError, wire_protocol.ProtocolError, AuthenticationError) as error:
+        return client, str(error) or type(error).__name__
+
+
+def poll_agents(clients, operation='get', timeout=60, connect_workers=64):
+    """Request every agent at once and gather the responses.
+
+    Connections are opened and authenticated in parallel, the requests
+    are written to all agents before any response is read, and the
+    replies are read as they arrive on a selector, so the total time is
+    bound by the slowest agent rather than the sum of them.
+
+    Args:
+        clients(list): AgentClient objects, one per agent
+        operation(string): The operation to request from every agent
+        timeout(float): Seconds to wait for all the responses
+        connect_workers(int): Connections opened at once
+
+    Returns:
+        results(dict): {'content': {host: content},
+            'failed': {host: message}}
+
+    """
+    selector = selectors.DefaultSelector()
+    results = {'content': {}, 'failed': {}}
+    pool = Pool(max(1, min(connect_workers, len(clients))))
+    try:
+        connected = pool.map(_connect, clients)
+    finally:
+        pool.close()
+    for client, error in connected:
+        if error is not None:
+            results['failed'][client.host] = error
+            continue
+        try:
+            client.sock.sendall(client.request_frame(operation))
+            client.sock.setblocking(False)
+            selector.register(client.sock, selectors.EVENT_READ, client)
+        except OSError as error:
+            client.close()
+            results['failed'][client.host] = str(error)
+
+    deadline = time.monotonic() + timeout
+    while selector.get_map():
+        remaining = deadline - time.monotonic()
+        events = selector.select(remaining) if remaining > 0 else []
+        if not events:
+            break
+        for key, _ in events:
+            client = key.data
+            try:
+                chunk = client.sock.recv(65536)
+                if not chunk:
+                    raise ConnectionError('Agent closed the connection')
+                client.buffer += chunk
+                for response in wire_protocol.decode_frames(client.buffer):
+                    client.apply(response)
+            except (OSError, wire_protocol.ProtocolError) as error:
+                selector.unregister(client.sock)
+                client.close()
+                results['failed'][client.host] = str(error)
+                continue
+            if not client.pending:
+                selector.unregister(client.sock)
+                # setblocking(False) dropped the timeout, put it back.
+                client.sock.settimeout(client.timeout)
+                results['content'][client.host] = client.content
+
+    for key in list(selector.get_map().values()):
+        selector.unregister(key.fileobj)
+        key.data.close()
+        results['failed'][key.data.host] = 'Timed out'
+    selector.close()
+    return results
+
+
+def main():
+    """Run the agent until interrupted."""
+    parser = argparse.ArgumentParser(description='Serve collector results from this host.')
+    parser.add_argument('--bind', default=DEFAULT_BIND)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--interval', type=int, default=DEFAULT_REFRESH_INTERVAL,
+                        help='seconds between collector refreshes')
+    args = parser.parse_args()
+
+    secret = os.environ.get(SECRET_VARIABLE, '')
+    if not secret:
+        print('Set the shared secret in the {0} environment variable'.format(SECRET_VARIABLE))
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    server = AgentServer((args.bind, args.port), CollectorCache(), secret, args.interval)
+    server.start_refresher()
+    print('Serving collector results on {0}:{1}'.format(args.bind, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
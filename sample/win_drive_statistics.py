@@ -2,6 +2,11 @@
 """
 Description: collect drive information.
 
+Physical drives, partitions and logical disks are joined into
+disk_topology from the Win32_DiskDriveToDiskPartition and
+Win32_LogicalDiskToPartition associations, one query each, instead of
+an associators() call per object.
+
 Author: Shayne Cardwell
 
 Date: August 16, 2016
@@ -10,13 +15,13 @@ Module: win_drive_statistics.py
 """
 import json
 import os
+import re
 import sys
 from datetime import datetime
 from platform import node
 
 try:
     import pythoncom
-    import wmi
     import sample.utility as utility
 except ModuleNotFoundError:
     print('Had trouble finding packages')
@@ -26,42 +31,127 @@ except ModuleNotFoundError:
 
 
 def _get_wmi_obj(name):
-    if name == node():
-        return wmi.WMI()
+    return utility.connect(name)
 
-    credentials = {
-        'user_name': os.environ.get('USER', ''),
-        'password':  os.environ.get('PASS', '')
-    }
-    return wmi.WMI(name, user=credentials['user_name'], password=credentials['password'])
+
+def link_pairs(rows):
+    """Return the DeviceIDs an association class links.
+
+    Args:
+        rows(iterable): Win32_DiskDriveToDiskPartition or
+            Win32_LogicalDiskToPartition instances
+
+    Returns:
+        pairs(list): (Antecedent DeviceID, Dependent DeviceID) pairs
+
+    """
+    return [(utility.parse_wmi_reference(row['Antecedent'])[1]['DeviceID'],
+             utility.parse_wmi_reference(row['Dependent'])[1]['DeviceID']) for row in rows]
+
+
+def _natural_key(device_id):
+    # 'Disk #0, Partition #10' after 'Disk #0, Partition #2'.
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', device_id)]
 
 
-def _run_process(reports, host):
+def build_topology(physical_drives, partitions, logical_drives, disk_links, volume_links):
+    """Return the disk, partition, volume tree with its reverse lookups.
+
+    Links to an object missing from its section, such as a drive left
+    out by a Win32_LogicalDisk filter, are ignored.
+
+    Args:
+        physical_drives(dict): Win32_DiskDrive instances keyed by Index
+        partitions(dict): Win32_DiskPartition instances keyed by DeviceID
+        logical_drives(dict): Win32_LogicalDisk instances keyed by DeviceID
+        disk_links(list): link_pairs of Win32_DiskDriveToDiskPartition
+        volume_links(list): link_pairs of Win32_LogicalDiskToPartition
+
+    Returns:
+        topology(dict): 'disks' {Index: {'DeviceID', 'partitions'}},
+            'partitions' {DeviceID: {'disk', 'logical_drives'}} and
+            'logical_drives' {DeviceID: {'partitions', 'disks'}}
+
+    """
+    disk_index = {disk['DeviceID']: index for index, disk in physical_drives.items()}
+    topology = {
+        'disks':          {index: {'DeviceID': disk['DeviceID'], 'partitions': []}
+                           for index, disk in physical_drives.items()},
+        'partitions':     {device_id: {'disk': partition.get('DiskIndex'),
+                                       'logical_drives': []}
+                           for device_id, partition in partitions.items()},
+        'logical_drives': {device_id: {'partitions': [], 'disks': []}
+                           for device_id in logical_drives}
+    }
+    for disk_id, partition_id in disk_links:
+        if disk_id not in disk_index or partition_id not in partitions:
+            continue
+        index = disk_index[disk_id]
+        topology['disks'][index]['partitions'].append(partition_id)
+        topology['partitions'][partition_id]['disk'] = index
+    for partition_id, logical_id in volume_links:
+        if partition_id not in partitions or logical_id not in logical_drives:
+            continue
+        partition = topology['partitions'][partition_id]
+        partition['logical_drives'].append(logical_id)
+        volume = topology['logical_drives'][logical_id]
+        volume['partitions'].append(partition_id)
+        if partition['disk'] is not None and partition['disk'] not in volume['disks']:
+            volume['disks'].append(partition['disk'])
+    for disk in topology['disks'].values():
+        disk['partitions'].sort(key=_natural_key)
+    for volume in topology['logical_drives'].values():
+        volume['partitions'].sort(key=_natural_key)
+    return topology
+
+
+def add_disk_topology(content):
+    """Replace the link sections of content with its disk_topology."""
+    if 'disk_drive_links' not in content or 'logical_disk_links' not in content:
+        return
+    content['disk_topology'] = build_topology(
+        content.get('physical_drives', {}), content.get('disk_partitions', {}),
+        content.get('logical_drives', {}), content.pop('disk_drive_links'),
+        content.pop('logical_disk_links'))
+
+
+def _run_process(reports, host, filters):
     wmi_obj = _get_wmi_obj(host)
+    filters = filters or {}
     partition_dict = {}
-    for item in wmi_obj.Win32_DiskPartition():
-        temp_item = utility.clean_win32_obj(str(item))
-        partition_dict[temp_item['DiskIndex']] = temp_item
+    wql = utility.build_wql('Win32_DiskPartition', filters.get('Win32_DiskPartition'))
+    for temp_item in utility.iter_query(wmi_obj, wql):
+        partition_dict[temp_item['DeviceID']] = temp_item
     reports['content']['disk_partitions'] = partition_dict
 
     disk_dict = {}
-    for item in wmi_obj.Win32_DiskDrive():
-        temp_item = utility.clean_win32_obj(str(item))
+    wql = utility.build_wql('Win32_DiskDrive', filters.get('Win32_DiskDrive'))
+    for temp_item in utility.iter_query(wmi_obj, wql):
         disk_dict[temp_item['Index']] = temp_item
     reports['content']['physical_drives'] = disk_dict
 
     logical_dict = {}
-    for item in wmi_obj.Win32_LogicalDisk():
-        temp_item = utility.clean_win32_obj(str(item))
+    wql = utility.build_wql('Win32_LogicalDisk', filters.get('Win32_LogicalDisk'))
+    for temp_item in utility.iter_query(wmi_obj, wql):
         logical_dict[temp_item['DeviceID']] = temp_item
     reports['content']['logical_drives'] = logical_dict
 
+    for section, class_name in (('disk_drive_links', 'Win32_DiskDriveToDiskPartition'),
+                                ('logical_disk_links', 'Win32_LogicalDiskToPartition')):
+        wql = utility.build_wql(class_name, filters.get(class_name))
+        reports['content'][section] = link_pairs(utility.iter_query(wmi_obj, wql))
+    add_disk_topology(reports['content'])
 
-def collect_win_disk_stats(host=node(), is_threaded=0, queue=None):
+
+def collect_win_disk_stats(host=node(), is_threaded=0, queue=None, filters=None):
     """Create business logic of the module.
 
     This module orchestrates the business logic for this module
 
+    Args:
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, see utility.build_wql
+
     Returns:
         return_body(dict): A key, value object that contains the
             response that is sent to the requester
@@ -73,6 +163,7 @@ def collect_win_disk_stats(host=node(), is_threaded=0, queue=None):
         'capability_name': str(os.path.basename(__file__)[:-3]),
         'version':         '0',
         'host':            node(),
+        'target':          host,
         'project_dir':     os.getcwd(),
         'log_path':        'logs',
         'outcome':         'Failed',
@@ -82,14 +173,15 @@ def collect_win_disk_stats(host=node(), is_threaded=0, queue=None):
     if is_threaded:
         pythoncom.CoInitialize()  # pylint: disable=E1101
         try:
-            _run_process(reports, host)
+            _run_process(reports, host, filters)
             reports['outcome'] = 'Successful'
-            queue.put(utility.reporting(reports)['content'])
-            return utility.reporting(reports)
+            return_body = utility.reporting(reports)
+            queue.put(return_body['content'])
+            return return_body
         finally:
             pythoncom.CoUninitialize()  # pylint: disable=E1101
     else:
-        _run_process(reports, host)
+        _run_process(reports, host, filters)
         reports['outcome'] = 'Successful'
         return utility.reporting(reports)
 
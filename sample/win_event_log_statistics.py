@@ -0,0 +1,294 @@
+#! /usr/bin/python
+"""
+Description: collect new Windows event log records.
+
+Every run only asks for the records written since the last one. A
+checkpoint per host keeps, per log file, the highest RecordNumber read
+and its TimeGenerated. Records are read in RecordNumber windows with
+forward only enumeration, streamed to the win_event_log_events report
+log in batches, and the checkpoint is advanced once a window is
+written, so a restart resumes after the last complete window. A log
+that was cleared or wrapped past the watermark since the last run is
+detected by its watermark record having gone. Such a log, like a log
+read for the first time, is read in windows from its oldest record,
+found from the newest and the log's NumberOfRecords.
+
+Author: Shayne Cardwell
+
+Module: win_event_log_statistics.py
+"""
+import json
+import os
+import sys
+from datetime import datetime
+from platform import node
+from urllib.parse import quote
+
+try:
+    import pythoncom
+    import sample.report_log as report_log
+    import sample.utility as utility
+except ModuleNotFoundError:
+    print('Had trouble finding packages')
+    print('Please install via the command below')
+    print('pipenv install')
+    sys.exit(1)
+
+DEFAULT_LOGFILES = ('Application', 'System', 'Security')
+
+EVENT_PROPERTIES = ('Logfile', 'RecordNumber', 'TimeGenerated', 'TimeWritten', 'EventCode',
+                    'EventIdentifier', 'EventType', 'Type', 'SourceName', 'Category',
+                    'CategoryString', 'ComputerName', 'User', 'Message', 'InsertionStrings')
+
+EVENTS_CAPABILITY = 'win_event_log_events'
+CHECKPOINT_PATH = 'logs/event_log_checkpoints'
+WINDOW_SIZE = 10000
+BATCH_SIZE = 500
+
+
+def _get_wmi_obj(name):
+    return utility.connect(name)
+
+
+def _checkpoint_file(checkpoint_path, host):
+    return os.path.join(checkpoint_path, '{0}.json'.format(quote(host, safe='')))
+
+
+def load_checkpoint(checkpoint_path, host):
+    """Return a host's watermarks, {Logfile: {'RecordNumber', 'TimeGenerated'}}."""
+    try:
+        with open(_checkpoint_file(checkpoint_path, host)) as file_obj:
+            return json.loads(file_obj.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def save_checkpoint(checkpoint_path, host, checkpoint):
+    """Replace a host's watermarks on disk in one step."""
+    os.makedirs(checkpoint_path, exist_ok=True)
+    path = _checkpoint_file(checkpoint_path, host)
+    with open(path + '.tmp', 'w') as file_obj:
+        file_obj.write(json.dumps(checkpoint))
+    os.replace(path + '.tmp', path)
+
+
+def _read_records(wmi_obj, logfile, conditions, properties=None):
+    wql = utility.build_wql('Win32_NTLogEvent', [('Logfile', '=', logfile)] + conditions,
+                            properties)
+    return utility.iter_query(wmi_obj, wql)
+
+
+def _record(wmi_obj, logfile, number):
+    for row in _read_records(wmi_obj, logfile, [('RecordNumber', '=', number)],
+                             ['RecordNumber', 'TimeGenerated']):
+        return row
+    return None
+
+
+def _log_was_cleared(wmi_obj, logfile, watermark):
+    row = _record(wmi_obj, logfile, watermark['RecordNumber'])
+    return row is None or row.get('TimeGenerated') != watermark['TimeGenerated']
+
+
+def _any_from(wmi_obj, logfile, number):
+    # Only the first row is fetched, the enumerator is dropped after it.
+    wql = utility.build_wql('Win32_NTLogEvent', [('Logfile', '=', logfile),
+                                                 ('RecordNumber', '>=', number)],
+                            ['RecordNumber'])
+    for _ in utility.iter_query(wmi_obj, wql, batch_size=1):
+        return True
+    return False
+
+
+def _oldest_record(wmi_obj, logfile, hint=0):
+    """Return the RecordNumber of the oldest record of a log, or None.
+
+    Whether any record is at or after a number only changes once, at
+    the newest record, so the newest is found by galloping from hint
+    and bisecting. The records of a log are numbered consecutively,
+    NumberOfRecords of them ending with the newest.
+
+    """
+    if not _any_from(wmi_obj, logfile, 1):
+        return None
+    low = 1
+    if hint > low and _any_from(wmi_obj, logfile, hint):
+        low = hint
+    step = 1
+    while _any_from(wmi_obj, logfile, low + step):
+        low, step = low + step, step * 2
+    high = low + step
+    while high - low > 1:
+        middle = (low + high) // 2
+        if _any_from(wmi_obj, logfile, middle):
+            low = middle
+        else:
+            high = middle
+    wql = utility.build_wql('Win32_NTEventlogFile', [('LogfileName', '=', logfile)],
+                            ['NumberOfRecords'])
+    count = 0
+    for row in utility.iter_query(wmi_obj, wql):
+        count = int(row.get('NumberOfRecords') or 0)
+    # Records written since the newest was found only make the count
+    # larger, and the start earlier than needed.
+    return max(1, low - count + 1)
+
+
+class _EventStream(object):
+
+    def __init__(self, writer, reports, logfile, batch_size):
+        self.writer = writer
+        self.reports = reports
+        self.logfile = logfile
+        self.batch_size = batch_size
+        self.batch = []
+        self.collected = 0
+        self.newest = None
+
+    def add(self, event):
+        self.collected += 1
+        if self.newest is None or event['RecordNumber'] > self.newest['RecordNumber']:
+            self.newest = {'RecordNumber': event['RecordNumber'],
+                           'TimeGenerated': event['TimeGenerated']}
+        self.batch.append(event)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.append({
+                'capability_name': EVENTS_CAPABILITY,
+                'start_time':      self.reports['start_time'],
+                'host':            self.reports['host'],
+                'target':          self.reports['target'],
+                'outcome':         'Successful',
+                'content':         {'event_log': {
+                    '{0}:{1}'.format(self.logfile, event['RecordNumber']): event
+                    for event in self.batch}}
+            }, self.reports['target'])
+            self.batch = []
+        self.writer.flush()
+
+
+def _collect_logfile(wmi_obj, stream, watermark, filters, window_size, save):
+    logfile = stream.logfile
+    cleared = bool(watermark['RecordNumber']) and _log_was_cleared(wmi_obj, logfile, watermark)
+    if cleared or not watermark['RecordNumber']:
+        # First run, or the log was cleared or wrapped past the watermark:
+        # the windows start before the oldest record.
+        oldest = _oldest_record(wmi_obj, logfile, watermark['RecordNumber'])
+        unread = {'RecordNumber': 0, 'TimeGenerated': None}
+        if oldest is None:
+            save(logfile, unread)
+            return dict(unread, collected=0, reset=cleared)
+        watermark = {'RecordNumber': oldest - 1, 'TimeGenerated': None}
+
+    # Record numbers after the watermark are consecutive, so they are read a
+    # window at a time and the checkpoint moves once a window is written.
+    while True:
+        start = watermark['RecordNumber']
+        end = start + window_size
+        for event in _read_records(wmi_obj, logfile, [('RecordNumber', '>', start),
+                                                      ('RecordNumber', '<=', end)] + list(filters),
+                                   list(EVENT_PROPERTIES)):
+            stream.add(event)
+        stream.flush()
+        edge = {row['RecordNumber']: row for row in _read_records(
+            wmi_obj, logfile, [('RecordNumber', '>=', end), ('RecordNumber', '<=', end + 1)],
+            ['RecordNumber', 'TimeGenerated'])}
+        if end in edge:
+            watermark = {'RecordNumber': end, 'TimeGenerated': edge[end]['TimeGenerated']}
+        elif stream.newest is not None and stream.newest['RecordNumber'] > start:
+            watermark = stream.newest
+        # Still before the oldest record, the next run looks for it again.
+        saved = watermark if watermark['TimeGenerated'] is not None else \
+            {'RecordNumber': 0, 'TimeGenerated': None}
+        save(logfile, saved)
+        if end + 1 not in edge:
+            break
+    return dict(saved, collected=stream.collected, reset=cleared)
+
+
+def _run_process(reports, host, filters, logfiles, checkpoint_path, window_size, batch_size):
+    wmi_obj = _get_wmi_obj(host)
+    filters = filters or {}
+    extra = filters.get('Win32_NTLogEvent') or []
+    if isinstance(extra, dict):
+        extra = list(extra.items())
+
+    watermarks = load_checkpoint(checkpoint_path, host)
+
+    def save(logfile, watermark):
+        watermarks[logfile] = watermark
+        save_checkpoint(checkpoint_path, host, watermarks)
+
+    writer = report_log.get_writer(reports['log_path'], EVENTS_CAPABILITY)
+    temp_dict = {}
+    for logfile in logfiles:
+        watermark = watermarks.get(logfile, {'RecordNumber': 0, 'TimeGenerated': None})
+        stream = _EventStream(writer, reports, logfile, batch_size)
+        temp_dict[logfile] = _collect_logfile(wmi_obj, stream, watermark, extra, window_size,
+                                              save)
+    reports['content']['event_logs'] = temp_dict
+
+
+def collect_win_event_log_stats(host=node(), is_threaded=0, queue=None, filters=None,
+                                logfiles=DEFAULT_LOGFILES, checkpoint_path=CHECKPOINT_PATH,
+                                window_size=WINDOW_SIZE, batch_size=BATCH_SIZE):
+    """Create business logic of the module.
+
+    This module orchestrates the business logic for this module. The
+    events themselves go to the win_event_log_events report log, the
+    content returned holds a summary per log file.
+
+    Args:
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, those of Win32_NTLogEvent are added to every
+            event query
+        logfiles(tuple): Optional, the event logs to read
+        checkpoint_path(string): Optional, where the watermarks are kept
+        window_size(int): Optional, RecordNumbers covered per query
+        batch_size(int): Optional, events per record written
+
+    Returns:
+        return_body(dict): A key, value object that contains the
+            response that is sent to the requester
+
+    """
+    reports = {
+        'messages':        [],
+        'start_time':      datetime.now().strftime('%d-%m-%Y %H:%M:%S'),
+        'capability_name': str(os.path.basename(__file__)[:-3]),
+        'version':         '0',
+        'host':            node(),
+        'target':          host,
+        'project_dir':     os.getcwd(),
+        'log_path':        'logs',
+        'outcome':         'Failed',
+        'content':         {},
+        'return_body':     {}
+    }
+    if is_threaded:
+        pythoncom.CoInitialize()  # pylint: disable=E1101
+        try:
+            _run_process(reports, host, filters, logfiles, checkpoint_path, window_size,
+                         batch_size)
+            reports['outcome'] = 'Successful'
+            return_body = utility.reporting(reports)
+            queue.put(return_body['content'])
+            return return_body
+        finally:
+            pythoncom.CoUninitialize()  # pylint: disable=E1101
+    else:
+        _run_process(reports, host, filters, logfiles, checkpoint_path, window_size, batch_size)
+        reports['outcome'] = 'Successful'
+        return utility.reporting(reports)
+
+
+def main():
+    """Make module a standalone module."""
+    print(json.dumps(collect_win_event_log_stats(), indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,7 +16,6 @@ from platform import node
 
 try:
     import pythoncom
-    import wmi
     import sample.utility as utility
 except ModuleNotFoundError:
     print('Had trouble finding packages')
@@ -26,30 +25,24 @@ except ModuleNotFoundError:
 
 
 def _get_wmi_obj(name):
-    if name == node():
-        return wmi.WMI()
+    return utility.connect(name)
 
-    credentials = {
-        'user_name': os.environ.get('USER', ''),
-        'password':  os.environ.get('PASS', '')
-    }
-    return wmi.WMI(name, user=credentials['user_name'], password=credentials['password'])
 
-
-def _run_process(reports, host):
+def _run_process(reports, host, filters):
     wmi_obj = _get_wmi_obj(host)
+    filters = filters or {}
 
     temp_dict = {}
-    for item in wmi_obj.Win32_Group():
-        temp_item = utility.clean_win32_obj(str(item))
+    wql = utility.build_wql('Win32_Group', filters.get('Win32_Group'))
+    for temp_item in utility.iter_query(wmi_obj, wql):
         if temp_item['Name'] not in temp_dict:
             temp_dict[temp_item['Name']] = {}
         temp_dict[temp_item['Name']]['group_information'] = temp_item
     reports['content']['local_groups'] = temp_dict
 
     temp_dict = {}
-    for item in wmi_obj.Win32_GroupUser():
-        temp_item = utility.clean_win32_obj(str(item))
+    wql = utility.build_wql('Win32_GroupUser', filters.get('Win32_GroupUser'))
+    for temp_item in utility.iter_query(wmi_obj, wql):
         group_name = temp_item['GroupComponent'].split(',')[1].split('=')[1].strip('"')
         if group_name not in temp_dict:
             temp_dict[group_name] = []
@@ -64,11 +57,15 @@ def _run_process(reports, host):
                 reports['content']['local_groups'][name]['group_users'].append(user_name)
 
 
-def collect_win_local_group_stats(host=node(), is_threaded=0, queue=None):
+def collect_win_local_group_stats(host=node(), is_threaded=0, queue=None, filters=None):
     """Create business logic of the module.
 
     This module orchestrates the business logic for this module
 
+    Args:
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, see utility.build_wql
+
     Returns:
         return_body(dict): A key, value object that contains the
             response that is sent to the requester
@@ -80,6 +77,7 @@ def collect_win_local_group_stats(host=node(), is_threaded=0, queue=None):
         'capability_name': str(os.path.basename(__file__)[:-3]),
         'version':         '0',
         'host':            node(),
+        'target':          host,
         'project_dir':     os.getcwd(),
         'log_path':        'logs',
         'outcome':         'Failed',
@@ -89,14 +87,15 @@ def collect_win_local_group_stats(host=node(), is_threaded=0, queue=None):
     if is_threaded:
         pythoncom.CoInitialize()  # pylint: disable=E1101
         try:
-            _run_process(reports, host)
+            _run_process(reports, host, filters)
             reports['outcome'] = 'Successful'
-            queue.put(utility.reporting(reports)['content'])
-            return utility.reporting(reports)
+            return_body = utility.reporting(reports)
+            queue.put(return_body['content'])
+            return return_body
         finally:
             pythoncom.CoUninitialize()  # pylint: disable=E1101
     else:
-        _run_process(reports, host)
+        _run_process(reports, host, filters)
         reports['outcome'] = 'Successful'
         return utility.reporting(reports)
 
@@ -16,7 +16,6 @@ from platform import node
 
 try:
     import pythoncom
-    import wmi
     import sample.utility as utility
 except ModuleNotFoundError:
     print('Had trouble finding packages')
@@ -25,40 +24,45 @@ except ModuleNotFoundError:
     sys.exit(1)
 
 
-def _get_wmi_obj(name):
-    if name == node():
-        return wmi.WMI()
+# Hidden and virtual adapters are dropped by the WMI provider rather than parsed here.
+DEFAULT_FILTERS = {
+    'Win32_NetworkAdapter':              [('NetEnabled', 'IS NOT', None)],
+    'Win32_NetworkAdapterConfiguration': {'IPEnabled': True}
+}
 
-    credentials = {
-        'user_name': os.environ.get('USER', ''),
-        'password':  os.environ.get('PASS', '')
-    }
-    return wmi.WMI(name, user=credentials['user_name'], password=credentials['password'])
 
+def _get_wmi_obj(name):
+    return utility.connect(name)
 
-def _run_process(reports, host):
+
+def _run_process(reports, host, filters):
     wmi_obj = _get_wmi_obj(host)
+    filters = utility.merge_filters(DEFAULT_FILTERS, filters)
 
     temp_dict = {}
-    for item in wmi_obj.Win32_NetworkAdapter():
-        temp_item = utility.clean_win32_obj(str(item))
-        if 'NetEnabled' in temp_item:
-            temp_dict[temp_item['Index']] = temp_item
+    wql = utility.build_wql('Win32_NetworkAdapter', filters.get('Win32_NetworkAdapter'))
+    for temp_item in utility.iter_query(wmi_obj, wql):
+        temp_dict[temp_item['Index']] = temp_item
     reports['content']['network_adapters'] = temp_dict
 
     temp_dict = {}
-    for item in wmi_obj.Win32_NetworkAdapterConfiguration():
-        temp_item = utility.clean_win32_obj(str(item))
-        if temp_item['IPEnabled']:
-            temp_dict[temp_item['Index']] = temp_item
+    wql = utility.build_wql('Win32_NetworkAdapterConfiguration',
+                            filters.get('Win32_NetworkAdapterConfiguration'))
+    for temp_item in utility.iter_query(wmi_obj, wql):
+        temp_dict[temp_item['Index']] = temp_item
     reports['content']['network_configuration'] = temp_dict
 
 
-def collect_win_network_stats(host=node(), is_threaded=0, queue=None):
+def collect_win_network_stats(host=node(), is_threaded=0, queue=None, filters=None):
     """Create business logic of the module.
 
     This module orchestrates the business logic for this module
 
+    Args:
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, see utility.build_wql. Entries replace the
+            DEFAULT_FILTERS for the same class
+
     Returns:
         return_body(dict): A key, value object that contains the
             response that is sent to the requester
@@ -70,6 +74,7 @@ def collect_win_network_stats(host=node(), is_threaded=0, queue=None):
         'capability_name': str(os.path.basename(__file__)[:-3]),
         'version':         '0',
         'host':            node(),
+        'target':          host,
         'project_dir':     os.getcwd(),
         'log_path':        'logs',
         'outcome':         'Failed',
@@ -79,14 +84,15 @@ def collect_win_network_stats(host=node(), is_threaded=0, queue=None):
     if is_threaded:
         pythoncom.CoInitialize()  # pylint: disable=E1101
         try:
-            _run_process(reports, host)
+            _run_process(reports, host, filters)
             reports['outcome'] = 'Successful'
-            queue.put(utility.reporting(reports)['content'])
-            return utility.reporting(reports)
+            return_body = utility.reporting(reports)
+            queue.put(return_body['content'])
+            return return_body
         finally:
             pythoncom.CoUninitialize()  # pylint: disable=E1101
     else:
-        _run_process(reports, host)
+        _run_process(reports, host, filters)
         reports['outcome'] = 'Successful'
         return utility.reporting(reports)
 
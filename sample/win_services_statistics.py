@@ -2,6 +2,10 @@
 """
 Description: collect services information.
 
+Besides the services keyed by Caption, the dependencies between
+services are read from the Win32_DependentService associations in one
+query and returned as service_dependencies, keyed by service Name.
+
 Author: Shayne Cardwell
 
 Date: August 16, 2016
@@ -16,7 +20,6 @@ from platform import node
 
 try:
     import pythoncom
-    import wmi
     import sample.utility as utility
 except ModuleNotFoundError:
     print('Had trouble finding packages')
@@ -26,31 +29,50 @@ except ModuleNotFoundError:
 
 
 def _get_wmi_obj(name):
-    if name == node():
-        return wmi.WMI()
+    return utility.connect(name)
 
-    credentials = {
-        'user_name': os.environ.get('USER', ''),
-        'password':  os.environ.get('PASS', '')
-    }
-    return wmi.WMI(name, user=credentials['user_name'], password=credentials['password'])
+
+def dependency_map(rows):
+    """Return the services each service depends on.
+
+    Args:
+        rows(iterable): Win32_DependentService instances
+
+    Returns:
+        dependencies(dict): {service Name: [Names it depends on]}
+
+    """
+    dependencies = {}
+    for row in rows:
+        _, antecedent = utility.parse_wmi_reference(row['Antecedent'])
+        _, dependent = utility.parse_wmi_reference(row['Dependent'])
+        dependencies.setdefault(dependent['Name'], []).append(antecedent['Name'])
+    return dependencies
 
 
-def _run_process(reports, host):
+def _run_process(reports, host, filters):
     wmi_obj = _get_wmi_obj(host)
+    filters = filters or {}
 
     temp_dict = {}
-    for item in wmi_obj.Win32_Service():
-        temp_item = utility.clean_win32_obj(str(item))
+    wql = utility.build_wql('Win32_Service', filters.get('Win32_Service'))
+    for temp_item in utility.iter_query(wmi_obj, wql):
         temp_dict[temp_item['Caption']] = temp_item
     reports['content']['services'] = temp_dict
 
+    wql = utility.build_wql('Win32_DependentService', filters.get('Win32_DependentService'))
+    reports['content']['service_dependencies'] = dependency_map(utility.iter_query(wmi_obj, wql))
 
-def collect_win_services_stats(host=node(), is_threaded=0, queue=None):
+
+def collect_win_services_stats(host=node(), is_threaded=0, queue=None, filters=None):
     """Create business logic of the module.
 
     This module orchestrates the business logic for this module
 
+    Args:
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, see utility.build_wql
+
     Returns:
         return_body(dict): A key, value object that contains the
             response that is sent to the requester
@@ -62,6 +84,7 @@ def collect_win_services_stats(host=node(), is_threaded=0, queue=None):
         'capability_name': str(os.path.basename(__file__)[:-3]),
         'version': '0',
         'host': node(),
+        'target': host,
         'project_dir': os.getcwd(),
         'log_path': 'logs',
         'outcome': 'Failed',
@@ -71,14 +94,15 @@ def collect_win_services_stats(host=node(), is_threaded=0, queue=None):
     if is_threaded:
         pythoncom.CoInitialize()  # pylint: disable=E1101
         try:
-            _run_process(reports, host)
+            _run_process(reports, host, filters)
             reports['outcome'] = 'Successful'
-            queue.put(utility.reporting(reports)['content'])
-            return utility.reporting(reports)
+            return_body = utility.reporting(reports)
+            queue.put(return_body['content'])
+            return return_body
         finally:
             pythoncom.CoUninitialize()  # pylint: disable=E1101
     else:
-        _run_process(reports, host)
+        _run_process(reports, host, filters)
         reports['outcome'] = 'Successful'
         return utility.reporting(reports)
 
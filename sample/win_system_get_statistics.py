@@ -2,6 +2,8 @@
 """
 Description: collect windows system information.
 
+Run with --profile to profile the collectors, see profiling.py.
+
 Author: Shayne Cardwell
 
 Date: August 16, 2016
@@ -10,18 +12,30 @@ Module: win_system_get_statistics.py
 """
 from __future__ import print_function
 
+import argparse
+import functools
 import json
 import os
 import sys
 from datetime import datetime
+from multiprocessing.dummy import Pool
 from multiprocessing.dummy import Process as _Process
 from multiprocessing.dummy import Queue
 from platform import node
+from queue import Empty
 
 # This setup was specifically added to stay in compliance with PEP008
 sys.path.insert(1, os.path.abspath('required_packages'))
 try:
+    import pythoncom
+    import sample.change_probe as change_probe
+    import sample.collector_scheduler as collector_scheduler
+    import sample.metric_store as metric_store
+    import sample.profiling as profiling
+    import sample.resilience as resilience
+    import sample.service_index as service_index
     import sample.utility as utility
+    import sample.wmi_query_planner as wmi_query_planner
     from sample.win_application_statistics import collect_win_application_stats
     from sample.win_bios_statistics import collect_win_bios_stats
     from sample.win_drive_statistics import collect_win_disk_stats
@@ -39,114 +53,217 @@ except ModuleNotFoundError:
     print('pipenv install')
     sys.exit(1)
 
+# Seconds a host may use when collect_system_stats is given no budget.
+DEFAULT_HOST_TIMEOUT = 600
+
+SYSTEM_INFORMATION_FUNCTIONS = [collect_win_application_stats, collect_win_bios_stats,
+                                collect_win_disk_stats, collect_win_local_account_stats,
+                                collect_win_local_group_stats, collect_win_mem_stats,
+                                collect_win_network_stats, collect_os_stats,
+                                collect_win_processes_stats, collect_win_cpu_stats,
+                                collect_win_services_stats]
+
+# Set by main() when profiling, every collector call is then wrapped by it.
+_PROFILER = None
+
 
 def _execute_funtion(function, arg):
     function(arg)
 
 
-def _get_hardware(host):
+def _get_hardware(host, filters=None):
     hardware_functions = [collect_win_bios_stats, collect_win_disk_stats, collect_win_mem_stats,
                           collect_win_network_stats, collect_win_cpu_stats]
     hardware_info = {}
     for hardware in hardware_functions:
-        hardware_info.update(hardware(host)['content'])
+        hardware_info.update(hardware(host, filters=filters)['content'])
     return hardware_info
 
 
-def _get_hardware_threaded(host):
-    hardware_functions = [collect_win_bios_stats, collect_win_disk_stats, collect_win_mem_stats,
-                          collect_win_network_stats, collect_win_cpu_stats]
-    hardware_info = {}
+def _incremental(collector):
+    # Keeps the collector's name, which failures, plans and schedules go by.
+    @functools.wraps(collector)
+    def incremental_collector(host, **kwargs):
+        return collector(host, incremental=True, **kwargs)
+    return incremental_collector
+
+
+def _call_collector(collector, host, filters=None, budget=None):
+    pythoncom.CoInitialize()  # pylint: disable=E1101
+    call = _PROFILER.wrap(collector) if _PROFILER else collector
+    try:
+        # utility.connect and utility.exec_query retry against the budget.
+        with resilience.budget_scope(budget):
+            return call(host, **utility.collector_kwargs(collector, filters))['content']
+    finally:
+        pythoncom.CoUninitialize()  # pylint: disable=E1101
+
+
+def _run_collector(collector, host, queue, filters=None, budget=None):
+    try:
+        content = _call_collector(collector, host, filters, budget)
+        queue.put((collector.__name__, content, None))
+    except Exception as error:  # pylint: disable=W0703
+        queue.put((collector.__name__, {}, '{0}: {1}'.format(type(error).__name__, error)))
+
+
+def _run_threaded(functions, host, filters=None, budget=None, failures=None):
+    information = {}
     queue = Queue()
-    list_of_processes = []
+    pending = set()
 
-    for hardware in hardware_functions:
-        process = _Process(target=hardware, args=(host, 1, queue,))
-        list_of_processes.append(process)
+    for function in functions:
+        process = _Process(target=_run_collector, args=(function, host, queue, filters, budget,))
+        process.daemon = True
+        pending.add(function.__name__)
         process.start()
 
-    for process in list_of_processes:
-        process.join()
-        hardware_info.update(queue.get())
-    return hardware_info
+    while pending:
+        try:
+            name, content, error = queue.get(timeout=budget.remaining() if budget else None)
+        except Empty:
+            break
+        pending.discard(name)
+        information.update(content)
+        if error and failures is not None:
+            failures[name] = error
+
+    if failures is not None:
+        for name in pending:
+            failures[name] = 'Timed out, timeout budget used up'
+    return information
+
+
+def _run_scheduled(functions, host, filters=None, budget=None, failures=None, scheduler=None):
+    jobs = {function.__name__: functools.partial(_call_collector, function, host, filters, budget)
+            for function in functions}
+    return scheduler.run(host, jobs, budget, failures)
 
 
-def _get_system_information(host):
-    system_information_functions = [collect_win_application_stats, collect_win_bios_stats,
-                                    collect_win_disk_stats, collect_win_local_account_stats,
-                                    collect_win_local_group_stats, collect_win_mem_stats,
-                                    collect_win_network_stats, collect_os_stats,
-                                    collect_win_processes_stats, collect_win_cpu_stats,
-                                    collect_win_services_stats]
+def _get_hardware_threaded(host, filters=None, budget=None, failures=None):
+    hardware_functions = [collect_win_bios_stats, collect_win_disk_stats, collect_win_mem_stats,
+                          collect_win_network_stats, collect_win_cpu_stats]
+    return _run_threaded(hardware_functions, host, filters, budget, failures)
+
+
+def _get_system_information(host, filters=None):
     system_information = {}
-    for sys_info in system_information_functions:
-        system_information.update(sys_info(host)['content'])
+    for sys_info in SYSTEM_INFORMATION_FUNCTIONS:
+        system_information.update(sys_info(host, **utility.collector_kwargs(sys_info,
+                                                                            filters))['content'])
     return system_information
 
 
-def _get_system_information_threaded(host):
-    system_information_functions = [collect_win_application_stats, collect_win_bios_stats,
-                                    collect_win_disk_stats, collect_win_local_account_stats,
-                                    collect_win_local_group_stats, collect_win_mem_stats,
-                                    collect_win_network_stats, collect_os_stats,
-                                    collect_win_processes_stats, collect_win_cpu_stats,
-                                    collect_win_services_stats]
-    system_information = {}
-    queue = Queue()
-    list_of_processes = []
+def _get_system_information_threaded(host, filters=None, budget=None, failures=None,
+                                     scheduler=None, functions=None):
+    functions = SYSTEM_INFORMATION_FUNCTIONS if functions is None else functions
+    if scheduler is not None:
+        return _run_scheduled(functions, host, filters, budget, failures, scheduler)
+    return _run_threaded(functions, host, filters, budget, failures)
 
-    for hardware in system_information_functions:
-        process = _Process(target=hardware, args=(host, 1, queue,))
-        list_of_processes.append(process)
-        process.start()
 
-    for process in list_of_processes:
-        process.join()
-        system_information.update(queue.get())
-    return system_information
+def _get_system_information_planned(host, filters=None, budget=None, failures=None,
+                                    scheduler=None, functions=None, messages=None):
+    functions = SYSTEM_INFORMATION_FUNCTIONS if functions is None else functions
+    plan = wmi_query_planner.plan_queries(functions, filters)
 
+    def collect_planned_stats(host):
+        content, stats = wmi_query_planner.run_plan(host, plan)
+        if messages is not None:
+            messages.append('{0} planned queries, {1} rows in {2:.2f}s'.format(
+                stats['queries'], stats['rows'], stats['seconds']))
+        return {'content': content}
 
-def get_hardware_information(machine_name):
+    functions = ([collect_planned_stats] if plan['queries'] else []) + plan['fallback']
+    if scheduler is not None:
+        return _run_scheduled(functions, host, filters, budget, failures, scheduler)
+    return _run_threaded(functions, host, filters, budget, failures)
+
+
+def get_hardware_information(machine_name, filters=None, budget=None, failures=None):
     """Return Hardware information.
 
     This functions collects all the hardware information about a host.
 
     Args:
         machine_name(string): The name of the host
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, passed to every collector
+        budget(TimeoutBudget): Optional, the time the host may use
+        failures(dict): Optional, filled with the error of every
+            collector that failed or ran out of time
 
     Returns:
         hardware_info(dict): A key value object that contains the
             hardware information about the machine
 
     """
-    # hardware_info = _get_hardware(machine_name)
-    hardware_info = _get_hardware_threaded(machine_name)
+    # hardware_info = _get_hardware(machine_name, filters)
+    hardware_info = _get_hardware_threaded(machine_name, filters, budget, failures)
     return hardware_info
 
 
-def get_system_information(machine_name):
+def get_system_information(machine_name, filters=None, budget=None, failures=None,
+                           planned=False, scheduler=None, functions=None, messages=None):
     """Return System information.
 
     This functions collects a lot of system information about a host.
 
     Args:
         machine_name(string): The name of the host
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, passed to every collector
+        budget(TimeoutBudget): Optional, the time the host may use
+        failures(dict): Optional, filled with the error of every
+            collector that failed or ran out of time
+        planned(bool): Optional, batch the plain WQL collectors through
+            wmi_query_planner over one connection
+        scheduler(CollectorScheduler): Optional, run the collectors
+            longest expected first in its shared worker pool rather
+            than all at once, see collector_scheduler
+        functions(list): Optional, the collectors to run, defaults to
+            SYSTEM_INFORMATION_FUNCTIONS
+        messages(list): Optional, the planned batch appends its query
+            and row counts to it
 
     Returns:
         system_info(dict): A key value object that contains the
             hardware information about the machine
 
     """
-    # system_info = _get_system_information(machine_name)
-    system_info = _get_system_information_threaded(machine_name)
+    if planned:
+        return _get_system_information_planned(machine_name, filters, budget, failures,
+                                               scheduler, functions, messages)
+    # system_info = _get_system_information(machine_name, filters)
+    system_info = _get_system_information_threaded(machine_name, filters, budget, failures,
+                                                   scheduler, functions)
     return system_info
 
 
-def collect_system_stats(machine_name=node()):
+def collect_system_stats(machine_name=node(), filters=None, budget=None, planned=False,
+                         scheduler=None, probe=None, incremental=False):
     """Create business logic of the module.
 
     This module orchestrates the business logic for this module
 
+    Args:
+        machine_name(string): The name of the host
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, e.g. {'Win32_Service': {'State': 'Running'},
+            'Win32_LogicalDisk': {'DriveType': 3}}
+        budget(TimeoutBudget): Optional, the time the host may use,
+            collectors still running when it is used up are reported
+            as failed, defaults to DEFAULT_HOST_TIMEOUT seconds
+        planned(bool): Optional, see get_system_information
+        scheduler(CollectorScheduler): Optional, see
+            get_system_information
+        probe(ChangeProbe): Optional, run only the collectors whose
+            change signals moved since they last succeeded, the others
+            are listed in messages as skipped
+        incremental(bool): Optional, rescan installed applications from
+            the key fingerprints of the last incremental run, see
+            collect_win_application_stats
+
     Returns:
         return_body(dict): A key, value object that contains the
             response that is sent to the requester
@@ -158,6 +275,7 @@ def collect_system_stats(machine_name=node()):
         'capability_name': str(os.path.basename(__file__)[:-3]),
         'version':         '0',
         'host':            node(),
+        'target':          machine_name,
         'project_dir':     os.getcwd(),
         'log_path':        'logs/',
         'outcome':         'Failed',
@@ -165,19 +283,155 @@ def collect_system_stats(machine_name=node()):
         'return_body':     {}
     }
     print(reports['start_time'])
-    # reports['content'] = get_hardware_information(machine_name)
-    reports['content'] = get_system_information(machine_name)
-
-    utility.reporting(reports)
+    if budget is None:
+        budget = resilience.TimeoutBudget(DEFAULT_HOST_TIMEOUT)
+    failures = {}
+    functions = None
+    if probe is not None:
+        try:
+            with resilience.budget_scope(budget):
+                functions, skipped = probe.select(machine_name, SYSTEM_INFORMATION_FUNCTIONS)
+        except Exception as error:  # pylint: disable=W0703
+            reports['messages'].append('Change probe failed, collecting everything: {0}: {1}'
+                                       .format(type(error).__name__, error))
+            skipped = {}
+        for name in sorted(skipped):
+            reports['messages'].append('{0} skipped: {1}'.format(name, skipped[name]))
+    collectors = functions
+    if incremental:
+        collectors = [_incremental(function) if function is collect_win_application_stats
+                      else function for function in
+                      (SYSTEM_INFORMATION_FUNCTIONS if functions is None else functions)]
+    # reports['content'] = get_hardware_information(machine_name, filters, budget, failures)
+    reports['content'] = get_system_information(machine_name, filters, budget, failures,
+                                                planned, scheduler, collectors,
+                                                reports['messages'])
+    for name in sorted(failures):
+        reports['messages'].append('{0} failed: {1}'.format(name, failures[name]))
+    if functions is not None:
+        # A failed planned batch leaves every planned collector uncollected.
+        planned_failed = 'collect_planned_stats' in failures
+        probe.commit(machine_name, [
+            function.__name__ for function in functions if function.__name__ not in failures and
+            not (planned_failed and wmi_query_planner.COLLECTOR_SECTIONS.get(function.__name__))])
+
+    if reports['content'] or not failures:
+        reports['outcome'] = 'Successful'
+        try:
+            metric_store.get_store().ingest_content(machine_name, reports['content'])
+        except (IOError, ValueError) as error:
+            reports['messages'].append('Storing metrics failed: {0}: {1}'.format(
+                type(error).__name__, error))
+        service_index.index_content(machine_name, reports['content'])
+    return_body = utility.reporting(reports)
     print('start time: {0}'.format(reports['start_time']))
     print('end time: {0}'.format(reports['end_time']))
-    reports['outcome'] = 'Successful'
-    return utility.reporting(reports)
+    return return_body
+
+
+def _collect_guarded(host, filters, host_timeout, breaker, scheduler=None):
+    if not breaker.allow(host):
+        return host, None, 'Skipped, circuit open after repeated failures'
+    budget = resilience.TimeoutBudget(host_timeout)
+    try:
+        return_body = collect_system_stats(host, filters, budget, scheduler=scheduler)
+    except Exception as error:  # pylint: disable=W0703
+        breaker.record_failure(host)
+        return host, None, str(error)
+    # A host is healthy when it accepted a connection, not whenever some
+    # content came back.
+    if return_body['outcome'] != 'Successful' or not budget.connections:
+        breaker.record_failure(host)
+    else:
+        breaker.record_success(host)
+    if return_body['outcome'] != 'Successful':
+        return host, None, '; '.join(return_body['messages'])
+    return host, return_body['content'], None
+
+
+_BREAKER = resilience.CircuitBreaker()
+
+
+def collect_fleet_stats(hosts, filters=None, host_timeout=600, max_workers=16, breaker=None,
+                        scheduler=None):
+    """Collect system information from many hosts without stalling.
+
+    Every host gets its own timeout budget and hosts whose circuit is
+    open are skipped, so an unreachable host costs at most host_timeout
+    seconds of one worker rather than holding up the fleet.
+
+    Args:
+        hosts(list): The names of the hosts
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, passed to every collector
+        host_timeout(float): Seconds each host may use
+        max_workers(int): The number of hosts collected at once
+        breaker(CircuitBreaker): Optional, defaults to one shared by
+            every call in this process
+        scheduler(CollectorScheduler): Optional, one worker pool and
+            concurrency limit shared by the collectors of every host
+
+    Returns:
+        fleet(dict): {'content': {host: content},
+            'failed_hosts': {host: message}}
+
+    """
+    breaker = breaker or _BREAKER
+    fleet = {'content': {}, 'failed_hosts': {}}
+    pool = Pool(max_workers)
+    try:
+        for host, content, error in pool.imap_unordered(
+                lambda host: _collect_guarded(host, filters, host_timeout, breaker, scheduler),
+                hosts):
+            if error is None:
+                fleet['content'][host] = content
+            else:
+                fleet['failed_hosts'][host] = error
+    finally:
+        pool.close()
+    return fleet
 
 
 def main():
     """Make module a standalone module."""
-    print(json.dumps(collect_system_stats(), indent=4))
+    global _PROFILER  # pylint: disable=W0603
+    parser = argparse.ArgumentParser(description='Collect windows system information.')
+    parser.add_argument('--host', default=node())
+    parser.add_argument('--planned', action='store_true',
+                        help='batch the plain WQL collectors over one connection')
+    parser.add_argument('--max-collectors', type=int,
+                        help='run at most this many collectors at once, longest expected first')
+    parser.add_argument('--probe', action='store_true',
+                        help='run only the collectors whose change signals moved')
+    parser.add_argument('--incremental', action='store_true',
+                        help='rescan installed applications from the last run\'s fingerprints')
+    parser.add_argument('--profile', nargs='?', const='sample', choices=profiling.MODES,
+                        help='profile the collectors, sampling by default')
+    parser.add_argument('--profile-output', default='logs/profile',
+                        help='directory the profile is written to')
+    args = parser.parse_args()
+    scheduler = collector_scheduler.CollectorScheduler(args.max_collectors) \
+        if args.max_collectors else None
+    probe = change_probe.ChangeProbe() if args.probe else None
+
+    if args.profile is None:
+        print(json.dumps(collect_system_stats(args.host, planned=args.planned,
+                                              scheduler=scheduler, probe=probe,
+                                              incremental=args.incremental), indent=4))
+        return
+
+    _PROFILER = profiling.CollectorProfiler(args.profile)
+    _PROFILER.start()
+    try:
+        # Only the collector calls are profiled, _call_collector wraps them.
+        return_body = collect_system_stats(args.host, planned=args.planned, scheduler=scheduler,
+                                           probe=probe, incremental=args.incremental)
+    finally:
+        _PROFILER.stop()
+    print(json.dumps(return_body, indent=4))
+    print(_PROFILER.top())
+    for path in _PROFILER.write(args.profile_output):
+        print('Profile written to {0}'.format(path))
 
 
 if __name__ == '__main__':
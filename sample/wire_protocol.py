@@ -0,0 +1,265 @@
+#! /usr/bin/python3
+"""
+Description: Encode collector results for the agent wire protocol.
+
+The payload format is the msgpack subset needed for collector results
+(nil, bool, int, float, str, bin, array and map), framed with a 4 byte
+big endian length and a flags byte. Frames larger than a threshold are
+zlib compressed.
+
+Author: Shayne Cardwell
+
+Module: wire_protocol.py
+"""
+import struct
+import zlib
+
+FLAG_COMPRESSED = 0x01
+COMPRESS_THRESHOLD = 1024
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+_FRAME_HEADER = struct.Struct('>IB')
+
+
+class ProtocolError(Exception):
+    """Raised when a frame or payload cannot be decoded."""
+
+
+def _pack_int(value, out):
+    if 0 <= value < 0x80:
+        out.append(value)
+    elif -32 <= value < 0:
+        out.append(value & 0xff)
+    elif 0 <= value <= 0xffffffffffffffff:
+        for marker, fmt, limit in ((0xcc, '>B', 0xff), (0xcd, '>H', 0xffff),
+                                   (0xce, '>I', 0xffffffff), (0xcf, '>Q', 0xffffffffffffffff)):
+            if value <= limit:
+                out.append(marker)
+                out += struct.pack(fmt, value)
+                return
+    elif -0x8000000000000000 <= value < 0:
+        for marker, fmt, limit in ((0xd0, '>b', 0x80), (0xd1, '>h', 0x8000),
+                                   (0xd2, '>i', 0x80000000), (0xd3, '>q', 0x8000000000000000)):
+            if value >= -limit:
+                out.append(marker)
+                out += struct.pack(fmt, value)
+                return
+    else:
+        # WMI uint64 values never get here, and a str would decode as one.
+        raise ProtocolError('Cannot encode int {0}, outside the 64 bit range'.format(value))
+
+
+def _pack_length(length, fix_marker, fix_limit, markers, out):
+    if fix_marker is not None and length < fix_limit:
+        out.append(fix_marker | length)
+    elif markers[0] is not None and length <= 0xff:
+        out.append(markers[0])
+        out += struct.pack('>B', length)
+    elif length <= 0xffff:
+        out.append(markers[1])
+        out += struct.pack('>H', length)
+    else:
+        out.append(markers[2])
+        out += struct.pack('>I', length)
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        _pack_int(obj, out)
+    elif isinstance(obj, float):
+        out.append(0xcb)
+        out += struct.pack('>d', obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        _pack_length(len(data), 0xa0, 32, (0xd9, 0xda, 0xdb), out)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        _pack_length(len(obj), None, 0, (0xc4, 0xc5, 0xc6), out)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(len(obj), 0x90, 16, (None, 0xdc, 0xdd), out)
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        _pack_length(len(obj), 0x80, 16, (None, 0xde, 0xdf), out)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise ProtocolError('Cannot encode object of type {0}'.format(type(obj).__name__))
+
+
+def pack(obj):
+    """Return the msgpack encoding of a collector result.
+
+    >>> unpack(pack({'Index': 1, 'IPEnabled': True, 'IPAddress': ['10.0.0.1']}))
+    {'Index': 1, 'IPEnabled': True, 'IPAddress': ['10.0.0.1']}
+
+    Args:
+        obj(object): A json like object made of dicts, lists and scalars
+
+    Returns:
+        data(bytes): The encoded object
+
+    """
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+class _Reader(object):  # pylint: disable=R0903
+
+    _FIXED = {0xca: '>f', 0xcb: '>d', 0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+              0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q'}
+    _LENGTHS = {0xc4: '>B', 0xc5: '>H', 0xc6: '>I', 0xd9: '>B', 0xda: '>H', 0xdb: '>I',
+                0xdc: '>H', 0xdd: '>I', 0xde: '>H', 0xdf: '>I'}
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def _take(self, size):
+        if self.offset + size > len(self.data):
+            raise ProtocolError('Truncated payload')
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+    def _unpack_fmt(self, fmt):
+        return struct.unpack(fmt, self._take(struct.calcsize(fmt)))[0]
+
+    def read(self):  # pylint: disable=R0911,R0912
+        marker = self._take(1)[0]
+        if marker < 0x80:
+            return marker
+        if marker >= 0xe0:
+            return marker - 0x100
+        if 0x80 <= marker <= 0x8f:
+            return self._read_map(marker & 0x0f)
+        if 0x90 <= marker <= 0x9f:
+            return [self.read() for _ in range(marker & 0x0f)]
+        if 0xa0 <= marker <= 0xbf:
+            return str(self._take(marker & 0x1f), 'utf-8')
+        if marker == 0xc0:
+            return None
+        if marker in (0xc2, 0xc3):
+            return marker == 0xc3
+        if marker in self._FIXED:
+            return self._unpack_fmt(self._FIXED[marker])
+        if marker in self._LENGTHS:
+            length = self._unpack_fmt(self._LENGTHS[marker])
+            if marker in (0xc4, 0xc5, 0xc6):
+                return bytes(self._take(length))
+            if marker in (0xd9, 0xda, 0xdb):
+                return str(self._take(length), 'utf-8')
+            if marker in (0xdc, 0xdd):
+                return [self.read() for _ in range(length)]
+            return self._read_map(length)
+        raise ProtocolError('Unsupported marker 0x{0:02x}'.format(marker))
+
+    def _read_map(self, length):
+        result = {}
+        for _ in range(length):
+            key = self.read()
+            result[key] = self.read()
+        return result
+
+
+def unpack(data):
+    """Return the object encoded by pack.
+
+    Args:
+        data(bytes): The encoded object
+
+    Returns:
+        obj(object): The decoded object
+
+    """
+    reader = _Reader(data)
+    obj = reader.read()
+    if reader.offset != len(reader.data):
+        raise ProtocolError('Trailing bytes after payload')
+    return obj
+
+
+def encode_frame(message, compress_threshold=COMPRESS_THRESHOLD):
+    """Return a length prefixed frame for the message.
+
+    Args:
+        message(object): The request or response to send
+        compress_threshold(int): Payloads of at least this many bytes
+            are zlib compressed, None disables compression
+
+    Returns:
+        frame(bytes): The header followed by the payload
+
+    """
+    payload = pack(message)
+    flags = 0
+    if compress_threshold is not None and len(payload) >= compress_threshold:
+        payload = zlib.compress(payload)
+        flags |= FLAG_COMPRESSED
+    return _FRAME_HEADER.pack(len(payload), flags) + payload
+
+
+def decode_frames(buffer):
+    """Split complete frames off the front of a receive buffer.
+
+    Args:
+        buffer(bytearray): Bytes received so far, consumed in place
+
+    Returns:
+        messages(list): The decoded messages of every complete frame
+
+    """
+    messages = []
+    while len(buffer) >= _FRAME_HEADER.size:
+        length, flags = _FRAME_HEADER.unpack_from(buffer)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError('Frame of {0} bytes exceeds the limit'.format(length))
+        end = _FRAME_HEADER.size + length
+        if len(buffer) < end:
+            break
+        payload = bytes(buffer[_FRAME_HEADER.size:end])
+        del buffer[:end]
+        if flags & FLAG_COMPRESSED:
+            decompressor = zlib.decompressobj()
+            payload = decompressor.decompress(payload, MAX_FRAME_SIZE)
+            if decompressor.unconsumed_tail:
+                raise ProtocolError('Frame inflates beyond {0} bytes'.format(MAX_FRAME_SIZE))
+        messages.append(unpack(payload))
+    return messages
+
+
+def read_frame(sock, buffer):
+    """Block until one message can be read from the socket.
+
+    Args:
+        sock(socket): A connected socket
+        buffer(bytearray): The connection's receive buffer, frames
+            beyond the first are left in it for the next call
+
+    Returns:
+        message(object): The decoded message, None when the peer closed
+            the connection
+
+    """
+    while True:
+        if len(buffer) >= _FRAME_HEADER.size:
+            length = _FRAME_HEADER.unpack_from(buffer)[0]
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError('Frame of {0} bytes exceeds the limit'.format(length))
+            if len(buffer) >= _FRAME_HEADER.size + length:
+                header_and_payload = bytearray(buffer[:_FRAME_HEADER.size + length])
+                del buffer[:_FRAME_HEADER.size + length]
+                return decode_frames(header_and_payload)[0]
+        chunk = sock.recv(65536)
+        if not chunk:
+            return None
+        buffer += chunk
@@ -0,0 +1,524 @@
+#! /usr/bin/python3
+"""
+Description: Record the WMI traffic of a collection and replay it off Windows.
+
+Recording swaps wmi.WMI and wmi.connect_server for factories whose
+connections pass every call through to the real ones and write down
+what they returned and how long it took: wmi_obj.query, the ExecQuery result sets read by
+utility.iter_results a batch at a time, class calls such as
+Win32_Process(Name=...) and the methods called on what they return,
+GetOwner or the StdRegProv EnumKey, EnumValues and GetStringValue.
+Errors are recorded with their HRESULT. The calls are written to a
+gzipped JSON cassette keyed by namespace, object path and arguments, a
+list of responses per key in the order they were made.
+
+Replaying installs stand-ins for the wmi, pythoncom and win32com
+modules in sys.modules that answer from the cassette, so every
+collector runs unchanged, on any platform, sleeping the recorded time
+divided by the speed (0 does not sleep) before answering.
+
+Both run the collectors through get_system_information, so recording
+or replaying a host writes no report log and adds nothing to the
+metric store or service index.
+
+Usage:
+    wmi_cassette.py record host.cassette.gz --host HOST
+    wmi_cassette.py replay host.cassette.gz --speed 0
+
+Author: Shayne Cardwell
+
+Module: wmi_cassette.py
+"""
+import argparse
+import gzip
+import json
+import sys
+import threading
+import time
+import types
+from datetime import datetime
+
+import sample.resilience as resilience
+import sample.utility as utility
+
+CASSETTE_VERSION = 1
+DEFAULT_NAMESPACE = 'root/cimv2'
+
+
+class CassetteMiss(LookupError):
+    """Raised on replay for a call the cassette has no response to."""
+
+
+class ReplayedError(Exception):
+    """Raised on replay where the recorded call raised.
+
+    args[0] is the recorded HRESULT, so resilience treats it as the
+    original error.
+
+    """
+
+
+def _namespace_of(kwargs):
+    return (kwargs.get('namespace') or DEFAULT_NAMESPACE).replace('\\', '/').lower()
+
+
+def _call_key(path, args, kwargs):
+    return '{0}|{1}'.format(path, json.dumps([list(args), sorted(kwargs.items())], default=str))
+
+
+def _is_wmi_object(value):
+    return hasattr(value, 'GetObjectText_')
+
+
+def _encode(value):
+    if isinstance(value, tuple):
+        return {'tuple': [_encode(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if _is_wmi_object(value):
+        return {'object': str(value)}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _encode_error(error, seconds):
+    return {'seconds': seconds, 'error': type(error).__name__, 'message': str(error),
+            'hresult': resilience.hresult_of(error)}
+
+
+class Cassette(object):
+    """The recorded calls of one host.
+
+    Args:
+        host(string): The host the calls were made to
+        calls(dict): Responses keyed by call, in the order they were made
+
+    """
+
+    def __init__(self, host, calls=None, recorded=None):
+        self.host = host
+        self.calls = calls if calls is not None else {}
+        self.recorded = recorded or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.lock = threading.Lock()
+        self.positions = {}
+
+    def add(self, key, response):
+        """Append a response for key, returned so it can still be filled in."""
+        with self.lock:
+            self.calls.setdefault(key, []).append(response)
+        return response
+
+    def next(self, key):
+        """Return the next response for key, the last one once all are used."""
+        with self.lock:
+            responses = self.calls.get(key)
+            if not responses:
+                raise CassetteMiss('No recorded response to {0}'.format(key))
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+            return responses[min(position, len(responses) - 1)]
+
+    def rewind(self):
+        """Start handing out the responses from the first again."""
+        with self.lock:
+            self.positions = {}
+
+    def save(self, path):
+        """Write the cassette as gzipped JSON."""
+        with gzip.open(path, 'wt', encoding='utf-8') as file_object:
+            json.dump({'version': CASSETTE_VERSION, 'host': self.host,
+                       'recorded': self.recorded, 'calls': self.calls},
+                      file_object, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path):
+        """Read a cassette written by save."""
+        with gzip.open(path, 'rt', encoding='utf-8') as file_object:
+            data = json.load(file_object)
+        if data.get('version') != CASSETTE_VERSION:
+            raise ValueError('Unsupported cassette version {0}'.format(data.get('version')))
+        return cls(data['host'], data['calls'], data['recorded'])
+
+
+class _RecordingObject(object):
+
+    def __init__(self, target, path, cassette):
+        self._target = target
+        self._path = path
+        self._cassette = cassette
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if callable(value):
+            return _RecordingObject(value, '{0}.{1}'.format(self._path, name), self._cassette)
+        return value
+
+    def __str__(self):
+        return str(self._target)
+
+    def __call__(self, *args, **kwargs):
+        key = _call_key(self._path, args, kwargs)
+        started = time.perf_counter()
+        try:
+            result = self._target(*args, **kwargs)
+        except Exception as error:
+            self._cassette.add(key, _encode_error(error, time.perf_counter() - started))
+            raise
+        self._cassette.add(key, {'seconds': time.perf_counter() - started,
+                                 'result': _encode(result)})
+        return self._wrap(result, key)
+
+    def _wrap(self, value, key, index=''):
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._wrap(item, key, '{0}[{1}]'.format(index, position))
+                               for position, item in enumerate(value))
+        if _is_wmi_object(value):
+            return _RecordingObject(value, key + index, self._cassette)
+        return value
+
+
+class _RecordingResultSet(object):
+    # Stands in for the SWbemObjectSet, its _oleobj_ and the IEnumVARIANT
+    # that utility.iter_results reaches through, recording every batch.
+
+    def __init__(self, target, response):
+        self._target = target
+        self._response = response
+
+    @property
+    def _oleobj_(self):
+        return _RecordingResultSet(self._target._oleobj_, self._response)
+
+    def InvokeTypes(self, *args):  # pylint: disable=C0103
+        return _RecordingResultSet(self._target.InvokeTypes(*args), self._response)
+
+    def QueryInterface(self, *args):  # pylint: disable=C0103
+        return _RecordingResultSet(self._target.QueryInterface(*args), self._response)
+
+    def Next(self, count):  # pylint: disable=C0103
+        from win32com.client import Dispatch  # pylint: disable=C0415
+
+        started = time.perf_counter()
+        batch = self._target.Next(count)
+        self._response['batches'].append([time.perf_counter() - started,
+                                          [Dispatch(item).GetObjectText_() for item in batch]])
+        return batch
+
+
+class _RecordingNamespace(object):
+
+    def __init__(self, target, namespace, cassette):
+        self._target = target
+        self._namespace = namespace
+        self._cassette = cassette
+
+    def ExecQuery(self, strQuery, iFlags=0):  # pylint: disable=C0103
+        key = _call_key('{0}.ExecQuery'.format(self._namespace), (strQuery,), {})
+        started = time.perf_counter()
+        try:
+            result_set = self._target.ExecQuery(strQuery=strQuery, iFlags=iFlags)
+        except Exception as error:
+            self._cassette.add(key, _encode_error(error, time.perf_counter() - started))
+            raise
+        response = self._cassette.add(key, {'seconds': time.perf_counter() - started,
+                                            'batches': []})
+        return _RecordingResultSet(result_set, response)
+
+
+class _RecordingConnection(_RecordingObject):
+
+    @property
+    def _namespace(self):
+        return _RecordingNamespace(self._target._namespace,  # pylint: disable=W0212
+                                   self._path, self._cassette)
+
+
+class Recorder(object):
+    """Record every WMI call made while installed.
+
+    Args:
+        host(string): The host being collected, stored in the cassette
+
+    """
+
+    def __init__(self, host):
+        self.cassette = Cassette(host)
+        self.wmi = None
+        self.factory = None
+        self.server_factory = None
+
+    def _timed_connect(self, namespace, factory, *args, **kwargs):
+        key = 'connect|{0}'.format(namespace)
+        started = time.perf_counter()
+        try:
+            connection = factory(*args, **kwargs)
+        except Exception as error:
+            self.cassette.add(key, _encode_error(error, time.perf_counter() - started))
+            raise
+        self.cassette.add(key, {'seconds': time.perf_counter() - started})
+        return connection
+
+    def connect(self, *args, **kwargs):
+        """Open a real connection wrapped for recording, used as wmi.WMI.
+
+        A connection wrapping one from connect_server was recorded there.
+
+        """
+        namespace = _namespace_of(kwargs)
+        if kwargs.get('wmi') is not None:
+            connection = self.factory(*args, **kwargs)
+        else:
+            connection = self._timed_connect(namespace, self.factory, *args, **kwargs)
+        return _RecordingConnection(connection, namespace, self.cassette)
+
+    def connect_server(self, server, namespace='', *args, **kwargs):
+        """Connect to a remote host, used as wmi.connect_server."""
+        return self._timed_connect(_namespace_of({'namespace': namespace}),
+                                   self.server_factory, server, namespace, *args, **kwargs)
+
+    def install(self):
+        """Replace wmi.WMI and wmi.connect_server with the recording factories."""
+        import wmi  # pylint: disable=C0415
+
+        self.wmi = wmi
+        self.factory = wmi.WMI
+        self.server_factory = wmi.connect_server
+        wmi.WMI = self.connect
+        wmi.connect_server = self.connect_server
+
+    def uninstall(self):
+        """Put the real wmi.WMI and wmi.connect_server back."""
+        if self.wmi is not None:
+            self.wmi.WMI = self.factory
+            self.wmi.connect_server = self.server_factory
+            self.wmi = None
+
+    def save(self, path):
+        """Write what was recorded, see Cassette.save."""
+        self.cassette.save(path)
+
+
+class _ReplayObject(object):
+
+    def __init__(self, player, path, text=None):
+        self._player = player
+        self._path = path
+        self._text = text
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _ReplayObject(self._player, '{0}.{1}'.format(self._path, name))
+
+    def __str__(self):
+        return self._text or ''
+
+    def GetObjectText_(self):  # pylint: disable=C0103
+        return str(self)
+
+    def __call__(self, *args, **kwargs):
+        key = _call_key(self._path, args, kwargs)
+        return self._decode(self._player.answer(key)['result'], key)
+
+    def _decode(self, value, key, index=''):
+        if isinstance(value, dict) and 'tuple' in value:
+            return tuple(self._decode(item, key, '{0}[{1}]'.format(index, position))
+                         for position, item in enumerate(value['tuple']))
+        if isinstance(value, list):
+            return [self._decode(item, key, '{0}[{1}]'.format(index, position))
+                    for position, item in enumerate(value)]
+        if isinstance(value, dict) and 'object' in value:
+            return _ReplayObject(self._player, key + index, value['object'])
+        return value
+
+
+class _ReplayResultSet(object):
+
+    def __init__(self, player, response):
+        self._player = player
+        self._batches = iter(response['batches'])
+        self._oleobj_ = self
+
+    def InvokeTypes(self, *args):  # pylint: disable=C0103,W0613
+        return self
+
+    def QueryInterface(self, *args):  # pylint: disable=C0103,W0613
+        return self
+
+    def Next(self, count):  # pylint: disable=C0103,W0613
+        for seconds, texts in self._batches:
+            self._player.wait(seconds)
+            return [_ReplayObject(self._player, '', text) for text in texts]
+        return ()
+
+
+class _ReplayNamespace(object):
+
+    def __init__(self, player, namespace):
+        self._player = player
+        self._namespace = namespace
+
+    def ExecQuery(self, strQuery, iFlags=0):  # pylint: disable=C0103,W0613
+        key = _call_key('{0}.ExecQuery'.format(self._namespace), (strQuery,), {})
+        return _ReplayResultSet(self._player, self._player.answer(key))
+
+
+class _ReplayConnection(_ReplayObject):
+
+    def __init__(self, player, namespace):
+        super(_ReplayConnection, self).__init__(player, namespace)
+        self._namespace = _ReplayNamespace(player, namespace)
+
+
+class Player(object):
+    """Answer WMI calls from a cassette.
+
+    Args:
+        cassette(Cassette): The recorded calls
+        speed(float): Recorded time is divided by it, 0 does not wait
+
+    """
+
+    def __init__(self, cassette, speed=1.0):
+        self.cassette = cassette
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.calls = 0
+
+    def wait(self, seconds):
+        """Sleep for a recorded duration at the replay speed."""
+        if self.speed and seconds:
+            time.sleep(seconds / self.speed)
+            with self.lock:
+                self.waited += seconds / self.speed
+
+    def answer(self, key):
+        """Return the next response to key, raising a recorded error."""
+        response = self.cassette.next(key)
+        with self.lock:
+            self.calls += 1
+        self.wait(response['seconds'])
+        if 'error' in response:
+            raise ReplayedError(response['hresult'], '{0}: {1}'.format(response['error'],
+                                                                       response['message']))
+        return response
+
+    def connect(self, *args, **kwargs):  # pylint: disable=W0613
+        """Return a replay connection, used as wmi.WMI."""
+        if kwargs.get('wmi') is not None:
+            return kwargs['wmi']
+        namespace = _namespace_of(kwargs)
+        self.answer('connect|{0}'.format(namespace))
+        return _ReplayConnection(self, namespace)
+
+    def connect_server(self, server, namespace='', *args, **kwargs):  # pylint: disable=W0613
+        """Return a replay connection, used as wmi.connect_server."""
+        return self.connect(namespace=namespace)
+
+    def modules(self):
+        """Return the stand-in modules by name."""
+        wmi = types.ModuleType('wmi')
+        wmi.WMI = self.connect
+        wmi.connect_server = self.connect_server
+        wmi.x_wmi = ReplayedError
+        pythoncom = types.ModuleType('pythoncom')
+        pythoncom.CoInitialize = lambda: None
+        pythoncom.CoUninitialize = lambda: None
+        pythoncom.DISPID_NEWENUM = -4
+        pythoncom.DISPATCH_METHOD = 1
+        pythoncom.DISPATCH_PROPERTYGET = 2
+        pythoncom.IID_IEnumVARIANT = '{00020404-0000-0000-C000-000000000046}'
+        pythoncom.com_error = ReplayedError
+        win32com = types.ModuleType('win32com')
+        win32com.client = types.ModuleType('win32com.client')
+        win32com.client.Dispatch = lambda item: item
+        return {'wmi': wmi, 'pythoncom': pythoncom, 'win32com': win32com,
+                'win32com.client': win32com.client}
+
+    def install(self):
+        """Put the stand-in modules in sys.modules.
+
+        Must run before the collectors are imported, as they bind wmi
+        and pythoncom at import time.
+
+        """
+        sys.modules.update(self.modules())
+
+
+def _collect(host, planned):
+    # get_system_information rather than collect_system_stats, which would
+    # also feed the metric store and service index, and no collector logs.
+    import sample.win_system_get_statistics as orchestrator  # pylint: disable=C0415
+
+    failures = {}
+    result = {'messages': []}
+    with utility.report_logs_off():
+        result['content'] = orchestrator.get_system_information(
+            host, budget=resilience.TimeoutBudget(orchestrator.DEFAULT_HOST_TIMEOUT),
+            failures=failures, planned=planned, messages=result['messages'])
+    for name in sorted(failures):
+        result['messages'].append('{0} failed: {1}'.format(name, failures[name]))
+    result['outcome'] = 'Successful' if result['content'] or not failures else 'Failed'
+    return result
+
+
+def record(path, host, planned=False):
+    """Collect a host and record its WMI calls to path.
+
+    Returns:
+        result(dict): 'outcome', 'messages' and 'content' of the
+            collection, nothing is logged or stored
+
+    """
+    recorder = Recorder(host)
+    recorder.install()
+    try:
+        return _collect(host, planned)
+    finally:
+        recorder.uninstall()
+        recorder.save(path)
+
+
+def replay(path, speed=1.0, planned=False):
+    """Collect the host of a cassette from the cassette.
+
+    Returns:
+        result(dict): As returned by record
+        player(Player): Holds the number of calls answered and the time
+            spent waiting
+
+    """
+    player = Player(Cassette.load(path), speed)
+    player.install()
+    return _collect(player.cassette.host, planned), player
+
+
+def main():
+    """Make module a standalone module."""
+    parser = argparse.ArgumentParser(description='Record or replay the WMI calls of a host.')
+    parser.add_argument('mode', choices=('record', 'replay'))
+    parser.add_argument('cassette')
+    parser.add_argument('--host', help='the host to record, defaults to this one')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, 0 answers without waiting')
+    parser.add_argument('--planned', action='store_true')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.mode == 'record':
+        from platform import node  # pylint: disable=C0415
+        result = record(args.cassette, args.host or node(), args.planned)
+        print('{0}: recorded in {1:.2f}s'.format(result['outcome'],
+                                                 time.perf_counter() - started))
+        return
+    result, player = replay(args.cassette, args.speed, args.planned)
+    print('{0}: {1} calls replayed in {2:.2f}s, {3:.2f}s of it waiting'.format(
+        result['outcome'], player.calls, time.perf_counter() - started, player.waited))
+    for message in result['messages']:
+        print(message)
+
+
+if __name__ == '__main__':
+    main()
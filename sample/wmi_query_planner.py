@@ -0,0 +1,184 @@
+#! /usr/bin/python
+"""
+Description: plan and run the WQL queries of many collectors per host.
+
+Most collectors are a single "select a class, key the rows by one
+property" query. The planner gathers those queries for every requested
+collector, drops duplicates, starts them all semisynchronously over one
+shared connection so the provider works on them concurrently, then
+drains the forward only enumerators and routes each result set back to
+the sections that asked for it. Collectors that need more than a query
+(method calls, registry walks, joins) are reported back as fallbacks to
+run as usual.
+
+Author: Shayne Cardwell
+
+Module: wmi_query_planner.py
+"""
+import json
+import sys
+import time
+from platform import node
+
+try:
+    import sample.utility as utility
+    from sample.win_network_statistics import DEFAULT_FILTERS as NETWORK_FILTERS
+    from sample.win_drive_statistics import add_disk_topology, link_pairs
+    from sample.win_services_statistics import dependency_map
+except ModuleNotFoundError:
+    print('Had trouble finding packages')
+    print('Please install via the command below')
+    print('pipenv install')
+    sys.exit(1)
+
+# section name: (namespace, class, key property, default filters), sections
+# without a key property are built from their rows by SECTION_BUILDERS
+SECTIONS = {
+    'bios_information':      ('root/cimv2', 'Win32_BIOS', 'Caption', None),
+    'disk_partitions':       ('root/cimv2', 'Win32_DiskPartition', 'DeviceID', None),
+    'disk_drive_links':      ('root/cimv2', 'Win32_DiskDriveToDiskPartition', None, None),
+    'logical_disk_links':    ('root/cimv2', 'Win32_LogicalDiskToPartition', None, None),
+    'physical_drives':       ('root/cimv2', 'Win32_DiskDrive', 'Index', None),
+    'logical_drives':        ('root/cimv2', 'Win32_LogicalDisk', 'DeviceID', None),
+    'local_accounts':        ('root/cimv2', 'Win32_UserAccount', 'Caption', None),
+    'physical_memory':       ('root/cimv2', 'Win32_PhysicalMemory', 'DeviceLocator', None),
+    'network_adapters':      ('root/cimv2', 'Win32_NetworkAdapter', 'Index',
+                              NETWORK_FILTERS['Win32_NetworkAdapter']),
+    'network_configuration': ('root/cimv2', 'Win32_NetworkAdapterConfiguration', 'Index',
+                              NETWORK_FILTERS['Win32_NetworkAdapterConfiguration']),
+    'os_info':               ('root/cimv2', 'Win32_OperatingSystem', 'Caption', None),
+    'processors':            ('root/cimv2', 'Win32_Processor', 'DeviceID', None),
+    'services':              ('root/cimv2', 'Win32_Service', 'Caption', None),
+    'service_dependencies':  ('root/cimv2', 'Win32_DependentService', None, None)
+}
+
+SECTION_BUILDERS = {
+    'disk_drive_links':     link_pairs,
+    'logical_disk_links':   link_pairs,
+    'service_dependencies': dependency_map
+}
+
+# Run over the whole content once every section is in, to join sections
+CONTENT_BUILDERS = [add_disk_topology]
+
+# collector name: the sections it produces, None when it cannot be planned
+COLLECTOR_SECTIONS = {
+    'collect_win_application_stats':   None,
+    'collect_win_bios_stats':          ['bios_information'],
+    'collect_win_disk_stats':          ['disk_partitions', 'physical_drives', 'logical_drives',
+                                        'disk_drive_links', 'logical_disk_links'],
+    'collect_win_local_account_stats': ['local_accounts'],
+    'collect_win_local_group_stats':   None,
+    'collect_win_mem_stats':           ['physical_memory'],
+    'collect_win_network_stats':       ['network_adapters', 'network_configuration'],
+    'collect_os_stats':                ['os_info'],
+    'collect_win_processes_stats':     None,
+    'collect_win_cpu_stats':           ['processors'],
+    'collect_win_services_stats':      ['services', 'service_dependencies']
+}
+
+
+def _get_wmi_obj(name, namespace):
+    return utility.connect(name, namespace)
+
+
+def plan_queries(collectors, filters=None):
+    """Return the deduplicated queries the collectors need.
+
+    Args:
+        collectors(list): Collector functions or their names
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name, replacing a section's default filters
+
+    Returns:
+        plan(dict): 'queries' maps (namespace, wql) to the
+            [(section, key property)] it feeds, 'fallback' lists the
+            collectors that must run on their own
+
+    """
+    filters = filters or {}
+    plan = {'queries': {}, 'fallback': []}
+    for collector in collectors:
+        name = getattr(collector, '__name__', collector)
+        sections = COLLECTOR_SECTIONS.get(name)
+        if sections is None:
+            plan['fallback'].append(collector)
+            continue
+        for section in sections:
+            namespace, class_name, key, default = SECTIONS[section]
+            wql = utility.build_wql(class_name, filters.get(class_name, default))
+            consumers = plan['queries'].setdefault((namespace, wql), [])
+            if (section, key) not in consumers:
+                consumers.append((section, key))
+    return plan
+
+
+def run_plan(host, plan, connections=None):
+    """Run a plan's queries against one host.
+
+    Every query is started before any result is read, then the result
+    sets are drained in order and parsed once for all their consumers.
+
+    Args:
+        host(string): The name of the host
+        plan(dict): As returned by plan_queries
+        connections(dict): Optional, open connections keyed by namespace
+            to reuse, new connections are added to it
+
+    Returns:
+        content(dict): The sections keyed by section name
+        stats(dict): 'connections', 'queries', 'rows' and 'seconds'
+
+    """
+    started = time.time()
+    connections = {} if connections is None else connections
+    stats = {'connections': 0, 'queries': len(plan['queries']), 'rows': 0}
+    pending = []
+    for (namespace, wql), consumers in plan['queries'].items():
+        if namespace not in connections:
+            connections[namespace] = _get_wmi_obj(host, namespace)
+            stats['connections'] += 1
+        pending.append((utility.exec_query(connections[namespace], wql), consumers))
+
+    content = {}
+    for enumerator, consumers in pending:
+        rows = list(utility.iter_results(enumerator))
+        stats['rows'] += len(rows)
+        for section, key in consumers:
+            if key is None:
+                content[section] = SECTION_BUILDERS[section](rows)
+            else:
+                content[section] = {row[key]: row for row in rows}
+    for builder in CONTENT_BUILDERS:
+        builder(content)
+    stats['seconds'] = time.time() - started
+    return content, stats
+
+
+def collect_planned_stats(host=node(), filters=None, collectors=None):
+    """Collect the sections of every plannable collector in one pass.
+
+    Args:
+        host(string): The name of the host
+        filters(dict): Optional, WQL filter expressions keyed by Win32
+            class name
+        collectors(list): Optional, the collectors to plan, defaults to
+            every plannable collector
+
+    Returns:
+        return_body(dict): 'content' with the sections and 'query_stats'
+
+    """
+    if collectors is None:
+        collectors = [name for name, sections in COLLECTOR_SECTIONS.items() if sections]
+    content, stats = run_plan(host, plan_queries(collectors, filters))
+    return {'content': content, 'query_stats': stats}
+
+
+def main():
+    """Make module a standalone module."""
+    print(json.dumps(collect_planned_stats(), indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""Benchmark sizes and results.
+
+Benchmarks are marked benchmark and run scaled down in the default
+test run, which still checks their results but not their timings. Set
+BENCHMARK=1 to run them at full size with their timing assertions, and
+their results are listed at the end of the pytest summary. A size
+variable, e.g. EVENT_BENCH_RECORDS, overrides a single size.
+"""
+import os
+
+FULL = os.environ.get('BENCHMARK', '') not in ('', '0')
+RESULTS = []
+
+
+def size(variable, full, scaled):
+    """Return a benchmark size, from its variable when set."""
+    return type(full)(os.environ.get(variable, full if FULL else scaled))
+
+
+def report(name, text):
+    """Keep a benchmark result for the pytest summary."""
+    RESULTS.append((name, text))
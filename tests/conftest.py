@@ -0,0 +1,30 @@
+"""Run the collectors against the fake WMI backend."""
+import pytest
+
+from tests import bench, fake_wmi
+
+# The collectors import wmi and pythoncom at import time.
+fake_wmi.install()
+
+
+def pytest_configure(config):
+    """Register the benchmark marker."""
+    config.addinivalue_line('markers', 'benchmark: measures performance, scaled down unless '
+                                       'BENCHMARK=1, see tests/bench.py')
+
+
+def pytest_terminal_summary(terminalreporter):
+    """List the benchmark results of a full size run."""
+    if bench.FULL and bench.RESULTS:
+        terminalreporter.section('benchmarks')
+        for name, text in bench.RESULTS:
+            terminalreporter.write_line('{0}: {1}'.format(name, text))
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    """Return an empty fake fleet, with the working directory in tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    fake_wmi.BACKEND.hosts = {}
+    yield fake_wmi.BACKEND
+    fake_wmi.BACKEND.hosts = {}
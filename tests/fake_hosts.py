@@ -0,0 +1,71 @@
+"""Rows for the WMI classes of a plausible server, to load into a FakeHost."""
+
+GB = 1024 ** 3
+
+
+def reference(class_name, **keys):
+    """Return a WMI object path like the ones association classes hold."""
+    return '\\\\SERVER\\root\\cimv2:{0}.{1}'.format(class_name, ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in sorted(keys.items())))
+
+
+def disk_classes(layout):
+    """Return the disk, partition and volume classes of a disk layout.
+
+    Args:
+        layout(dict): {disk Index: [drive letter, or None for a
+            partition without a volume, per partition]}
+
+    """
+    classes = {'Win32_DiskDrive': [], 'Win32_DiskPartition': [], 'Win32_LogicalDisk': [],
+               'Win32_DiskDriveToDiskPartition': [], 'Win32_LogicalDiskToPartition': []}
+    for index, volumes in layout.items():
+        device = '\\\\.\\PHYSICALDRIVE{0}'.format(index)
+        classes['Win32_DiskDrive'].append({'Index': index, 'DeviceID': device,
+                                           'Model': 'Disk {0}'.format(index),
+                                           'Partitions': len(volumes), 'Size': str(512 * GB)})
+        for number, letter in enumerate(volumes):
+            partition = 'Disk #{0}, Partition #{1}'.format(index, number)
+            classes['Win32_DiskPartition'].append({'DeviceID': partition, 'DiskIndex': index,
+                                                   'Index': number, 'Size': str(64 * GB)})
+            classes['Win32_DiskDriveToDiskPartition'].append({
+                'Antecedent': reference('Win32_DiskDrive', DeviceID=device),
+                'Dependent': reference('Win32_DiskPartition', DeviceID=partition)})
+            if letter is None:
+                continue
+            classes['Win32_LogicalDisk'].append({'DeviceID': letter, 'DriveType': 3,
+                                                 'Size': str(64 * GB), 'FreeSpace': str(GB)})
+            classes['Win32_LogicalDiskToPartition'].append({
+                'Antecedent': reference('Win32_DiskPartition', DeviceID=partition),
+                'Dependent': reference('Win32_LogicalDisk', DeviceID=letter)})
+    return classes
+
+
+def server_classes(services=60, layout=None):
+    """Return the classes every plannable collector reads, for one server."""
+    classes = {
+        'Win32_BIOS': [{'Caption': 'BIOS', 'Version': 'DELL - 1072009',
+                        'SerialNumber': 'ABC1234'}],
+        'Win32_OperatingSystem': [{'Caption': 'Microsoft Windows Server 2019 Standard',
+                                   'Version': '10.0.17763', 'LastBootUpTime':
+                                   '20210301080000.500000+000', 'FreePhysicalMemory': '4194304'}],
+        'Win32_Processor': [{'DeviceID': 'CPU{0}'.format(number), 'Name': 'Xeon',
+                             'NumberOfCores': 8} for number in range(2)],
+        'Win32_PhysicalMemory': [{'DeviceLocator': 'DIMM{0}'.format(number),
+                                  'Capacity': str(16 * GB)} for number in range(4)],
+        'Win32_NetworkAdapter': [{'Index': number, 'Name': 'Adapter {0}'.format(number),
+                                  'NetEnabled': number < 2} for number in range(6)],
+        'Win32_NetworkAdapterConfiguration': [{'Index': number, 'IPEnabled': number < 2}
+                                              for number in range(6)],
+        'Win32_UserAccount': [{'Caption': 'SERVER\\user{0}'.format(number),
+                               'Name': 'user{0}'.format(number)} for number in range(3)],
+        'Win32_Service': [{'Name': 'svc{0}'.format(number), 'Caption': 'Service {0}'.format(number),
+                           'State': 'Running', 'StartMode': 'Auto'}
+                          for number in range(services)],
+        'Win32_DependentService': [{
+            'Antecedent': reference('Win32_Service', Name='svc{0}'.format(number - 1)),
+            'Dependent': reference('Win32_Service', Name='svc{0}'.format(number))}
+            for number in range(1, services, 3)]}
+    classes.update(disk_classes(layout or {0: ['C:', None], 1: ['D:']}))
+    return classes
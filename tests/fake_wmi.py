@@ -0,0 +1,468 @@
+"""A scriptable fake of the wmi, pythoncom and win32com modules.
+
+Every host is a FakeHost holding rows per WMI class and a registry
+tree. Queries are parsed and evaluated like the provider would, so
+WHERE clauses really reduce the rows returned, and every query, method
+call and connection is recorded on the host for tests to assert on.
+
+Injected latencies model the round trips: a synchronous query waits
+for its latency when it is made, a semisynchronous one returns at once
+and its first Next waits until the provider would have the result, so
+queries started together overlap like they do on a real host.
+"""
+import re
+import sys
+import time
+import types
+import weakref
+
+HKEY_LOCAL_MACHINE = 2147483650
+WBEM_FLAG_RETURN_IMMEDIATELY = 0x10
+
+_TOKEN = re.compile(r"\s*(?:(\()|(\))|('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")|"
+                    r"(<=|>=|<>|!=|=|<|>)|([\w.]+))")
+
+
+class WQLError(Exception):
+    """The fake provider could not parse a query, like WBEM_E_INVALID_QUERY."""
+
+
+def _unescape(literal):
+    return re.sub(r'\\(.)', r'\1', literal[1:-1])
+
+
+def _tokens(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            raise WQLError('Cannot parse {0!r}'.format(text[position:]))
+        position = match.end()
+        opening, closing, string, operator, word = match.groups()
+        if string is not None:
+            tokens.append(('value', _unescape(string)))
+        elif operator is not None:
+            tokens.append(('op', operator))
+        elif opening or closing:
+            tokens.append(('paren', opening or closing))
+        elif word.upper() in ('AND', 'OR', 'NOT', 'IS', 'NULL', 'TRUE', 'FALSE'):
+            tokens.append(('keyword', word.upper()))
+        elif re.match(r'^-?\d+(\.\d+)?$', word):
+            tokens.append(('value', float(word) if '.' in word else int(word)))
+        else:
+            tokens.append(('name', word))
+    return tokens
+
+
+class _Parser(object):
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if (kind and token[0] != kind) or (value and token[1] != value):
+            raise WQLError('Expected {0} {1}, got {2}'.format(kind, value, token))
+        self.position += 1
+        return token
+
+    def expression(self):
+        node = self.conjunction()
+        while self.peek() == ('keyword', 'OR'):
+            self.take()
+            node = ('or', node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.atom()
+        while self.peek() == ('keyword', 'AND'):
+            self.take()
+            node = ('and', node, self.atom())
+        return node
+
+    def atom(self):
+        if self.peek() == ('paren', '('):
+            self.take()
+            node = self.expression()
+            self.take('paren', ')')
+            return node
+        if self.peek() == ('keyword', 'NOT'):
+            self.take()
+            return ('not', self.atom())
+        name = self.take('name')[1]
+        if self.peek() == ('keyword', 'IS'):
+            self.take()
+            negate = self.peek() == ('keyword', 'NOT')
+            if negate:
+                self.take()
+            self.take('keyword', 'NULL')
+            return ('isnull', name, negate)
+        operator = self.take('op')[1]
+        kind, value = self.take()
+        if kind == 'keyword' and value in ('TRUE', 'FALSE', 'NULL'):
+            value = {'TRUE': True, 'FALSE': False, 'NULL': None}[value]
+        elif kind != 'value':
+            raise WQLError('Expected a value after {0}'.format(operator))
+        return ('compare', name, operator, value)
+
+
+def _compare(left, operator, right):
+    if left is None:
+        return False
+    if isinstance(right, bool):
+        left = left if isinstance(left, bool) else str(left).upper() == 'TRUE'
+    elif isinstance(right, (int, float)):
+        left = float(left)
+    elif isinstance(left, str):
+        left, right = left.lower(), str(right).lower()
+    return {'=': left == right, '<>': left != right, '!=': left != right, '<': left < right,
+            '>': left > right, '<=': left <= right, '>=': left >= right}[operator]
+
+
+def evaluate(node, row):
+    """Return whether a row matches a parsed WHERE clause."""
+    if node is None:
+        return True
+    if node[0] == 'and':
+        return evaluate(node[1], row) and evaluate(node[2], row)
+    if node[0] == 'or':
+        return evaluate(node[1], row) or evaluate(node[2], row)
+    if node[0] == 'not':
+        return not evaluate(node[1], row)
+    if node[0] == 'isnull':
+        return (row.get(node[1]) is None) == (not node[2])
+    return _compare(row.get(node[1]), node[2], node[3])
+
+
+def parse_query(wql):
+    """Return the properties, class and parsed WHERE clause of a query."""
+    match = re.match(r'^\s*SELECT\s+(.+?)\s+FROM\s+(\w+)(?:\s+WHERE\s+(.*))?$', wql,
+                     re.IGNORECASE | re.DOTALL)
+    if match is None:
+        raise WQLError('Invalid query {0!r}'.format(wql))
+    properties = [name.strip() for name in match.group(1).split(',')]
+    where = None
+    if match.group(3):
+        parser = _Parser(_tokens(match.group(3)))
+        where = parser.expression()
+        if parser.peek() != (None, None):
+            raise WQLError('Trailing tokens in {0!r}'.format(wql))
+    return (None if properties == ['*'] else properties), match.group(2), where
+
+
+def mof_text(class_name, properties):
+    """Return the GetObjectText_ rendering of an instance."""
+    lines = []
+    for name, value in properties.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            text = 'TRUE' if value else 'FALSE'
+        elif isinstance(value, (int, float)):
+            text = str(value)
+        elif isinstance(value, (list, tuple)):
+            text = '{' + ', '.join('"{0}"'.format(item) if isinstance(item, str) else str(item)
+                                   for item in value) + '}'
+        else:
+            text = '"{0}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        lines.append('\t{0} = {1};\n'.format(name, text))
+    return 'instance of {0}\n{{\n{1}}};'.format(class_name, ''.join(lines))
+
+
+class FakeInstance(object):
+    """A WMI instance, rendered with GetObjectText_ like SWbemObject."""
+
+    def __init__(self, host, class_name, properties):
+        self.host = host
+        self.class_name = class_name
+        self.properties = properties
+        host.instances.add(self)
+
+    def GetObjectText_(self):  # pylint: disable=C0103
+        return mof_text(self.class_name, self.properties)
+
+    def __str__(self):
+        return self.GetObjectText_()
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['properties'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def GetOwner(self):  # pylint: disable=C0103
+        self.host.call('GetOwner')
+        owner = self.host.owners.get(self.properties.get('ProcessId'), ('DOMAIN', 0, 'user'))
+        return owner
+
+
+class _Enumerator(object):
+
+    def __init__(self, host, rows, ready_at=None):
+        self.host = host
+        self.rows = rows
+        self.ready_at = ready_at
+        self._oleobj_ = self
+
+    def InvokeTypes(self, *args):  # pylint: disable=C0103,W0613
+        return self
+
+    def QueryInterface(self, *args):  # pylint: disable=C0103,W0613
+        return self
+
+    def Next(self, count):  # pylint: disable=C0103
+        if self.ready_at is not None:
+            self.host.wait(max(0.0, self.ready_at - self.host.clock()))
+            self.ready_at = None
+        self.host.wait(self.host.latency_per_batch)
+        batch = []
+        for row in self.rows:
+            batch.append(row)
+            if len(batch) == count:
+                break
+        self.host.batches += 1
+        self.host.batch_sizes.append(count)
+        return tuple(batch)
+
+
+class _Namespace(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def ExecQuery(self, strQuery, iFlags=0, strQueryLanguage='WQL'):  # pylint: disable=C0103,W0613
+        host = self.connection.host
+        rows = self.connection.run_query(strQuery, iFlags)
+        ready_at = None
+        if iFlags & WBEM_FLAG_RETURN_IMMEDIATELY:
+            ready_at = host.clock() + host.latency_per_query
+        return _Enumerator(host, iter(rows), ready_at)
+
+
+class _Class(object):
+
+    def __init__(self, connection, class_name):
+        self.connection = connection
+        self.class_name = class_name
+
+    def __call__(self, *properties, **where):
+        rows = self.connection.run_query('SELECT * FROM {0}'.format(self.class_name), None)
+        return [row for row in rows if all(row.properties.get(name) == value
+                                           for name, value in where.items())]
+
+
+class FakeRegistry(object):
+    """StdRegProv over a tree of {path: {'values': {...}}} entries.
+
+    Paths are backslash separated and case insensitive like the
+    registry. A path's subkeys are the paths directly below it.
+    """
+
+    def __init__(self, host):
+        self.host = host
+
+    def __call__(self, **kwargs):
+        return []
+
+    def _children(self, path):
+        prefix = path.lower().rstrip('\\') + '\\'
+        names = []
+        for key in self.host.registry:
+            if key.lower().startswith(prefix) and '\\' not in key[len(prefix):]:
+                names.append(key[len(prefix):])
+        return names
+
+    def _find(self, path):
+        for key, entry in self.host.registry.items():
+            if key.lower() == path.lower():
+                return entry
+        return None
+
+    def EnumKey(self, hDefKey, sSubKeyName):  # pylint: disable=C0103,W0613
+        self.host.call('EnumKey', sSubKeyName)
+        if self._find(sSubKeyName) is None and not self._children(sSubKeyName):
+            return (2, None)
+        return (0, self._children(sSubKeyName) or None)
+
+    def EnumValues(self, hDefKey, sSubKeyName):  # pylint: disable=C0103,W0613
+        self.host.call('EnumValues', sSubKeyName)
+        entry = self._find(sSubKeyName)
+        if entry is None:
+            return (2, None, None)
+        names = list(entry.get('values', {}))
+        return (0, names or None, [1] * len(names) or None)
+
+    def GetStringValue(self, hDefKey, sSubKeyName, sValueName):  # pylint: disable=C0103,W0613
+        self.host.call('GetStringValue', sSubKeyName)
+        entry = self._find(sSubKeyName)
+        if entry is None or sValueName not in entry.get('values', {}):
+            return (1, None)
+        return (0, entry['values'][sValueName])
+
+
+class FakeConnection(object):
+    """A wmi.WMI connection to one namespace of a FakeHost."""
+
+    def __init__(self, host, namespace):
+        self.host = host
+        self.namespace = namespace
+        self._namespace = _Namespace(self)
+        self.StdRegProv = FakeRegistry(host)  # pylint: disable=C0103
+
+    def run_query(self, wql, flags):
+        """Evaluate a query against the host, recording it."""
+        self.host.queries.append(wql)
+        self.host.flags.append(flags)
+        if not (flags or 0) & WBEM_FLAG_RETURN_IMMEDIATELY:
+            self.host.wait(self.host.latency_per_query)
+        if self.host.query_error is not None:
+            raise self.host.query_error
+        properties, class_name, where = parse_query(wql)
+        source = self.host.classes.get(class_name, [])
+        if callable(source):
+            # Generated rows are made as they are read, like a provider
+            # streaming a large class.
+            return self._stream(class_name, properties, where, source(where))
+        matched = [row for row in source if evaluate(where, row)]
+        self.host.rows_returned += len(matched)
+        return [FakeInstance(self.host, class_name, row if properties is None else
+                             {name: row.get(name) for name in properties})
+                for row in matched]
+
+    def _stream(self, class_name, properties, where, rows):
+        for row in rows:
+            if evaluate(where, row):
+                self.host.rows_returned += 1
+                yield FakeInstance(self.host, class_name, row if properties is None else
+                                   {name: row.get(name) for name in properties})
+
+    def query(self, wql):
+        """Run a query the way wmi.WMI.query does, escaping backslashes first."""
+        return self.run_query(wql.replace('\\', '\\\\'), 0)
+
+    def __getattr__(self, name):
+        if name.startswith('Win32_'):
+            return _Class(self, name)
+        raise AttributeError(name)
+
+
+class FakeHost(object):
+    """Everything a fake machine answers with and a record of what it was asked.
+
+    Args:
+        classes(dict): Rows per WMI class name, a list of dicts or a
+            callable taking the parsed WHERE clause and returning rows
+        registry(dict): Registry keys by path, see FakeRegistry
+        latency_per_query(float): Seconds every query waits
+        latency_per_batch(float): Seconds every enumerator batch waits
+        connect_latency(float): Seconds every connection waits
+        sleep(function): Optional, how to wait, e.g. a simulated clock
+        clock(function): Optional, the time sleep waits on
+
+    """
+
+    def __init__(self, classes=None, registry=None, latency_per_query=0.0, latency_per_batch=0.0,
+                 connect_latency=0.0, sleep=time.sleep, clock=time.monotonic):
+        self.classes = classes or {}
+        self.registry = registry or {}
+        self.latency_per_query = latency_per_query
+        self.latency_per_batch = latency_per_batch
+        self.connect_latency = connect_latency
+        self.sleep = sleep
+        self.clock = clock
+        self.owners = {}
+        self.connect_flags = []
+        self.connect_error = None
+        self.query_error = None
+        # The instances still referenced anywhere, to check they are released.
+        self.instances = weakref.WeakSet()
+        self.reset()
+
+    def reset(self):
+        """Forget what the host was asked so far."""
+        self.queries = []
+        self.flags = []
+        self.calls = []
+        self.connections = 0
+        self.batches = 0
+        self.batch_sizes = []
+        self.rows_returned = 0
+
+    def wait(self, seconds):
+        """Wait for an injected latency."""
+        if seconds:
+            self.sleep(seconds)
+
+    def call(self, method, *args):
+        """Record a method call."""
+        self.calls.append((method,) + args)
+        self.wait(self.latency_per_query)
+
+    def connect(self, namespace):
+        """Open a connection, or raise the injected connect error."""
+        self.connections += 1
+        self.wait(self.connect_latency)
+        if self.connect_error is not None:
+            raise self.connect_error
+        return FakeConnection(self, namespace)
+
+
+class Backend(object):
+    """The fake hosts the wmi module connects to, by host name."""
+
+    def __init__(self):
+        self.hosts = {}
+
+    def add(self, name, host=None, **settings):
+        """Add a host and return it."""
+        self.hosts[name] = host if host is not None else FakeHost(**settings)
+        return self.hosts[name]
+
+    def connect(self, computer='', namespace='root/cimv2', wmi=None,
+                **kwargs):  # pylint: disable=W0613
+        """The fake wmi.WMI, wmi is a connection from connect_server."""
+        from platform import node  # pylint: disable=C0415
+
+        if wmi is not None:
+            return wmi
+        name = computer or node()
+        if name not in self.hosts:
+            raise ConnectionError('The RPC server is unavailable: {0}'.format(name))
+        return self.hosts[name].connect(namespace or 'root/cimv2')
+
+    def connect_server(self, server, namespace='', user='', password='',
+                       security_flags=0, **kwargs):  # pylint: disable=W0613
+        """The fake wmi.connect_server, recording the flags it was given."""
+        if server not in self.hosts:
+            raise ConnectionError('The RPC server is unavailable: {0}'.format(server))
+        self.hosts[server].connect_flags.append(security_flags)
+        return self.hosts[server].connect(namespace or 'root/cimv2')
+
+
+BACKEND = Backend()
+
+
+def install():
+    """Put the fake wmi, pythoncom and win32com modules in sys.modules."""
+    wmi = types.ModuleType('wmi')
+    wmi.WMI = lambda *args, **kwargs: BACKEND.connect(*args, **kwargs)
+    wmi.connect_server = lambda *args, **kwargs: BACKEND.connect_server(*args, **kwargs)
+    wmi.x_wmi = type('x_wmi', (Exception,), {})
+    pythoncom = types.ModuleType('pythoncom')
+    pythoncom.CoInitialize = pythoncom.CoUninitialize = lambda: None
+    pythoncom.com_error = type('com_error', (Exception,), {})
+    pythoncom.DISPID_NEWENUM = -4
+    pythoncom.DISPATCH_METHOD = 1
+    pythoncom.DISPATCH_PROPERTYGET = 2
+    pythoncom.IID_IEnumVARIANT = 'IEnumVARIANT'
+    win32com = types.ModuleType('win32com')
+    win32com.client = types.ModuleType('win32com.client')
+    win32com.client.Dispatch = lambda item: item
+    sys.modules.update({'wmi': wmi, 'pythoncom': pythoncom, 'win32com': win32com,
+                        'win32com.client': win32com.client})
@@ -0,0 +1,189 @@
+"""Adaptive polling on a simulated clock: fingerprints, back off, polls saved and slow polls."""
+import bisect
+import heapq
+import random
+import statistics
+import threading
+from queue import Empty
+
+import pytest
+
+from sample.adaptive_polling import PollingScheduler, fingerprint
+from tests import bench
+
+GB = 1024 ** 3
+DAY = 24 * 60 * 60
+FIXED_CADENCE = 15 * 60
+BENCH_HOSTS = bench.size('POLLING_BENCH_HOSTS', 10000, 200)
+COLLECTORS = 10
+
+
+class _SimulatedClock(object):
+    """Simulated seconds, moved on only while every running poll sleeps in them.
+
+    A poll takes simulated time with sleep. The scheduler's wait returns
+    polls as they finish and moves the clock on to the next wake up, or
+    by the seconds it was given, once all the polls still running sleep.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.condition = threading.Condition()
+        self.wakes = []
+        self.scheduler = None
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        """Sleep in a poll's thread, for simulated seconds."""
+        with self.condition:
+            wake = self.now + seconds
+            heapq.heappush(self.wakes, wake)
+            self.condition.notify_all()
+            while self.now < wake:
+                self.condition.wait()
+
+    def wait(self, finished, seconds):
+        """The scheduler's wait for the next finished poll."""
+        while True:
+            try:
+                return finished.get_nowait()
+            except Empty:
+                pass
+            with self.condition:
+                if len(self.wakes) == self.scheduler.running:
+                    stops = self.wakes[:1] + ([self.now + seconds] if seconds is not None else [])
+                    self.now = min(stops)
+                    while self.wakes and self.wakes[0] <= self.now:
+                        heapq.heappop(self.wakes)
+                    self.condition.notify_all()
+                    raise Empty
+                # A poll that took no simulated time has yet to be queued.
+                self.condition.wait(0.001)
+
+
+def _drives(free, size=64 * GB):
+    return {'logical_drives': {'C:': {'DeviceID': 'C:', 'Size': str(size), 'FreeSpace': str(free)}},
+            'disk_drive_links': [['\\\\.\\PHYSICALDRIVE0', 'Disk #0, Partition #0']]}
+
+
+def test_volatile_properties_do_not_change_the_fingerprint():
+    disk = 'collect_win_disk_stats'
+    assert fingerprint(_drives(GB), disk) == fingerprint(_drives(2 * GB), disk)
+    assert fingerprint(_drives(GB), disk) != fingerprint(_drives(GB, 128 * GB), disk)
+    assert fingerprint(_drives(GB)) != fingerprint(_drives(2 * GB))
+
+    def os_info(free, version):
+        return {'os_info': {'Windows': {'Caption': 'Windows', 'Version': version,
+                                        'FreePhysicalMemory': free,
+                                        'LocalDateTime': '2021030{0}'.format(free)}}}
+    assert fingerprint(os_info(1, '10.0.17763'), 'collect_os_stats') == \
+        fingerprint(os_info(2, '10.0.17763'), 'collect_os_stats')
+    assert fingerprint(os_info(1, '10.0.17763'), 'collect_os_stats') != \
+        fingerprint(os_info(1, '10.0.20348'), 'collect_os_stats')
+
+
+def test_a_static_pair_backs_off_while_its_free_space_moves():
+    now = [0.0]
+    scheduler = PollingScheduler(min_interval=60, max_interval=3600, clock=lambda: now[0])
+    scheduler.add('server01', 'collect_win_disk_stats')
+    for poll in range(10):
+        now[0] = scheduler.next_due()
+        scheduler.due()
+        scheduler.report('server01', 'collect_win_disk_stats', _drives(GB + poll))
+
+    assert scheduler.interval('server01', 'collect_win_disk_stats') == 3600
+
+
+def test_polls_are_reported_while_a_slow_one_runs():
+    clock = _SimulatedClock()
+    scheduler = PollingScheduler(min_interval=0.125, max_interval=10, clock=clock)
+    clock.scheduler = scheduler
+    scheduler.add('slow', 'collect_os_stats')
+    scheduler.add('fast', 'collect_os_stats')
+    scheduler.add('broken', 'collect_os_stats')
+    polls = []
+
+    def poll(host, collector):  # pylint: disable=W0613
+        polls.append((host, clock()))
+        if host == 'slow':
+            clock.sleep(2.0)
+        if host == 'broken':
+            raise ConnectionError('The RPC server is unavailable')
+        return {'os_info': {'Windows': {'Version': len(polls)}}}
+
+    scheduler.run(poll, workers=4, wait=clock.wait, until=1.0)
+
+    # The fast pair changes every poll and stays at min_interval, failed
+    # polls are retried at it, neither waits for the slow poll.
+    assert [now for host, now in polls if host == 'fast'] == [0.125 * step for step in range(8)]
+    assert [now for host, now in polls if host == 'broken'] == [0.125 * step for step in range(8)]
+    assert [now for host, now in polls if host == 'slow'] == [0.0]
+    # The slow poll finished after until and was still reported.
+    assert scheduler.pairs[('slow', 'collect_os_stats')].polled == 2.0
+    assert scheduler.pairs[('broken', 'collect_os_stats')].polls == 0
+    assert scheduler.running == 0
+
+
+def _changes(rand, period, duration):
+    """Return the times a pair changes, a Poisson process of the given mean period."""
+    times = []
+    now = rand.expovariate(1.0 / period)
+    while now < duration:
+        times.append(now)
+        now += rand.expovariate(1.0 / period)
+    return times
+
+
+@pytest.mark.benchmark
+def test_polls_saved_against_a_fixed_cadence():
+    rand = random.Random(49)
+    duration = 2 * DAY
+    periods = {}
+    changes = {}
+    # 5% of hosts are busy, though half their collectors are static, 25%
+    # change every six hours and the rest weekly.
+    for host in range(BENCH_HOSTS):
+        draw = rand.random()
+        for collector in range(COLLECTORS):
+            if draw < 0.05 and not collector % 2:
+                period = FIXED_CADENCE
+            elif 0.05 <= draw < 0.3:
+                period = 6 * 60 * 60
+            else:
+                period = 7 * DAY
+            periods[host, collector] = period
+            changes[host, collector] = _changes(rand, period, duration)
+
+    now = [0.0]
+    scheduler = PollingScheduler(min_interval=300, max_interval=DAY, clock=lambda: now[0])
+    for host, collector in changes:
+        scheduler.add(host, collector, due=rand.uniform(0, FIXED_CADENCE))
+    polls = 0
+    lags = []
+    seen = dict.fromkeys(changes, 0)
+    while scheduler.next_due() < duration:
+        now[0] = scheduler.next_due()
+        for pair in scheduler.due():
+            version = bisect.bisect_right(changes[pair], now[0])
+            scheduler.report(pair[0], pair[1], {'section': {'version': version}}, now[0])
+            if version > seen[pair] and periods[pair] == FIXED_CADENCE:
+                lags.append(now[0] - changes[pair][seen[pair]])
+            seen[pair] = version
+            polls += 1
+
+    fixed = len(changes) * duration / FIXED_CADENCE
+    intervals = {}
+    for pair, period in periods.items():
+        intervals.setdefault(period, []).append(scheduler.interval(*pair))
+    bench.report('adaptive polling', '{0} pairs over 2 days, {1} polls against {2:.0f} at a '
+                 'fixed 15 minutes ({3:.0%} fewer), busy pairs seen {4:.0f}s after a change '
+                 '(median)'.format(len(changes), polls, fixed, 1 - polls / fixed,
+                                   statistics.median(lags)))
+
+    assert polls < fixed / 5
+    # Static pairs back off all the way, busy ones stay near the cadence.
+    assert statistics.median(intervals[7 * DAY]) == DAY
+    assert statistics.median(intervals[FIXED_CADENCE]) < 2 * FIXED_CADENCE
+    assert statistics.median(lags) <= FIXED_CADENCE
@@ -0,0 +1,72 @@
+"""Incremental rescans of the uninstall keys against the fake registry."""
+import os
+
+import sample.win_system_get_statistics as orchestrator
+from sample.win_application_statistics import REG_PATHS, collect_win_application_stats
+from tests.fake_hosts import server_classes
+
+UNINSTALL = REG_PATHS[0]
+
+
+def _product(name, version, **values):
+    values.update({'DisplayName': name, 'DisplayVersion': version, 'Publisher': 'Contoso'})
+    return {'values': values}
+
+
+def _registry():
+    return {
+        UNINSTALL: {'values': {}},
+        UNINSTALL + r'\Agent': _product('Agent', '2.1', InstallDate='20210101'),
+        UNINSTALL + r'\Agent\Plugin': _product('Agent Plugin', '1.0'),
+        UNINSTALL + r'\Viewer': _product('Viewer', '5.0')}
+
+
+def _rescan(host, state_path):
+    host.calls = []
+    return collect_win_application_stats('server01', incremental=True,
+                                         state_path=state_path)['content']
+
+
+def _full():
+    return collect_win_application_stats('server01')['content']
+
+
+def test_nested_keys_are_found_and_dropped_below_unchanged_parents(backend, tmp_path):
+    host = backend.add('server01', registry=_registry())
+    state_path = str(tmp_path / 'state')
+    assert _rescan(host, state_path)['software_list'] == ['Agent', 'Agent Plugin', 'Viewer']
+
+    # The parent keys keep their values, so their fingerprints match.
+    host.registry[UNINSTALL + r'\Agent\Hotfix'] = _product('Agent Hotfix', '1.1')
+    del host.registry[UNINSTALL + r'\Agent\Plugin']
+    content = _rescan(host, state_path)
+    assert content['software_list'] == ['Agent', 'Agent Hotfix', 'Viewer']
+    assert content['software_removed'] == ['Agent Plugin']
+    assert content['software_details'] == _full()['software_details']
+
+
+def test_unchanged_keys_are_not_read_again(backend, tmp_path):
+    registry = _registry()
+    for number in range(50):
+        registry[UNINSTALL + r'\Product{0}'.format(number)] = _product(
+            'Product {0}'.format(number), '1.0', InstallLocation='C:\\Product', UninstallString='x')
+    host = backend.add('server01', registry=registry)
+    state_path = str(tmp_path / 'state')
+    _rescan(host, state_path)
+    first_reads = sum(call[0] == 'GetStringValue' for call in host.calls)
+
+    host.registry[UNINSTALL + r'\Viewer']['values']['DisplayVersion'] = '5.1'
+    content = _rescan(host, state_path)
+    reads = sum(call[0] == 'GetStringValue' for call in host.calls)
+
+    assert content['software_details']['Viewer']['DisplayVersion'] == '5.1'
+    assert content['software_details'] == _full()['software_details']
+    assert reads < first_reads / 2
+
+
+def test_collect_system_stats_runs_incrementally(backend):
+    backend.add('server01', classes=server_classes(), registry=_registry())
+    return_body = orchestrator.collect_system_stats('server01', incremental=True)
+
+    assert return_body['content']['software_removed'] == []
+    assert os.path.exists(os.path.join('logs', 'application_state', 'server01.json'))
@@ -0,0 +1,145 @@
+"""Fleet capacity analytics, with a benchmark against walking the host dicts."""
+import random
+import time
+
+import pytest
+
+import sample.capacity_analytics as capacity_analytics
+from tests import bench
+
+BENCH_HOSTS = bench.size('CAPACITY_BENCH_HOSTS', 50000, 2000)
+GB = 1024 ** 3
+
+
+def _fleet(hosts, seed=11, growth=0):
+    rand = random.Random(seed)
+    results = {}
+    models = {}
+    for number in range(hosts):
+        host = 'host{0:05d}'.format(number)
+        drives = {}
+        for letter in 'CDE'[:rand.randint(1, 3)]:
+            size = rand.choice((128, 256, 512, 1024)) * GB
+            free = max(0, int(size * rand.random()) - growth * number % 7 * GB)
+            drives[letter + ':'] = {'DeviceID': letter + ':', 'DriveType': 3, 'Size': str(size),
+                                    'FreeSpace': str(free)}
+        drives['Z:'] = {'DeviceID': 'Z:', 'DriveType': 4, 'Size': str(GB), 'FreeSpace': '0'}
+        memory = {'DIMM{0}'.format(slot): {'Capacity': str(rand.choice((8, 16, 32)) * GB)}
+                  for slot in range(rand.choice((2, 4)))}
+        results[host] = {'logical_drives': drives, 'physical_memory': memory}
+        models[host] = 'Model {0}'.format(number % 12)
+    return results, models
+
+
+def _percentile(values, percent):
+    # Linear interpolation between closest ranks, as numpy does by default.
+    position = (len(values) - 1) * percent / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def _naive_percentiles(results, percentiles):
+    percent = sorted(100.0 * float(drive['FreeSpace']) / float(drive['Size'])
+                     for content in results.values()
+                     for drive in content['logical_drives'].values()
+                     if drive['DriveType'] == 3 and float(drive['Size']) > 0)
+    return {value: _percentile(percent, value) for value in percentiles}
+
+
+def _naive_under(results, threshold):
+    low = []
+    for host, content in results.items():
+        for device, drive in content['logical_drives'].items():
+            if drive['DriveType'] == 3 and float(drive['Size']) > 0:
+                percent = 100.0 * float(drive['FreeSpace']) / float(drive['Size'])
+                if percent < threshold:
+                    low.append((percent, host, device))
+    return [(host, device, percent) for percent, host, device in sorted(low)]
+
+
+def _naive_by_model(results, models):
+    grouped = {}
+    for host, content in results.items():
+        installed = sum(float(dimm['Capacity']) for dimm in content['physical_memory'].values())
+        grouped.setdefault(models.get(host, 'unknown'), []).append(installed)
+    return {model: {'hosts': len(values), 'total': sum(values), 'mean': sum(values) / len(values),
+                    'min': min(values), 'max': max(values)} for model, values in grouped.items()}
+
+
+def _naive_growth(before, after):
+    per_host = {}
+    for host, content in after.items():
+        for device, drive in content['logical_drives'].items():
+            old = before.get(host, {}).get('logical_drives', {}).get(device)
+            if old is None or drive['DriveType'] != 3 or float(drive['Size']) <= 0:
+                continue
+            used = (float(drive['Size']) - float(drive['FreeSpace'])) - \
+                (float(old['Size']) - float(old['FreeSpace']))
+            per_host[host] = per_host.get(host, 0.0) + used
+    return per_host
+
+
+def _timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def test_small_fleet():
+    results = {
+        'a': {'logical_drives': {'C:': {'DriveType': 3, 'Size': '100', 'FreeSpace': '5'},
+                                 'D:': {'DriveType': 3, 'Size': '0', 'FreeSpace': '0'}},
+              'physical_memory': {'DIMM0': {'Capacity': '8'}, 'DIMM1': {'Capacity': '8'}}},
+        'b': {'logical_drives': {'C:': {'DriveType': 3, 'Size': '100', 'FreeSpace': None}},
+              'physical_memory': {'DIMM0': {'Capacity': '32'}}}}
+    drives = capacity_analytics.load_logical_drives(results)
+    memory = capacity_analytics.load_physical_memory(results)
+
+    assert capacity_analytics.hosts_under_threshold(drives) == [('a', 'C:', 5.0)]
+    assert capacity_analytics.installed_memory(memory).tolist() == [16, 32]
+    assert capacity_analytics.memory_by_model(memory, {'a': 'X'}) == {
+        'X': {'hosts': 1, 'total': 16.0, 'mean': 16.0, 'min': 16.0, 'max': 16.0},
+        'unknown': {'hosts': 1, 'total': 32.0, 'mean': 32.0, 'min': 32.0, 'max': 32.0}}
+
+
+@pytest.mark.benchmark
+def test_benchmark_against_walking_dicts():
+    before, models = _fleet(BENCH_HOSTS)
+    after, _ = _fleet(BENCH_HOSTS, growth=1)
+    percentiles = (5, 25, 50, 75, 95)
+
+    drives, load_seconds = _timed(capacity_analytics.load_logical_drives, after)
+    memory, memory_load_seconds = _timed(capacity_analytics.load_physical_memory, after)
+    old_drives = capacity_analytics.load_logical_drives(before)
+    timings = []
+    for vectorized, naive in (
+            ((capacity_analytics.free_space_percentiles, drives, percentiles),
+             (_naive_percentiles, after, percentiles)),
+            ((capacity_analytics.hosts_under_threshold, drives, 10.0),
+             (_naive_under, after, 10.0)),
+            ((capacity_analytics.memory_by_model, memory, models),
+             (_naive_by_model, after, models)),
+            ((capacity_analytics.free_space_growth, old_drives, drives),
+             (_naive_growth, before, after))):
+        result, seconds = _timed(*vectorized)
+        expected, naive_seconds = _timed(*naive)
+        if isinstance(result, dict) and 'per_host' in result:
+            result = result['per_host']
+        timings.append((vectorized[0].__name__, seconds, naive_seconds))
+        if isinstance(expected, dict):
+            assert result.keys() == expected.keys()
+            for key, value in expected.items():
+                assert result[key] == pytest.approx(value)
+        else:
+            # Drives with equal free space may come in any order.
+            assert [entry[2] for entry in result] == pytest.approx([entry[2] for entry in expected])
+            assert sorted(result) == sorted(expected)
+
+    bench.report('capacity analytics', '{0} hosts, {1} drives: loaded once in {2:.2f}s, '
+                 '{3}'.format(BENCH_HOSTS, len(drives['size']), load_seconds + memory_load_seconds,
+                              ', '.join('{0} {1:.1f}ms against {2:.1f}ms'.format(
+                                  name, seconds * 1e3, naive_seconds * 1e3)
+                                        for name, seconds, naive_seconds in timings)))
+    if bench.FULL:
+        assert all(seconds < naive_seconds for _, seconds, naive_seconds in timings)
@@ -0,0 +1,105 @@
+"""The change probe across a sequence of changes to a fake host, and what a skip saves."""
+import time
+
+import sample.win_system_get_statistics as orchestrator
+from sample.change_probe import FREE_SPACE_STEP, ChangeProbe
+from sample.win_application_statistics import REG_PATHS
+from tests.fake_hosts import server_classes
+
+
+class _Clock(object):  # pylint: disable=R0903
+
+    def __init__(self):
+        self.now = 1600000000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _registry(products=5):
+    registry = {REG_PATHS[0]: {'values': {}}}
+    for number in range(products):
+        registry[REG_PATHS[0] + r'\Product{0}'.format(number)] = {
+            'values': {'DisplayName': 'Product {0}'.format(number), 'DisplayVersion': '1.0'}}
+    return registry
+
+
+def _skipped(return_body):
+    return sorted(message.split(' skipped: ')[0] for message in return_body['messages']
+                  if ' skipped: ' in message)
+
+
+def _ran(return_body):
+    return sorted(set(name.__name__ for name in orchestrator.SYSTEM_INFORMATION_FUNCTIONS) -
+                  set(_skipped(return_body)))
+
+
+def test_each_collector_runs_again_when_its_signal_moves(backend, tmp_path):
+    classes = server_classes()
+    classes['Win32_OperatingSystem'][0]['TotalVisibleMemorySize'] = '67108864'
+    host = backend.add('server01', classes=classes)
+    clock = _Clock()
+    probe = ChangeProbe(str(tmp_path / 'probe'), clock=clock)
+
+    def sweep():
+        clock.now += 300
+        return orchestrator.collect_system_stats('server01', probe=probe)
+
+    assert _skipped(sweep()) == []
+    assert _ran(sweep()) == []
+
+    # Less than a step of free space used is not worth a drive collection.
+    host.classes['Win32_LogicalDisk'][0]['FreeSpace'] = str(FREE_SPACE_STEP * 5 // 4)
+    assert _ran(sweep()) == []
+    host.classes['Win32_LogicalDisk'][0]['FreeSpace'] = str(FREE_SPACE_STEP * 5)
+    assert _ran(sweep()) == ['collect_win_disk_stats']
+
+    host.classes['Win32_NetworkAdapterConfiguration'][0]['IPAddress'] = ['10.0.0.5']
+    assert _ran(sweep()) == ['collect_win_network_stats']
+    # Adapters the network collector filters out do not count.
+    host.classes['Win32_NetworkAdapterConfiguration'][5]['IPAddress'] = ['10.0.0.6']
+    assert _ran(sweep()) == []
+
+    host.classes['Win32_OperatingSystem'][0]['TotalVisibleMemorySize'] = '134217728'
+    assert _ran(sweep()) == ['collect_win_mem_stats']
+
+    host.classes['Win32_Service'][0]['State'] = 'Stopped'
+    assert _ran(sweep()) == ['collect_win_services_stats']
+
+    host.classes['Win32_OperatingSystem'][0]['LastBootUpTime'] = '20210302080000.500000+000'
+    assert _skipped(sweep()) == []
+
+
+def test_skipped_collectors_run_once_older_than_max_age(backend, tmp_path):
+    backend.add('server01', classes=server_classes())
+    clock = _Clock()
+    probe = ChangeProbe(str(tmp_path / 'probe'), max_age=3600, clock=clock)
+    orchestrator.collect_system_stats('server01', probe=probe)
+
+    clock.now += 1800
+    assert _ran(orchestrator.collect_system_stats('server01', probe=probe)) == []
+    clock.now += 1800
+    assert _skipped(orchestrator.collect_system_stats('server01', probe=probe)) == []
+
+
+def test_a_skipped_sweep_costs_less_than_a_full_one(backend, tmp_path):
+    # Every WMI round trip waits, as it would against a remote host.
+    host = backend.add('server01', classes=server_classes(), registry=_registry(),
+                       latency_per_query=0.02, latency_per_batch=0.005, connect_latency=0.02)
+    probe = ChangeProbe(str(tmp_path / 'probe'), clock=_Clock())
+
+    def sweep(**kwargs):
+        host.reset()
+        started = time.monotonic()
+        return_body = orchestrator.collect_system_stats('server01', **kwargs)
+        return return_body, time.monotonic() - started, len(host.queries) + len(host.calls)
+
+    full, full_seconds, full_calls = sweep()
+    sweep(probe=probe)
+    skipped, skipped_seconds, skipped_calls = sweep(probe=probe)
+
+    assert full['outcome'] == skipped['outcome'] == 'Successful'
+    assert _ran(skipped) == []
+    # A skipped sweep only asks the probe's signal queries, in one round trip.
+    assert skipped_calls < full_calls
+    assert skipped_seconds < full_seconds
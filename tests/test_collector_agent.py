@@ -0,0 +1,171 @@
+"""The collector agent over loopback, with the fake WMI backend."""
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from platform import node
+
+import pytest
+
+import sample.win_collector_agent as agent
+import sample.wire_protocol as wire_protocol
+
+SECRET = 'test-secret'
+
+
+def _classes(os_caption='Windows Server 2019'):
+    return {'Win32_BIOS': [{'Caption': 'BIOS', 'Version': 'A1'}],
+            'Win32_OperatingSystem': [{'Caption': os_caption, 'Version': '10.0'}]}
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def _serve(cache, secret=SECRET):
+        server = agent.AgentServer(('127.0.0.1', 0), cache, secret, refresh_interval=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, server.server_address[1]
+
+    yield _serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _cache():
+    cache = agent.CollectorCache(agent.load_collectors(['win_bios_statistics',
+                                                        'win_os_statistics']))
+    cache.refresh()
+    return cache
+
+
+def test_imports_without_com():
+    # A clean interpreter without the fake modules in sys.modules.
+    result = subprocess.run([sys.executable, '-c', 'import sample.win_collector_agent'],
+                            cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert result.returncode == 0
+
+
+def test_get_returns_only_changed_sections(backend, serve):
+    backend.add(node(), classes=_classes())
+    _, port = serve(_cache())
+    client = agent.AgentClient('127.0.0.1', SECRET, port, timeout=5)
+
+    content = client.get()
+    assert set(content) == {'win_bios_statistics', 'win_os_statistics'}
+    assert 'Windows Server 2019' in content['win_os_statistics']['os_info']
+
+    client.send()
+    response = client.receive()
+    assert response['sections'] == {}
+    assert sorted(response['unchanged']) == ['win_bios_statistics', 'win_os_statistics']
+    client.close()
+
+
+def test_versions_survive_an_agent_restart(backend, serve):
+    host = backend.add(node(), classes=_classes())
+    server, port = serve(_cache())
+    client = agent.AgentClient('127.0.0.1', SECRET, port, timeout=5)
+    client.get()
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+    host.classes.update(_classes('Windows Server 2022'))
+    _, port = serve(_cache())
+    client.port = port
+    client.send()
+    response = client.receive()
+    assert list(response['sections']) == ['win_os_statistics']
+    assert response['unchanged'] == ['win_bios_statistics']
+    assert 'Windows Server 2022' in client.content['win_os_statistics']['os_info']
+
+
+def test_pipelined_responses_come_back_in_order(backend, serve):
+    backend.add(node(), classes=_classes())
+    _, port = serve(_cache())
+    client = agent.AgentClient('127.0.0.1', SECRET, port, timeout=5)
+    ids = [client.send('ping'), client.send('get'), client.send('ping')]
+    assert [client.receive()['id'] for _ in ids] == ids
+    assert not client.pending
+
+
+def test_wrong_secret_is_rejected(backend, serve):
+    backend.add(node(), classes=_classes())
+    _, port = serve(_cache())
+    client = agent.AgentClient('127.0.0.1', 'wrong', port, timeout=5)
+    with pytest.raises(agent.AuthenticationError):
+        client.get()
+
+
+def test_collector_errors_are_replied(serve):
+    def broken(host):
+        raise RuntimeError('access denied on {0}'.format(host))
+
+    cache = agent.CollectorCache({'broken': broken})
+    cache.refresh()
+    _, port = serve(cache)
+    client = agent.AgentClient('127.0.0.1', SECRET, port, timeout=5)
+    client.send()
+    response = client.receive()
+    assert response['errors']['broken'].startswith('RuntimeError: access denied')
+
+
+def test_poll_agents_overlaps_dead_agents(backend, serve):
+    backend.add(node(), classes=_classes())
+    _, port = serve(_cache())
+    silent = []
+    for _ in range(4):
+        # Accepts connections but never sends its challenge.
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        silent.append(listener)
+    clients = [agent.AgentClient('127.0.0.1', SECRET, port, timeout=1)]
+    for listener in silent:
+        clients.append(agent.AgentClient('127.0.0.1', SECRET, listener.getsockname()[1],
+                                         timeout=1))
+        clients[-1].host = 'silent-{0}'.format(len(clients))
+
+    started = time.monotonic()
+    results = agent.poll_agents(clients, timeout=5)
+    assert time.monotonic() - started < 2.5
+    assert '127.0.0.1' in results['content']
+    assert sorted(results['failed']) == ['silent-2', 'silent-3', 'silent-4', 'silent-5']
+    assert clients[0].sock.gettimeout() == 1
+    for listener in silent:
+        listener.close()
+
+
+def test_compressed_frames_are_bounded(monkeypatch):
+    monkeypatch.setattr(wire_protocol, 'MAX_FRAME_SIZE', 64 * 1024)
+    payload = zlib.compress(wire_protocol.pack('x' * (1024 * 1024)))
+    frame = wire_protocol._FRAME_HEADER.pack(  # pylint: disable=W0212
+        len(payload), wire_protocol.FLAG_COMPRESSED) + payload
+    with pytest.raises(wire_protocol.ProtocolError):
+        wire_protocol.decode_frames(bytearray(frame))
+
+
+def test_ints_outside_64_bits_are_refused():
+    assert wire_protocol.unpack(wire_protocol.pack([2 ** 64 - 1, -2 ** 63])) == [
+        2 ** 64 - 1, -2 ** 63]
+    for value in (2 ** 64, -2 ** 63 - 1):
+        with pytest.raises(wire_protocol.ProtocolError):
+            wire_protocol.pack({'Capacity': value})
+
+
+def test_unencodable_content_is_replied_as_an_error(serve):
+    def huge(host):  # pylint: disable=W0613
+        return {'content': {'huge': {'Capacity': 2 ** 70}}}
+
+    cache = agent.CollectorCache({'huge': huge})
+    cache.refresh()
+    _, port = serve(cache)
+    client = agent.AgentClient('127.0.0.1', SECRET, port, timeout=5)
+    client.send()
+    assert 'outside the 64 bit range' in client.receive()['error']
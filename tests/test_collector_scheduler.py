@@ -0,0 +1,115 @@
+"""The collector scheduler: cost model saves, the cost of failed or overrunning jobs and LPT."""
+import json
+import os
+import threading
+import time
+
+from sample.collector_scheduler import CollectorScheduler, CostModel
+from sample.resilience import TimeoutBudget
+
+
+def _section(name, seconds=0.0, error=None):
+    def collector():
+        time.sleep(seconds)
+        if error:
+            raise error
+        return {name: {'collected': True}}
+    return collector
+
+
+# Seconds per collector, listed quick ones first as a naive dispatch takes them.
+LATENCIES = [('bios', 0.05), ('os', 0.05), ('cpu', 0.05), ('memory', 0.05), ('disk', 0.05),
+             ('network', 0.05), ('applications', 0.4)]
+
+
+def _sweep(scheduler, hosts, started):
+    """Run the hosts at once through the scheduler and return the makespan."""
+    def job(host, name, seconds):
+        def collector():
+            started[host, name] = time.monotonic()
+            time.sleep(seconds)
+            return {name: {'host': host}}
+        return collector
+
+    results = {}
+    threads = [threading.Thread(target=lambda host=host: results.update({host: scheduler.run(
+        host, {name: job(host, name, seconds) for name, seconds in LATENCIES})}))
+               for host in hosts]
+    began = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(len(results[host]) == len(LATENCIES) for host in hosts)
+    return time.monotonic() - began
+
+
+def test_longest_first_beats_a_naive_dispatch_under_the_shared_limit():
+    hosts = ['server01', 'server02', 'server03']
+    scheduler = CollectorScheduler(max_workers=6, cost_model=CostModel(None, alpha=1.0))
+
+    # With nothing learned every estimate is the same and jobs start in list order.
+    naive = _sweep(scheduler, hosts, {})
+    started = {}
+    learned = _sweep(scheduler, hosts, started)
+
+    # Naive: the 0.4s collectors wait behind 0.15s of quick ones, about 0.55s.
+    # LPT: each host's starts first and the quick ones fill the other slots,
+    # 0.4 to 0.45s as a host queued first can take slots before the rest.
+    assert learned <= naive
+    for host in hosts:
+        assert started[host, 'applications'] == min(started[host, name] for name, _ in LATENCIES)
+
+
+def test_concurrent_saves_leave_a_whole_file(tmp_path):
+    path = str(tmp_path / 'costs.json')
+    models = [CostModel(path) for _ in range(4)]
+    for number, model in enumerate(models):
+        model.observe('server01', 'collector{0}'.format(number), number + 1.0)
+
+    def save(model):
+        for _ in range(50):
+            model.save()
+    threads = [threading.Thread(target=save, args=(model,)) for model in models for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(path) as file_object:
+        assert len(json.load(file_object)['server01']) == 1
+    assert os.listdir(str(tmp_path)) == ['costs.json']
+
+
+def test_a_failed_save_keeps_the_results(tmp_path):
+    blocker = tmp_path / 'not_a_directory'
+    blocker.write_text('')
+    scheduler = CollectorScheduler(max_workers=2,
+                                   cost_model=CostModel(str(blocker / 'costs.json')))
+    information = scheduler.run('server01', {'os': _section('os')})
+
+    assert information == {'os': {'collected': True}}
+    assert scheduler.save_error.startswith(('FileExistsError', 'NotADirectoryError'))
+
+
+def test_failing_and_overrunning_collectors_learn_their_cost(tmp_path):
+    model = CostModel(str(tmp_path / 'costs.json'), alpha=1.0, default=0.01)
+    scheduler = CollectorScheduler(max_workers=2, cost_model=model)
+    failures = {}
+    scheduler.run('server01', {
+        'slow': _section('slow', 1.0),
+        'broken': _section('broken', 0.2, ConnectionError('The RPC server is unavailable'))},
+        budget=TimeoutBudget(0.4), failures=failures)
+
+    assert failures == {'slow': 'Timed out, timeout budget used up',
+                        'broken': 'ConnectionError: The RPC server is unavailable'}
+    assert 0.3 < model.estimate('server01', 'slow') < 1.0
+    assert 0.15 < model.estimate('server01', 'broken') < 0.4
+    # The late finish of the overrunning job is not counted again.
+    time.sleep(0.8)
+    assert model.estimate('server01', 'slow') < 1.0
+
+    failures = {}
+    scheduler.run('server01', {'slow': _section('slow', 1.0)}, budget=TimeoutBudget(0.2),
+                  failures=failures)
+    assert failures['slow'].startswith('Skipped, expected')
@@ -0,0 +1,39 @@
+"""Disk topology joined from the association classes of the fake provider."""
+from sample.win_drive_statistics import collect_win_disk_stats
+from tests.fake_hosts import disk_classes
+
+# Disk 0 carries twelve partitions, a few of them without a volume.
+LAYOUT = {0: ['C:', None, 'E:', 'F:', 'G:', 'H:', 'I:', 'J:', 'K:', 'L:', None, 'M:'],
+          1: ['D:'], 2: [None, None]}
+
+
+def test_many_partitions_in_five_queries(backend):
+    host = backend.add('server01', classes=disk_classes(LAYOUT))
+    topology = collect_win_disk_stats('server01')['content']['disk_topology']
+
+    assert len(host.queries) == 5
+    assert topology['disks'][0]['partitions'] == [
+        'Disk #0, Partition #{0}'.format(number) for number in range(12)]
+    assert topology['disks'][2]['partitions'] == ['Disk #2, Partition #0',
+                                                  'Disk #2, Partition #1']
+    assert topology['partitions']['Disk #0, Partition #10'] == {'disk': 0,
+                                                                'logical_drives': []}
+    assert topology['partitions']['Disk #0, Partition #11'] == {'disk': 0,
+                                                                'logical_drives': ['M:']}
+    assert topology['logical_drives']['D:'] == {'partitions': ['Disk #1, Partition #0'],
+                                                'disks': [1]}
+    assert len(topology['logical_drives']) == 11
+
+
+def test_filtered_out_drives_stay_out_of_the_topology(backend):
+    host = backend.add('server01', classes=disk_classes(LAYOUT))
+    content = collect_win_disk_stats('server01', filters={
+        'Win32_LogicalDisk': {'DeviceID': 'C:'}, 'Win32_DiskDrive': {'Index': 0}})['content']
+    topology = content['disk_topology']
+
+    assert 'SELECT * FROM Win32_LogicalDisk WHERE DeviceID = \'C:\'' in host.queries
+    assert sorted(content['logical_drives']) == sorted(topology['logical_drives']) == ['C:']
+    assert sorted(topology['disks']) == [0]
+    assert topology['partitions']['Disk #0, Partition #2']['logical_drives'] == []
+    # A partition of a filtered out disk keeps its DiskIndex, not its volume.
+    assert topology['partitions']['Disk #1, Partition #0'] == {'disk': 1, 'logical_drives': []}
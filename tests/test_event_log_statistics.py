@@ -0,0 +1,125 @@
+"""Event log windows, checkpoints and resumes against a generated fake event log."""
+import time
+
+import pytest
+
+import sample.report_log as report_log
+from sample.win_event_log_statistics import (EVENTS_CAPABILITY, WINDOW_SIZE,
+                                             collect_win_event_log_stats, load_checkpoint)
+from tests import bench
+
+BENCH_RECORDS = bench.size('EVENT_BENCH_RECORDS', 2000000, 20000)
+
+
+class _EventLog(object):
+    """Win32_NTLogEvent rows made on demand for the RecordNumbers asked for.
+
+    Args:
+        logs(dict): {Logfile: [oldest RecordNumber, newest RecordNumber]}
+
+    """
+
+    def __init__(self, logs):
+        self.logs = logs
+        self.fail_from = None
+
+    @staticmethod
+    def _comparisons(node):
+        if node is None:
+            return []
+        if node[0] == 'and':
+            return _EventLog._comparisons(node[1]) + _EventLog._comparisons(node[2])
+        return [node[1:]] if node[0] == 'compare' else []
+
+    def events(self, where):
+        """Return the rows the RecordNumber bounds of a query cover."""
+        comparisons = self._comparisons(where)
+        logfile = [value for name, _, value in comparisons if name == 'Logfile'][0]
+        low, high = self.logs[logfile]
+        for name, operator, value in comparisons:
+            if name != 'RecordNumber':
+                continue
+            if operator in ('>', '>=', '='):
+                low = max(low, value + (operator == '>'))
+            if operator in ('<', '<=', '='):
+                high = min(high, value - (operator == '<'))
+            if operator == '>' and self.fail_from is not None and value >= self.fail_from:
+                raise ConnectionError('The RPC server is unavailable')
+        return ({'Logfile': logfile, 'RecordNumber': number, 'EventCode': number % 1000,
+                 'TimeGenerated': '2021{0:010d}.000000-000'.format(number),
+                 'SourceName': 'Service Control Manager', 'Type': 'Information',
+                 'Message': 'Event {0}'.format(number)} for number in range(low, high + 1))
+
+    def files(self, where):  # pylint: disable=W0613
+        """Return the Win32_NTEventlogFile rows."""
+        return [{'LogfileName': name, 'NumberOfRecords': newest - oldest + 1 if newest else 0}
+                for name, (oldest, newest) in self.logs.items()]
+
+
+def _host(backend, logs):
+    source = _EventLog(logs)
+    host = backend.add('server01', classes={'Win32_NTLogEvent': source.events,
+                                            'Win32_NTEventlogFile': source.files})
+    return host, source
+
+
+def _collect(tmp_path, **kwargs):
+    return collect_win_event_log_stats('server01', logfiles=('Application',),
+                                       checkpoint_path=str(tmp_path / 'checkpoints'),
+                                       **kwargs)['content']['event_logs']['Application']
+
+
+def _stored():
+    return [event['RecordNumber'] for record in report_log.scan('logs', EVENTS_CAPABILITY, 1)
+            for event in record['content']['event_log'].values()]
+
+
+def test_a_wrapped_log_is_read_in_windows_from_its_oldest_record(backend, tmp_path):
+    host, _ = _host(backend, {'Application': [123457, 130000]})
+    summary = _collect(tmp_path, window_size=1000)
+
+    assert summary['collected'] == 130000 - 123457 + 1
+    assert summary['RecordNumber'] == 130000
+    assert sorted(_stored()) == list(range(123457, 130001))
+    probes = [wql for wql in host.queries if wql.startswith('SELECT RecordNumber FROM')]
+    windows = [wql for wql in host.queries if 'RecordNumber > ' in wql]
+    assert len(probes) < 40
+    assert len(windows) == 7
+
+
+def test_a_cleared_log_starts_again_at_one(backend, tmp_path):
+    _, source = _host(backend, {'Application': [1, 5000]})
+    _collect(tmp_path, window_size=1000)
+    source.logs['Application'] = [1, 1200]
+    summary = _collect(tmp_path, window_size=1000)
+
+    assert summary['reset'] is True
+    assert summary['collected'] == 1200
+    source.logs['Application'] = [0, 0]
+    assert _collect(tmp_path)['collected'] == 0
+
+
+@pytest.mark.benchmark
+def test_benchmark_millions_of_records_with_a_crash(backend, tmp_path):
+    _, source = _host(backend, {'Application': [1001, 1000 + BENCH_RECORDS]})
+    fail_from = source.fail_from = 1000 + BENCH_RECORDS // 2
+    checkpoint_path = str(tmp_path / 'checkpoints')
+    with pytest.raises(ConnectionError):
+        _collect(tmp_path)
+    checkpoint = load_checkpoint(checkpoint_path, 'server01')['Application']
+
+    source.fail_from = None
+    started = time.perf_counter()
+    summary = _collect(tmp_path)
+    resume_seconds = time.perf_counter() - started
+    stored = _stored()
+
+    bench.report('event log', '{0} records: the crash left the checkpoint at {1}, the resume '
+                 'read {2} records in {3:.1f}s, {4:.0f} records/s'.format(
+                     BENCH_RECORDS, checkpoint['RecordNumber'], summary['collected'],
+                     resume_seconds, summary['collected'] / resume_seconds))
+    # The crash came in the first query past the checkpoint, nothing is read twice.
+    read_before = checkpoint['RecordNumber'] - 1000
+    assert read_before % WINDOW_SIZE == 0 and checkpoint['RecordNumber'] >= fail_from
+    assert summary['collected'] == BENCH_RECORDS - read_before
+    assert sorted(stored) == list(range(1001, 1001 + BENCH_RECORDS))
@@ -0,0 +1,67 @@
+"""The fleet sweep: worker deaths, pooled connections and every host reported once."""
+import os
+
+import sample.fleet_sweep as fleet_sweep
+import sample.win_system_get_statistics as orchestrator
+from tests.fake_hosts import server_classes
+
+
+def _collect(host, filters=None):  # pylint: disable=W0613
+    if host.startswith('crash'):
+        # As a driver fault taking the whole worker down would.
+        os._exit(3)  # pylint: disable=W0212
+    return {'host': {'name': host}}, {}
+
+
+class _Writer(object):  # pylint: disable=R0903
+
+    def __init__(self):
+        self.hosts = []
+
+    def __call__(self, host, content, failures):
+        self.hosts.append(host)
+        return {'host': host}
+
+
+def test_a_dead_worker_fails_its_host_and_the_rest_are_retried(monkeypatch):
+    monkeypatch.setattr(fleet_sweep, 'POLL_SECONDS', 0.1)
+    hosts = ['host{0:02d}'.format(number) for number in range(40)]
+    hosts[13] = 'crash13'
+    writer = _Writer()
+    summary = fleet_sweep.sweep(hosts, workers=2, shard_size=5, collect=_collect, writer=writer)
+
+    # Results still in the dead worker's queue feeder are lost and how
+    # many depends on timing, but every host is written exactly once.
+    assert summary['hosts'] == 40
+    assert sorted(writer.hosts) == sorted(hosts)
+    assert summary['failed_hosts'] == {
+        'crash13': {'worker': 'Worker process exited with code 3'}}
+    assert summary['restarts'] == 1
+
+
+def test_a_worker_that_keeps_dying_leaves_its_hosts_uncollected(monkeypatch):
+    monkeypatch.setattr(fleet_sweep, 'POLL_SECONDS', 0.1)
+    hosts = ['crash{0:02d}'.format(number) for number in range(12)]
+    summary = fleet_sweep.sweep(hosts, workers=1, shard_size=1, collect=_collect,
+                                writer=_Writer())
+
+    # Every replacement dies on its first host, which fails, and is
+    # replaced while hosts are left.
+    assert summary['restarts'] == 11
+    assert sorted(summary['failed_hosts']) == hosts
+    assert summary['workers'] == []
+
+
+def test_collect_host_shares_pooled_connections(backend):
+    host = backend.add('server01', classes=server_classes())
+    content, failures = fleet_sweep.collect_host('server01')
+    assert not failures
+    pooled = host.connections
+
+    host.reset()
+    failures = {}
+    threaded = orchestrator.get_system_information('server01', failures=failures, planned=True)
+    assert not failures
+    assert content == threaded
+    # root/cimv2 and root/default, once each.
+    assert pooled == 2 < host.connections
@@ -0,0 +1,86 @@
+"""Inventories collected from the fake fleet loaded into SQLite, with a load benchmark."""
+import time
+
+import pytest
+
+import sample.win_system_get_statistics as orchestrator
+from sample.inventory_sql import InventoryDatabase
+from tests import bench
+from tests.fake_hosts import server_classes
+
+BENCH_HOSTS = bench.size('INVENTORY_BENCH_HOSTS', 2000, 100)
+
+
+def _fleet_report(number, services=200, processes=100):
+    host = 'host{0:05d}'.format(number)
+    return {
+        'capability_name': 'win_system_get_statistics', 'host': 'collector', 'target': host,
+        'start_time': '2021-03-01 08:00:00', 'end_time': '2021-03-01 08:00:05',
+        'outcome': 'Successful', 'messages': [],
+        'content': {
+            'services': {'svc{0}'.format(index): {
+                'Name': 'svc{0}'.format(index), 'State': 'Stopped' if index == number % services
+                else 'Running', 'StartMode': 'Auto', 'PathName': 'C:\\svc{0}.exe'.format(index)}
+                for index in range(services)},
+            'processes': {'process{0}.exe'.format(index): {
+                'ProcessId': index, 'WorkingSetSize': index * 4096,
+                'Owner': {'Domain': 'NT AUTHORITY', 'User': 'SYSTEM'}}
+                for index in range(processes)},
+            'software_list': ['Agent', 'Viewer']}}
+
+
+def test_collected_reports_load_by_target(backend, tmp_path):
+    for name, stopped in (('server01', 'svc3'), ('server02', None)):
+        classes = server_classes(services=8)
+        for service in classes['Win32_Service']:
+            if service['Name'] == stopped:
+                service['State'] = 'Stopped'
+        backend.add(name, classes=classes)
+        orchestrator.collect_system_stats(name)
+
+    database = InventoryDatabase(str(tmp_path / 'fleet.db'))
+    assert database.load_capability('logs', 'win_system_get_statistics') == 2
+    _, rows = database.query('SELECT host, key FROM services WHERE State = ?', ('Stopped',))
+    assert rows == [('server01', 'Service 3')]
+    _, rows = database.query('SELECT DISTINCT host FROM logical_drives ORDER BY host')
+    assert rows == [('server01',), ('server02',)]
+    database.close()
+
+
+def test_untargeted_reports_have_no_host(tmp_path):
+    database = InventoryDatabase(str(tmp_path / 'fleet.db'))
+    legacy = _fleet_report(1, services=2, processes=0)
+    del legacy['target']
+    database.load([_fleet_report(0, services=2, processes=0), legacy])
+
+    _, rows = database.query('SELECT target FROM reports ORDER BY id')
+    assert rows == [('host00000',), (None,)]
+    _, rows = database.query('SELECT host, count(*) FROM services GROUP BY host ORDER BY host')
+    assert rows == [(None, 2), ('host00000', 2)]
+    database.close()
+
+
+@pytest.mark.benchmark
+def test_benchmark_synthetic_fleet(tmp_path):
+    reports = [_fleet_report(number) for number in range(BENCH_HOSTS)]
+    rows = sum(1 + sum(len(section) if isinstance(section, dict) else 1
+                       for section in report['content'].values()) for report in reports)
+    database = InventoryDatabase(str(tmp_path / 'fleet.db'))
+    started = time.perf_counter()
+    database.load(reports)
+    seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    _, stopped = database.query("SELECT host FROM services WHERE State = 'Stopped' "
+                                "AND key = 'svc7'")
+    query_seconds = time.perf_counter() - started
+    bench.report('inventory sql', '{0} hosts, {1} rows: loaded in {2:.2f}s, {3:.0f} rows/s, '
+                 'stopped service query {4:.1f}ms'.format(BENCH_HOSTS, rows, seconds,
+                                                          rows / seconds, query_seconds * 1e3))
+    assert stopped == [('host{0:05d}'.format(number),) for number in range(7, BENCH_HOSTS, 200)]
+    _, counted = database.query('SELECT (SELECT count(*) FROM reports) + '
+                                '(SELECT count(*) FROM services) + '
+                                '(SELECT count(*) FROM processes) + '
+                                '(SELECT count(*) FROM software_list)')
+    assert counted == [(rows,)]
+    database.close()
@@ -0,0 +1,124 @@
+"""The metric store across runs, with a benchmark over years of synthetic points."""
+import math
+import os
+import time
+
+import pytest
+
+import sample.metric_store as metric_store
+import sample.win_system_get_statistics as orchestrator
+from sample.metric_store import MetricStore
+from tests import bench
+from tests.fake_hosts import server_classes
+
+BENCH_DAYS = bench.size('METRIC_BENCH_DAYS', 3 * 365, 60)
+INTERVAL = 300
+DAY = 86400
+
+
+def _files(path):
+    return sorted(name for _, _, names in os.walk(path) for name in names)
+
+
+def test_runs_keep_filling_the_open_chunk(tmp_path):
+    for run in range(5):
+        # A new process each run, as from the scheduled task.
+        store = MetricStore(str(tmp_path), chunk_points=4)
+        assert store.append('server01', 'os.NumberOfProcesses', 'os', 1000 + run * 60, run) == 1
+        assert store.query('server01', 'os.NumberOfProcesses', 'os') == [
+            (1000 + number * 60, number) for number in range(run + 1)]
+        if run < 3:
+            assert _files(tmp_path) == ['os.NumberOfProcesses@os.head']
+
+    assert _files(tmp_path) == ['os.NumberOfProcesses@os.head', 'os.NumberOfProcesses@os.rollup',
+                                'os.NumberOfProcesses@os.tsc']
+    assert os.path.getsize(str(tmp_path / 'server01' / 'os.NumberOfProcesses@os.head')) == 16
+    assert store.series('server01') == [('os.NumberOfProcesses', 'os')]
+    assert store.query_rollup('server01', 'os.NumberOfProcesses', 'os') == [(0, 0, 4, 2, 5)]
+
+
+def test_out_of_order_points_are_checked_against_sealed_chunks(tmp_path):
+    store = MetricStore(str(tmp_path), chunk_points=2)
+    assert store.extend('server01', 'cpu', 'CPU0', [(10, 1), (20, 2), (15, 9), (20, 9)]) == 2
+    assert _files(tmp_path) == ['cpu@CPU0.rollup', 'cpu@CPU0.tsc']
+
+    store = MetricStore(str(tmp_path), chunk_points=2)
+    assert store.append('server01', 'cpu', 'CPU0', 20, 5) == 0
+    assert store.append('server01', 'cpu', 'CPU0', 30, 3) == 1
+    assert store.query('server01', 'cpu', 'CPU0') == [(10, 1), (20, 2), (30, 3)]
+
+
+def test_a_crash_after_sealing_does_not_repeat_points(tmp_path):
+    store = MetricStore(str(tmp_path), chunk_points=3)
+    store.extend('server01', 'cpu', 'CPU0', [(10, 1), (20, 2)])
+    head = str(tmp_path / 'server01' / 'cpu@CPU0.head')
+    with open(head, 'rb') as file_object:
+        before_seal = file_object.read()
+    store.append('server01', 'cpu', 'CPU0', 30, 3)
+    # The chunk was written but the head was not yet replaced, and the
+    # last point was torn.
+    with open(head, 'wb') as file_object:
+        file_object.write(before_seal + metric_store._POINT.pack(30, 3.0)[:9])
+
+    store = MetricStore(str(tmp_path), chunk_points=3)
+    store.append('server01', 'cpu', 'CPU0', 40, 4)
+    assert store.query('server01', 'cpu', 'CPU0') == [(10, 1), (20, 2), (30, 3), (40, 4)]
+    assert store.query_rollup('server01', 'cpu', 'CPU0')[0][4] == 4
+
+
+def test_a_failing_store_is_reported(backend, monkeypatch):
+    backend.add('server01', classes=server_classes())
+
+    def failing_store():
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(metric_store, 'get_store', failing_store)
+    return_body = orchestrator.collect_system_stats('server01')
+
+    assert return_body['outcome'] == 'Successful'
+    assert 'Storing metrics failed: OSError: [Errno 28] No space left on device' in \
+        return_body['messages']
+
+
+@pytest.mark.benchmark
+def test_benchmark_years_of_points(tmp_path):
+    points = [(1500000000 + number * INTERVAL,
+               round(50 + 30 * math.sin(number / 288.0 * 2 * math.pi) + number % 7, 1))
+              for number in range(BENCH_DAYS * DAY // INTERVAL)]
+    store = MetricStore(str(tmp_path))
+    started = time.perf_counter()
+    store.extend('server01', 'processor.LoadPercentage', 'CPU0', points)
+    write_seconds = time.perf_counter() - started
+    stored = sum(os.path.getsize(os.path.join(root, name))
+                 for root, _, names in os.walk(str(tmp_path)) for name in names
+                 if not name.endswith('.rollup'))
+
+    middle = points[len(points) // 2][0]
+    started = time.perf_counter()
+    day = store.query('server01', 'processor.LoadPercentage', 'CPU0', middle, middle + DAY - 1)
+    day_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    daily = store.query_rollup('server01', 'processor.LoadPercentage', 'CPU0',
+                               bucket_seconds=DAY)
+    rollup_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    raw_daily = metric_store.downsample(
+        store.query('server01', 'processor.LoadPercentage', 'CPU0'), DAY)
+    raw_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    MetricStore(str(tmp_path)).append('server01', 'processor.LoadPercentage', 'CPU0',
+                                      points[-1][0] + INTERVAL, 1.0)
+    reopen_seconds = time.perf_counter() - started
+
+    bench.report('metric store', '{0} days, {1} points: written in {2:.2f}s, {3:.2f} bytes per '
+                 'point against 16 raw, one day {4:.1f}ms, daily rollup {5:.1f}ms against '
+                 '{6:.1f}ms from points, reopen and append {7:.1f}ms'.format(
+                     BENCH_DAYS, len(points), write_seconds, stored / float(len(points)),
+                     day_seconds * 1e3, rollup_seconds * 1e3, raw_seconds * 1e3,
+                     reopen_seconds * 1e3))
+    assert day == [point for point in points if middle <= point[0] < middle + DAY]
+    assert [bucket[0] for bucket in daily] == [bucket[0] for bucket in raw_daily]
+    assert [bucket[4] for bucket in daily] == [bucket[4] for bucket in raw_daily]
+    assert stored < len(points) * 8
+    if bench.FULL:
+        assert day_seconds < raw_seconds / 10
+        assert rollup_seconds < raw_seconds
@@ -0,0 +1,166 @@
+"""Network throughput from a fake raw counter feed: wraps, resets and exact rates."""
+import math
+
+import pytest
+
+from sample import network_throughput
+from sample.network_throughput import PERF_CLASS, ThroughputSampler
+
+WRAP_32 = 1 << 32
+
+
+class _Feed(object):
+    """Raw counters of fake interfaces, advanced by a set rate per counter.
+
+    Args:
+        frequencies(dict): Frequency_PerfTime per host name
+        interfaces(dict): Interface names per host name
+
+    """
+
+    def __init__(self, frequencies, interfaces):
+        self.frequencies = frequencies
+        self.ticks = {host: 10 ** 9 for host in frequencies}
+        self.counters = {(host, name): {counter: 1000 for counter in network_throughput.COUNTERS}
+                         for host in interfaces for name in interfaces[host]}
+
+    def advance(self, seconds, rates):
+        """Move every host on by seconds, rates are per (host, name) then counter."""
+        for host, frequency in self.frequencies.items():
+            self.ticks[host] += int(seconds * frequency)
+        for key, counters in self.counters.items():
+            for counter, rate in rates.get(key, {}).items():
+                bits = network_throughput.COUNTERS[counter][0]
+                counters[counter] = (counters[counter] + int(rate * seconds)) % (1 << bits)
+
+    def read(self, host):
+        """Return the rows of a host, values as strings the way WMI gives uint64."""
+        rows = []
+        for (owner, name), counters in sorted(self.counters.items()):
+            if owner == host:
+                row = {'Name': name, 'Timestamp_PerfTime': str(self.ticks[host]),
+                       'Frequency_PerfTime': str(self.frequencies[host])}
+                row.update((counter, str(value)) for counter, value in counters.items())
+                rows.append(row)
+        return rows
+
+
+def _by_interface(result, counter):
+    return {(host, name): value for host, name, value in
+            zip(result['host'], result['interface'], result[counter])}
+
+
+def test_rates_are_exact_over_every_window_interface_and_host():
+    frequencies = {'server01': 10000000, 'server02': 14318180, 'server03': 1000000000}
+    interfaces = {'server01': ['Ethernet0', 'Ethernet1'], 'server02': ['Ethernet0'],
+                  'server03': ['Ethernet0', 'Ethernet1', 'Loopback']}
+    feed = _Feed(frequencies, interfaces)
+    sampler = ThroughputSampler(read=feed.read)
+    assert sampler.sample(sorted(frequencies)) is None
+
+    rates = {}
+    for number, key in enumerate(sorted(feed.counters)):
+        rates[key] = {'BytesReceivedPersec': 125000 * (number + 1),
+                      'BytesSentPersec': 64000 * (number + 1),
+                      'PacketsReceivedPersec': 400 * (number + 1),
+                      'PacketsReceivedErrors': 4 * number}
+    for seconds in (1, 2.5, 7.25, 60):
+        feed.advance(seconds, rates)
+        result = sampler.sample(sorted(frequencies))
+
+        assert sorted(zip(result['host'], result['interface'])) == sorted(feed.counters)
+        assert list(result['seconds']) == pytest.approx([seconds] * len(feed.counters), rel=1e-12)
+        for counter in ('BytesReceivedPersec', 'BytesSentPersec', 'PacketsReceivedPersec'):
+            assert _by_interface(result, counter) == pytest.approx(
+                {key: rates[key][counter] for key in rates}, rel=1e-12)
+        # Error counters are counts over the window, not rates.
+        assert _by_interface(result, 'PacketsReceivedErrors') == {
+            key: rates[key]['PacketsReceivedErrors'] * seconds for key in rates}
+        assert set(_by_interface(result, 'PacketsOutboundErrors').values()) == {0}
+
+
+def test_a_wrapped_32_bit_counter_keeps_its_rate():
+    feed = _Feed({'server01': 10000000}, {'server01': ['Ethernet0']})
+    feed.counters['server01', 'Ethernet0']['PacketsReceivedPersec'] = WRAP_32 - 300
+    sampler = ThroughputSampler(read=feed.read)
+    sampler.sample(['server01'])
+
+    feed.advance(2, {('server01', 'Ethernet0'): {'PacketsReceivedPersec': 500}})
+    assert feed.counters['server01', 'Ethernet0']['PacketsReceivedPersec'] == 700
+    result = sampler.sample(['server01'])
+    assert list(result['PacketsReceivedPersec']) == [500]
+
+
+def test_a_64_bit_counter_going_back_is_a_reset():
+    feed = _Feed({'server01': 10000000}, {'server01': ['Ethernet0', 'Ethernet1']})
+    sampler = ThroughputSampler(read=feed.read)
+    sampler.sample(['server01'])
+
+    steady = {'BytesReceivedPersec': 1000, 'PacketsReceivedPersec': 10}
+    feed.advance(5, {('server01', 'Ethernet0'): steady, ('server01', 'Ethernet1'): steady})
+    # Ethernet1 was reset, its byte counter starts again below where it was.
+    feed.counters['server01', 'Ethernet1']['BytesReceivedPersec'] = 20
+    result = sampler.sample(['server01'])
+
+    received = _by_interface(result, 'BytesReceivedPersec')
+    assert received['server01', 'Ethernet0'] == 1000
+    assert math.isnan(received['server01', 'Ethernet1'])
+
+    # The next window rates the interface from where it restarted.
+    feed.advance(5, {('server01', 'Ethernet0'): steady, ('server01', 'Ethernet1'): steady})
+    result = sampler.sample(['server01'])
+    assert _by_interface(result, 'BytesReceivedPersec') == {('server01', 'Ethernet0'): 1000,
+                                                            ('server01', 'Ethernet1'): 1000}
+
+
+@pytest.mark.parametrize('ticks', [0, -5000])
+def test_a_perf_time_that_did_not_advance_gives_no_rate(ticks):
+    feed = _Feed({'server01': 10000000, 'server02': 10000000},
+                 {'server01': ['Ethernet0'], 'server02': ['Ethernet0']})
+    sampler = ThroughputSampler(read=feed.read)
+    sampler.sample(['server01', 'server02'])
+
+    rates = {key: {'BytesSentPersec': 4000, 'PacketsReceivedErrors': 3} for key in feed.counters}
+    feed.advance(1, rates)
+    # server01's perf time stands still or goes back, its counters still move.
+    feed.ticks['server01'] -= 10000000 - ticks
+    result = sampler.sample(['server01', 'server02'])
+
+    seconds = dict(zip(result['host'], result['seconds']))
+    assert math.isnan(seconds['server01'])
+    assert seconds['server02'] == 1
+    for counter in ('BytesSentPersec', 'PacketsReceivedErrors', 'PacketsSentPersec'):
+        values = _by_interface(result, counter)
+        assert math.isnan(values['server01', 'Ethernet0'])
+        assert not math.isnan(values['server02', 'Ethernet0'])
+    assert _by_interface(result, 'BytesSentPersec')['server02', 'Ethernet0'] == 4000
+
+
+def test_interfaces_in_one_sample_only_are_left_out():
+    feed = _Feed({'server01': 10000000}, {'server01': ['Ethernet0', 'Ethernet1']})
+    sampler = ThroughputSampler(read=feed.read)
+    sampler.sample(['server01'])
+
+    del feed.counters['server01', 'Ethernet1']
+    feed.counters['server01', 'Ethernet2'] = dict(feed.counters['server01', 'Ethernet0'])
+    feed.advance(1, {})
+    result = sampler.sample(['server01'])
+    assert result['interface'] == ['Ethernet0']
+
+    feed.counters.clear()
+    result = sampler.sample(['server01'])
+    assert result['host'] == [] and result['interface'] == []
+    assert len(result['BytesTotalPersec']) == 0
+
+
+def test_counters_are_read_through_wmi(backend):
+    feed = _Feed({'server01': 10000000}, {'server01': ['Ethernet0']})
+    host = backend.add('server01', classes={PERF_CLASS: lambda where: feed.read('server01')})
+    sampler = ThroughputSampler()
+    sampler.sample(['server01'])
+    feed.advance(4, {('server01', 'Ethernet0'): {'BytesTotalPersec': 2500000}})
+    result = sampler.sample(['server01'])
+
+    assert list(result['BytesTotalPersec']) == [2500000]
+    assert len(host.queries) == 2
+    assert host.queries[0].startswith('SELECT Name, Timestamp_PerfTime, Frequency_PerfTime, ')
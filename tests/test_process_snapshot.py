@@ -0,0 +1,142 @@
+"""Process snapshots read from the fake provider, with a 5k process benchmark."""
+import random
+import time
+
+import pytest
+
+import sample.utility as utility
+from sample.process_snapshot import ProcessSnapshot, take_snapshot
+from tests import bench
+
+BENCH_PROCESSES = bench.size('SNAPSHOT_BENCH_PROCESSES', 5000, 500)
+NAMES = ['svchost.exe', 'chrome.exe', 'sqlservr.exe', 'w3wp.exe', 'conhost.exe', 'java.exe']
+
+
+def _process(pid, parent, name, created='20210101000000.000000+000', **values):
+    row = {'ProcessId': pid, 'ParentProcessId': parent, 'Name': name, 'CreationDate': created,
+           'WorkingSetSize': '0', 'PageFileUsage': 0, 'KernelModeTime': '0',
+           'UserModeTime': '0', 'HandleCount': 0, 'ThreadCount': 0}
+    row.update(values)
+    return row
+
+
+def _processes(count, seed=5, cpu=0):
+    rand = random.Random(seed)
+    rows = [_process(4, 0, 'system')]
+    for pid in range(8, 8 + 4 * (count - 1), 4):
+        rows.append(_process(pid, rand.choice(rows)['ProcessId'], rand.choice(NAMES),
+                             WorkingSetSize=str(rand.randint(1, 2 ** 31)),
+                             PageFileUsage=rand.randint(1, 2 ** 20),
+                             KernelModeTime=str(pid * 1000 + cpu * pid),
+                             UserModeTime=str(pid * 3000 + cpu * pid),
+                             HandleCount=rand.randint(10, 5000), ThreadCount=rand.randint(1, 90)))
+    return rows
+
+
+def test_tree_and_aggregates():
+    snapshot = ProcessSnapshot([
+        _process(0, 0, 'System Idle Process'),
+        _process(4, 0, 'System', WorkingSetSize='100'),
+        _process(500, 4, 'svchost.exe', WorkingSetSize='2000', ThreadCount=3),
+        _process(600, 500, 'svchost.exe', WorkingSetSize='3000', ThreadCount=4),
+        # Its parent id was reused by a process created after it.
+        _process(700, 500, 'orphan.exe', created='20200101000000.000000+000',
+                 WorkingSetSize=str(2 ** 40))], timestamp=0)
+
+    assert snapshot.roots() == [0, 700]
+    assert sorted(snapshot.subtree(4)) == [4, 500, 600]
+    assert snapshot.aggregate_subtree(500)['WorkingSetSize'] == 5000
+    assert snapshot.total('WorkingSetSize') == 2 ** 40 + 5100
+    by_name = snapshot.aggregate_by_name()
+    assert by_name['svchost.exe']['count'] == 2
+    assert by_name['svchost.exe']['ThreadCount'] == 7
+    assert snapshot.top('WorkingSetSize', 2) == [(2 ** 40, 700, 'orphan.exe'),
+                                                 (3000, 600, 'svchost.exe')]
+
+
+def test_cpu_rates_use_the_host_clock(backend):
+    clock = {'Timestamp_Sys100NS': str(130000000000000000)}
+    rows = [_process(4, 0, 'system', KernelModeTime='0'),
+            _process(8, 4, 'busy.exe', KernelModeTime='10000000'),
+            _process(12, 4, 'reused.exe')]
+    host = backend.add('server01', classes={'Win32_PerfRawData_PerfOS_System': [clock],
+                                            'Win32_Process': rows})
+    wmi_obj = utility.connect('server01')
+    earlier = take_snapshot(wmi_obj)
+
+    clock['Timestamp_Sys100NS'] = str(130000000000000000 + 2 * 10000000)
+    rows[1]['KernelModeTime'] = '20000000'
+    rows[1]['UserModeTime'] = '10000000'
+    rows[2]['CreationDate'] = '20220101000000.000000+000'
+    # However long the collector takes, the host saw two seconds pass.
+    time.sleep(0.2)
+    later = take_snapshot(wmi_obj)
+
+    assert later.timestamp - earlier.timestamp == 2
+    assert later.cpu_rates(earlier) == {4: 0.0, 8: 1.0}
+    assert later.top_cpu(earlier, 1) == [(1.0, 8, 'busy.exe')]
+    assert host.queries[0] == 'SELECT Timestamp_Sys100NS FROM Win32_PerfRawData_PerfOS_System'
+
+
+def _naive_by_name(rows):
+    totals = {}
+    for row in rows:
+        entry = totals.setdefault(row['Name'], {'count': 0, 'WorkingSetSize': 0,
+                                                'HandleCount': 0})
+        entry['count'] += 1
+        entry['WorkingSetSize'] += int(row['WorkingSetSize'])
+        entry['HandleCount'] += int(row['HandleCount'])
+    return totals
+
+
+def _naive_rates(rows, earlier_rows, elapsed):
+    earlier = {row['ProcessId']: row for row in earlier_rows}
+    rates = {}
+    for row in rows:
+        old = earlier.get(row['ProcessId'])
+        if old is not None and old['CreationDate'] == row['CreationDate']:
+            ticks = int(row['KernelModeTime']) + int(row['UserModeTime']) - \
+                int(old['KernelModeTime']) - int(old['UserModeTime'])
+            rates[row['ProcessId']] = max(ticks, 0) / 10000000 / elapsed
+    return rates
+
+
+def _timed(function, *args):
+    started = time.perf_counter()
+    for _ in range(20):
+        result = function(*args)
+    return result, (time.perf_counter() - started) / 20
+
+
+@pytest.mark.benchmark
+def test_benchmark_5k_processes(backend):
+    earlier_rows = _processes(BENCH_PROCESSES)
+    rows = _processes(BENCH_PROCESSES, cpu=7)
+    backend.add('server01', classes={'Win32_Process': earlier_rows})
+    started = time.perf_counter()
+    earlier = take_snapshot(utility.connect('server01'))
+    read_seconds = time.perf_counter() - started
+    earlier.timestamp = 0
+    later = ProcessSnapshot(rows, timestamp=10)
+
+    columns = ('WorkingSetSize', 'HandleCount')
+    by_name, by_name_seconds = _timed(later.aggregate_by_name, columns)
+    naive_by_name, naive_by_name_seconds = _timed(_naive_by_name, rows)
+    rates, rates_seconds = _timed(later.cpu_rates, earlier)
+    naive_rates, naive_rates_seconds = _timed(_naive_rates, rows, earlier_rows, 10)
+    _, top_seconds = _timed(later.top, 'WorkingSetSize', 10)
+    _, subtree_seconds = _timed(later.aggregate_subtree, 4)
+
+    bench.report('process snapshot', '{0} processes: read through the fake provider {1:.1f}ms, '
+                 'by name {2:.2f}ms against {3:.2f}ms walking rows, cpu rates {4:.2f}ms against '
+                 '{5:.2f}ms, top 10 {6:.2f}ms, whole tree {7:.2f}ms'.format(
+                     len(later), read_seconds * 1e3, by_name_seconds * 1e3,
+                     naive_by_name_seconds * 1e3, rates_seconds * 1e3, naive_rates_seconds * 1e3,
+                     top_seconds * 1e3, subtree_seconds * 1e3))
+    assert by_name == naive_by_name
+    assert rates == naive_rates
+    assert len(earlier) == BENCH_PROCESSES
+    assert later.aggregate_subtree(4)['count'] == BENCH_PROCESSES
+    if bench.FULL:
+        assert by_name_seconds < naive_by_name_seconds
+        assert rates_seconds < naive_rates_seconds
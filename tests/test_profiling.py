@@ -0,0 +1,125 @@
+"""The collector profiler in both modes, and its overhead on a collection."""
+import os
+import pstats
+import sys
+import time
+
+import pytest
+
+import sample.win_system_get_statistics as orchestrator
+from sample.profiling import CollectorProfiler
+from tests import bench
+from tests.fake_hosts import server_classes
+
+BENCH_SERVICES = bench.size('PROFILE_BENCH_SERVICES', 5000, 300)
+BENCH_RUNS = bench.size('PROFILE_BENCH_RUNS', 10, 2)
+
+COLLECTORS = {function.__name__ for function in orchestrator.SYSTEM_INFORMATION_FUNCTIONS}
+
+
+def _profiled(monkeypatch, mode, host='server01', interval=0.001):
+    profiler = CollectorProfiler(mode, interval=interval)
+    monkeypatch.setattr(orchestrator, '_PROFILER', profiler)
+    profiler.start()
+    try:
+        orchestrator.collect_system_stats(host)
+    finally:
+        profiler.stop()
+    return profiler
+
+
+def test_sampling_adds_up_the_stacks_of_every_collector(backend, monkeypatch):
+    # Every query waits long enough for the collector threads to be sampled.
+    backend.add('server01', classes=server_classes(), latency_per_query=0.02)
+    profiler = _profiled(monkeypatch, 'sample')
+
+    lines = profiler.collapsed().splitlines()
+    assert lines
+    roots = set()
+    for line in lines:
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+        roots.add(stack.split(';')[0])
+    # Stacks start at the collector, the thread plumbing below it is cut.
+    assert roots <= COLLECTORS
+    assert {'collect_win_services_stats', 'collect_win_disk_stats'} <= roots
+
+    top = profiler.top().splitlines()
+    assert top[0].split() == ['total', 'own', 'function']
+    assert top[-1] == '{0} samples every 0.001s'.format(profiler.samples)
+    assert 'collect_win_services_stats' in {line.split()[-1] for line in top[1:-1]}
+    assert not profiler.threads
+
+    paths = profiler.write('profile')
+    assert [os.path.splitext(path)[1] for path in paths] == ['.collapsed', '.txt']
+    with open(paths[0]) as file_object:
+        assert file_object.read() == profiler.collapsed()
+
+
+def test_cprofile_merges_the_collector_calls(backend, monkeypatch):
+    backend.add('server01', classes=server_classes())
+    profiler = _profiled(monkeypatch, 'cprofile')
+
+    called = {name for _, _, name in profiler.stats.stats}
+    assert COLLECTORS <= called
+    assert 'collect_system_stats' not in called
+    top = profiler.top(limit=10)
+    assert 'function calls' in top
+    assert 'Ordered by: cumulative time' in top
+
+    paths = profiler.write('profile')
+    assert [os.path.splitext(path)[1] for path in paths] == ['.pstats', '.txt']
+    assert {name for _, _, name in pstats.Stats(paths[0]).stats} == called
+
+
+@pytest.mark.parametrize('mode', ['cprofile', 'sample'])
+def test_main_profiles_only_the_collectors(backend, monkeypatch, capsys, mode):
+    backend.add('server01', classes=server_classes(), latency_per_query=0.01)
+    monkeypatch.setattr(sys, 'argv', ['win_system_get_statistics.py', '--host', 'server01',
+                                      '--profile', mode, '--profile-output', 'profile'])
+    monkeypatch.setattr(orchestrator, '_PROFILER', None)
+    orchestrator.main()
+
+    written = sorted(os.listdir('profile'))
+    assert len(written) == 2
+    assert 'Profile written to' in capsys.readouterr().out
+    if mode == 'cprofile':
+        stats = pstats.Stats(os.path.join('profile', written[0]))
+        called = {name for _, _, name in stats.stats}
+        assert 'collect_win_services_stats' in called
+        # The orchestrator waiting on its collector threads is not a collector's cost.
+        assert 'collect_system_stats' not in called
+    else:
+        with open(os.path.join('profile', written[0])) as file_object:
+            roots = {line.split(';')[0] for line in file_object}
+        assert roots <= COLLECTORS
+
+
+def _timed(monkeypatch, mode):
+    started = time.perf_counter()
+    if mode is None:
+        monkeypatch.setattr(orchestrator, '_PROFILER', None)
+        orchestrator.collect_system_stats('server01')
+    else:
+        _profiled(monkeypatch, mode, interval=0.005)
+    return time.perf_counter() - started
+
+
+@pytest.mark.benchmark
+def test_profiling_overhead(backend, monkeypatch):
+    backend.add('server01', classes=server_classes(services=BENCH_SERVICES))
+    best = {}
+    # Rounds interleave the modes, so none gains from running after the others.
+    for _ in range(BENCH_RUNS):
+        for mode in (None, 'sample', 'cprofile'):
+            seconds = _timed(monkeypatch, mode)
+            best[mode] = min(best.get(mode, seconds), seconds)
+    plain, sampled, profiled = best[None], best['sample'], best['cprofile']
+
+    bench.report('profiling overhead', '{0} services, unprofiled {1:.3f}s, sample {2:.3f}s '
+                 '({3:+.0%}), cprofile {4:.3f}s ({5:+.0%})'.format(
+                     BENCH_SERVICES, plain, sampled, sampled / plain - 1, profiled,
+                     profiled / plain - 1))
+    if bench.FULL:
+        # Sampling costs a fixed interval, cProfile a hook on every call.
+        assert sampled < profiled
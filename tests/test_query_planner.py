@@ -0,0 +1,73 @@
+"""The query planner against the fake provider, with injected round trip latency."""
+import time
+
+import pytest
+
+import sample.win_system_get_statistics as orchestrator
+import sample.wmi_query_planner as wmi_query_planner
+from tests import bench
+from tests.fake_hosts import server_classes
+
+PLANNABLE = [function for function in orchestrator.SYSTEM_INFORMATION_FUNCTIONS
+             if wmi_query_planner.COLLECTOR_SECTIONS.get(function.__name__)]
+# Round trip latencies of a remote host over a WAN link.
+LATENCY = {'connect_latency': 0.08, 'latency_per_query': 0.04, 'latency_per_batch': 0.01}
+
+
+def _round_trips(host):
+    return host.connections + len(host.queries) + host.batches
+
+
+def test_planned_content_matches_the_collectors(backend):
+    host = backend.add('server01', classes=server_classes())
+    failures = {}
+    separate = orchestrator.get_system_information('server01', failures=failures,
+                                                   functions=PLANNABLE)
+    assert not failures
+    queries = len(host.queries)
+    host.reset()
+    messages = []
+    planned = orchestrator.get_system_information('server01', failures=failures, planned=True,
+                                                  functions=PLANNABLE, messages=messages)
+
+    assert not failures
+    assert planned == separate
+    assert host.connections == 1
+    assert len(host.queries) == queries == len(set(host.queries))
+    assert len(messages) == 1
+    assert messages[0].startswith('{0} planned queries, {1} rows in '.format(
+        queries, host.rows_returned))
+
+
+def test_shared_queries_run_once():
+    plan = wmi_query_planner.plan_queries(['collect_win_disk_stats', 'collect_win_disk_stats',
+                                           'collect_win_processes_stats'])
+    assert len(plan['queries']) == 5
+    assert plan['fallback'] == ['collect_win_processes_stats']
+
+
+@pytest.mark.benchmark
+def test_benchmark_round_trips_and_wall_time(backend):
+    host = backend.add('server01', classes=server_classes(
+        services=bench.size('PLANNER_BENCH_SERVICES', 250, 60)), **LATENCY)
+    results = {}
+    for name, run in (
+            ('one after another', lambda: [function('server01') for function in PLANNABLE]),
+            ('threaded', lambda: orchestrator.get_system_information(
+                'server01', functions=PLANNABLE)),
+            ('planned', lambda: orchestrator.get_system_information(
+                'server01', functions=PLANNABLE, planned=True))):
+        host.reset()
+        started = time.perf_counter()
+        run()
+        results[name] = (time.perf_counter() - started, host.connections, len(host.queries),
+                         host.batches, _round_trips(host))
+
+    bench.report('query planner', ', '.join(
+        '{0} {1:.2f}s with {2} connections, {3} queries, {4} batches, {5} round trips'.format(
+            name, seconds, connections, queries, batches, trips)
+        for name, (seconds, connections, queries, batches, trips) in results.items()))
+    assert results['planned'][1] == 1
+    assert results['planned'][4] < results['threaded'][4] == results['one after another'][4]
+    if bench.FULL:
+        assert results['planned'][0] < results['one after another'][0] / 3
@@ -0,0 +1,128 @@
+"""Report history import: which copies of a report are merged, and MB/s per core."""
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import pytest
+
+from sample.inventory_sql import InventoryDatabase
+from sample.report_import import import_reports, parse_range, split_ranges
+from tests import bench
+
+BENCH_MB = bench.size('IMPORT_BENCH_MB', 256, 4)
+
+
+def _report(content, end_time='01-03-2021 08:00:05', **fields):
+    reports = {'capability_name': 'win_services_statistics', 'host': 'COLLECTOR01',
+               'start_time': '01-03-2021 08:00:00', 'end_time': end_time,
+               'outcome': 'Successful', 'messages': [], 'content': content}
+    reports.update(fields)
+    return reports
+
+
+def _import(tmp_path, lines):
+    path = tmp_path / 'win_services_statistics_report'
+    path.write_text(''.join(json.dumps(reports) + '\n' for reports in lines))
+    database = InventoryDatabase(str(tmp_path / 'fleet.db'))
+    try:
+        summary = import_reports(database, [str(path)], processes=1)
+        database.flush()
+        rows = database.connection.execute(
+            'SELECT target, end_time, outcome FROM reports ORDER BY id').fetchall()
+    finally:
+        database.close()
+    return summary, rows
+
+
+def test_reports_without_a_target_are_told_apart_by_content(tmp_path):
+    server01 = {'services': {'Spooler': {'State': 'Running'}}}
+    server02 = {'services': {'Spooler': {'State': 'Stopped'}}}
+    summary, rows = _import(tmp_path, [
+        _report(server01), _report(server02),
+        # The second copy of a threaded write, finished a moment later.
+        _report(server01, end_time='01-03-2021 08:00:06')])
+
+    assert summary['reports'] == 2
+    assert summary['duplicates'] == 1
+    assert rows == [(None, '01-03-2021 08:00:05', 'Successful'),
+                    (None, '01-03-2021 08:00:06', 'Successful')]
+
+
+def test_reports_with_a_target_keep_the_last_copy(tmp_path):
+    summary, rows = _import(tmp_path, [
+        _report({'services': {}}, target='server01'),
+        _report({'services': {'Spooler': {}}}, target='server01', end_time='01-03-2021 08:00:09'),
+        _report({'services': {}}, target='server02')])
+
+    assert summary['reports'] == 2
+    assert rows == [('server01', '01-03-2021 08:00:09', 'Successful'),
+                    ('server02', '01-03-2021 08:00:05', 'Successful')]
+
+
+def test_a_failed_copy_rewritten_as_successful_is_merged(tmp_path):
+    content = {'services': {'Spooler': {'State': 'Running'}}}
+    failed = _report(content, outcome='Failed', return_body={'outcome': 'Failed'})
+    successful = _report(content, end_time='01-03-2021 08:00:07',
+                         return_body={'outcome': 'Successful', 'content': content})
+    other = _report({'services': {'Spooler': {'State': 'Stopped'}}}, outcome='Failed')
+    summary, rows = _import(tmp_path, [failed, other, successful])
+
+    assert summary['reports'] == 2
+    assert summary['duplicates'] == 1
+    assert rows == [(None, '01-03-2021 08:00:05', 'Failed'),
+                    (None, '01-03-2021 08:00:07', 'Successful')]
+
+
+def _history(path, megabytes):
+    services = {'Service {0}'.format(number): {
+        'Name': 'svc{0}'.format(number), 'State': 'Running', 'StartMode': 'Auto',
+        'PathName': 'C:\\Windows\\System32\\svchost.exe -k netsvcs'} for number in range(150)}
+    written = 0
+    with open(path, 'w') as file_object:
+        while file_object.tell() < megabytes * 1024 * 1024:
+            host = written % 500
+            file_object.write(json.dumps(_report(
+                {'services': services}, target='server{0:03d}'.format(host),
+                start_time='{0:06d}'.format(written // 500))) + '\n')
+            written += 1
+    return written
+
+
+def _parse_rate(tasks, workers, megabytes):
+    pool = Pool(workers)
+    try:
+        started = time.perf_counter()
+        pool.map(parse_range, tasks)
+        return megabytes / (time.perf_counter() - started)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@pytest.mark.benchmark
+def test_import_throughput_per_core(tmp_path):
+    path = str(tmp_path / 'win_services_statistics_report')
+    written = _history(path, BENCH_MB)
+    megabytes = os.path.getsize(path) / 1024 / 1024
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    tasks = [(path, start, end) for start, end in split_ranges(path, 1024 * 1024)]
+
+    # Decoding and flattening alone, which is what the workers scale.
+    rates = {workers: _parse_rate(tasks, workers, megabytes)
+             for workers in sorted({1, min(2, cores), cores})}
+    database = InventoryDatabase(str(tmp_path / 'fleet.db'))
+    try:
+        summary = import_reports(database, [path], processes=cores, chunk_bytes=1024 * 1024)
+    finally:
+        database.close()
+
+    assert summary['reports'] == written
+    assert summary['invalid'] == summary['duplicates'] == 0
+    bench.report('report import', '{0:.0f} MB, {1} cores, parsing {2}, import {3:.1f} MB/s'.format(
+        megabytes, cores, ', '.join('{0:.1f} MB/s per core on {1}'.format(
+            rate / workers, workers) for workers, rate in sorted(rates.items())),
+        megabytes / summary['seconds']))
+    if bench.FULL and cores > 1:
+        # Parsing runs in separate processes, it should not be serialised.
+        assert rates[cores] > 1.5 * rates[1]
@@ -0,0 +1,97 @@
+"""The compressed report log: durability across processes, segment claims and reads."""
+import gzip
+import json
+import multiprocessing
+import os
+
+import pytest
+
+import sample.report_log as report_log
+import sample.utility as utility
+
+CAPABILITY = 'win_test_statistics'
+FORK = multiprocessing.get_context('fork')
+
+
+def _reports(tmp_path, target):
+    return {'project_dir': str(tmp_path), 'log_path': str(tmp_path / 'logs'),
+            'capability_name': CAPABILITY, 'host': 'collector', 'target': target,
+            'outcome': 'Successful', 'messages': [], 'content': {'target': target},
+            'return_body': {}}
+
+
+def _report_and_die(tmp_path):
+    utility.reporting(_reports(tmp_path, 'server02'))
+    # No atexit and no finalizers, as when a worker crashes.
+    os._exit(0)  # pylint: disable=W0212
+
+
+def _append_and_exit(log_path):
+    report_log.get_writer(log_path, CAPABILITY).append({'target': 'server03'}, 'server03')
+
+
+def _run(target, *args):
+    process = FORK.Process(target=target, args=args)
+    process.start()
+    process.join(30)
+    assert process.exitcode == 0
+
+
+@pytest.fixture
+def writers():
+    """Start and end each test without cached writers."""
+    report_log._forget_writers()  # pylint: disable=W0212
+    yield
+    report_log._forget_writers()  # pylint: disable=W0212
+
+
+def test_reporting_is_durable_when_it_returns(tmp_path, writers):
+    _run(_report_and_die, tmp_path)
+    records = report_log.find(str(tmp_path / 'logs'), CAPABILITY, 'server02')
+    assert [record['content'] for record in records] == [{'target': 'server02'}]
+
+
+def test_children_flush_and_do_not_repeat_inherited_buffers(tmp_path, writers):
+    log_path = str(tmp_path / 'logs')
+    parent = report_log.get_writer(log_path, CAPABILITY)
+    parent.append({'target': 'server01'}, 'server01')
+
+    _run(_append_and_exit, log_path)
+    assert [record['target'] for record in report_log.scan(log_path, CAPABILITY, 1)] == [
+        'server03']
+
+    parent.flush()
+    assert sorted(record['target'] for record in report_log.scan(log_path, CAPABILITY, 1)) == [
+        'server01', 'server03']
+
+
+def test_writers_claim_their_own_segment(tmp_path):
+    log_path = str(tmp_path / 'logs')
+    # Separate writers, as in separate processes, opening in the same second.
+    first = report_log.ReportLogWriter(log_path, CAPABILITY)
+    second = report_log.ReportLogWriter(log_path, CAPABILITY)
+    locations = [first.write({'n': 1}, 'a'), second.write({'n': 2}, 'a'),
+                 first.write({'n': 3}, 'a')]
+
+    assert first.segment != second.segment
+    assert locations[0]['segment'] == locations[2]['segment'] == first.segment
+    assert locations[2]['offset'] > locations[0]['offset'] == 0
+    assert [record['n'] for record in report_log.find(log_path, CAPABILITY, 'a')] == [1, 3, 2]
+    with open(first.segment, 'rb') as file_object:
+        file_object.seek(locations[2]['offset'])
+        block = gzip.decompress(file_object.read(locations[2]['length']))
+    assert json.loads(block.splitlines()[locations[2]['record']]) == {'n': 3}
+
+
+def test_read_records_streams(tmp_path):
+    path = str(tmp_path / 'segment.gz')
+    with gzip.open(path, 'wt') as file_object:
+        for number in range(50000):
+            file_object.write(json.dumps({'n': number}) + '\n')
+    plain = tmp_path / 'plain_report'
+    plain.write_text('{"n": 0}\n\n{"n": 1}\n')
+
+    records = report_log.read_records(path)
+    assert next(records) == {'n': 0}
+    assert sum(1 for _ in records) == 49999
+    assert list(report_log.read_records(str(plain))) == [{'n': 0}, {'n': 1}]
@@ -0,0 +1,156 @@
+"""Retry, budgets and the circuit breaker, with faults injected into the fake provider."""
+import time
+
+import pytest
+import pythoncom
+
+import sample.resilience as resilience
+import sample.utility as utility
+import sample.win_system_get_statistics as orchestrator
+from sample.win_bios_statistics import collect_win_bios_stats
+from tests import fake_wmi
+
+# RPC_S_SERVER_UNAVAILABLE as the signed value pywintypes carries.
+UNAVAILABLE = 0x800706BA - 2 ** 32
+ACCESS_DENIED = 0x80070005 - 2 ** 32
+BIOS = {'Win32_BIOS': [{'Caption': 'BIOS', 'Version': 'A1'}]}
+
+
+class FlakyHost(fake_wmi.FakeHost):
+    """Fails its first connects with a transient error."""
+
+    def __init__(self, failures, **settings):
+        super(FlakyHost, self).__init__(**settings)
+        self.failures = failures
+
+    def connect(self, namespace):
+        if self.failures:
+            self.failures -= 1
+            self.connections += 1
+            raise pythoncom.com_error(UNAVAILABLE, 'The RPC server is unavailable.')
+        return super(FlakyHost, self).connect(namespace)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(autouse=True)
+def no_delay(monkeypatch):
+    monkeypatch.setattr(utility, 'RETRY_POLICY', resilience.RetryPolicy(base_delay=0))
+
+
+def test_connect_is_retried_not_the_collector(backend):
+    host = backend.add('server01', FlakyHost(2, classes=BIOS))
+    budget = resilience.TimeoutBudget(60)
+    with resilience.budget_scope(budget):
+        content = collect_win_bios_stats('server01')['content']
+
+    assert list(content['bios_information']) == ['BIOS']
+    assert host.connections == 3
+    assert host.queries == ['SELECT * FROM Win32_BIOS']
+    assert (budget.connections, budget.connect_failures) == (1, 0)
+
+
+def test_remote_connect_waits_at_most_two_minutes(backend):
+    host = backend.add('server01', classes=BIOS)
+    collect_win_bios_stats('server01')
+    assert host.connect_flags == [utility.WBEM_FLAG_CONNECT_USE_MAX_WAIT]
+
+
+def test_query_errors_are_retried_only_when_transient(backend):
+    host = backend.add('server01', classes=BIOS)
+    wmi_obj = utility.connect('server01')
+    host.query_error = pythoncom.com_error(ACCESS_DENIED, 'Access is denied.')
+    with pytest.raises(pythoncom.com_error):
+        utility.exec_query(wmi_obj, 'SELECT * FROM Win32_BIOS')
+    assert len(host.queries) == 1
+
+    host.query_error = pythoncom.com_error(UNAVAILABLE, 'The RPC server is unavailable.')
+    with pytest.raises(pythoncom.com_error):
+        utility.exec_query(wmi_obj, 'SELECT * FROM Win32_BIOS')
+    assert len(host.queries) == 1 + utility.RETRY_POLICY.attempts
+
+
+def test_retries_stop_when_the_budget_is_used_up(backend):
+    host = backend.add('server01', FlakyHost(5, classes=BIOS))
+    budget = resilience.TimeoutBudget(0)
+    with resilience.budget_scope(budget), pytest.raises(resilience.BudgetExhausted):
+        utility.connect('server01')
+    assert host.connections == 0
+    assert not budget.reachable()
+
+
+def test_a_host_without_a_budget_still_times_out(backend, monkeypatch):
+    def hang(host):
+        time.sleep(5)
+        return {'content': {'late': host}}
+
+    def quick(host):
+        return {'content': {'quick': host}}
+
+    monkeypatch.setattr(orchestrator, 'DEFAULT_HOST_TIMEOUT', 0.5)
+    monkeypatch.setattr(orchestrator, 'SYSTEM_INFORMATION_FUNCTIONS', [hang, quick])
+    started = time.monotonic()
+    return_body = orchestrator.collect_system_stats('server01')
+    assert time.monotonic() - started < 3
+    assert return_body['content'] == {'quick': 'server01'}
+    assert 'hang failed: Timed out, timeout budget used up' in return_body['messages']
+
+
+def test_half_open_lets_a_single_trial_through():
+    clock = Clock()
+    breaker = resilience.CircuitBreaker(failure_threshold=2, cooldown=100, clock=clock)
+    breaker.record_failure('server01')
+    assert breaker.allow('server01')
+    breaker.record_failure('server01')
+    assert not breaker.allow('server01')
+
+    clock.now = 100
+    assert breaker.state('server01') == 'half_open'
+    assert breaker.allow('server01')
+    assert not breaker.allow('server01')
+    breaker.record_failure('server01')
+    assert not breaker.allow('server01')
+
+    clock.now = 200
+    assert breaker.allow('server01')
+    breaker.record_success('server01')
+    assert breaker.allow('server01') and breaker.allow('server01')
+
+
+def test_a_lost_trial_is_replaced_after_the_cooldown():
+    clock = Clock()
+    breaker = resilience.CircuitBreaker(failure_threshold=1, cooldown=100, clock=clock)
+    breaker.record_failure('server01')
+    clock.now = 100
+    assert breaker.allow('server01')
+    clock.now = 150
+    assert not breaker.allow('server01')
+    clock.now = 200
+    assert breaker.allow('server01')
+
+
+def test_only_reachable_hosts_close_the_circuit(backend, monkeypatch):
+    def offline(host):
+        return {'content': {'cached': host}}
+
+    backend.add('server01', classes=BIOS)
+    monkeypatch.setattr(orchestrator, 'SYSTEM_INFORMATION_FUNCTIONS',
+                        [collect_win_bios_stats, offline])
+    breaker = resilience.CircuitBreaker(failure_threshold=1)
+    fleet = orchestrator.collect_fleet_stats(['server01', 'server02'], breaker=breaker)
+
+    # server02 refuses every connection, the content of the collector that
+    # needs no connection does not make it healthy.
+    assert sorted(fleet['content']) == ['server01', 'server02']
+    assert breaker.state('server01') == 'closed'
+    assert breaker.state('server02') == 'open'
+    fleet = orchestrator.collect_fleet_stats(['server02'], breaker=breaker)
+    assert fleet['failed_hosts'] == {
+        'server02': 'Skipped, circuit open after repeated failures'}
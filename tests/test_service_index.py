@@ -0,0 +1,117 @@
+"""The service index built alongside collection, with a 10k host benchmark."""
+import json
+import time
+
+import pytest
+
+import sample.service_index as service_index
+import sample.win_system_get_statistics as orchestrator
+from sample.service_index import ServiceIndex
+from sample.win_services_statistics import collect_win_services_stats
+from tests import bench
+from tests.fake_hosts import reference, server_classes
+
+BENCH_HOSTS = bench.size('SERVICE_BENCH_HOSTS', 10000, 300)
+
+
+@pytest.fixture
+def index(monkeypatch):
+    """Return an empty process wide index."""
+    fresh = ServiceIndex()
+    monkeypatch.setattr(service_index, '_INDEX', fresh)
+    return fresh
+
+
+def _server(backend, name, stopped=(), services=12):
+    classes = server_classes(services=services)
+    for service in classes['Win32_Service']:
+        if service['Name'] in stopped:
+            service['State'] = 'Stopped'
+    classes['Win32_DependentService'].append({
+        'Antecedent': reference('Win32_Service', Name='svc4'),
+        'Dependent': reference('Win32_Service', Name='svc5')})
+    return backend.add(name, classes=classes)
+
+
+def test_collection_fills_the_index(backend, index):
+    _server(backend, 'server01', stopped=('svc3',))
+    _server(backend, 'server02')
+    _server(backend, 'server03', stopped=('svc3', 'svc5'))
+    for host in ('server01', 'server02', 'server03'):
+        orchestrator.collect_system_stats(host)
+
+    assert service_index.get_index() is index
+    assert index.hosts_with('Auto', 'Stopped') == ['server01', 'server03']
+    assert index.services_in('Auto', 'Stopped') == {'svc3': ['server01', 'server03'],
+                                                    'svc5': ['server03']}
+    # svc4 depends on svc3 and svc5 on svc4.
+    assert index.dependents_of('svc3', 'server02') == {'svc4', 'svc5'}
+    assert index.dependents_of('svc3', 'server02', recursive=False) == {'svc4'}
+    assert index.dependencies_of('svc5', 'server02') == {'svc4', 'svc3'}
+
+    stopped = index.bitmap('Auto', 'Stopped')
+    assert index.host_names(index.not_(stopped)) == ['server02']
+    index.remove('server02')
+    assert index.host_names(index.not_(stopped)) == []
+
+    # A collection that finds the service running again replaces the host.
+    backend.hosts['server01'].classes['Win32_Service'][3]['State'] = 'Running'
+    orchestrator.collect_system_stats('server01')
+    assert index.hosts_with('Auto', 'Stopped') == ['server03']
+
+
+def test_untargeted_reports_are_skipped(backend, tmp_path, index):
+    _server(backend, 'server01', stopped=('svc3',))
+    _server(backend, 'server02')
+    log_file = tmp_path / 'win_services_statistics_report'
+    with open(str(log_file), 'w') as file_object:
+        for host in ('server01', 'server02'):
+            reports = {'capability_name': 'win_services_statistics', 'host': 'collector',
+                       'outcome': 'Successful',
+                       'content': collect_win_services_stats(host)['content']}
+            # Older collectors only recorded the collecting machine.
+            file_object.write(json.dumps(dict(reports, target=host)) + '\n' +
+                              json.dumps(reports) + '\n')
+
+    assert index.add_report_log(str(log_file)) == {'hosts': 2, 'untargeted': 2}
+    assert index.hosts == ['server01', 'server02']
+    assert index.hosts_with('Auto', 'Stopped') == ['server01']
+
+
+@pytest.mark.benchmark
+def test_benchmark_10k_hosts(backend, index):
+    contents = {}
+    for number in range(BENCH_HOSTS):
+        host = 'host{0:05d}'.format(number)
+        _server(backend, host, stopped=('svc{0}'.format(number % 40),) if number % 3 else (),
+                services=60)
+        contents[host] = collect_win_services_stats(host)['content']
+
+    started = time.perf_counter()
+    for host, content in contents.items():
+        service_index.index_content(host, content)
+    index.build()
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(20):
+        scanned = sorted(host for host, content in contents.items()
+                         if any(service['StartMode'] == 'Auto' and service['State'] == 'Stopped'
+                                and service['Name'] in ('svc7', 'svc8')
+                                for service in content['services'].values()))
+    scan_seconds = (time.perf_counter() - started) / 20
+    started = time.perf_counter()
+    for _ in range(20):
+        indexed = index.host_names(index.bitmap('Auto', 'Stopped', 'svc7') |
+                                   index.bitmap('Auto', 'Stopped', 'svc8'))
+    index_seconds = (time.perf_counter() - started) / 20
+
+    bench.report('service index', '{0} hosts, {1} services: build {2:.2f}s, query {3:.3f}ms '
+                 'indexed against {4:.1f}ms scanning'.format(
+                     BENCH_HOSTS, BENCH_HOSTS * 60, build_seconds, index_seconds * 1e3,
+                     scan_seconds * 1e3))
+    assert indexed == scanned
+    assert len(index.host_names(index.not_(index.bitmap('Auto', 'Stopped')))) == \
+        len(range(0, BENCH_HOSTS, 3))
+    if bench.FULL:
+        assert index_seconds < scan_seconds / 10
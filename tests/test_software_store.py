@@ -0,0 +1,126 @@
+"""The content addressed software store, with a synthetic fleet benchmark."""
+import json
+import os
+import random
+import time
+
+import pytest
+
+import sample.utility as utility
+from sample.software_store import SoftwareStore
+from tests import bench
+
+# Raise for a larger benchmark, e.g. SOFTWARE_BENCH_HOSTS=20000.
+BENCH_HOSTS = bench.size('SOFTWARE_BENCH_HOSTS', 2000, 200)
+
+
+def _product(name, version, **values):
+    record = {'DisplayName': name, 'DisplayVersion': version, 'Publisher': 'Contoso',
+              'InstallDate': '20200101', 'InstallLocation': 'C:\\Program Files\\' + name}
+    record.update(values)
+    return record
+
+
+def _registry_values(index, version):
+    # The values a typical MSI product registers besides its name.
+    return {'UninstallString': 'MsiExec.exe /X{{{0:08d}-0000-0000-0000-000000000000}}'
+                               .format(index),
+            'ModifyPath': 'MsiExec.exe /I{{{0:08d}-0000-0000-0000-000000000000}}'.format(index),
+            'HelpLink': 'https://support.contoso.com/product/{0}'.format(index),
+            'URLInfoAbout': 'https://www.contoso.com/product/{0}'.format(index),
+            'Comments': 'Contoso product {0} version {1}'.format(index, version),
+            'EstimatedSize': 1024 * index, 'Language': 1033, 'VersionMajor': index % 5,
+            'NoModify': 1, 'NoRepair': 1, 'WindowsInstaller': 1}
+
+
+def _fleet(hosts, products_per_host=120, seed=7):
+    rand = random.Random(seed)
+    catalog = []
+    for index in range(300):
+        for minor in range(4):
+            version = '{0}.{1}.{2}'.format(index % 5, minor, rand.randint(0, 3000))
+            catalog.append(_product('Product {0}'.format(index), version,
+                                    **_registry_values(index, version)))
+    for number in range(hosts):
+        details = {}
+        for record in rand.sample(catalog, products_per_host):
+            record = dict(record, InstallDate='2020{0:02d}{1:02d}'.format(rand.randint(1, 12),
+                                                                        rand.randint(1, 28)))
+            details[record['DisplayName'] + record['DisplayVersion']] = record
+        yield 'host{0:05d}'.format(number), details
+
+
+def _write_reports(path, entries):
+    with open(path, 'w') as file_object:
+        for reports in entries:
+            file_object.write(json.dumps(reports) + '\n')
+
+
+def test_round_trip_and_version_ranges(tmp_path):
+    store = SoftwareStore(str(tmp_path / 'store'))
+    details = {'a': _product('Agent', '2.10.0'), 'b': _product('Agent', '2.9.1'),
+               'c': _product('Viewer', '1.0')}
+    store.ingest([('server01', details), ('server02', {'a': _product('Agent', '2.2')})])
+
+    assert store.host_software('server01') == details
+    assert store.hosts_with('agent') == {'server01', 'server02'}
+    assert store.hosts_with('Agent', min_version='2.9') == {'server01'}
+    assert store.hosts_with('Agent', below_version='2.9.1') == {'server02'}
+    assert store.hosts_with('Agent', '2.3', '2.10') == {'server01'}
+
+    store.ingest([('server02', {'a': _product('Agent', '3.0')})])
+    assert store.hosts_with('Agent', min_version='3') == {'server02'}
+    assert SoftwareStore(str(tmp_path / 'store')).hosts_with('Agent', below_version='2.9.1') \
+        == set()
+
+
+def test_reports_without_a_target_are_skipped(tmp_path):
+    log_file = str(tmp_path / 'win_application_statistics_report')
+    details = {'a': _product('Agent', '1.0')}
+    _write_reports(log_file, [
+        {'host': 'collector', 'target': 'server01', 'outcome': 'Successful',
+         'content': {'software_details': details}},
+        {'host': 'collector', 'outcome': 'Successful', 'content': {'software_details': details}}])
+    store = SoftwareStore(str(tmp_path / 'store'))
+
+    assert store.ingest_report_log(log_file) == {'hosts': 1, 'new_records': 1, 'untargeted': 1}
+    assert sorted(store.manifests) == ['server01']
+
+
+@pytest.mark.benchmark
+def test_benchmark_synthetic_fleet(tmp_path):
+    log_file = str(tmp_path / 'win_application_statistics_report')
+    _write_reports(log_file, ({'host': 'collector', 'target': host, 'outcome': 'Successful',
+                               'content': {'software_details': details}}
+                              for host, details in _fleet(BENCH_HOSTS)))
+    store = SoftwareStore(str(tmp_path / 'store'))
+    started = time.perf_counter()
+    store.ingest_report_log(log_file)
+    ingest_seconds = time.perf_counter() - started
+    stats = store.stats()
+
+    inventories = {host: details for host, details in _fleet(BENCH_HOSTS)}
+    low, high = utility.parse_version('1.1'), utility.parse_version('1.2')
+    started = time.perf_counter()
+    for number in range(20):
+        name = 'Product {0}'.format(number * 5 + 1)
+        scanned = {host for host, details in inventories.items() for record in details.values()
+                   if record['DisplayName'] == name and
+                   low <= utility.parse_version(record['DisplayVersion']) < high}
+    scan_seconds = (time.perf_counter() - started) / 20
+    started = time.perf_counter()
+    for number in range(20):
+        indexed = store.hosts_with('Product {0}'.format(number * 5 + 1), '1.1', '1.2')
+    index_seconds = (time.perf_counter() - started) / 20
+
+    bench.report('software store', '{0} hosts: {1} records for {2} references, {3:.1f} MB '
+                 'stored against {4:.1f} MB of reports, ingest {5:.2f}s, query {6:.3f}ms '
+                 'indexed against {7:.1f}ms scanning'.format(
+                     stats['hosts'], stats['records'], stats['references'],
+                     stats['bytes_on_disk'] / 1e6, os.path.getsize(log_file) / 1e6,
+                     ingest_seconds, index_seconds * 1e3, scan_seconds * 1e3))
+    assert indexed == scanned
+    assert stats['records'] == 1200
+    assert stats['bytes_on_disk'] < os.path.getsize(log_file) / 2
+    if bench.FULL:
+        assert index_seconds < scan_seconds
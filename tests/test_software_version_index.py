@@ -0,0 +1,90 @@
+"""The software version index, with a 10k host build and query benchmark."""
+import json
+import random
+import time
+
+import pytest
+
+from sample.software_version_index import SoftwareVersionIndex
+from tests import bench
+
+BENCH_HOSTS = bench.size('VERSION_BENCH_HOSTS', 10000, 500)
+
+
+def _record(name, version, publisher='Contoso'):
+    return {'DisplayName': name, 'DisplayVersion': version, 'Publisher': publisher}
+
+
+def test_readding_a_host_replaces_its_installs():
+    index = SoftwareVersionIndex()
+    index.add('server01', {'a': _record('Agent', '2.9'), 'b': _record('Viewer', '1.0')})
+    index.add('server02', {'a': _record('Agent', '2.10')})
+    assert index.hosts_between('Agent', '2.0', '3.0') == [('server01', '2.9'),
+                                                           ('server02', '2.10')]
+
+    index.add('server01', {'a': _record('Agent', '3.1')})
+    assert index.hosts_between('Agent', '2.0', '3.0') == [('server02', '2.10')]
+    assert index.hosts_between('Agent', min_version='3.0') == [('server01', '3.1')]
+    assert index.search_prefix('v') == []
+
+    index.remove('server02')
+    assert index.search_prefix('agent') == [('Agent', 'Contoso', 1)]
+
+
+def test_ranges_and_publishers():
+    index = SoftwareVersionIndex()
+    index.add('server01', {'a': _record('Agent', '16.0.4266.1001')})
+    index.add('server02', {'a': _record('Agent', '16.0.10827.20118', 'Other')})
+    index.add('server03', {'a': _record('Agent', '16.0.10827.20118')})
+
+    assert index.hosts_between('agent', max_version='16.0.10827.20118') == [
+        ('server01', '16.0.4266.1001')]
+    assert [host for host, _ in index.hosts_between(
+        'Agent', max_version='16.0.10827.20118', include_max=True)] == [
+            'server01', 'server03', 'server02']
+    assert index.hosts_between('Agent', publisher='other') == [('server02', '16.0.10827.20118')]
+
+
+def test_untargeted_reports_are_skipped(tmp_path):
+    log_file = tmp_path / 'win_application_statistics_report'
+    log_file.write_text(json.dumps({'host': 'collector', 'outcome': 'Successful',
+                                    'content': {'software_details': {'a': _record('A', '1')}}})
+                        + '\n')
+    index = SoftwareVersionIndex()
+    index.add_report_log(str(log_file))
+    assert index.search_prefix('') == []
+
+
+@pytest.mark.benchmark
+def test_benchmark_10k_hosts():
+    rand = random.Random(3)
+    catalog = [_record('Product {0:03d}'.format(number), '{0}.{1}.{2}'.format(
+        number % 7, minor, rand.randint(0, 9999))) for number in range(400) for minor in range(5)]
+    fleet = [('host{0:05d}'.format(number), {str(key): record for key, record in
+                                             enumerate(rand.sample(catalog, 60))})
+             for number in range(BENCH_HOSTS)]
+
+    index = SoftwareVersionIndex()
+    started = time.perf_counter()
+    for host, details in fleet:
+        index.add(host, details)
+    index.build()
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for number in range(100):
+        installs = index.hosts_between('Product {0:03d}'.format(number), '1.2', '1.4')
+    query_seconds = (time.perf_counter() - started) / 100
+    started = time.perf_counter()
+    for number in range(100):
+        products = index.search_prefix('Product {0:02d}'.format(number % 40))
+    prefix_seconds = (time.perf_counter() - started) / 100
+
+    bench.report('software version index', '{0} hosts, {1} installs: build {2:.2f}s, range '
+                 'query {3:.3f}ms, prefix search {4:.3f}ms'.format(
+                     BENCH_HOSTS, BENCH_HOSTS * 60, build_seconds, query_seconds * 1e3,
+                     prefix_seconds * 1e3))
+    assert all('1.2' <= version < '1.4' for _, version in installs)
+    assert len(products) == 10
+    if bench.FULL:
+        assert query_seconds < 0.01
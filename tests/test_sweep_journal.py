@@ -0,0 +1,63 @@
+"""The sweep journal: torn lines from a crash and the result locations it records."""
+import gzip
+import json
+
+import sample.fleet_sweep as fleet_sweep
+import sample.sweep_journal as sweep_journal
+
+
+def _collect(host, filters=None, collectors=None):  # pylint: disable=W0613
+    return {'host': {'name': host}}, {}
+
+
+def _lines(path):
+    with open(path) as file_object:
+        return [json.loads(line) for line in file_object]
+
+
+def test_a_torn_line_is_cut_before_appending(tmp_path):
+    path = str(tmp_path / 'sweep.journal')
+    journal = sweep_journal.SweepJournal(path)
+    journal.record('host01', None, {})
+    journal.record('host02', None, {'collect_win_disk_stats': 'Timed out'})
+    journal.close()
+    with open(path, 'a') as file_object:
+        # A crash in the middle of a line.
+        file_object.write('{"host": "host03", "ran": nu')
+
+    journal = sweep_journal.SweepJournal(path)
+    journal.record('host03', None, {})
+    journal.record('host02', ['collect_win_disk_stats'], {})
+    journal.close()
+
+    assert [entry['host'] for entry in _lines(path)] == ['host01', 'host02', 'host03', 'host02']
+    assert sweep_journal.remaining(['host01', 'host02', 'host03', 'host04'],
+                                   sweep_journal.load(path)) == [('host04', None)]
+
+
+def test_a_journal_without_any_whole_line_starts_over(tmp_path):
+    path = str(tmp_path / 'sweep.journal')
+    with open(path, 'w') as file_object:
+        file_object.write('{"host": "ho')
+    journal = sweep_journal.SweepJournal(path)
+    journal.record('host01', None, {})
+    journal.close()
+
+    assert [entry['host'] for entry in _lines(path)] == ['host01']
+
+
+def test_the_journal_points_at_each_result(backend, tmp_path):  # pylint: disable=W0613
+    hosts = ['host{0:02d}'.format(number) for number in range(6)]
+    journal_path = str(tmp_path / 'sweep.journal')
+    fleet_sweep.sweep(hosts, workers=1, collect=_collect, journal_path=journal_path)
+
+    entries = _lines(journal_path)
+    assert sorted(entry['host'] for entry in entries) == hosts
+    for entry in entries:
+        location = entry['location']
+        with open(location['segment'], 'rb') as file_object:
+            file_object.seek(location['offset'])
+            block = gzip.decompress(file_object.read(location['length'])).splitlines()
+        record = json.loads(block[location['record']])
+        assert record['target'] == entry['host']
+        assert record['content'] == {'host': {'name': entry['host']}}
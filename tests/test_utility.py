@@ -0,0 +1,67 @@
+"""Semisynchronous queries: the flags they are started with and what they keep alive.
+
+And report logs turned off across the collector threads.
+"""
+import os
+import threading
+import tracemalloc
+
+import sample.utility as utility
+from sample.win_network_statistics import collect_win_network_stats
+from tests.fake_hosts import server_classes
+
+ROWS = 5000
+
+
+def _processes(where):  # pylint: disable=W0613
+    return ({'ProcessId': number, 'Caption': 'process{0}.exe'.format(number),
+             'CommandLine': 'C:\\Program Files\\process{0}.exe --service'.format(number)}
+            for number in range(ROWS))
+
+
+def test_queries_are_semisynchronous_and_read_in_batches(backend):
+    host = backend.add('server01', classes=server_classes())
+    collect_win_network_stats('server01')
+
+    assert len(host.queries) == 2
+    assert host.flags == [utility.WBEM_FLAG_RETURN_IMMEDIATELY |
+                          utility.WBEM_FLAG_FORWARD_ONLY] * 2
+    assert host.batch_sizes and set(host.batch_sizes) == {utility.DEFAULT_BATCH_SIZE}
+
+
+def test_instances_are_released_while_iterating(backend):
+    host = backend.add('server01', classes={'Win32_Process': _processes})
+    wmi_obj = utility.connect('server01')
+    alive = 0
+    for row in utility.iter_query(wmi_obj, 'SELECT * FROM Win32_Process', batch_size=50):
+        alive = max(alive, len(host.instances))
+    assert row['ProcessId'] == ROWS - 1
+    assert host.batch_sizes[:-1] == [50] * (ROWS // 50)
+    # One batch of COM objects at a time, not the whole result set.
+    assert alive <= 50
+
+    tracemalloc.start()
+    try:
+        for row in utility.iter_query(wmi_obj, 'SELECT * FROM Win32_Process'):
+            pass
+        streamed = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        rows = list(utility.iter_query(wmi_obj, 'SELECT * FROM Win32_Process'))
+        materialized = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert len(rows) == ROWS
+    assert streamed * 10 < materialized
+
+
+def test_report_logs_off_holds_in_every_thread(backend):
+    backend.add('server01', classes=server_classes())
+    with utility.report_logs_off():
+        thread = threading.Thread(target=collect_win_network_stats, args=('server01',))
+        thread.start()
+        thread.join()
+        assert collect_win_network_stats('server01')['content']
+    assert not os.path.exists('logs')
+
+    collect_win_network_stats('server01')
+    assert os.listdir('logs')
@@ -0,0 +1,81 @@
+"""Recording a collection against the fake backend and replaying it in a fresh process."""
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+import sample.service_index as service_index
+from sample import wmi_cassette
+from sample.service_index import ServiceIndex
+from sample.win_application_statistics import REG_PATHS
+from tests.fake_hosts import server_classes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The stand-in modules must be installed before the collectors are
+# imported, which this test process has already done against fake_wmi.
+REPLAY = '''
+import json, sys
+from sample import wmi_cassette
+result, player = wmi_cassette.replay(sys.argv[1], speed=0, planned=sys.argv[2] == 'planned')
+json.dump({'result': result, 'calls': player.calls}, sys.stdout)
+'''
+
+
+def _registry():
+    return {REG_PATHS[0]: {'values': {}},
+            REG_PATHS[0] + r'\Agent': {'values': {'DisplayName': 'Agent', 'DisplayVersion': '2.1',
+                                                  'Publisher': 'Contoso'}}}
+
+
+def _untimed(messages):
+    return [re.sub(r' in [0-9.]+s$', '', message) for message in messages]
+
+
+def _replay(path, mode):
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.run([sys.executable, '-c', REPLAY, path, mode], env=environment,
+                            stdout=subprocess.PIPE, check=True, timeout=120).stdout
+    # The collectors print their start and end times before the result.
+    return json.loads(output[output.index(b'{"result"'):])
+
+
+@pytest.mark.parametrize('mode', ['threaded', 'planned'])
+def test_replay_gives_the_recorded_content(backend, monkeypatch, tmp_path, mode):
+    backend.add('server01', classes=server_classes(services=30), registry=_registry())
+    index = ServiceIndex()
+    monkeypatch.setattr(service_index, '_INDEX', index)
+    path = str(tmp_path / 'server01.cassette.gz')
+
+    recorded = wmi_cassette.record(path, 'server01', planned=mode == 'planned')
+    replayed = _replay(path, mode)
+
+    assert recorded['outcome'] == 'Successful'
+    assert recorded['content']['services']
+    assert replayed['result']['outcome'] == recorded['outcome']
+    assert replayed['result']['content'] == json.loads(json.dumps(recorded['content']))
+    assert _untimed(replayed['result']['messages']) == _untimed(recorded['messages'])
+    responses = sum(len(calls) for calls in wmi_cassette.Cassette.load(path).calls.values())
+    assert replayed['calls'] == responses
+    # Neither side logged a report or fed the metric store and service index.
+    assert os.listdir(str(tmp_path)) == ['server01.cassette.gz']
+    assert not index.records
+
+
+def test_a_call_missing_from_the_cassette_fails_its_collector(backend, tmp_path):
+    backend.add('server01', classes=server_classes(services=5))
+    path = str(tmp_path / 'server01.cassette.gz')
+    wmi_cassette.record(path, 'server01')
+    cassette = wmi_cassette.Cassette.load(path)
+    for key in [key for key in cassette.calls if 'Win32_Service' in key]:
+        del cassette.calls[key]
+    cassette.save(path)
+
+    replayed = _replay(path, 'threaded')['result']
+    assert replayed['outcome'] == 'Successful'
+    assert 'services' not in replayed['content']
+    assert any(message.startswith('collect_win_services_stats failed: CassetteMiss')
+               for message in replayed['messages'])
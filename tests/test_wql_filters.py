@@ -0,0 +1,59 @@
+"""Collector filters compiled into WQL and evaluated by the fake provider."""
+from tests import fake_wmi
+
+import sample.utility as utility
+from sample.win_application_statistics import collect_win_application_stats
+from sample.win_network_statistics import collect_win_network_stats
+from sample.win_services_statistics import collect_win_services_stats
+
+
+def _adapters(count, enabled):
+    adapters = [{'Index': index, 'Name': 'Adapter {0}'.format(index),
+                 'NetEnabled': True if index < enabled else None} for index in range(count)]
+    configurations = [{'Index': index, 'IPEnabled': index < enabled} for index in range(count)]
+    return {'Win32_NetworkAdapter': adapters,
+            'Win32_NetworkAdapterConfiguration': configurations}
+
+
+def test_quoted_values_round_trip():
+    values = ["Bob's agent", 'say "hi"', 'both \' and "', 'C:\\Program Files\\x.exe', '\\\'']
+    for value in values:
+        wql = utility.build_wql('Win32_Service', {'PathName': value})
+        _, class_name, where = fake_wmi.parse_query(wql)
+        assert class_name == 'Win32_Service'
+        assert fake_wmi.evaluate(where, {'PathName': value})
+        assert not fake_wmi.evaluate(where, {'PathName': value + 'x'})
+
+
+def test_network_filters_run_on_the_provider(backend):
+    host = backend.add('server01', classes=_adapters(40, 4))
+    content = collect_win_network_stats('server01')['content']
+
+    assert host.queries == [
+        'SELECT * FROM Win32_NetworkAdapter WHERE NetEnabled IS NOT NULL',
+        'SELECT * FROM Win32_NetworkAdapterConfiguration WHERE IPEnabled = TRUE']
+    assert sorted(content['network_adapters']) == [0, 1, 2, 3]
+    assert sorted(content['network_configuration']) == [0, 1, 2, 3]
+    # 8 rows parsed instead of the 80 an unfiltered query returns.
+    assert host.rows_returned == 8
+
+
+def test_caller_filters_reach_the_query(backend):
+    path = 'C:\\Program Files\\Bob\'s "agent"\\agent.exe'
+    services = [{'Name': 'agent', 'Caption': 'Agent', 'PathName': path, 'State': 'Running'},
+                {'Name': 'other', 'Caption': 'Other', 'PathName': 'C:\\other.exe',
+                 'State': 'Running'}]
+    host = backend.add('server01', classes={'Win32_Service': services,
+                                            'Win32_DependentService': []})
+    content = collect_win_services_stats(
+        'server01', filters={'Win32_Service': {'PathName': path}})['content']
+
+    assert list(content['services']) == ['Agent']
+    assert content['services']['Agent']['PathName'] == path
+    assert host.queries[0].startswith('SELECT * FROM Win32_Service WHERE PathName = ')
+
+
+def test_collectors_without_queries_take_no_filters():
+    filters = {'Win32_Service': {'State': 'Running'}}
+    assert utility.collector_kwargs(collect_win_application_stats, filters) == {}
+    assert utility.collector_kwargs(collect_win_services_stats, filters) == {'filters': filters}